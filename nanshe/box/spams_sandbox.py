@@ -215,6 +215,359 @@ def call_multiprocessing_array_spams_trainDL(X, *args, **kwargs):
     return(result)
 
 
+#@nanshe.advanced_debugging.log_call(logger)
+def shared_memory_directory():
+    """
+        Finds a directory to place shared memory files in. This is POSIX shared memory (i.e. /dev/shm) if it is
+        available. Otherwise, the temporary directory is used. So, arrays are file-backed instead.
+
+        Returns:
+            str:                                    the directory to use.
+    """
+
+    import os
+    import tempfile
+
+    dirname = "/dev/shm"
+    if not (os.path.isdir(dirname) and os.access(dirname, os.W_OK)):
+        dirname = tempfile.gettempdir()
+
+    return(dirname)
+
+
+#@nanshe.advanced_debugging.log_call(logger)
+def empty_shared_array(shape, dtype, order = "F"):
+    """
+        Creates an array in shared memory (see shared_memory_directory). Other processes can map the same memory
+        using its filename. Fill this directly instead of an ordinary array to avoid copying X when calling
+        call_memmap_spams_trainDL.
+
+        Args:
+            shape(tuple of ints):                   shape of the array.
+            dtype(numpy.dtype):                     type of the array.
+            order(str):                             memory layout of the array ("F" as SPAMS needs Fortran order).
+
+        Returns:
+            numpy.memmap:                           an uninitialized array backed by shared memory. Should be
+                                                    removed with remove_shared_array when finished.
+    """
+
+    import os
+    import tempfile
+
+    import numpy
+
+    fd, filename = tempfile.mkstemp(prefix = "nanshe_spams_", suffix = ".dat", dir = shared_memory_directory())
+    os.close(fd)
+
+    return(numpy.memmap(filename, dtype = dtype, mode = "w+", shape = shape, order = order))
+
+
+#@nanshe.advanced_debugging.log_call(logger)
+def remove_shared_array(a):
+    """
+        Removes the file behind an array from empty_shared_array. The memory stays valid until the array is freed.
+
+        Args:
+            a(numpy.memmap):                        array to remove the file for.
+    """
+
+    import os
+
+    if os.path.exists(a.filename):
+        os.remove(a.filename)
+
+
+#@nanshe.advanced_debugging.log_call(logger)
+def find_memmap_file_offset(a):
+    """
+        Finds the file and the byte offset in it that the data of an array starts at, if the array is a view onto
+        memory mapped from a file.
+
+        Args:
+            a(numpy.ndarray):                       array to find the file for.
+
+        Returns:
+            tuple:                                  the filename and offset or None if the array is not memory
+                                                    mapped from a file.
+    """
+
+    import mmap
+
+    import numpy
+
+    a_mmap = getattr(a, "_mmap", None)
+    if (a_mmap is None) or (getattr(a, "filename", None) is None):
+        return(None)
+
+    # numpy.memmap maps from the offset requested rounded down to the allocation granularity.
+    a_mmap_offset = a.offset - (a.offset % mmap.ALLOCATIONGRANULARITY)
+    a_mmap_address = numpy.frombuffer(a_mmap, dtype = numpy.uint8).ctypes.data
+
+    return((a.filename, a_mmap_offset + (a.ctypes.data - a_mmap_address)))
+
+
+#@nanshe.advanced_debugging.log_call(logger)
+def run_spams_sandbox(connection):
+    """
+        Serves calls to spams in a long-lived sandbox process. So, spams is only imported once for all calls.
+
+        It is necessary to run SPAMS in a separate process as segmentation faults
+        have been discovered in later parts of the Python code dependent on whether
+        SPAMS has run or not. It is suspected that spams may interfere with the
+        interpreter. Thus, it should be sandboxed (run in a different Python interpreter)
+        so that it doesn't damage what happens in this one.
+
+        Each request names a spams function and gives X and the result as the filename, offset, dtype, and shape of
+        Fortran ordered arrays in shared memory. Both are mapped without copying. If the function returns a tuple
+        (e.g. spams.trainDL with return_model), the first value is the result and the rest are sent back in the
+        reply. The reply is the formatted exception (or None) and any other values returned (or None). A request of
+        None stops the sandbox.
+
+        Args:
+            connection(multiprocessing.Connection): where requests are received and replies are sent.
+    """
+
+    import traceback
+
+    import numpy
+
+    # Just to make sure this exists in the new process. Shouldn't be necessary.
+    # Also, it is not needed outside of calling this function.
+    import spams
+
+    request = connection.recv()
+    while request is not None:
+        func_name, X_info, result_info, args, kwargs = request
+
+        reply = (None, None)
+        try:
+            X_filename, X_offset, X_dtype, X_shape = X_info
+            result_filename, result_offset, result_dtype, result_shape = result_info
+
+            # Copy on write. So, X is left alone by anything spams might do to it.
+            X = numpy.memmap(X_filename, dtype = X_dtype, mode = "c", offset = X_offset, shape = X_shape, order = "F")
+            result = numpy.memmap(
+                result_filename, dtype = result_dtype, mode = "r+", offset = result_offset, shape = result_shape, order = "F"
+            )
+
+            result_values = getattr(spams, func_name)(X, *args, **kwargs)
+
+            if isinstance(result_values, tuple):
+                reply = (None, result_values[1:])
+                result_values = result_values[0]
+
+            result[:] = result_values
+            result.flush()
+
+            del X
+            del result
+        except Exception:
+            reply = (traceback.format_exc(), None)
+
+        connection.send(reply)
+
+        request = connection.recv()
+
+    connection.close()
+
+
+class SPAMSSandbox(object):
+    """
+        A long-lived process that runs spams (see run_spams_sandbox). So, spams is only imported once and arrays are
+        shared with it through memory maps instead of being copied. If the sandbox dies, it is restarted on the next
+        call.
+    """
+
+    def __init__(self):
+        import threading
+
+        self.lock = threading.Lock()
+
+        self.process = None
+        self.connection = None
+
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def start(self):
+        """
+            Starts the sandbox process, if it is not already running.
+        """
+
+        import multiprocessing
+
+        if (self.process is not None) and self.process.is_alive():
+            return
+
+        self.connection, child_connection = multiprocessing.Pipe()
+
+        self.process = multiprocessing.Process(target = run_spams_sandbox, args = (child_connection,))
+        self.process.daemon = True
+        self.process.start()
+
+        child_connection.close()
+
+    def close(self):
+        """
+            Stops the sandbox process.
+        """
+
+        with self.lock:
+            if self.process is None:
+                return
+
+            try:
+                self.connection.send(None)
+            except (IOError, OSError):
+                pass
+
+            self.process.join()
+            self.connection.close()
+
+            self.process = None
+            self.connection = None
+
+    def call(self, func_name, X, result_shape, *args, **kwargs):
+        """
+            Runs a spams function in the sandbox.
+
+            Args:
+                func_name(str):                     name of the spams function to call.
+                X(numpy.ndarray):                   first argument of the function. If this is a Fortran ordered
+                                                    array memory mapped from a file (e.g. from empty_shared_array),
+                                                    it is used without copying. Otherwise, it is copied to shared
+                                                    memory first.
+                result_shape(tuple of ints):        shape of the array returned by the function.
+                *args(list):                        a list of position arguments to pass to the function.
+                **kwargs(dict):                     a dictionary of keyword arguments to pass to the function.
+
+            Returns:
+                numpy.ndarray:                      the result (backed by shared memory). If the function returns a
+                                                    tuple, this is the first value followed by the rest.
+        """
+
+        import numpy
+
+        X_shared = None
+        X_file_offset = None
+        if X.flags.f_contiguous:
+            X_file_offset = find_memmap_file_offset(X)
+        if X_file_offset is None:
+            X_shared = empty_shared_array(X.shape, X.dtype)
+            X_shared[:] = X
+            X_shared.flush()
+            X_file_offset = (X_shared.filename, 0)
+        else:
+            X.flush()
+
+        result = empty_shared_array(result_shape, X.dtype)
+
+        try:
+            with self.lock:
+                self.start()
+
+                try:
+                    self.connection.send((
+                        func_name,
+                        X_file_offset + (X.dtype, X.shape),
+                        (result.filename, 0, result.dtype, result.shape),
+                        args,
+                        kwargs
+                    ))
+                    reply_exception, reply_values = self.connection.recv()
+                except (EOFError, IOError, OSError):
+                    self.process.join()
+                    exitcode = self.process.exitcode
+
+                    self.connection.close()
+                    self.process = None
+                    self.connection = None
+
+                    raise SPAMSException("SPAMS has terminated with exitcode \"" + repr(exitcode) + "\".")
+
+            if reply_exception is not None:
+                raise SPAMSException("SPAMS has raised an exception.\n" + reply_exception)
+        finally:
+            if X_shared is not None:
+                remove_shared_array(X_shared)
+            remove_shared_array(result)
+
+        # The memory is freed once the result is no longer used.
+        result = result.view(numpy.ndarray)
+
+        if reply_values is not None:
+            result = (result,) + reply_values
+
+        return(result)
+
+
+# The sandbox belonging to this process (with the process ID it belongs to).
+spams_sandbox = (None, None)
+
+
+#@nanshe.advanced_debugging.log_call(logger)
+def get_spams_sandbox():
+    """
+        Gets the SPAMSSandbox for this process. It is created on the first call and reused after. Forked processes
+        get their own.
+
+        Returns:
+            SPAMSSandbox:                           the sandbox for this process.
+    """
+
+    import atexit
+    import os
+
+    global spams_sandbox
+
+    sandbox_pid, sandbox = spams_sandbox
+    if sandbox_pid != os.getpid():
+        sandbox = SPAMSSandbox()
+        atexit.register(sandbox.close)
+
+        spams_sandbox = (os.getpid(), sandbox)
+
+    return(sandbox)
+
+
+#@nanshe.advanced_debugging.log_call(logger)
+def call_memmap_spams_trainDL(X, *args, **kwargs):
+    """
+        Designed to start spams.trainDL in a separate process and handle the result in an unnoticeably different way.
+
+        It is necessary to run SPAMS in a separate process as segmentation faults
+        have been discovered in later parts of the Python code dependent on whether
+        SPAMS has run or not. It is suspected that spams may interfere with the
+        interpreter. Thus, it should be sandboxed (run in a different Python interpreter)
+        so that it doesn't damage what happens in this one.
+
+        This particular version reuses a long-lived sandbox (see get_spams_sandbox). So, spams is only imported once
+        per process. Also, X and the resulting dictionary are shared through memory maps.
+
+
+        Args:
+            X(numpy.matrix):                        a Fortran order NumPy Matrix with the same name as used by spams.trainDL (so if someone tries to use it as a keyword argument...).
+                                                    If it was made with empty_shared_array (or is otherwise memory mapped from a file), it is not copied.
+            *args(list):                            a list of position arguments to pass to spams.trainDL.
+            **kwargs(dict):                         a dictionary of keyword arguments to pass to spams.trainDL.
+
+        Returns:
+            result(numpy.ndarray): the dictionary found (and the model if return_model is set)
+
+        Note:
+            This avoids the copy of X and the import of spams that call_multiprocessing_array_spams_trainDL makes on
+            every call.
+    """
+
+    result = get_spams_sandbox().call("trainDL", X, (X.shape[0], kwargs["K"]), *args, **kwargs)
+
+    return(result)
+
+
 #@nanshe.advanced_debugging.log_call(logger)
 def call_spams_trainDL(*args, **kwargs):
     """
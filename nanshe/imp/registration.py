@@ -2,6 +2,7 @@ __author__ = "John Kirkham <kirkhamj@janelia.hhmi.org>"
 __date__ = "$Jan 28, 2015 11:25:47 EST$"
 
 
+import hashlib
 import itertools
 import os
 import tempfile
@@ -13,11 +14,15 @@ import numpy
 
 try:
     import pyfftw.interfaces.numpy_fft as fft
+    import pyfftw.interfaces.cache
+
+    # Keep FFTW plans around as the same shapes are transformed repeatedly.
+    pyfftw.interfaces.cache.enable()
 except Exception as e:
     warnings.warn(str(e) + ". Falling back to NumPy FFTPACK.", ImportWarning)
     import numpy.fft as fft
 
-from nanshe.util import iters, xnumpy
+from nanshe.util import iters, xmultiprocessing, xnumpy
 from nanshe.io import hdf5
 
 # Need in order to have logging information no matter what.
@@ -30,7 +35,9 @@ logger = prof.logging.getLogger(__name__)
 
 
 @prof.log_call(logger)
-def register_mean_offsets(frames2reg, max_iters=-1, block_frame_length=-1, include_shift=False, to_truncate=False):
+def register_mean_offsets(frames2reg, max_iters=-1, block_frame_length=-1, include_shift=False, to_truncate=False,
+                          num_threads=1, upsample_factor=1, keep_fft=True, out=None, out_name="reg_frames",
+                          window_length=-1):
     """
         This algorithm registers the given image stack against its mean projection. This is done by computing
         translations needed to put each frame in alignment. Then the translation is performed and new translations are
@@ -38,6 +45,24 @@ def register_mean_offsets(frames2reg, max_iters=-1, block_frame_length=-1, inclu
 
         The code for translations can be found in find_mean_offsets.
 
+        As frames are real, only half of their spectra are computed and stored (as done by rfftn). Blocks of frames
+        may be spread across threads.
+
+        If window_length is given, frames are split into windows of that many frames. Each window is registered
+        against its own mean projection. So, slow drift over long recordings does not blur the template and windows
+        can be registered in parallel. Each window's converged template is then registered against the previous
+        window's (already aligned) template to bring all windows in line.
+
+        When frames2reg is an HDF5 dataset (or is blocked), spectra are kept in a temporary HDF5 file. If keep_fft is
+        False, they are not kept at all. Instead, each block's spectra are recomputed as the frames are streamed. Only
+        the shifts and the template are kept between passes. Registered frames are written directly into out (if
+        given) or a results file.
+
+        If upsample_factor is more than 1, translations are found to within 1/upsample_factor of a pixel (see
+        find_offsets). Frames are then translated by multiplying their spectra with phase ramps. As the result is
+        interpolated, registered frames will be floating point. Any pixel that is partially rolled is masked (or
+        truncated).
+
         Notes:
             Adapted from code provided by Wenzhi Sun with speed improvements provided by Uri Dubin.
 
@@ -50,9 +75,21 @@ def register_mean_offsets(frames2reg, max_iters=-1, block_frame_length=-1, inclu
                                                  By default all. (Default -1)
             include_shift(bool):                 Whether to return the shifts used, as well. (Default False)
             to_truncate(bool):                   Whether to truncate the frames to remove all masked portions. (Default False)
+            num_threads(int):                    Number of threads to spread blocks of frames across. (Default 1)
+            upsample_factor(int):                Translations are found to within 1/upsample_factor of a pixel.
+                                                 By default, only integer translations are used. (Default 1)
+            keep_fft(bool):                      Whether to keep the spectra of the frames or recompute them on each
+                                                 pass. (Default True)
+            out(h5py.Group):                     Where to write the registered frames. (Default None)
+            out_name(str):                       Name of the registered frames in out. (Default "reg_frames")
+            window_length(int):                  Number of frames registered against each template.
+                                                 By default all. (Default -1)
 
         Returns:
             (numpy.ndarray):                     an array containing the translations to apply to each frame.
+                                                 If out is given, the registered frames in out are returned. If not,
+                                                 but frames2reg is an HDF5 dataset (or is blocked), the filename of
+                                                 the results is returned instead.
 
         Examples:
             >>> a = numpy.zeros((5, 3, 4)); a[:,0] = 1; a[2,0] = 0; a[2,2] = 1; a
@@ -123,133 +160,162 @@ def register_mean_offsets(frames2reg, max_iters=-1, block_frame_length=-1, inclu
                    [1, 0],
                    [0, 0],
                    [0, 0]]))
+
+            >>> y, x = numpy.indices((12, 12))
+            >>> b = numpy.array(4 * [numpy.exp(-((y - 6.0) ** 2 + (x - 6.0) ** 2) / 4.0)] + [
+            ...     numpy.exp(-((y - 5.5) ** 2 + (x - 6.25) ** 2) / 4.0)
+            ... ])
+            >>> b_reg, b_shift = register_mean_offsets(b, include_shift=True, upsample_factor=4)
+            >>> b_shift
+            array([[ 0.  ,  0.  ],
+                   [ 0.  ,  0.  ],
+                   [ 0.  ,  0.  ],
+                   [ 0.  ,  0.  ],
+                   [ 0.5 , -0.25]])
+            >>> numpy.abs(b_reg - b[0]).max() < 1e-3
+            True
+            >>> b_reg.mask[4].sum(axis=1)
+            array([12,  1,  1,  1,  1,  1,  1,  1,  1,  1,  1,  1])
     """
 
     if block_frame_length == -1:
         block_frame_length = len(frames2reg)
 
-    tempdir_name = ""
-    if isinstance(frames2reg, h5py.Dataset) or \
-            (block_frame_length != len(frames2reg)):
-        tempdir_name = tempfile.mkdtemp()
+    frame_blocks = list(iters.lagged_generators_zipped(
+        itertools.chain(xrange(0, len(frames2reg), block_frame_length), [len(frames2reg)])
+    ))
 
-    temporaries_filename = ""
-    frames2reg_fft = None
-    space_shift = None
-    this_space_shift = None
-    if tempdir_name:
-        temporaries_filename = os.path.join(tempdir_name, "temporaries.h5")
-        temporaries_file = h5py.File(temporaries_filename, "w")
-
-        frames2reg_fft = temporaries_file.create_dataset(
-            "frames2reg_fft", shape=frames2reg.shape, dtype=complex
-        )
-        space_shift = temporaries_file.create_dataset(
-            "space_shift",
-            shape=(len(frames2reg), len(frames2reg.shape)-1),
-            dtype=int
-        )
-        this_space_shift = temporaries_file.create_dataset(
-            "this_space_shift",
-            shape=space_shift.shape,
-            dtype=space_shift.dtype
-        )
-    else:
-        frames2reg_fft = numpy.empty(frames2reg.shape, dtype=complex)
-        space_shift = numpy.zeros(
-            (len(frames2reg), len(frames2reg.shape)-1), dtype=int
-        )
-        this_space_shift = numpy.empty_like(space_shift)
+    spatial_shape = tuple(frames2reg.shape[1:])
+    spatial_axes = range(1, len(frames2reg.shape))
 
-    for i, j in iters.lagged_generators_zipped(itertools.chain(xrange(0, len(frames2reg), block_frame_length), [len(frames2reg)])):
-        frames2reg_fft[i:j] = fft.fftn(frames2reg[i:j], axes=range(1, len(frames2reg.shape)))
-    template_fft = numpy.empty(frames2reg.shape[1:], dtype=complex)
+    # Frames are real. So, only half of the spectrum needs to be kept (as rfftn does). Also, single precision data
+    # only needs a single precision spectrum.
+    frames2reg_fft_shape = (len(frames2reg),) + spatial_shape[:-1] + (spatial_shape[-1] // 2 + 1,)
+    frames2reg_fft_dtype = numpy.result_type(numpy.complex64, frames2reg.dtype)
 
-    negative_wave_vector = numpy.asarray(template_fft.shape, dtype=float)
-    numpy.reciprocal(negative_wave_vector, out=negative_wave_vector)
-    negative_wave_vector *= 2*numpy.pi
-    numpy.negative(negative_wave_vector, out=negative_wave_vector)
+    # Subpixel translations need fractional shifts and interpolate the registered frames.
+    space_shift_dtype = int
+    reg_frames_dtype = frames2reg.dtype
+    if upsample_factor > 1:
+        space_shift_dtype = float
+        reg_frames_dtype = numpy.result_type(numpy.float32, frames2reg.dtype)
 
-    template_fft_indices = xnumpy.cartesian_product([numpy.arange(_) for _ in template_fft.shape])
+    out_of_core = isinstance(frames2reg, h5py.Dataset) or \
+        (block_frame_length != len(frames2reg))
 
-    unit_space_shift_fft = template_fft_indices * negative_wave_vector
-    unit_space_shift_fft = unit_space_shift_fft.T.copy()
-    unit_space_shift_fft = unit_space_shift_fft.reshape((template_fft.ndim,) + template_fft.shape)
+    # Scratch space is only needed to keep spectra that won't fit in memory or results when there is nowhere to put
+    # them.
+    tempdir_name = ""
+    if out_of_core and (keep_fft or (out is None)):
+        tempdir_name = tempfile.mkdtemp()
 
-    negative_wave_vector = None
-    template_fft_indices = None
+    temporaries_filename = ""
+    temporaries_file = None
+    frames2reg_fft = None
+    if keep_fft:
+        if out_of_core:
+            temporaries_filename = os.path.join(tempdir_name, "temporaries.h5")
+            temporaries_file = h5py.File(temporaries_filename, "w")
 
-    # Repeat shift calculation until there is no further adjustment.
-    num_iters = 0
-    squared_magnitude_delta_space_shift = 1.0
-    while (squared_magnitude_delta_space_shift != 0.0):
-        squared_magnitude_delta_space_shift = 0.0
+            frames2reg_fft = temporaries_file.create_dataset(
+                "frames2reg_fft", shape=frames2reg_fft_shape, dtype=frames2reg_fft_dtype
+            )
+        else:
+            frames2reg_fft = numpy.empty(frames2reg_fft_shape, dtype=frames2reg_fft_dtype)
 
-        template_fft[:] = 0
-        for i, j in iters.lagged_generators_zipped(itertools.chain(xrange(0, len(frames2reg), block_frame_length), [len(frames2reg)])):
-            frames2reg_shifted_fft_ij = numpy.exp(1j * numpy.tensordot(space_shift[i:j], unit_space_shift_fft, axes=[-1, 0]))
-            frames2reg_shifted_fft_ij *= frames2reg_fft[i:j]
-            template_fft += numpy.sum(frames2reg_shifted_fft_ij, axis=0)
-        template_fft /= len(frames2reg)
+        def compute_frames2reg_fft(frame_block):
+            i, j = frame_block
+            frames2reg_fft[i:j] = fft.rfftn(frames2reg[i:j], axes=spatial_axes)
 
-        for i, j in iters.lagged_generators_zipped(itertools.chain(xrange(0, len(frames2reg), block_frame_length), [len(frames2reg)])):
-            this_space_shift[i:j] = find_offsets(frames2reg_fft[i:j], template_fft)
+        xmultiprocessing.thread_map(compute_frames2reg_fft, frame_blocks, num_threads)
 
-        # Remove global shifts.
-        this_space_shift_mean = numpy.zeros(this_space_shift.shape[1:], dtype=this_space_shift.dtype)
-        for i, j in iters.lagged_generators_zipped(itertools.chain(xrange(0, len(frames2reg), block_frame_length), [len(frames2reg)])):
-            this_space_shift_mean = this_space_shift[i:j].sum(axis=0)
-        this_space_shift_mean = numpy.round(
-            this_space_shift_mean.astype(float) / len(this_space_shift)
-        ).astype(int)
-        for i, j in iters.lagged_generators_zipped(itertools.chain(xrange(0, len(frames2reg), block_frame_length), [len(frames2reg)])):
-            this_space_shift[i:j] = xnumpy.find_relative_offsets(
-                this_space_shift[i:j],
-                this_space_shift_mean
+    def get_frames2reg_fft(i, j, selection=None):
+        # Spectra are either read back or recomputed from the frames as they are streamed.
+        if keep_fft:
+            frames2reg_fft_ij = frames2reg_fft[i:j]
+            if selection is not None:
+                frames2reg_fft_ij = frames2reg_fft_ij[selection]
+        else:
+            frames2reg_ij = frames2reg[i:j]
+            if selection is not None:
+                frames2reg_ij = frames2reg_ij[selection]
+            frames2reg_fft_ij = fft.rfftn(frames2reg_ij, axes=spatial_axes).astype(frames2reg_fft_dtype)
+
+        return(frames2reg_fft_ij)
+
+    if window_length == -1:
+        window_length = len(frames2reg)
+
+    windows = list(iters.lagged_generators_zipped(
+        itertools.chain(xrange(0, len(frames2reg), window_length), [len(frames2reg)])
+    ))
+
+    # Spread windows across threads if there are several. Otherwise, spread blocks within the window.
+    num_window_threads = num_threads
+    num_block_threads = 1
+    if len(windows) == 1:
+        num_window_threads = 1
+        num_block_threads = num_threads
+
+    def find_window_offsets(window):
+        return(find_mean_offsets(
+            frames2reg,
+            max_iters=max_iters,
+            block_frame_length=block_frame_length,
+            num_threads=num_block_threads,
+            upsample_factor=upsample_factor,
+            frames2reg_fft=frames2reg_fft,
+            frames_range=window,
+            include_template=True
+        ))
+
+    windows_offsets = xmultiprocessing.thread_map(find_window_offsets, windows, num_window_threads)
+
+    # Bring each window in line with the one before it by registering its converged template against the previous
+    # (already aligned) template. This only needs the templates. So, it is cheap to do in order.
+    space_shift = numpy.empty(
+        (len(frames2reg), len(frames2reg.shape)-1), dtype=space_shift_dtype
+    )
+    template_fft = None
+    for (start, stop), (each_space_shift, each_template_fft) in itertools.izip(windows, windows_offsets):
+        if template_fft is not None:
+            each_template_shift = find_offsets(
+                each_template_fft[None], template_fft, shape=spatial_shape, upsample_factor=upsample_factor
             )
+            xnumpy.find_shortest_wraparound(each_template_shift, spatial_shape, out=each_template_shift)
 
-        # Find the shortest roll possible (i.e. if it is going over halfway switch direction so it will go less than half).
-        # Note all indices by definition were positive semi-definite and upper bounded by the shape. This change will make
-        # them bound by the half shape, but with either sign.
-        for i, j in iters.lagged_generators_zipped(itertools.chain(xrange(0, len(frames2reg), block_frame_length), [len(frames2reg)])):
-            this_space_shift[i:j] = xnumpy.find_shortest_wraparound(
-                this_space_shift[i:j],
-                frames2reg_fft.shape[1:]
-            )
+            each_space_shift += each_template_shift
+            each_template_fft = each_template_fft * find_phase_ramps(each_template_shift, spatial_shape)[0]
 
-        for i, j in iters.lagged_generators_zipped(itertools.chain(xrange(0, len(frames2reg), block_frame_length), [len(frames2reg)])):
-            delta_space_shift_ij = this_space_shift[i:j] - space_shift[i:j]
-            squared_magnitude_delta_space_shift += numpy.dot(
-                delta_space_shift_ij, delta_space_shift_ij.T
-            ).sum()
+        space_shift[start:stop] = each_space_shift
+        template_fft = each_template_fft
 
-        for i, j in iters.lagged_generators_zipped(itertools.chain(xrange(0, len(frames2reg), block_frame_length), [len(frames2reg)])):
-            space_shift[i:j] = this_space_shift[i:j]
+    windows_offsets = None
+    template_fft = None
 
-        if max_iters != -1:
-            num_iters += 1
-            if num_iters >= max_iters:
-                break
+    if len(windows) > 1:
+        # Remove global shifts.
+        space_shift_mean = space_shift.sum(axis=0)
+        if upsample_factor > 1:
+            space_shift_mean = numpy.round(
+                space_shift_mean * (float(upsample_factor) / len(space_shift))
+            ) / upsample_factor
+        else:
+            space_shift_mean = numpy.round(
+                space_shift_mean.astype(float) / len(space_shift)
+            ).astype(int)
+        xnumpy.find_relative_offsets(space_shift, space_shift_mean, out=space_shift)
+        xnumpy.find_shortest_wraparound(space_shift, spatial_shape, out=space_shift)
 
     reg_frames_shape = frames2reg.shape
     if to_truncate:
-        space_shift_max = numpy.zeros(
-            space_shift.shape[1:], dtype=space_shift.dtype
-        )
-        space_shift_min = numpy.zeros(
-            space_shift.shape[1:], dtype=space_shift.dtype
-        )
-        for i, j in iters.lagged_generators_zipped(itertools.chain(xrange(0, len(frames2reg), block_frame_length), [len(frames2reg)])):
-            numpy.maximum(
-                space_shift_max,
-                space_shift[i:j].max(axis=0),
-                out=space_shift_max
-            )
-            numpy.minimum(
-                space_shift_min,
-                space_shift[i:j].min(axis=0),
-                out=space_shift_min
-            )
+        space_shift_max = numpy.maximum(space_shift.max(axis=0), 0)
+        space_shift_min = numpy.minimum(space_shift.min(axis=0), 0)
+
+        # Partially rolled pixels are removed too.
+        space_shift_max = numpy.ceil(space_shift_max).astype(int)
+        space_shift_min = numpy.floor(space_shift_min).astype(int)
+
         reg_frames_shape = numpy.asarray(reg_frames_shape)
         reg_frames_shape[1:] -= space_shift_max
         reg_frames_shape[1:] += space_shift_min
@@ -261,71 +327,295 @@ def register_mean_offsets(frames2reg, max_iters=-1, block_frame_length=-1, inclu
         space_shift_min = tuple(space_shift_min)
         reg_frames_slice = tuple(slice(_1, _2) for _1, _2 in itertools.izip(space_shift_max, space_shift_min))
 
+    # Registered frames go directly where they are wanted. Otherwise, they are written to a results file when too
+    # large for memory.
+    results_filename = ""
+    results_file = None
+    reg_frames_group = None
+    if out is not None:
+        reg_frames_group = out
+    elif out_of_core:
+        results_filename = os.path.join(tempdir_name, "results.h5")
+        results_file = h5py.File(results_filename, "w")
+
+        reg_frames_group = results_file
+        out_name = "reg_frames"
+
     # Adjust the registered frames using the translations found.
     # Mask rolled values.
     reg_frames = None
-    if tempdir_name:
+    if reg_frames_group is not None:
         if to_truncate:
-            reg_frames = temporaries_file.create_dataset(
-                "reg_frames",
+            reg_frames = reg_frames_group.create_dataset(
+                out_name,
                 shape=reg_frames_shape,
-                dtype=frames2reg.dtype,
-                chunks=True
+                dtype=reg_frames_dtype,
+                chunks=hdf5.serializers.guess_chunks(
+                    reg_frames_shape, reg_frames_dtype, "frames"
+                )
             )
         else:
-            reg_frames = temporaries_file.create_group("reg_frames")
+            reg_frames = reg_frames_group.create_group(out_name)
             reg_frames = hdf5.serializers.HDF5MaskedDataset(
-                reg_frames, shape=frames2reg.shape, dtype=frames2reg.dtype
+                reg_frames, shape=frames2reg.shape, dtype=reg_frames_dtype
             )
     else:
         if to_truncate:
-            reg_frames = numpy.empty(reg_frames_shape, dtype=frames2reg.dtype)
+            reg_frames = numpy.empty(reg_frames_shape, dtype=reg_frames_dtype)
         else:
-            reg_frames = numpy.ma.empty_like(frames2reg)
+            reg_frames = numpy.ma.empty(frames2reg.shape, dtype=reg_frames_dtype)
             reg_frames.mask = numpy.ma.getmaskarray(reg_frames)
             reg_frames.set_fill_value(reg_frames.dtype.type(0))
 
-    for i, j in iters.lagged_generators_zipped(itertools.chain(xrange(0, len(frames2reg), block_frame_length), [len(frames2reg)])):
-        for k in xrange(i, j):
-            if to_truncate:
-                reg_frames[k] = xnumpy.roll(frames2reg[k], space_shift[k])[reg_frames_slice]
-            else:
-                reg_frames[k] = xnumpy.roll(frames2reg[k], space_shift[k], to_mask=True)
+    def shift_block_frames(frame_block):
+        i, j = frame_block
+
+        space_shift_ij = space_shift[i:j]
+
+        reg_frames_ij = None
+        if upsample_factor > 1:
+            reg_frames_ij = fft.irfftn(
+                find_phase_ramps(space_shift_ij, spatial_shape) * get_frames2reg_fft(i, j),
+                s=spatial_shape,
+                axes=spatial_axes
+            )
+
+            if not to_truncate:
+                reg_frames_ij = numpy.ma.masked_array(
+                    reg_frames_ij, mask=find_shifted_masks(space_shift_ij, spatial_shape)
+                )
+        else:
+            reg_frames_ij = xnumpy.roll_frames(frames2reg[i:j], space_shift_ij, to_mask=(not to_truncate))
 
-    result = None
-    results_filename = ""
-    if tempdir_name:
-        result = results_filename
-        results_filename = os.path.join(tempdir_name, "results.h5")
-        results_file = h5py.File(results_filename, "w")
         if to_truncate:
-            temporaries_file.copy(reg_frames.name, results_file)
+            reg_frames[i:j] = reg_frames_ij[(slice(None),) + reg_frames_slice]
         else:
-            temporaries_file.copy(reg_frames.group, results_file)
-        if include_shift:
-            temporaries_file.copy(space_shift, results_file)
-        frames2reg_fft = None
-        reg_frames = None
-        space_shift = None
-        this_space_shift = None
+            reg_frames_ij.set_fill_value(reg_frames_ij.dtype.type(0))
+            reg_frames[i:j] = reg_frames_ij
+
+    xmultiprocessing.thread_map(shift_block_frames, frame_blocks, num_threads)
+
+    frames2reg_fft = None
+    if temporaries_file is not None:
         temporaries_file.close()
+        temporaries_file = None
         os.remove(temporaries_filename)
         temporaries_filename = ""
+
+    result = None
+    if results_file is not None:
+        if include_shift:
+            results_file.create_dataset("space_shift", data=space_shift)
+
+        reg_frames = None
+        results_file.close()
+        results_file = None
+
         result = results_filename
     else:
+        if tempdir_name:
+            os.rmdir(tempdir_name)
+            tempdir_name = ""
+
         result = reg_frames
         if include_shift:
             result = (reg_frames, space_shift)
 
-    if tempdir_name:
-        results_file.close()
-        results_file = None
+    return(result)
+
+
+@prof.log_call(logger)
+def find_mean_offsets(frames2reg, max_iters=-1, block_frame_length=-1, num_threads=1, upsample_factor=1,
+                      frames2reg_fft=None, frames_range=None, include_template=False):
+    """
+        Finds the translations needed to register the given image stack against its mean projection. Translations
+        are computed against the mean projection. Then the mean projection of the translated frames is used to compute
+        new translations. This is repeated until no further improvement can be made.
+
+        The spectrum of the mean projection (the template) is kept as a running sum of the shifted frames' spectra.
+        So, phase ramps are only computed for frames whose shift changed in the last iteration. Blocks of frames may be
+        spread across threads.
+
+        Args:
+            frames2reg(numpy.ndarray):           Image stack to register (time is the first dimension uses C-order tyx
+                                                 or tzyx).
+            max_iters(int):                      Number of iterations to allow before forcing termination if stable
+                                                 point is not found yet. Set to -1 if no limit. (Default -1)
+            block_frame_length(int):             Number of frames to work with at a time.
+                                                 By default all. (Default -1)
+            num_threads(int):                    Number of threads to spread blocks of frames across. (Default 1)
+            upsample_factor(int):                Translations are found to within 1/upsample_factor of a pixel.
+                                                 By default, only integer translations are used. (Default 1)
+            frames2reg_fft(numpy.ndarray):       Half spectra of frames2reg (as from rfftn) if they were kept. By
+                                                 default, they are recomputed from the frames on each pass.
+                                                 (Default None)
+            frames_range(tuple of ints):         Start and stop of the frames to register. By default all.
+                                                 (Default None)
+            include_template(bool):              Whether to return the template's half spectrum, as well.
+                                                 (Default False)
+
+        Returns:
+            (numpy.ndarray):                     an array containing the translations to apply to each frame.
+
+        Examples:
+            >>> a = numpy.zeros((5, 3, 4)); a[:,0] = 1; a[2,0] = 0; a[2,2] = 1
+            >>> find_mean_offsets(a)
+            array([[0, 0],
+                   [0, 0],
+                   [1, 0],
+                   [0, 0],
+                   [0, 0]])
+
+            >>> find_mean_offsets(a, block_frame_length=2, frames_range=(1, 4))
+            array([[0, 0],
+                   [1, 0],
+                   [0, 0]])
+
+            >>> s, t = find_mean_offsets(a, include_template=True)
+            >>> numpy.allclose(numpy.fft.irfftn(t, s=a.shape[1:]), a[0])
+            True
+    """
+
+    start, stop = (0, len(frames2reg)) if frames_range is None else frames_range
+    num_frames = stop - start
+
+    if block_frame_length == -1:
+        block_frame_length = num_frames
+
+    frame_blocks = list(iters.lagged_generators_zipped(
+        itertools.chain(xrange(start, stop, block_frame_length), [stop])
+    ))
+
+    spatial_shape = tuple(frames2reg.shape[1:])
+    spatial_axes = range(1, len(frames2reg.shape))
+
+    frames2reg_fft_dtype = numpy.result_type(numpy.complex64, frames2reg.dtype)
+
+    space_shift_dtype = int
+    if upsample_factor > 1:
+        space_shift_dtype = float
+
+    space_shift = numpy.zeros(
+        (num_frames, len(frames2reg.shape)-1), dtype=space_shift_dtype
+    )
+    this_space_shift = numpy.empty_like(space_shift)
+
+    def get_frames2reg_fft(i, j, selection=None):
+        # Spectra are either read back or recomputed from the frames as they are streamed.
+        if frames2reg_fft is not None:
+            frames2reg_fft_ij = frames2reg_fft[i:j]
+            if selection is not None:
+                frames2reg_fft_ij = frames2reg_fft_ij[selection]
+        else:
+            frames2reg_ij = frames2reg[i:j]
+            if selection is not None:
+                frames2reg_ij = frames2reg_ij[selection]
+            frames2reg_fft_ij = fft.rfftn(frames2reg_ij, axes=spatial_axes).astype(frames2reg_fft_dtype)
+
+        return(frames2reg_fft_ij)
+
+    # All shifts start at zero. So, the sum of the frames is the sum of the shifted frames. Afterwards, the sum is
+    # only updated for frames whose shift changed.
+    template_fft_sum = numpy.zeros(spatial_shape[:-1] + (spatial_shape[-1] // 2 + 1,), dtype=complex)
+    for each_template_fft_sum in xmultiprocessing.thread_map(
+            lambda frame_block: get_frames2reg_fft(*frame_block).sum(axis=0), frame_blocks, num_threads
+    ):
+        template_fft_sum += each_template_fft_sum
+
+    def find_block_offsets(frame_block):
+        i, j = frame_block
+        this_space_shift[(i - start):(j - start)] = find_offsets(
+            get_frames2reg_fft(i, j), template_fft, shape=spatial_shape, upsample_factor=upsample_factor
+        )
+
+    def update_block_template_fft_sum(frame_block):
+        i, j = frame_block
+
+        space_shift_ij = space_shift[(i - start):(j - start)]
+        this_space_shift_ij = this_space_shift[(i - start):(j - start)]
+
+        # Only frames that moved need new phase ramps.
+        changed_ij = (this_space_shift_ij != space_shift_ij).any(axis=1)
+        if not changed_ij.any():
+            return(None)
+
+        frames2reg_fft_changed_ij = get_frames2reg_fft(i, j, changed_ij)
+
+        delta_template_fft_sum = find_phase_ramps(this_space_shift_ij[changed_ij], spatial_shape)
+        delta_template_fft_sum -= find_phase_ramps(space_shift_ij[changed_ij], spatial_shape)
+        delta_template_fft_sum *= frames2reg_fft_changed_ij
+
+        return(delta_template_fft_sum.sum(axis=0))
+
+    # Repeat shift calculation until there is no further adjustment.
+    # Shifts may also cycle through the same states without settling. So, returning to a state seen ends it too.
+    space_shifts_seen = set([hashlib.sha1(space_shift.tobytes()).hexdigest()])
+    num_iters = 0
+    squared_magnitude_delta_space_shift = 1.0
+    while (squared_magnitude_delta_space_shift != 0.0):
+        squared_magnitude_delta_space_shift = 0.0
+
+        template_fft = template_fft_sum / num_frames
+
+        xmultiprocessing.thread_map(find_block_offsets, frame_blocks, num_threads)
+
+        # Remove global shifts.
+        this_space_shift_mean = this_space_shift.sum(axis=0)
+        if upsample_factor > 1:
+            this_space_shift_mean = numpy.round(
+                this_space_shift_mean * (float(upsample_factor) / len(this_space_shift))
+            ) / upsample_factor
+        else:
+            this_space_shift_mean = numpy.round(
+                this_space_shift_mean.astype(float) / len(this_space_shift)
+            ).astype(int)
+        xnumpy.find_relative_offsets(
+            this_space_shift,
+            this_space_shift_mean,
+            out=this_space_shift
+        )
+
+        # Find the shortest roll possible (i.e. if it is going over halfway switch direction so it will go less than half).
+        # Note all indices by definition were positive semi-definite and upper bounded by the shape. This change will make
+        # them bound by the half shape, but with either sign.
+        xnumpy.find_shortest_wraparound(
+            this_space_shift,
+            spatial_shape,
+            out=this_space_shift
+        )
+
+        delta_space_shift = this_space_shift - space_shift
+        squared_magnitude_delta_space_shift += (delta_space_shift ** 2).sum()
+
+        this_space_shift_hash = hashlib.sha1(this_space_shift.tobytes()).hexdigest()
+        if (squared_magnitude_delta_space_shift != 0.0) and (this_space_shift_hash in space_shifts_seen):
+            logger.debug("Shifts returned to a previous state. So, they will not settle.")
+            break
+        space_shifts_seen.add(this_space_shift_hash)
+
+        for each_delta_template_fft_sum in xmultiprocessing.thread_map(
+                update_block_template_fft_sum, frame_blocks, num_threads
+        ):
+            if each_delta_template_fft_sum is not None:
+                template_fft_sum += each_delta_template_fft_sum
+
+        space_shift[...] = this_space_shift
+
+        if max_iters != -1:
+            num_iters += 1
+            if num_iters >= max_iters:
+                break
+
+    result = space_shift
+    if include_template:
+        template_fft = template_fft_sum / num_frames
+        result = (space_shift, template_fft)
 
     return(result)
 
 
 @prof.log_call(logger)
-def find_offsets(frames2reg_fft, template_fft):
+def find_offsets(frames2reg_fft, template_fft, shape=None, upsample_factor=1):
     """
         Computes the convolution of the template with the frames by taking advantage of their FFTs for faster
         computation that an ordinary convolution ( O(N*lg(N)) vs O(N^2) )
@@ -333,6 +623,8 @@ def find_offsets(frames2reg_fft, template_fft):
         Once computed the maximum of the convolution is found to determine the best overlap of each frame with the
         template, which provides the needed offset. Some corrections are performed to make reasonable offsets.
 
+        If upsample_factor is more than 1, the offsets are refined to a fraction of a pixel (see refine_peaks).
+
         Notes:
             Adapted from code provided by Wenzhi Sun with speed improvements provided by Uri Dubin.
 
@@ -341,6 +633,11 @@ def find_offsets(frames2reg_fft, template_fft):
                                                  or tzyx).
             template_fft(numpy.ndarray):         what to register the image stack against (single frame using C-order
                                                  yx or zyx).
+            shape(tuple of ints):                spatial shape of the frames if the FFTs given only include half of
+                                                 the spectrum (as from rfftn). By default, the full spectrum is
+                                                 expected. (Default None)
+            upsample_factor(int):                offsets are found to within 1/upsample_factor of a pixel. Integer
+                                                 offsets are found by default. (Default 1)
 
         Returns:
             (numpy.ndarray):                     an array containing the translations to apply to each frame.
@@ -399,6 +696,27 @@ def find_offsets(frames2reg_fft, template_fft):
                    [-2,  0],
                    [ 0,  0],
                    [ 0,  0]])
+
+            >>> find_offsets(
+            ...     numpy.fft.rfftn(a, axes=range(1, a.ndim)), numpy.fft.rfftn(a.mean(axis=0)), shape=a.shape[1:]
+            ... )
+            array([[ 0,  0],
+                   [ 0,  0],
+                   [-2,  0],
+                   [ 0,  0],
+                   [ 0,  0]])
+
+            >>> y, x = numpy.indices((10, 10))
+            >>> b = numpy.array([
+            ...     numpy.exp(-((y - 4.0) ** 2 + (x - 4.0) ** 2) / 4.0),
+            ...     numpy.exp(-((y - 4.5) ** 2 + (x - 3.75) ** 2) / 4.0)
+            ... ])
+            >>> find_offsets(
+            ...     numpy.fft.rfftn(b, axes=range(1, b.ndim)), numpy.fft.rfftn(b[0]), shape=b.shape[1:],
+            ...     upsample_factor=4
+            ... )
+            array([[ 0.  ,  0.  ],
+                   [-0.5 ,  0.25]])
     """
 
     # If there is only one frame, add a singleton axis to indicate this.
@@ -410,7 +728,12 @@ def find_offsets(frames2reg_fft, template_fft):
     frames2reg_template_conv_fft = frames2reg_fft * template_fft.conj()[None]
 
     # Find the FFT inverse (over all spatial dimensions) to return to the convolution.
-    frames2reg_template_conv = fft.ifftn(frames2reg_template_conv_fft, axes=range(1, frames2reg_fft.ndim))
+    if shape is None:
+        frames2reg_template_conv = fft.ifftn(frames2reg_template_conv_fft, axes=range(1, frames2reg_fft.ndim))
+    else:
+        frames2reg_template_conv = fft.irfftn(
+            frames2reg_template_conv_fft, s=shape, axes=range(1, frames2reg_fft.ndim)
+        )
 
     # Find where the convolution is maximal. Will have the most things in common between the template and frames.
     frames2reg_template_conv_max, frames2reg_template_conv_max_indices = xnumpy.max_abs(
@@ -423,7 +746,232 @@ def find_offsets(frames2reg_fft, template_fft):
     # Convert indices into an array for easy manipulation.
     frames2reg_template_conv_max_indices = numpy.array(frames2reg_template_conv_max_indices).T.copy()
 
+    # Look more closely around each maximum to find it to within a fraction of a pixel.
+    if upsample_factor > 1:
+        frames2reg_template_conv_max_indices = refine_peaks(
+            frames2reg_template_conv_fft, frames2reg_template_conv_max_indices, upsample_factor, shape=shape
+        )
+
     # Shift will have to be in the opposite direction to bring everything to the center.
     numpy.negative(frames2reg_template_conv_max_indices, out=frames2reg_template_conv_max_indices)
 
+    # Fractional offsets should not end up as negative zeros.
+    if upsample_factor > 1:
+        frames2reg_template_conv_max_indices += 0.0
+
     return(frames2reg_template_conv_max_indices)
+
+
+@prof.log_call(logger)
+def refine_peaks(frames_fft, peaks, upsample_factor, shape=None):
+    """
+        Refines integer peaks of some frames (given by their FFTs) to within 1/upsample_factor of a pixel. Only a
+        region 1.5 pixels across around each peak is upsampled. This is done with a DFT by matrix multiplication
+        along each axis (as in Guizar-Sicairos, et al. 2008
+        < http://dx.doi.org/10.1364/OL.33.000156 >). So, the full frames are never upsampled.
+
+        Args:
+            frames_fft(numpy.ndarray):           FFTs of real frames (time is the first dimension uses C-order tyx or
+                                                 tzyx).
+            peaks(numpy.ndarray):                integer peak of each frame (first dimension is frames and the second
+                                                 is the spatial dimensions).
+            upsample_factor(int):                peaks are found to within 1/upsample_factor of a pixel.
+            shape(tuple of ints):                spatial shape of the frames if the FFTs given only include half of
+                                                 the spectrum (as from rfftn). By default, the full spectrum is
+                                                 expected. (Default None)
+
+        Returns:
+            (numpy.ndarray):                     refined peaks.
+
+        Examples:
+            >>> x = numpy.arange(16) - 5.3
+            >>> a = numpy.exp(-(x ** 2) / 4.0)[None]
+            >>> refine_peaks(numpy.fft.fft(a), numpy.array([[5]]), 10)
+            array([[ 5.3]])
+            >>> refine_peaks(numpy.fft.rfft(a), numpy.array([[5]]), 10, shape=a.shape[1:])
+            array([[ 5.3]])
+    """
+
+    peaks = numpy.asarray(peaks)
+
+    ndim = frames_fft.ndim - 1
+
+    half_spectrum = (shape is not None)
+    if not half_spectrum:
+        shape = frames_fft.shape[1:]
+    shape = tuple(shape)
+
+    region_size = int(numpy.ceil(1.5 * upsample_factor))
+    region_offsets = (numpy.arange(region_size) - region_size // 2) / float(upsample_factor)
+
+    frames_upsampled = numpy.array(frames_fft, dtype=complex)
+
+    # Terms of the half spectrum (besides the first and Nyquist) stand in for their conjugates too. As the frames are
+    # real, taking the real part at the end leaves the same result as the full spectrum would.
+    if half_spectrum:
+        frames_upsampled[..., 1:((shape[-1] + 1) // 2)] *= 2
+
+    for i, each_shape in enumerate(shape):
+        if half_spectrum and (i == (ndim - 1)):
+            each_wave_numbers = numpy.arange(each_shape // 2 + 1, dtype=float)
+        else:
+            each_wave_numbers = numpy.fft.fftfreq(each_shape) * each_shape
+
+        # Positions to sample for each frame along this axis.
+        each_positions = peaks[:, i, None] + region_offsets[None]
+
+        each_kernel = numpy.exp(
+            (2j * numpy.pi / each_shape) * each_positions[..., None] * each_wave_numbers[None, None]
+        )
+
+        # Move the axis to the end and contract it with the kernel of the frame.
+        frames_upsampled = numpy.rollaxis(frames_upsampled, 1 + i, frames_upsampled.ndim)
+        frames_upsampled_shape = frames_upsampled.shape
+        frames_upsampled = numpy.einsum(
+            "fmk,frk->fmr",
+            frames_upsampled.reshape((len(frames_upsampled), -1, frames_upsampled_shape[-1])),
+            each_kernel
+        )
+        frames_upsampled = frames_upsampled.reshape(frames_upsampled_shape[:-1] + (region_size,))
+        frames_upsampled = numpy.rollaxis(frames_upsampled, frames_upsampled.ndim - 1, 1 + i)
+
+    frames_upsampled = numpy.abs(frames_upsampled.real)
+
+    frames_upsampled_max_indices = frames_upsampled.reshape((len(frames_upsampled), -1)).argmax(axis=1)
+    frames_upsampled_max_indices = numpy.array(
+        numpy.unravel_index(frames_upsampled_max_indices, frames_upsampled.shape[1:])
+    ).T
+
+    refined_peaks = peaks + region_offsets[frames_upsampled_max_indices]
+
+    return(refined_peaks)
+
+
+@prof.log_call(logger)
+def find_phase_ramps(space_shift, shape):
+    """
+        Finds the phase ramps that translate frames when multiplied with their half spectra (as from rfftn). As
+        translation is separable, a ramp is found along each axis and these are multiplied together.
+
+        Args:
+            space_shift(numpy.ndarray):          translations to apply to each frame (first dimension is frames and
+                                                 the second is the spatial dimensions).
+            shape(tuple of ints):                spatial shape of the frames.
+
+        Returns:
+            (numpy.ndarray):                     phase ramps for each frame in the half spectrum layout.
+
+        Examples:
+            >>> a = numpy.zeros((2, 3, 4)); a[:, 0, 1] = 1
+            >>> s = numpy.array([[0, 0], [1, 2]])
+            >>> r = find_phase_ramps(s, a.shape[1:]); r.shape
+            (2, 3, 3)
+
+            >>> numpy.fft.irfftn(
+            ...     r * numpy.fft.rfftn(a, axes=range(1, a.ndim)), s=a.shape[1:], axes=range(1, a.ndim)
+            ... ).round(8) + 0
+            array([[[ 0.,  1.,  0.,  0.],
+                    [ 0.,  0.,  0.,  0.],
+                    [ 0.,  0.,  0.,  0.]],
+            <BLANKLINE>
+                   [[ 0.,  0.,  0.,  0.],
+                    [ 0.,  0.,  0.,  1.],
+                    [ 0.,  0.,  0.,  0.]]])
+    """
+
+    space_shift = numpy.asarray(space_shift)
+    shape = tuple(shape)
+
+    assert (space_shift.ndim == 2)
+    assert (space_shift.shape[1] == len(shape))
+
+    phase_ramps = numpy.ones((len(space_shift),) + shape[:-1] + (shape[-1] // 2 + 1,), dtype=complex)
+    for i, each_shape in enumerate(shape):
+        if i == (len(shape) - 1):
+            each_wave_numbers = numpy.arange(each_shape // 2 + 1, dtype=float)
+        else:
+            each_wave_numbers = numpy.fft.fftfreq(each_shape) * each_shape
+
+        each_wave_numbers *= -2 * numpy.pi / each_shape
+
+        each_phase_ramp = numpy.exp(1j * numpy.multiply.outer(space_shift[:, i], each_wave_numbers))
+
+        each_phase_ramp_shape = [len(space_shift)] + len(shape) * [1]
+        each_phase_ramp_shape[1 + i] = each_phase_ramp.shape[1]
+        phase_ramps *= each_phase_ramp.reshape(each_phase_ramp_shape)
+
+    return(phase_ramps)
+
+
+@prof.log_call(logger)
+def find_shifted_masks(space_shift, shape):
+    """
+        Finds the portion of each frame that was rolled around by a translation. Fractional translations mask any
+        pixel that was partially rolled around.
+
+        Args:
+            space_shift(numpy.ndarray):          translations applied to each frame (first dimension is frames and
+                                                 the second is the spatial dimensions).
+            shape(tuple of ints):                spatial shape of the frames.
+
+        Returns:
+            (numpy.ndarray):                     masks of what was rolled around for each frame.
+
+        Examples:
+            >>> find_shifted_masks(numpy.array([[0.5, -1]]), (3, 4))
+            array([[[ True,  True,  True,  True],
+                    [False, False, False,  True],
+                    [False, False, False,  True]]], dtype=bool)
+    """
+
+    space_shift = numpy.asarray(space_shift)
+    shape = tuple(shape)
+
+    space_shift_ceil = numpy.ceil(space_shift).astype(int)
+    space_shift_floor = numpy.floor(space_shift).astype(int)
+
+    shifted_masks = numpy.zeros((len(space_shift),) + shape, dtype=bool)
+    for i, each_shape in enumerate(shape):
+        each_indices = numpy.arange(each_shape)
+
+        each_shifted_mask = (each_indices[None] < space_shift_ceil[:, i, None])
+        each_shifted_mask |= (each_indices[None] >= (each_shape + space_shift_floor[:, i, None]))
+
+        each_shifted_mask_shape = [len(space_shift)] + len(shape) * [1]
+        each_shifted_mask_shape[1 + i] = each_shape
+        shifted_masks |= each_shifted_mask.reshape(each_shifted_mask_shape)
+
+    return(shifted_masks)
+
+
+@prof.log_call(logger)
+def find_block_frame_length(shape, memory_budget):
+    """
+        Finds how many frames can be registered at a time within the memory budget given. Each pixel of a block is
+        estimated to need 32 bytes (the frames, their half spectra, phase ramps, and products at double precision).
+
+        Args:
+            shape(tuple of ints):                shape of the image stack (time is the first dimension).
+            memory_budget(int):                  bytes of memory to use at a time.
+
+        Returns:
+            (int):                               number of frames to work with at a time (at least 1 and at most
+                                                 all of them).
+
+        Examples:
+            >>> find_block_frame_length((100, 64, 64), 32 * 64 * 64 * 10)
+            10
+
+            >>> find_block_frame_length((100, 64, 64), 1)
+            1
+
+            >>> find_block_frame_length((100, 64, 64), 2**40)
+            100
+    """
+
+    frame_size = int(numpy.prod(shape[1:]))
+
+    block_frame_length = int(memory_budget // (32 * frame_size))
+    block_frame_length = max(1, min(block_frame_length, shape[0]))
+
+    return(block_frame_length)
@@ -44,6 +44,7 @@ import rank_filter
 # Need in order to have logging information no matter what.
 from nanshe.util import prof
 
+from nanshe.util import xmultiprocessing
 from nanshe.util import xnumpy
 
 # Short function to process image data.
@@ -278,10 +279,16 @@ def extract_f0(new_data,
                bias = None,
                out = None,
                return_f0 = False,
+               block_size = None,
+               num_threads = 1,
                **parameters):
     """
         Attempts to find an estimate for dF/F.
 
+        If block_size is given, the steps of estimate_f0 and the division are fused and run through the data a block
+        of rows at a time (see extract_f0_blocked). This avoids holding copies of all the data for F_0. However, F_0
+        cannot be returned and is not recorded.
+
         Args:
             new_data(numpy.ndarray):                                array of data for finding baseline (first axis is time).
             half_window_size(int):                                  the rank filter window size is 2*half_window_size+1.
@@ -295,12 +302,19 @@ def extract_f0(new_data,
             bias(float):                                            value to be added to dataset to avoid nan.
             out(numpy.ndarray):                                     where the final result will be stored.
             return_f0(bool):                                        whether to return F_0 also, F_0 will be returned first.
+            block_size(int):                                        number of rows (along the first spatial
+                                                                    dimension) to work on at a time (None works on
+                                                                    all of the data at once).
+            num_threads(int):                                       number of threads to split each block across
+                                                                    (only with block_size).
             **parameters(dict):                                     essentially unused (catches unneeded arguments).
 
         Returns:
             numpy.ndarray:                                          dF/F or if return_f0 is True a tuple (F_0, dF/F).
     """
 
+    assert ((block_size is None) or (not return_f0)), "Cannot return F_0 when working on blocks of rows."
+
     if not issubclass(new_data.dtype.type, numpy.float32):
         warnings.warn("Provided new_data with type \"" + repr(new_data.dtype.type) + "\". " +
                       "Will be cast to type \"" + repr(numpy.float32) + "\"", RuntimeWarning)
@@ -325,6 +339,22 @@ def extract_f0(new_data,
     if bias is None:
         bias = 1 - new_data.min()
 
+    if block_size is not None:
+        extract_f0_blocked(new_data_df_over_f,
+                           half_window_size,
+                           which_quantile,
+                           temporal_smoothing_gaussian_filter_stdev,
+                           temporal_smoothing_gaussian_filter_window_size,
+                           spatial_smoothing_gaussian_filter_stdev,
+                           spatial_smoothing_gaussian_filter_window_size,
+                           bias,
+                           block_size,
+                           num_threads = num_threads)
+
+        extract_f0.recorders.array_debug_recorder["new_data_df_over_f"] = new_data_df_over_f
+
+        return(new_data_df_over_f)
+
     new_data_f0_estimation = new_data_df_over_f.astype(numpy.float32)
 
     estimate_f0(new_data_f0_estimation,
@@ -349,6 +379,164 @@ def extract_f0(new_data,
         return(new_data_df_over_f)
 
 
+@prof.log_call(logger)
+def extract_f0_blocked(new_data,
+                       half_window_size,
+                       which_quantile,
+                       temporal_smoothing_gaussian_filter_stdev,
+                       temporal_smoothing_gaussian_filter_window_size,
+                       spatial_smoothing_gaussian_filter_stdev,
+                       spatial_smoothing_gaussian_filter_window_size,
+                       bias,
+                       block_size,
+                       num_threads = 1):
+    """
+        Replaces new_data with dF/F (as extract_f0 would). The data is worked through a block of rows (along the first
+        spatial dimension, spanning all of time) at a time. As each block spans all of time, the temporal smoothing
+        and rank filter are done once for each pixel. Only the spatial smoothing needs rows on either side of the
+        block. Their temporal F_0 is kept aside from the block before (as those rows have since been overwritten) or
+        is computed ahead for the block after. So, only a few blocks worth of scratch memory is used. Within a block,
+        the temporal steps are split across threads by pixel and the rest by frame.
+
+        Args:
+            new_data(numpy.ndarray):                                data to replace with dF/F (first axis is time).
+            half_window_size(int):                                  the rank filter window size is 2*half_window_size+1.
+            which_quantile(float):                                  while quantile to return from the rank filter.
+            temporal_smoothing_gaussian_filter_stdev(float):        stdev for gaussian filter to convolve over time.
+            temporal_smoothing_gaussian_filter_window_size(float):  window for gaussian filter to convolve over time.
+                                                                    (Measured in standard deviations)
+            spatial_smoothing_gaussian_filter_stdev(float):         stdev for gaussian filter to convolve over space.
+            spatial_smoothing_gaussian_filter_window_size(float):   window for gaussian filter to convolve over space.
+                                                                    (Measured in standard deviations)
+            bias(float):                                            value to be added to F_0 to avoid nan.
+            block_size(int):                                        number of rows (along the first spatial
+                                                                    dimension) to work on at a time.
+            num_threads(int):                                       number of threads to split each block across.
+
+        Returns:
+            numpy.ndarray:                                          new_data (now dF/F).
+    """
+
+    assert (block_size > 0)
+
+    which_quantile_len = None
+    try:
+        which_quantile_len = len(which_quantile)
+    except TypeError:
+        # Does not have len
+        which_quantile_len = 1
+
+    # Only allowed to have one quantile.
+    if (which_quantile_len > 1):
+        raise Exception("Provided more than one quantile \"" + repr(which_quantile) + "\".")
+
+    temporal_smoothing_gaussian_filter = vigra.filters.gaussianKernel(temporal_smoothing_gaussian_filter_stdev,
+                                                                      1.0,
+                                                                      temporal_smoothing_gaussian_filter_window_size)
+    temporal_smoothing_gaussian_filter.setBorderTreatment(vigra.filters.BorderTreatmentMode.BORDER_TREATMENT_REFLECT)
+
+    spatial_smoothing_gaussian_filter = vigra.filters.gaussianKernel(spatial_smoothing_gaussian_filter_stdev,
+                                                                     1.0,
+                                                                     spatial_smoothing_gaussian_filter_window_size)
+    spatial_smoothing_gaussian_filter.setBorderTreatment(vigra.filters.BorderTreatmentMode.BORDER_TREATMENT_REFLECT)
+
+    # Same radius as vigra.filters.gaussianKernel.
+    if spatial_smoothing_gaussian_filter_window_size == 0:
+        spatial_smoothing_gaussian_filter_window_size = 3.0
+
+    # Rows needed on either side for the spatial smoothing to match.
+    num_halo_rows = int(spatial_smoothing_gaussian_filter_window_size * spatial_smoothing_gaussian_filter_stdev + 0.5)
+
+    # Without any spatial dimensions, all of the data is one row.
+    new_data_rows = new_data
+    if new_data_rows.ndim == 1:
+        new_data_rows = new_data_rows[:, None]
+
+    num_rows = new_data_rows.shape[1]
+
+    def estimate_f0_temporally(new_data_block):
+        new_data_block = numpy.array(new_data_block, dtype=numpy.float32)
+
+        vigra.filters.convolveOneDimension(new_data_block,
+                                           0,
+                                           temporal_smoothing_gaussian_filter,
+                                           out=new_data_block)
+
+        rank_filter.lineRankOrderFilter(new_data_block,
+                                        ctypes.c_ulong(half_window_size).value,
+                                        which_quantile,
+                                        ctypes.c_uint(0).value,
+                                        out = new_data_block)
+
+        return(new_data_block)
+
+    def estimate_f0_spatially_and_divide(new_data_block_f0_block):
+        new_data_block, new_data_f0_block, row_slice = new_data_block_f0_block
+
+        for d in xrange(1, new_data.ndim):
+            vigra.filters.convolveOneDimension(new_data_f0_block,
+                                               d,
+                                               spatial_smoothing_gaussian_filter,
+                                               out=new_data_f0_block)
+
+            # The rows on either side are only needed for smoothing along them.
+            if d == 1:
+                new_data_f0_block = new_data_f0_block[:, row_slice]
+
+        new_data_block -= new_data_f0_block
+        new_data_f0_block += bias
+        new_data_block /= new_data_f0_block
+
+    # Temporal F_0 of the rows from the last block. Some are needed for the next block.
+    new_data_f0 = None
+    new_data_f0_start = 0
+    new_data_f0_stop = 0
+    for row_start in xrange(0, num_rows, block_size):
+        row_stop = min(row_start + block_size, num_rows)
+
+        halo_start = max(row_start - num_halo_rows, 0)
+        halo_stop = min(row_stop + num_halo_rows, num_rows)
+
+        new_data_f0_kept = []
+        if new_data_f0 is not None:
+            new_data_f0_kept.append(new_data_f0[:, (halo_start - new_data_f0_start):])
+
+        # Rows past the last block have not been overwritten yet.
+        if new_data_f0_stop < halo_stop:
+            new_data_raw = numpy.array(new_data_rows[:, new_data_f0_stop:halo_stop], dtype=numpy.float32)
+
+            # Temporal steps are independent for each pixel.
+            num_pixels = int(numpy.prod(new_data_raw.shape[1:]))
+            pixel_bounds = numpy.linspace(0, num_pixels, min(num_threads, num_pixels) + 1).astype(int)
+            new_data_raw_pixels = new_data_raw.reshape((len(new_data_raw), num_pixels))
+            new_data_f0_kept.append(numpy.concatenate(xmultiprocessing.thread_map(
+                estimate_f0_temporally,
+                [new_data_raw_pixels[:, _1:_2] for _1, _2 in zip(pixel_bounds[:-1], pixel_bounds[1:])],
+                num_threads
+            ), axis=1).reshape(new_data_raw.shape))
+
+        new_data_f0 = numpy.concatenate(new_data_f0_kept, axis=1)
+        new_data_f0_start = halo_start
+        new_data_f0_stop = halo_stop
+
+        row_slice = slice(row_start - halo_start, row_stop - halo_start)
+        new_data_block = numpy.array(new_data_rows[:, row_start:row_stop], dtype=numpy.float32)
+        new_data_f0_block = new_data_f0.copy()
+
+        # Spatial steps are independent for each frame.
+        frame_bounds = numpy.linspace(0, len(new_data_block), min(num_threads, len(new_data_block)) + 1).astype(int)
+        xmultiprocessing.thread_map(
+            estimate_f0_spatially_and_divide,
+            [(new_data_block[_1:_2], new_data_f0_block[_1:_2], row_slice)
+             for _1, _2 in zip(frame_bounds[:-1], frame_bounds[1:])],
+            num_threads
+        )
+
+        new_data_rows[:, row_start:row_stop] = new_data_block
+
+    return(new_data)
+
+
 @prof.log_call(logger)
 @hdf5.record.static_array_debug_recorder
 def normalize_data(new_data, out = None, **parameters):
@@ -446,7 +634,8 @@ def preprocess_data(new_data, out = None, **parameters):
                             out = new_data_maybe_lines_removed,
                             **parameters["remove_zeroed_lines"])
         preprocess_data.recorders.array_debug_recorder["images_lines_removed"] = new_data_maybe_lines_removed
-        preprocess_data.recorders.array_debug_recorder["images_lines_removed_max"] = xnumpy.add_singleton_op(
+        preprocess_data.recorders.array_debug_recorder["images_lines_removed_max"] = hdf5.record.DeferredArray(
+            xnumpy.add_singleton_op,
             numpy.max,
             new_data_maybe_lines_removed,
             axis = 0
@@ -459,7 +648,8 @@ def preprocess_data(new_data, out = None, **parameters):
                    out = new_data_maybe_f0_result,
                    **parameters["extract_f0"])
         preprocess_data.recorders.array_debug_recorder["images_f0"] = new_data_maybe_f0_result
-        preprocess_data.recorders.array_debug_recorder["images_f0_max"] = xnumpy.add_singleton_op(
+        preprocess_data.recorders.array_debug_recorder["images_f0_max"] = hdf5.record.DeferredArray(
+            xnumpy.add_singleton_op,
             numpy.max,
             new_data_maybe_f0_result,
             axis = 0
@@ -474,7 +664,8 @@ def preprocess_data(new_data, out = None, **parameters):
                                             out = new_data_maybe_wavelet_result,
                                             **parameters["wavelet.transform"])
         preprocess_data.recorders.array_debug_recorder["images_wavelet_transformed"] = new_data_maybe_wavelet_result
-        preprocess_data.recorders.array_debug_recorder["images_wavelet_transformed_max"] = xnumpy.add_singleton_op(
+        preprocess_data.recorders.array_debug_recorder["images_wavelet_transformed_max"] = hdf5.record.DeferredArray(
+            xnumpy.add_singleton_op,
             numpy.max,
             new_data_maybe_wavelet_result,
             axis = 0
@@ -487,7 +678,8 @@ def preprocess_data(new_data, out = None, **parameters):
                    **parameters["normalize_data"])
 
     preprocess_data.recorders.array_debug_recorder["images_normalized"] = new_data_normalized
-    preprocess_data.recorders.array_debug_recorder["images_normalized_max"] = xnumpy.add_singleton_op(
+    preprocess_data.recorders.array_debug_recorder["images_normalized_max"] = hdf5.record.DeferredArray(
+            xnumpy.add_singleton_op,
             numpy.max,
             new_data_normalized,
             axis = 0
@@ -496,30 +688,291 @@ def preprocess_data(new_data, out = None, **parameters):
     return(out)
 
 
+@prof.log_call(logger)
+def preprocess_data_halo(ndim, **parameters):
+    """
+        Determines how far the preprocessing steps (remove_zeroed_lines, extract_f0, and wavelet.transform) reach
+        along each dimension. So, preprocessing a tile extended by this much on either side gives the same result
+        within the tile as preprocessing all of the data.
+
+        Note:
+            remove_zeroed_lines interpolates over whole regions of zeros. So, a region extending past the halo may be
+            filled in a little differently.
+
+        Args:
+            ndim(int):                          number of dimensions of the data (first axis is time).
+            **parameters(dict):                 parameters for each step of preprocessing (as for preprocess_data).
+
+        Returns:
+            numpy.ndarray:                      how far to extend along each dimension (time is never extended).
+
+        Examples:
+            >>> preprocess_data_halo(3)
+            array([0, 0, 0])
+
+            >>> preprocess_data_halo(3, **{"wavelet.transform" : {"scale" : 3}})
+            array([ 0, 14, 14])
+
+            >>> preprocess_data_halo(3, **{"wavelet.transform" : {"scale" : [3, 1, 2]}})
+            array([0, 2, 6])
+
+            >>> preprocess_data_halo(3,
+            ...     **{"remove_zeroed_lines" : {"erosion_shape" : [21, 1], "dilation_shape" : [1, 3]},
+            ...        "extract_f0" : {"spatial_smoothing_gaussian_filter_stdev" : 5.0,
+            ...                        "spatial_smoothing_gaussian_filter_window_size" : 5.0}}
+            ... )
+            array([ 0, 35, 26])
+    """
+
+    halo = numpy.zeros((ndim,), dtype=int)
+
+    if "remove_zeroed_lines" in parameters:
+        # Regions of zeros are eroded and then dilated.
+        halo[1:] += numpy.array(parameters["remove_zeroed_lines"]["erosion_shape"], dtype=int) // 2
+        halo[1:] += numpy.array(parameters["remove_zeroed_lines"]["dilation_shape"], dtype=int) // 2
+
+    if "extract_f0" in parameters:
+        spatial_smoothing_gaussian_filter_stdev = parameters["extract_f0"]["spatial_smoothing_gaussian_filter_stdev"]
+        spatial_smoothing_gaussian_filter_window_size = parameters["extract_f0"]["spatial_smoothing_gaussian_filter_window_size"]
+
+        # Same radius as vigra.filters.gaussianKernel.
+        if spatial_smoothing_gaussian_filter_window_size == 0:
+            spatial_smoothing_gaussian_filter_window_size = 3.0
+
+        halo[1:] += int(spatial_smoothing_gaussian_filter_window_size * spatial_smoothing_gaussian_filter_stdev + 0.5)
+
+    if "wavelet.transform" in parameters:
+        scale = parameters["wavelet.transform"].get("scale", 5)
+
+        try:
+            scale = numpy.array(list(scale))
+        except TypeError:
+            scale = numpy.repeat([scale], ndim)
+
+        # Each scale convolves with a larger kernel.
+        for d in xrange(1, ndim):
+            for i in xrange(1, scale[d] + 1):
+                halo[d] += (wavelet.binomial_1D_array_kernel(i).size - 1) // 2
+
+    return(halo)
+
+
+@prof.log_call(logger)
+def preprocess_data_tile_shape(shape, halo, memory_budget):
+    """
+        Finds the largest tile (spanning all of time) that can be preprocessed within the memory budget. The longest
+        spatial dimension of the tile is halved until the tile and its halo fit.
+
+        Args:
+            shape(tuple of ints):               shape of the data (first axis is time).
+            halo(numpy.ndarray):                how far each tile is extended along each dimension.
+            memory_budget(int):                 roughly how many bytes preprocessing a tile may use.
+
+        Returns:
+            tuple:                              shape of each tile.
+
+        Examples:
+            >>> preprocess_data_tile_shape((10, 64, 64), numpy.array([0, 0, 0]), 10 * 64 * 64 * 4 * 4)
+            (10, 64, 64)
+
+            >>> preprocess_data_tile_shape((10, 64, 64), numpy.array([0, 0, 0]), 10 * 64 * 64 * 4)
+            (10, 32, 32)
+
+            >>> preprocess_data_tile_shape((10, 64, 64), numpy.array([0, 4, 4]), 10 * 64 * 64 * 4)
+            (10, 16, 32)
+    """
+
+    # Roughly how many float32 copies of a tile the preprocessing steps hold at once.
+    num_tile_copies = 4
+
+    shape = numpy.array(shape, dtype=int)
+    tile_shape = shape.copy()
+
+    while True:
+        tile_halo_shape = numpy.minimum(tile_shape + 2 * halo, shape)
+        tile_halo_nbytes = num_tile_copies * numpy.dtype(numpy.float32).itemsize * tile_halo_shape.prod()
+
+        if tile_halo_nbytes <= memory_budget:
+            break
+
+        if (tile_shape[1:] <= 1).all():
+            warnings.warn("Unable to preprocess within the memory budget of \"" + repr(memory_budget) + "\" bytes. " +
+                          "Will use tiles that need \"" + repr(tile_halo_nbytes) + "\" bytes.", RuntimeWarning)
+            break
+
+        largest_dim = 1 + tile_shape[1:].argmax()
+        tile_shape[largest_dim] = (tile_shape[largest_dim] + 1) // 2
+
+    return(tuple(int(_) for _ in tile_shape))
+
+
 @prof.log_call(logger)
 @hdf5.record.static_array_debug_recorder
-def generate_dictionary(new_data, **parameters):
+def preprocess_data_blocked(new_data, out, memory_budget, **parameters):
     """
-        Generates a dictionary using the data and parameters given for trainDL.
-        
+        Performs the same preprocessing as preprocess_data. However, this works through spatial tiles (each spanning
+        all of time) extended by the halo the steps need. As only one tile is held in memory at a time, new_data and
+        out can be HDF5 datasets much larger than memory.
+
+        Note:
+            Normalization needs the mean and norm of each whole image. So, out is read back tile by tile to find
+            these and then to apply them.
+
         Args:
-            new_data(numpy.ndarray):            array of data for generating a dictionary (first axis is time).
-            **parameters(dict):                 passed directly to spams.trainDL.
-        
+            new_data(numpy.ndarray or h5py.Dataset):    data to preprocess (first axis is time).
+            out(numpy.ndarray or h5py.Dataset):         where the final result will be stored (must not be new_data).
+            memory_budget(int):                         roughly how many bytes preprocessing a tile may use.
+            **parameters(dict):                         additional parameters for each step of preprocessing.
+
         Returns:
-            dict:                               the dictionary found.
+            numpy.ndarray or h5py.Dataset:              out.
     """
 
-    import nanshe.box
+    assert (tuple(new_data.shape) == tuple(out.shape))
+
+    shape = tuple(new_data.shape)
+
+    halo = preprocess_data_halo(len(shape), **parameters)
+    tile_shape = preprocess_data_tile_shape(shape, halo, memory_budget)
+    tile_slices = xnumpy.tile_slices_with_halo(shape, tile_shape, halo)
+
+    logger.info("Preprocessing in \"" + str(len(tile_slices)) + "\" tiles of shape \"" + repr(tile_shape) + "\" " +
+                "with halo \"" + repr(tuple(halo)) + "\".")
+
+    # Recording the intermediates of each tile is not useful.
+    remove_zeroed_lines.recorders.array_debug_recorder = hdf5.record.EmptyArrayRecorder()
+    extract_f0.recorders.array_debug_recorder = hdf5.record.EmptyArrayRecorder()
+    wavelet.transform.recorders.array_debug_recorder = hdf5.record.EmptyArrayRecorder()
+
+    # The bias is found from all of the data. So, it must be found before any tile can be processed.
+    extract_f0_parameters = None
+    if "extract_f0" in parameters:
+        extract_f0_parameters = dict(parameters["extract_f0"])
+
+        if extract_f0_parameters.get("bias") is None:
+            new_data_min = numpy.inf
+            for each_tile_halo_slice, each_tile_slice, each_tile_halo_tile_slice in tile_slices:
+                if "remove_zeroed_lines" in parameters:
+                    each_tile = new_data[each_tile_halo_slice].astype(numpy.float32)
+                    remove_zeroed_lines(each_tile,
+                                        out = each_tile,
+                                        **parameters["remove_zeroed_lines"])
+                    each_tile = each_tile[each_tile_halo_tile_slice]
+                else:
+                    each_tile = new_data[each_tile_slice].astype(numpy.float32)
+
+                new_data_min = min(new_data_min, each_tile.min())
+
+            extract_f0_parameters["bias"] = 1 - new_data_min
+
+    frames_sum = numpy.zeros((shape[0],), dtype=numpy.float64)
+    for each_tile_halo_slice, each_tile_slice, each_tile_halo_tile_slice in tile_slices:
+        each_tile = new_data[each_tile_halo_slice].astype(numpy.float32)
+
+        if "remove_zeroed_lines" in parameters:
+            remove_zeroed_lines(each_tile,
+                                out = each_tile,
+                                **parameters["remove_zeroed_lines"])
+
+        if "extract_f0" in parameters:
+            extract_f0(each_tile,
+                       out = each_tile,
+                       **extract_f0_parameters)
+
+        if "wavelet.transform" in parameters:
+            wavelet.transform(each_tile,
+                              include_intermediates = False,
+                              include_lower_scales = False,
+                              out = each_tile,
+                              **parameters["wavelet.transform"])
+
+        each_tile = each_tile[each_tile_halo_tile_slice]
+        out[each_tile_slice] = each_tile
+
+        frames_sum += each_tile.reshape((len(each_tile), -1)).sum(axis=1, dtype=numpy.float64)
+
+    # Same normalization as normalize_data, but with the mean and norm of each image gathered from all tiles.
+    frames_shape = (-1,) + (len(shape) - 1) * (1,)
+    frames_mean = frames_sum / numpy.prod(shape[1:])
+
+    ord = parameters["normalize_data"]["renormalized_images"].get("ord", 2)
+
+    frames_norm = None
+    if ord == -numpy.inf:
+        frames_norm = numpy.empty((shape[0],), dtype=numpy.float64)
+        frames_norm.fill(numpy.inf)
+    else:
+        frames_norm = numpy.zeros((shape[0],), dtype=numpy.float64)
+
+    for each_tile_halo_slice, each_tile_slice, each_tile_halo_tile_slice in tile_slices:
+        each_tile = numpy.asarray(out[each_tile_slice], dtype=numpy.float64)
+        each_tile -= frames_mean.reshape(frames_shape)
+        each_tile = numpy.abs(each_tile.reshape((len(each_tile), -1)))
+
+        if ord == numpy.inf:
+            numpy.maximum(frames_norm, each_tile.max(axis=1), out=frames_norm)
+        elif ord == -numpy.inf:
+            numpy.minimum(frames_norm, each_tile.min(axis=1), out=frames_norm)
+        elif ord == 0:
+            frames_norm += (each_tile != 0).sum(axis=1)
+        else:
+            frames_norm += (each_tile ** ord).sum(axis=1)
+
+    if ord not in [numpy.inf, -numpy.inf, 0]:
+        frames_norm **= (1.0 / ord)
+
+    # Images that are all zero are left alone.
+    frames_norm[frames_norm == 0] = 1
+
+    # The max projection is only needed for debugging.
+    images_normalized_max = None
+    if preprocess_data_blocked.recorders.array_debug_recorder:
+        images_normalized_max = numpy.empty((1,) + shape[1:], dtype=out.dtype)
+
+    for each_tile_halo_slice, each_tile_slice, each_tile_halo_tile_slice in tile_slices:
+        each_tile = out[each_tile_slice]
+        each_tile -= frames_mean.reshape(frames_shape)
+        each_tile /= frames_norm.reshape(frames_shape)
+        out[each_tile_slice] = each_tile
+
+        if images_normalized_max is not None:
+            images_normalized_max[(slice(None),) + each_tile_slice[1:]] = each_tile.max(axis=0)
+
+    if images_normalized_max is not None:
+        preprocess_data_blocked.recorders.array_debug_recorder["images_normalized_max"] = images_normalized_max
+
+    return(out)
+
+
+@prof.log_call(logger)
+def convert_spams_trainDL_parameters(new_data_dtype, spams_parameters):
+    """
+        Finds the floating point type to run spams.trainDL with for the data. Also, converts NumPy types in the
+        parameters to the normal C types that SPAMS expects.
+
+        Args:
+            new_data_dtype(numpy.dtype):        type of the data for generating a dictionary.
+            spams_parameters(dict):             parameters for spams.trainDL.
+
+        Returns:
+            (numpy.dtype, dict):                the floating point type and the converted parameters.
+
+        Examples:
+            >>> convert_spams_trainDL_parameters(numpy.dtype(numpy.uint16), {"K" : numpy.int64(2)})
+            (dtype('float32'), {'K': 2})
+
+            >>> convert_spams_trainDL_parameters(numpy.dtype(numpy.float64), {"lambda1" : numpy.float32(0.5)})
+            (dtype('float64'), {'lambda1': 0.5})
+    """
 
     # Needs to be floating point.
     # However, it need not be double precision as there is single precision function signature.
     float_dtype = None
     float_ctype = None
-    if not issubclass(new_data.dtype.type, numpy.floating):
+    if not issubclass(new_data_dtype.type, numpy.floating):
         float_dtype = numpy.dtype(numpy.float32)
         float_ctype = ctypes.c_float
-    elif new_data.dtype.itemsize > numpy.dtype(numpy.float32).itemsize:
+    elif new_data_dtype.itemsize > numpy.dtype(numpy.float32).itemsize:
         float_dtype = numpy.dtype(numpy.float64)
         float_ctype = ctypes.c_double
     else:
@@ -528,7 +981,8 @@ def generate_dictionary(new_data, **parameters):
 
     # Want to support NumPy types in parameters. However, SPAMS expects normal C types. So, we convert them in advance.
     # This was needed for the Ilastik based GUI.
-    for _k, _v in parameters["spams.trainDL"].items():
+    spams_parameters = dict(spams_parameters)
+    for _k, _v in spams_parameters.items():
         _v = numpy.array(_v)[()] # Convert to NumPy type
         if isinstance(_v, numpy.integer):
             _v = int(_v)
@@ -537,29 +991,210 @@ def generate_dictionary(new_data, **parameters):
         elif isinstance(_v, numpy.bool_):
             _v = bool(_v)
 
-        parameters["spams.trainDL"][_k] = _v
+        spams_parameters[_k] = _v
+
+    return(float_dtype, spams_parameters)
+
+
+@prof.log_call(logger)
+def prepare_initial_dictionary(initial_dictionary, new_data, float_dtype):
+    """
+        Puts a dictionary to start spams.trainDL from in the form it needs. Namely, each atom is a unit length column
+        of a Fortran ordered matrix. Atoms that are all zero (e.g. cropped away from the dictionary of a neighboring
+        block) are replaced by randomly chosen frames of the data, as spams.trainDL does without a dictionary to start
+        from.
+
+        Args:
+            initial_dictionary(numpy.ndarray):  dictionary to start from (first axis is atoms).
+            new_data(numpy.ndarray):            data for generating a dictionary (first axis is time).
+            float_dtype(numpy.dtype):           floating point type spams.trainDL is run with.
+
+        Returns:
+            numpy.ndarray:                      the dictionary to give spams.trainDL.
+
+        Examples:
+            >>> prepare_initial_dictionary(numpy.array([[3, 4], [0, 0]]), numpy.array([[0, 2]]), numpy.float64)
+            array([[ 0.6,  0. ],
+                   [ 0.8,  1. ]])
+    """
+
+    initial_dictionary = numpy.array(initial_dictionary, dtype=float_dtype)
+    initial_dictionary = initial_dictionary.reshape((len(initial_dictionary), -1))
+
+    empty_atoms = (~(initial_dictionary != 0).any(axis=1)).nonzero()[0]
+    if len(empty_atoms):
+        empty_atoms_frames = numpy.random.choice(len(new_data),
+                                                 len(empty_atoms),
+                                                 replace=(len(empty_atoms) > len(new_data)))
+        for each_atom, each_frame in itertools.izip(empty_atoms, empty_atoms_frames):
+            initial_dictionary[each_atom] = numpy.asarray(new_data[int(each_frame)]).flat
+
+    initial_dictionary_norms = numpy.sqrt((initial_dictionary ** 2).sum(axis=1))
+    initial_dictionary_norms[initial_dictionary_norms == 0] = 1
+    initial_dictionary /= initial_dictionary_norms[:, None]
+
+    return(numpy.asfortranarray(initial_dictionary.T))
+
+
+@prof.log_call(logger)
+@hdf5.record.static_array_debug_recorder
+def generate_dictionary(new_data, initial_dictionary=None, **parameters):
+    """
+        Generates a dictionary using the data and parameters given for trainDL.
+        
+        Args:
+            new_data(numpy.ndarray):            array of data for generating a dictionary (first axis is time).
+            initial_dictionary(numpy.ndarray):  dictionary to start from (e.g. of a neighboring block or an earlier
+                                                session). Otherwise, spams.trainDL starts from random frames.
+            **parameters(dict):                 passed directly to spams.trainDL.
+        
+        Returns:
+            dict:                               the dictionary found.
+    """
+
+    import nanshe.box
+
+    float_dtype, spams_parameters = convert_spams_trainDL_parameters(new_data.dtype, parameters["spams.trainDL"])
 
-    # Requires floating point type.
-    new_data_processed = numpy.asarray(new_data, dtype=float_dtype)
+    # Each image is a column vector of a Fortran ordered matrix (as spams requires), which is the same memory as the
+    # images flattened in C order. So, the data is cast and written straight into shared memory. Then, the sandbox
+    # maps it without copying.
+    new_data_processed = nanshe.box.spams_sandbox.empty_shared_array(
+        (numpy.prod(new_data.shape[1:]), len(new_data)), float_dtype
+    )
 
-    # Reshape data into a matrix (each image is now a column vector)
-    new_data_processed = xnumpy.array_to_matrix(new_data_processed)
-    new_data_processed = numpy.asmatrix(new_data_processed)
-    new_data_processed = new_data_processed.transpose()
+    try:
+        new_data_processed.T[:] = xnumpy.array_to_matrix(new_data)
 
-    # Spams requires all matrices to be fortran.
-    new_data_processed = numpy.asfortranarray(new_data_processed)
+        if initial_dictionary is not None:
+            spams_parameters["D"] = prepare_initial_dictionary(initial_dictionary, new_data, float_dtype)
 
-    # Simply trains the dictionary. Does not return sparse code.
-    # Need to look into generating the sparse code given the dictionary, spams.nmf? (may be too slow))
-    new_dictionary = nanshe.box.spams_sandbox.call_multiprocessing_array_spams_trainDL(new_data_processed,
-                                                                                                 **parameters["spams.trainDL"])
+        # Simply trains the dictionary. Does not return sparse code.
+        # Need to look into generating the sparse code given the dictionary, spams.nmf? (may be too slow))
+        new_dictionary = nanshe.box.spams_sandbox.call_memmap_spams_trainDL(new_data_processed,
+                                                                            **spams_parameters)
+    finally:
+        nanshe.box.spams_sandbox.remove_shared_array(new_data_processed)
+        del new_data_processed
 
     # Fix dictionary so that the first index will be the particular image.
     # The rest will be the shape of an image (same as input shape).
     new_dictionary = new_dictionary.transpose()
     new_dictionary = numpy.asarray(new_dictionary, dtype=new_data.dtype.type)
-    new_dictionary = new_dictionary.reshape((parameters["spams.trainDL"]["K"],) + new_data.shape[1:])
+    new_dictionary = new_dictionary.reshape((spams_parameters["K"],) + new_data.shape[1:])
+
+    return(new_dictionary)
+
+
+@prof.log_call(logger)
+@hdf5.record.static_array_debug_recorder
+def generate_dictionary_streamed(new_data,
+                                 block_frame_length,
+                                 checkpoint = hdf5.record.EmptyArrayRecorder(),
+                                 initial_dictionary = None,
+                                 **parameters):
+    """
+        Generates a dictionary using the data and parameters given for trainDL. Unlike generate_dictionary, only
+        block_frame_length frames are in memory at a time. So, new_data may be a h5py.Dataset larger than memory.
+
+        Blocks of frames are taken in turn (wrapping around at the end). Each trains the dictionary further with
+        spams.trainDL (for as many iterations as it takes to go through the block once). The dictionary and the
+        sufficient statistics of the online learner (the model returned by spams.trainDL) are carried to the next
+        block and stored in checkpoint. If checkpoint already has these, learning resumes from them.
+
+        Args:
+            new_data(numpy.ndarray):            array of data for generating a dictionary (first axis is time).
+            block_frame_length(int):            number of frames to train with at a time.
+            checkpoint(HDF5ArrayRecorder):      where the state of learning is stored after each block.
+            initial_dictionary(numpy.ndarray):  dictionary to start from if there is nothing to resume (see
+                                                generate_dictionary).
+            **parameters(dict):                 passed directly to spams.trainDL (iter is the total number of
+                                                iterations over all blocks).
+
+        Returns:
+            dict:                               the dictionary found.
+    """
+
+    import nanshe.box
+
+    float_dtype, spams_parameters = convert_spams_trainDL_parameters(new_data.dtype, parameters["spams.trainDL"])
+
+    num_frames = len(new_data)
+    block_frame_length = min(block_frame_length, num_frames)
+    num_blocks = int(numpy.ceil(float(num_frames) / float(block_frame_length)))
+
+    num_iters = spams_parameters.pop("iter")
+    assert (num_iters > 0), "The number of iterations must be positive when streaming. " + \
+                            "Instead got \"" + repr(num_iters) + "\"."
+
+    batchsize = spams_parameters.get("batchsize", 256)
+    if batchsize <= 0:
+        batchsize = 256
+
+    # Restore the state of learning (if any).
+    new_dictionary = checkpoint.get("D", None)
+    model = None
+    num_iters_done = 0
+    block_index = 0
+    if new_dictionary is not None:
+        new_dictionary = numpy.asfortranarray(new_dictionary, dtype=float_dtype)
+        model = {
+            "A" : numpy.asfortranarray(checkpoint["A"], dtype=float_dtype),
+            "B" : numpy.asfortranarray(checkpoint["B"], dtype=float_dtype),
+            "iter" : int(checkpoint["iter"][0])
+        }
+        num_iters_done = int(checkpoint["num_iters_done"][0])
+        block_index = int(checkpoint["block_index"][0])
+
+        logger.info("Resuming dictionary learning after \"" + repr(num_iters_done) + "\" iterations.")
+    elif initial_dictionary is not None:
+        new_dictionary = prepare_initial_dictionary(initial_dictionary, new_data, float_dtype)
+
+    # Blocks of frames are written into the same shared memory that the sandbox maps.
+    new_data_block_processed = nanshe.box.spams_sandbox.empty_shared_array(
+        (numpy.prod(new_data.shape[1:]), block_frame_length), float_dtype
+    )
+
+    try:
+        while num_iters_done < num_iters:
+            block_start = block_index * block_frame_length
+            block_stop = min(block_start + block_frame_length, num_frames)
+
+            # The first columns of a Fortran ordered matrix are contiguous. So, short blocks are still fine for spams.
+            new_data_block = new_data_block_processed[:, :(block_stop - block_start)]
+            new_data_block.T[:] = xnumpy.array_to_matrix(new_data[block_start:block_stop])
+
+            block_num_iters = int(numpy.ceil(float(block_stop - block_start) / float(batchsize)))
+            block_num_iters = min(block_num_iters, num_iters - num_iters_done)
+
+            block_spams_parameters = dict(spams_parameters)
+            block_spams_parameters["iter"] = block_num_iters
+            block_spams_parameters["return_model"] = True
+            if new_dictionary is not None:
+                block_spams_parameters["D"] = new_dictionary
+                block_spams_parameters["model"] = model
+
+            new_dictionary, model = nanshe.box.spams_sandbox.call_memmap_spams_trainDL(new_data_block,
+                                                                                       **block_spams_parameters)
+
+            num_iters_done += block_num_iters
+            block_index = (block_index + 1) % num_blocks
+
+            checkpoint["D"] = new_dictionary
+            checkpoint["A"] = model["A"]
+            checkpoint["B"] = model["B"]
+            checkpoint["iter"] = numpy.array([model["iter"]])
+            checkpoint["num_iters_done"] = numpy.array([num_iters_done])
+            checkpoint["block_index"] = numpy.array([block_index])
+    finally:
+        nanshe.box.spams_sandbox.remove_shared_array(new_data_block_processed)
+        del new_data_block_processed
+
+    # Fix dictionary so that the first index will be the particular image.
+    # The rest will be the shape of an image (same as input shape).
+    new_dictionary = new_dictionary.transpose()
+    new_dictionary = numpy.asarray(new_dictionary, dtype=new_data.dtype.type)
+    new_dictionary = new_dictionary.reshape((spams_parameters["K"],) + new_data.shape[1:])
 
     return(new_dictionary)
 
@@ -1256,33 +1891,486 @@ def get_neuron_dtype(shape, dtype):
 
     """
 
-    ndim = len(shape)
+    ndim = len(shape)
+
+    neurons_dtype = [("mask", numpy.bool8, shape),
+                     ("contour", numpy.bool8, shape),
+                     ("image", numpy.dtype(dtype).type, shape),
+                     ("area", numpy.float64),
+                     ("max_F", numpy.float64),
+                     ("gaussian_mean", numpy.float64, (ndim,)),
+                     ("gaussian_cov", numpy.float64, (ndim, ndim,)),
+                     ("centroid", numpy.dtype(dtype).type, (ndim,))]
+
+    return(neurons_dtype)
+
+
+@prof.log_call(logger)
+def get_empty_neuron(shape, dtype):
+    """
+        Gets a numpy structured array using the type from get_neuron_dtype that has no contents.
+
+        Args:
+            new_image(numpy.ndarray):     an empty numpy structured array with all types needed for a neuron.
+
+        Returns:
+            numpy.ndarray:                a numpy structured array with no contents and type from get_neuron_dtype.
+
+        Examples:
+            >>> get_empty_neuron((3,), numpy.float64) #doctest: +NORMALIZE_WHITESPACE
+            array([], dtype=[('mask', '?', (3,)),
+                             ('contour', '?', (3,)),
+                             ('image', '<f8', (3,)),
+                             ('area', '<f8'),
+                             ('max_F', '<f8'),
+                             ('gaussian_mean', '<f8', (1,)),
+                             ('gaussian_cov', '<f8', (1, 1)),
+                             ('centroid', '<f8', (1,))])
+
+            >>> get_empty_neuron((2, 3), numpy.float64) #doctest: +NORMALIZE_WHITESPACE
+            array([], dtype=[('mask', '?', (2, 3)),
+                             ('contour', '?', (2, 3)),
+                             ('image', '<f8', (2, 3)),
+                             ('area', '<f8'),
+                             ('max_F', '<f8'),
+                             ('gaussian_mean', '<f8', (2,)),
+                             ('gaussian_cov', '<f8', (2, 2)),
+                             ('centroid', '<f8', (2,))])
+
+    """
+
+    neurons_dtype = get_neuron_dtype(shape=shape, dtype=dtype)
+    neurons = numpy.zeros((0,), dtype = neurons_dtype)
+
+    return(neurons)
+
+
+@prof.log_call(logger)
+def get_one_neuron(shape, dtype):
+    """
+        Gets a numpy structured array using the type from get_neuron_dtype that has one neuron with all zeros.
+
+        Args:
+            new_image(numpy.ndarray):     an empty numpy structured array with all types needed for a neuron.
+
+        Returns:
+            numpy.ndarray:                a numpy structured array with one neuron using type from get_neuron_dtype.
+
+        Examples:
+            >>> get_one_neuron((3,), numpy.float) #doctest: +NORMALIZE_WHITESPACE
+            array([ ([False, False, False],
+                     [False, False, False],
+                     [0.0, 0.0, 0.0],
+                     0.0,
+                     0.0,
+                     [0.0],
+                     [[0.0]],
+                     [0.0])],
+                   dtype=[('mask', '?', (3,)),
+                          ('contour', '?', (3,)),
+                          ('image', '<f8', (3,)),
+                          ('area', '<f8'),
+                          ('max_F', '<f8'),
+                          ('gaussian_mean', '<f8', (1,)),
+                          ('gaussian_cov', '<f8', (1, 1)),
+                          ('centroid', '<f8', (1,))])
+
+
+            >>> get_one_neuron((2, 3), numpy.float) #doctest: +NORMALIZE_WHITESPACE
+            array([ ([[False, False, False],
+                      [False, False, False]],
+                     [[False, False, False],
+                      [False, False, False]],
+                     [[0.0, 0.0, 0.0],
+                      [0.0, 0.0, 0.0]],
+                     0.0,
+                     0.0,
+                     [0.0, 0.0],
+                    [[0.0, 0.0],
+                     [0.0, 0.0]],
+                    [0.0, 0.0])],
+                   dtype=[('mask', '?', (2, 3)),
+                          ('contour', '?', (2, 3)),
+                          ('image', '<f8', (2, 3)),
+                          ('area', '<f8'),
+                          ('max_F', '<f8'),
+                          ('gaussian_mean', '<f8', (2,)),
+                          ('gaussian_cov', '<f8', (2, 2)),
+                          ('centroid', '<f8', (2,))])
+    """
+
+    neurons_dtype = get_neuron_dtype(shape=shape, dtype=dtype)
+    neurons = numpy.zeros((1,), dtype = neurons_dtype)
+
+    return(neurons)
+
+
+@prof.log_call(logger)
+def get_sparse_neuron_dtype(ndim, dtype):
+    """
+        Gets the type of each neuron in a SparseNeuronSet. This matches get_neuron_dtype except the full frame mask,
+        contour, and image are replaced by a bounding box and a range of pixels (in SparseNeuronSet.pixels).
+
+        Args:
+            ndim(int):                    number of spatial dimensions.
+            dtype(type):                  type of the image.
+
+        Returns:
+            list:                         a list that can be converted to a numpy.dtype using numpy.ndtype's constructor.
+
+        Examples:
+            >>> get_sparse_neuron_dtype(2, numpy.float64) #doctest: +NORMALIZE_WHITESPACE
+            [('bounding_box', <type 'numpy.int64'>, (2, 2)),
+             ('pixels_start', <type 'numpy.int64'>),
+             ('pixels_stop', <type 'numpy.int64'>),
+             ('area', <type 'numpy.float64'>),
+             ('max_F', <type 'numpy.float64'>),
+             ('gaussian_mean', <type 'numpy.float64'>, (2,)),
+             ('gaussian_cov', <type 'numpy.float64'>, (2, 2)),
+             ('centroid', <type 'numpy.float64'>, (2,))]
+    """
+
+    neurons_dtype = [("bounding_box", numpy.int64, (2, ndim,)),
+                     ("pixels_start", numpy.int64),
+                     ("pixels_stop", numpy.int64),
+                     ("area", numpy.float64),
+                     ("max_F", numpy.float64),
+                     ("gaussian_mean", numpy.float64, (ndim,)),
+                     ("gaussian_cov", numpy.float64, (ndim, ndim,)),
+                     ("centroid", numpy.dtype(dtype).type, (ndim,))]
+
+    return(neurons_dtype)
+
+
+@prof.log_call(logger)
+def get_sparse_neuron_pixel_dtype(ndim, dtype):
+    """
+        Gets the type of each pixel in a SparseNeuronSet.
+
+        Args:
+            ndim(int):                    number of spatial dimensions.
+            dtype(type):                  type of the image.
+
+        Returns:
+            list:                         a list that can be converted to a numpy.dtype using numpy.ndtype's constructor.
+
+        Examples:
+            >>> get_sparse_neuron_pixel_dtype(2, numpy.float64) #doctest: +NORMALIZE_WHITESPACE
+            [('index', <type 'numpy.int64'>, (2,)),
+             ('mask', <type 'numpy.bool_'>),
+             ('contour', <type 'numpy.bool_'>),
+             ('image', <type 'numpy.float64'>)]
+    """
+
+    pixels_dtype = [("index", numpy.int64, (ndim,)),
+                    ("mask", numpy.bool8),
+                    ("contour", numpy.bool8),
+                    ("image", numpy.dtype(dtype).type)]
+
+    return(pixels_dtype)
+
+
+@prof.log_class(logger)
+class SparseNeuronSet(object):
+    """
+        A compact alternative to a structured array of neurons (dtype get_neuron_dtype). Instead of full frame mask,
+        contour, and image fields, each neuron has a bounding box and a range of rows (pixels_start to pixels_stop)
+        in a table with the position, mask, contour, and image value of each of its pixels (similar to CSR).
+
+        Selecting neurons (e.g. new_sparse_neurons[[0, 2]]) behaves like NumPy except the result is always a
+        SparseNeuronSet (even for a single index). Assigning to neurons drops the pixels of the neurons replaced.
+    """
+
+    def __init__(self, shape, neurons, pixels):
+        """
+            Constructs a SparseNeuronSet from its parts.
+
+            Args:
+                shape(tuple):                   shape of a frame.
+                neurons(numpy.ndarray):         structured array of neurons (dtype get_sparse_neuron_dtype).
+                pixels(numpy.ndarray):          structured array of pixels (dtype get_sparse_neuron_pixel_dtype).
+        """
+
+        self.shape = tuple(shape)
+        self.neurons = neurons
+        self.pixels = pixels
+
+    @property
+    def ndim(self):
+        return(len(self.shape))
+
+    @property
+    def dtype(self):
+        return(self.pixels.dtype["image"])
+
+    @property
+    def size(self):
+        return(len(self.neurons))
+
+    def __len__(self):
+        return(len(self.neurons))
+
+    def __array__(self, dtype=None):
+        new_neurons = densify_neurons(self)
+
+        if dtype is not None:
+            new_neurons = new_neurons.astype(dtype)
+
+        return(new_neurons)
+
+    def get_neuron_indices(self, index):
+        """
+            Gets the indices of the neurons selected.
+
+            Args:
+                index(int, slice, or array):    anything NumPy accepts to index a 1-D array.
+
+            Returns:
+                numpy.ndarray:                  1-D array of selected neuron indices.
+        """
+
+        return(numpy.atleast_1d(numpy.arange(len(self))[index]))
+
+    def get_pixel_owners(self):
+        """
+            Gets which neuron owns each pixel (-1 if unused).
+
+            Returns:
+                numpy.ndarray:                  the neuron index of each pixel.
+        """
+
+        pixel_owners = -numpy.ones((len(self.pixels),), dtype=numpy.int64)
+        for i, (each_start, each_stop) in enumerate(itertools.izip(self.neurons["pixels_start"],
+                                                                   self.neurons["pixels_stop"])):
+            pixel_owners[each_start:each_stop] = i
+
+        return(pixel_owners)
+
+    def __getitem__(self, index):
+        neuron_indices = self.get_neuron_indices(index)
+
+        new_neurons = self.neurons[neuron_indices]
+
+        # Gather the pixels of the neurons selected so that they are contiguous and in order.
+        pixels_count = new_neurons["pixels_stop"] - new_neurons["pixels_start"]
+        pixels_new_stop = numpy.cumsum(pixels_count)
+        pixels_new_start = pixels_new_stop - pixels_count
+
+        pixel_indices = numpy.arange(pixels_count.sum())
+        pixel_indices += numpy.repeat(new_neurons["pixels_start"] - pixels_new_start, pixels_count)
+
+        new_pixels = self.pixels[pixel_indices]
+
+        new_neurons["pixels_start"] = pixels_new_start
+        new_neurons["pixels_stop"] = pixels_new_stop
+
+        return(SparseNeuronSet(self.shape, new_neurons, new_pixels))
+
+    def __setitem__(self, index, value):
+        neuron_indices = self.get_neuron_indices(index)
+
+        assert isinstance(value, SparseNeuronSet)
+        assert (value.shape == self.shape)
+        assert (len(value) == len(neuron_indices))
+
+        value = value.copy()
+
+        # Only the pixels of the neurons that are not replaced are kept. The new pixels follow them.
+        neurons_kept = numpy.ones((len(self),), dtype=bool)
+        neurons_kept[neuron_indices] = False
+        neurons_kept = neurons_kept.nonzero()[0]
+
+        kept = self[neurons_kept]
+
+        new_neurons = value.neurons
+        new_neurons["pixels_start"] += len(kept.pixels)
+        new_neurons["pixels_stop"] += len(kept.pixels)
+
+        self.pixels = numpy.concatenate([kept.pixels, value.pixels.astype(self.pixels.dtype)])
+        self.neurons[neurons_kept] = kept.neurons
+        self.neurons[neuron_indices] = new_neurons
+
+    def copy(self):
+        """
+            Copies all neurons (only keeping the pixels they use).
+
+            Returns:
+                SparseNeuronSet:                the copy.
+        """
+
+        return(self[:])
+
+    def crop(self, index, field, bounding_box):
+        """
+            Gets a field of a neuron as a dense array over a bounding box (e.g. the intersection of two neurons).
+
+            Args:
+                index(int):                     which neuron.
+                field(str):                     one of mask, contour, or image.
+                bounding_box(numpy.ndarray):    lower (inclusive) and upper (exclusive) bounds of the region.
+
+            Returns:
+                numpy.ndarray:                  the field of the neuron in the region.
+        """
+
+        bounding_box = numpy.asarray(bounding_box)
+
+        each_neuron = self.neurons[index]
+        each_pixels = self.pixels[each_neuron["pixels_start"]:each_neuron["pixels_stop"]]
+
+        each_pixels_inside = ((bounding_box[0] <= each_pixels["index"]) &
+                              (each_pixels["index"] < bounding_box[1])).all(axis=1)
+        each_pixels = each_pixels[each_pixels_inside]
+
+        cropped = numpy.zeros(tuple(bounding_box[1] - bounding_box[0]), dtype=each_pixels.dtype[field])
+        cropped[tuple((each_pixels["index"] - bounding_box[0]).T)] = each_pixels[field]
+
+        return(cropped)
+
+    def astype(self, dtype):
+        """
+            Copies all neurons with a different type for the image (and centroid).
+
+            Args:
+                dtype(type):                    type of the image.
+
+            Returns:
+                SparseNeuronSet:                the converted neurons.
+        """
+
+        new_sparse_neurons = self.copy()
+
+        new_sparse_neurons.neurons = new_sparse_neurons.neurons.astype(
+            get_sparse_neuron_dtype(ndim=self.ndim, dtype=dtype)
+        )
+        new_sparse_neurons.pixels = new_sparse_neurons.pixels.astype(
+            get_sparse_neuron_pixel_dtype(ndim=self.ndim, dtype=dtype)
+        )
+
+        return(new_sparse_neurons)
+
+    def translate(self, offset, shape):
+        """
+            Moves all neurons to a new position in a (possibly) larger frame. Only the pixels and bounding boxes
+            are moved. Other properties are left as is.
+
+            Args:
+                offset(tuple):                  position of this frame within the new frame.
+                shape(tuple):                   shape of the new frame.
+
+            Returns:
+                SparseNeuronSet:                the translated neurons.
+        """
+
+        offset = numpy.array(offset, dtype=numpy.int64)
+
+        assert (len(offset) == len(shape) == self.ndim)
+        assert ((offset >= 0).all() and ((offset + self.shape) <= shape).all())
+
+        new_sparse_neurons = self.copy()
+        new_sparse_neurons.shape = tuple(shape)
+
+        new_sparse_neurons.pixels["index"] += offset
+        new_sparse_neurons.neurons["bounding_box"] += offset
+
+        return(new_sparse_neurons)
+
+
+@prof.log_call(logger)
+def get_empty_sparse_neurons(shape, dtype):
+    """
+        Gets a SparseNeuronSet that has no neurons.
+
+        Args:
+            shape(tuple):                 shape of a frame.
+            dtype(type):                  type of the image.
+
+        Returns:
+            SparseNeuronSet:              a SparseNeuronSet with no neurons.
+
+        Examples:
+            >>> len(get_empty_sparse_neurons((2, 3), numpy.float64))
+            0
+    """
+
+    return(SparseNeuronSet(shape,
+                           numpy.zeros((0,), dtype=get_sparse_neuron_dtype(ndim=len(shape), dtype=dtype)),
+                           numpy.zeros((0,), dtype=get_sparse_neuron_pixel_dtype(ndim=len(shape), dtype=dtype))))
+
+
+@prof.log_call(logger)
+def sparsify_neurons(new_neurons):
+    """
+        Converts a structured array of neurons (dtype get_neuron_dtype) to a SparseNeuronSet. Only pixels in the
+        mask, contour, or image are kept.
+
+        Args:
+            new_neurons(numpy.ndarray):   neurons with full frame fields (dtype get_neuron_dtype).
+
+        Returns:
+            SparseNeuronSet:              the same neurons.
+
+        Examples:
+            >>> a = get_one_neuron((2, 3), numpy.float64)
+            >>> a["mask"][0, 0, 1:] = True; a["image"][0, 0, 1:] = [1, 2]; a["area"] = 2
+            >>> b = sparsify_neurons(a)
+            >>> b.neurons["bounding_box"]
+            array([[[0, 1],
+                    [1, 3]]])
+            >>> b.pixels["index"]
+            array([[0, 1],
+                   [0, 2]])
+            >>> b.pixels["image"]
+            array([ 1.,  2.])
+            >>> (densify_neurons(b) == a).all()
+            True
+    """
+
+    shape = new_neurons["mask"].shape[1:]
+    dtype = new_neurons["image"].dtype
 
-    neurons_dtype = [("mask", numpy.bool8, shape),
-                     ("contour", numpy.bool8, shape),
-                     ("image", numpy.dtype(dtype).type, shape),
-                     ("area", numpy.float64),
-                     ("max_F", numpy.float64),
-                     ("gaussian_mean", numpy.float64, (ndim,)),
-                     ("gaussian_cov", numpy.float64, (ndim, ndim,)),
-                     ("centroid", numpy.dtype(dtype).type, (ndim,))]
+    new_neurons_support = new_neurons["mask"] | new_neurons["contour"] | (new_neurons["image"] != 0)
 
-    return(neurons_dtype)
+    new_sparse_neurons = get_empty_sparse_neurons(shape=shape, dtype=dtype)
+    new_sparse_neurons.neurons = numpy.zeros((len(new_neurons),), dtype=new_sparse_neurons.neurons.dtype)
+
+    for each_name in ["area", "max_F", "gaussian_mean", "gaussian_cov", "centroid"]:
+        new_sparse_neurons.neurons[each_name] = new_neurons[each_name]
+
+    new_sparse_neurons.neurons["bounding_box"] = xnumpy.masks_bounding_boxes(new_neurons_support)
+
+    # Points are in C order. So, the pixels of each neuron are already contiguous and in order.
+    new_neurons_support_points = new_neurons_support.nonzero()
+
+    pixels_count = numpy.bincount(new_neurons_support_points[0], minlength=len(new_neurons))
+    new_sparse_neurons.neurons["pixels_stop"] = numpy.cumsum(pixels_count)
+    new_sparse_neurons.neurons["pixels_start"] = new_sparse_neurons.neurons["pixels_stop"] - pixels_count
+
+    new_sparse_neurons.pixels = numpy.zeros((len(new_neurons_support_points[0]),),
+                                            dtype=new_sparse_neurons.pixels.dtype)
+    new_sparse_neurons.pixels["index"] = numpy.array(new_neurons_support_points[1:], dtype=numpy.int64).T.reshape(
+        (-1, len(shape))
+    )
+    new_sparse_neurons.pixels["mask"] = new_neurons["mask"][new_neurons_support_points]
+    new_sparse_neurons.pixels["contour"] = new_neurons["contour"][new_neurons_support_points]
+    new_sparse_neurons.pixels["image"] = new_neurons["image"][new_neurons_support_points]
+
+    return(new_sparse_neurons)
 
 
 @prof.log_call(logger)
-def get_empty_neuron(shape, dtype):
+def densify_neurons(new_sparse_neurons):
     """
-        Gets a numpy structured array using the type from get_neuron_dtype that has no contents.
+        Converts a SparseNeuronSet to a structured array of neurons (dtype get_neuron_dtype).
 
         Args:
-            new_image(numpy.ndarray):     an empty numpy structured array with all types needed for a neuron.
+            new_sparse_neurons(SparseNeuronSet):    the neurons to convert.
 
         Returns:
-            numpy.ndarray:                a numpy structured array with no contents and type from get_neuron_dtype.
+            numpy.ndarray:                          the same neurons with full frame fields (dtype get_neuron_dtype).
 
         Examples:
-            >>> get_empty_neuron((3,), numpy.float64) #doctest: +NORMALIZE_WHITESPACE
+            >>> densify_neurons(get_empty_sparse_neurons((3,), numpy.float64)) #doctest: +NORMALIZE_WHITESPACE
             array([], dtype=[('mask', '?', (3,)),
                              ('contour', '?', (3,)),
                              ('image', '<f8', (3,)),
@@ -1291,83 +2379,130 @@ def get_empty_neuron(shape, dtype):
                              ('gaussian_mean', '<f8', (1,)),
                              ('gaussian_cov', '<f8', (1, 1)),
                              ('centroid', '<f8', (1,))])
+    """
 
-            >>> get_empty_neuron((2, 3), numpy.float64) #doctest: +NORMALIZE_WHITESPACE
-            array([], dtype=[('mask', '?', (2, 3)),
-                             ('contour', '?', (2, 3)),
-                             ('image', '<f8', (2, 3)),
-                             ('area', '<f8'),
-                             ('max_F', '<f8'),
-                             ('gaussian_mean', '<f8', (2,)),
-                             ('gaussian_cov', '<f8', (2, 2)),
-                             ('centroid', '<f8', (2,))])
+    new_sparse_neurons = new_sparse_neurons.copy()
 
-    """
+    new_neurons = numpy.zeros(
+        (len(new_sparse_neurons),),
+        dtype=get_neuron_dtype(shape=new_sparse_neurons.shape, dtype=new_sparse_neurons.dtype)
+    )
 
-    neurons_dtype = get_neuron_dtype(shape=shape, dtype=dtype)
-    neurons = numpy.zeros((0,), dtype = neurons_dtype)
+    for each_name in ["area", "max_F", "gaussian_mean", "gaussian_cov", "centroid"]:
+        new_neurons[each_name] = new_sparse_neurons.neurons[each_name]
 
-    return(neurons)
+    new_neurons_points = (new_sparse_neurons.get_pixel_owners(),) + tuple(new_sparse_neurons.pixels["index"].T)
+
+    new_neurons["mask"][new_neurons_points] = new_sparse_neurons.pixels["mask"]
+    new_neurons["contour"][new_neurons_points] = new_sparse_neurons.pixels["contour"]
+    new_neurons["image"][new_neurons_points] = new_sparse_neurons.pixels["image"]
+
+    return(new_neurons)
 
 
 @prof.log_call(logger)
-def get_one_neuron(shape, dtype):
+def concatenate_sparse_neurons(new_sparse_neurons_sets):
     """
-        Gets a numpy structured array using the type from get_neuron_dtype that has one neuron with all zeros.
+        Joins several SparseNeuronSets into one (like numpy.hstack for neurons).
 
         Args:
-            new_image(numpy.ndarray):     an empty numpy structured array with all types needed for a neuron.
+            new_sparse_neurons_sets(list):          SparseNeuronSets with the same frame shape and type.
 
         Returns:
-            numpy.ndarray:                a numpy structured array with one neuron using type from get_neuron_dtype.
+            SparseNeuronSet:                        all of the neurons in the order given.
+    """
 
-        Examples:
-            >>> get_one_neuron((3,), numpy.float) #doctest: +NORMALIZE_WHITESPACE
-            array([ ([False, False, False],
-                     [False, False, False],
-                     [0.0, 0.0, 0.0],
-                     0.0,
-                     0.0,
-                     [0.0],
-                     [[0.0]],
-                     [0.0])],
-                   dtype=[('mask', '?', (3,)),
-                          ('contour', '?', (3,)),
-                          ('image', '<f8', (3,)),
-                          ('area', '<f8'),
-                          ('max_F', '<f8'),
-                          ('gaussian_mean', '<f8', (1,)),
-                          ('gaussian_cov', '<f8', (1, 1)),
-                          ('centroid', '<f8', (1,))])
+    new_sparse_neurons_sets = [_.copy() for _ in new_sparse_neurons_sets]
 
+    assert len(new_sparse_neurons_sets)
+    assert all([(_.shape == new_sparse_neurons_sets[0].shape) for _ in new_sparse_neurons_sets])
 
-            >>> get_one_neuron((2, 3), numpy.float) #doctest: +NORMALIZE_WHITESPACE
-            array([ ([[False, False, False],
-                      [False, False, False]],
-                     [[False, False, False],
-                      [False, False, False]],
-                     [[0.0, 0.0, 0.0],
-                      [0.0, 0.0, 0.0]],
-                     0.0,
-                     0.0,
-                     [0.0, 0.0],
-                    [[0.0, 0.0],
-                     [0.0, 0.0]],
-                    [0.0, 0.0])],
-                   dtype=[('mask', '?', (2, 3)),
-                          ('contour', '?', (2, 3)),
-                          ('image', '<f8', (2, 3)),
-                          ('area', '<f8'),
-                          ('max_F', '<f8'),
-                          ('gaussian_mean', '<f8', (2,)),
-                          ('gaussian_cov', '<f8', (2, 2)),
-                          ('centroid', '<f8', (2,))])
+    pixels_offsets = numpy.cumsum([0] + [len(_.pixels) for _ in new_sparse_neurons_sets[:-1]])
+    for each_pixels_offset, each_sparse_neurons in itertools.izip(pixels_offsets, new_sparse_neurons_sets):
+        each_sparse_neurons.neurons["pixels_start"] += each_pixels_offset
+        each_sparse_neurons.neurons["pixels_stop"] += each_pixels_offset
+
+    return(SparseNeuronSet(new_sparse_neurons_sets[0].shape,
+                           numpy.concatenate([_.neurons for _ in new_sparse_neurons_sets]),
+                           numpy.concatenate([_.pixels for _ in new_sparse_neurons_sets])))
+
+
+@prof.log_call(logger)
+def sparse_neurons_from_crops(shape, dtype, new_image_crops, neuron_mask_crops, bounding_boxes):
     """
+        Creates a SparseNeuronSet from the image and mask of each neuron within its bounding box. Computes all
+        properties the same as extract_neurons would with full frames.
 
-    neurons_dtype = get_neuron_dtype(shape=shape, dtype=dtype)
-    neurons = numpy.zeros((1,), dtype = neurons_dtype)
+        Args:
+            shape(tuple):                           shape of a frame.
+            dtype(type):                            type of the image.
+            new_image_crops(list):                  image within the bounding box of each neuron.
+            neuron_mask_crops(list):                mask within the bounding box of each neuron.
+            bounding_boxes(numpy.ndarray):          bounding box of each neuron (as from masks_bounding_boxes).
 
-    return(neurons)
+        Returns:
+            SparseNeuronSet:                        the neurons.
+    """
+
+    shape = numpy.array(shape, dtype=numpy.int64)
+
+    new_sparse_neurons_sets = []
+    for each_image_crop, each_mask_crop, each_bounding_box in itertools.izip(new_image_crops,
+                                                                            neuron_mask_crops,
+                                                                            bounding_boxes):
+        each_mask_crop = (each_mask_crop != 0)
+        each_image_crop = (each_image_crop * each_mask_crop).astype(dtype)
+
+        # Padding with one background pixel (unless at the edge of the frame) gives the same contour as a full frame.
+        each_padding = numpy.array([numpy.minimum(each_bounding_box[0], 1),
+                                    numpy.minimum(shape - each_bounding_box[1], 1)]).T
+        each_contour_crop = xnumpy.generate_contour(numpy.pad(each_mask_crop, each_padding, mode="constant"))
+        each_contour_crop = each_contour_crop[tuple(slice(_1, _1 + _2) for _1, _2 in itertools.izip(
+            each_padding[:, 0], each_mask_crop.shape
+        ))]
+
+        each_support_crop = each_mask_crop | each_contour_crop | (each_image_crop != 0)
+        each_support_points = numpy.array(each_support_crop.nonzero(), dtype=numpy.int64)
+
+        each_sparse_neuron = get_empty_sparse_neurons(shape=tuple(shape), dtype=dtype)
+        each_sparse_neuron.neurons = numpy.zeros((1,), dtype=each_sparse_neuron.neurons.dtype)
+        each_sparse_neuron.pixels = numpy.zeros((each_support_points.shape[1],),
+                                                dtype=each_sparse_neuron.pixels.dtype)
+
+        each_sparse_neuron.pixels["index"] = (each_support_points + each_bounding_box[0][:, None]).T
+        each_sparse_neuron.pixels["mask"] = each_mask_crop[tuple(each_support_points)]
+        each_sparse_neuron.pixels["contour"] = each_contour_crop[tuple(each_support_points)]
+        each_sparse_neuron.pixels["image"] = each_image_crop[tuple(each_support_points)]
+
+        each_sparse_neuron.neurons["pixels_stop"] = len(each_sparse_neuron.pixels)
+
+        if each_support_points.size:
+            each_sparse_neuron.neurons["bounding_box"] = numpy.array([
+                each_sparse_neuron.pixels["index"].min(axis=0), each_sparse_neuron.pixels["index"].max(axis=0) + 1
+            ])
+
+        each_sparse_neuron.neurons["area"] = each_mask_crop.sum()
+
+        # Pixels outside of the mask count as zero (as with full frames).
+        each_sparse_neuron.neurons["max_F"] = each_image_crop.max() if each_image_crop.size else 0
+        if each_sparse_neuron.neurons["area"] < shape.prod():
+            each_sparse_neuron.neurons["max_F"] = numpy.maximum(each_sparse_neuron.neurons["max_F"], 0)
+
+        new_sparse_neurons_sets.append(each_sparse_neuron)
+
+    if not new_sparse_neurons_sets:
+        return(get_empty_sparse_neurons(shape=tuple(shape), dtype=dtype))
+
+    new_sparse_neurons = concatenate_sparse_neurons(new_sparse_neurons_sets)
+
+    new_sparse_neurons_mask_pixels = new_sparse_neurons.pixels["mask"]
+    new_sparse_neurons.neurons["gaussian_mean"], new_sparse_neurons.neurons["gaussian_cov"] = \
+        xnumpy.grouped_mean_and_covariance(new_sparse_neurons.get_pixel_owners()[new_sparse_neurons_mask_pixels],
+                                           new_sparse_neurons.pixels["index"][new_sparse_neurons_mask_pixels].T,
+                                           len(new_sparse_neurons))
+    new_sparse_neurons.neurons["centroid"] = new_sparse_neurons.neurons["gaussian_mean"]
+
+    return(new_sparse_neurons)
 
 
 @prof.log_call(logger)
@@ -1601,7 +2736,7 @@ class ExtendedRegionProps(object):
 
             ExtendedRegionProps.recorders.array_debug_recorder["count"] = self.count
             ExtendedRegionProps.recorders.array_debug_recorder["masks"] = \
-                xnumpy.all_permutations_equal(failed_labels, self.label_image)
+                hdf5.record.DeferredArray(xnumpy.all_permutations_equal, failed_labels, self.label_image)
             ExtendedRegionProps.recorders.array_debug_recorder["masks_labels"] = failed_labels
 
             # Renumber labels. This way there are no labels without local maxima.
@@ -1860,6 +2995,7 @@ def remove_too_close_local_maxima(local_maxima, min_local_max_distance, **parame
 def wavelet_denoising(new_image,
                       accepted_region_shape_constraints,
                       accepted_neuron_shape_constraints,
+                      sparse = False,
                       **parameters):
     """
         Performs wavelet denoising on the given dictionary.
@@ -1875,13 +3011,18 @@ def wavelet_denoising(new_image,
                                                         region_properties) under this should be a dictionary that
                                                         contains the keys min and/or max with a value for each.
 
+            sparse(bool):                               whether to return a SparseNeuronSet instead.
+
             **parameters(dict):                         additional parameters for various other function calls.
         
         Returns:
             numpy.ndarray:                              a structured array of candidate neurons.
     """
 
-    neurons = get_empty_neuron(shape=new_image.shape, dtype=new_image.dtype)
+    if sparse:
+        neurons = get_empty_sparse_neurons(shape=new_image.shape, dtype=new_image.dtype)
+    else:
+        neurons = get_empty_neuron(shape=new_image.shape, dtype=new_image.dtype)
 
     new_wavelet_image_denoised_segmentation = None
 
@@ -2009,19 +3150,19 @@ def wavelet_denoising(new_image,
 
         wavelet_denoising.recorders.array_debug_recorder["local_maxima_label_image"] = local_maxima.label_image[None]
         wavelet_denoising.recorders.array_debug_recorder["local_maxima_label_image_contours"] = \
-            xnumpy.generate_labeled_contours(local_maxima.label_image > 0)[None]
+            hdf5.record.DeferredArray(lambda: xnumpy.generate_labeled_contours(local_maxima.label_image > 0)[None])
 
         local_maxima = remove_low_intensity_local_maxima(local_maxima, **parameters["remove_low_intensity_local_maxima"])
 
         wavelet_denoising.recorders.array_debug_recorder["local_maxima_label_image"] = local_maxima.label_image[None]
         wavelet_denoising.recorders.array_debug_recorder["local_maxima_label_image_contours"] = \
-            xnumpy.generate_labeled_contours(local_maxima.label_image > 0)[None]
+            hdf5.record.DeferredArray(lambda: xnumpy.generate_labeled_contours(local_maxima.label_image > 0)[None])
 
         local_maxima = remove_too_close_local_maxima(local_maxima, **parameters["remove_too_close_local_maxima"])
 
         wavelet_denoising.recorders.array_debug_recorder["local_maxima_label_image"] = local_maxima.label_image[None]
         wavelet_denoising.recorders.array_debug_recorder["local_maxima_label_image_contours"] = \
-            xnumpy.generate_labeled_contours(local_maxima.label_image > 0)[None]
+            hdf5.record.DeferredArray(lambda: xnumpy.generate_labeled_contours(local_maxima.label_image > 0)[None])
 
         if local_maxima.props.size:
             logger.debug("Entering watershed segmentation.")
@@ -2045,7 +3186,7 @@ def wavelet_denoising(new_image,
             wavelet_denoising.recorders.array_debug_recorder["watershed_segmentation"] = \
                 new_wavelet_image_denoised_segmentation[None]
             wavelet_denoising.recorders.array_debug_recorder["watershed_segmentation_contours"] = \
-                xnumpy.generate_labeled_contours(new_wavelet_image_denoised_segmentation)[None]
+                hdf5.record.DeferredArray(lambda: xnumpy.generate_labeled_contours(new_wavelet_image_denoised_segmentation)[None])
 
             watershed_local_maxima = ExtendedRegionProps(local_maxima.intensity_image,
                                                          new_wavelet_image_denoised_segmentation,
@@ -2054,7 +3195,7 @@ def wavelet_denoising(new_image,
             wavelet_denoising.recorders.array_debug_recorder["watershed_local_maxima_label_image"] = \
                 watershed_local_maxima.label_image[None]
             wavelet_denoising.recorders.array_debug_recorder["watershed_local_maxima_label_image_contours"] = \
-                xnumpy.generate_labeled_contours(watershed_local_maxima.label_image > 0)[None]
+                hdf5.record.DeferredArray(lambda: xnumpy.generate_labeled_contours(watershed_local_maxima.label_image > 0)[None])
 
             wavelet_denoising.recorders.array_debug_recorder["watershed_local_maxima_props"] = watershed_local_maxima.props
             wavelet_denoising.recorders.array_debug_recorder["watershed_local_maxima_count"] = watershed_local_maxima.count
@@ -2070,7 +3211,7 @@ def wavelet_denoising(new_image,
             wavelet_denoising.recorders.array_debug_recorder["watershed_local_maxima_label_image"] = \
                 watershed_local_maxima.label_image[None]
             wavelet_denoising.recorders.array_debug_recorder["watershed_local_maxima_label_image_contours"] = \
-                xnumpy.generate_labeled_contours(watershed_local_maxima.label_image > 0)[None]
+                hdf5.record.DeferredArray(lambda: xnumpy.generate_labeled_contours(watershed_local_maxima.label_image > 0)[None])
 
             if watershed_local_maxima.props.size:
                 wavelet_denoising.recorders.array_debug_recorder["watershed_local_maxima_props"] = watershed_local_maxima.props
@@ -2109,14 +3250,41 @@ def wavelet_denoising(new_image,
             wavelet_denoising.recorders.array_debug_recorder["watershed_local_maxima_label_image"] = \
                 watershed_local_maxima.label_image[None]
             wavelet_denoising.recorders.array_debug_recorder["watershed_local_maxima_label_image_contours"] = \
-                               xnumpy.generate_labeled_contours(watershed_local_maxima.label_image > 0)[None]
+                               hdf5.record.DeferredArray(lambda: xnumpy.generate_labeled_contours(watershed_local_maxima.label_image > 0)[None])
 
             if watershed_local_maxima.props.size:
                 wavelet_denoising.recorders.array_debug_recorder["watershed_local_maxima_props"] = watershed_local_maxima.props
             if watershed_local_maxima.count.size:
                 wavelet_denoising.recorders.array_debug_recorder["watershed_local_maxima_count"] = watershed_local_maxima.count
 
-            if watershed_local_maxima.props.size:
+            if watershed_local_maxima.props.size and sparse:
+                # Only the region around each label is needed.
+                watershed_local_maxima_label_slices = scipy.ndimage.find_objects(watershed_local_maxima.label_image)
+                watershed_local_maxima_label_slices = [
+                    watershed_local_maxima_label_slices[_ - 1] for _ in watershed_local_maxima.props["label"]
+                ]
+
+                neurons = sparse_neurons_from_crops(
+                    new_image.shape,
+                    new_image.dtype,
+                    [new_image[_] for _ in watershed_local_maxima_label_slices],
+                    [(watershed_local_maxima.label_image[_2] == _1) for _1, _2 in itertools.izip(
+                        watershed_local_maxima.props["label"], watershed_local_maxima_label_slices
+                    )],
+                    [numpy.array([[_.start for _ in _2], [_.stop for _ in _2]])
+                     for _2 in watershed_local_maxima_label_slices]
+                )
+
+                neurons.neurons["area"] = watershed_local_maxima.props["area"]
+                neurons.neurons["centroid"] = watershed_local_maxima.props["centroid"]
+
+                if len(neurons) > 1:
+                    logger.debug("Extracted neurons. Found " + str(len(neurons)) + " neurons.")
+                else:
+                    logger.debug("Extracted a neuron. Found " + str(len(neurons)) + " neuron.")
+
+                wavelet_denoising.recorders.array_debug_recorder["new_neuron_set"] = neurons
+            elif watershed_local_maxima.props.size:
                 # Creates a NumPy structure array to store
                 neurons = numpy.zeros(len(watershed_local_maxima.props), dtype = neurons.dtype)
 
@@ -2130,12 +3298,8 @@ def wavelet_denoising(new_image,
 
                 neurons["max_F"] = xnumpy.array_to_matrix(neurons["image"]).max(axis = 1)
 
-                for i in xrange(len(neurons)):
-                    neuron_mask_i_points = numpy.array(neurons["mask"][i].nonzero())
-
-                    neurons["contour"][i] = xnumpy.generate_contour(neurons["mask"][i])
-                    neurons["gaussian_mean"][i] = neuron_mask_i_points.mean(axis = 1)
-                    neurons["gaussian_cov"][i] = numpy.cov(neuron_mask_i_points)
+                neurons["contour"] = xnumpy.generate_contours(neurons["mask"])
+                neurons["gaussian_mean"], neurons["gaussian_cov"] = xnumpy.masks_mean_and_covariance(neurons["mask"])
 
                 neurons["centroid"] = watershed_local_maxima.props["centroid"]
 
@@ -2158,7 +3322,7 @@ def wavelet_denoising(new_image,
 
 @prof.log_call(logger)
 @hdf5.record.static_array_debug_recorder
-def extract_neurons(new_image, neuron_masks):
+def extract_neurons(new_image, neuron_masks, sparse = False):
     """
         Extracts neurons from an image using a stack of masks.
 
@@ -2167,10 +3331,24 @@ def extract_neurons(new_image, neuron_masks):
 
             neuron_masks(numpy.ndarray):        first index of denotes which mask and all others are spatial indices.
 
+            sparse(bool):                       whether to return a SparseNeuronSet instead.
+
         Returns:
             numpy.ndarray:                      a stack of neurons in the same order as the masks.
     """
 
+    if sparse:
+        neuron_masks_bounding_boxes = xnumpy.masks_bounding_boxes(neuron_masks)
+        neuron_masks_crops = [tuple(slice(_1, _2) for _1, _2 in _.T) for _ in neuron_masks_bounding_boxes]
+
+        neurons = sparse_neurons_from_crops(new_image.shape,
+                                            new_image.dtype,
+                                            [new_image[_] for _ in neuron_masks_crops],
+                                            [_1[_2] for _1, _2 in itertools.izip(neuron_masks, neuron_masks_crops)],
+                                            neuron_masks_bounding_boxes)
+
+        return(neurons)
+
     neurons = numpy.zeros(len(neuron_masks), dtype = get_neuron_dtype(shape=new_image.shape, dtype=new_image.dtype))
 
     neurons["mask"] = neuron_masks
@@ -2178,18 +3356,59 @@ def extract_neurons(new_image, neuron_masks):
     neurons["area"] = xnumpy.array_to_matrix(neurons["mask"]).sum(axis = 1)
     neurons["max_F"] = xnumpy.array_to_matrix(neurons["image"]).max(axis = 1)
 
-    for i in xrange(len(neurons)):
-        neuron_mask_i_points = numpy.array(neurons["mask"][i].nonzero())
-
-        neurons["contour"][i] = xnumpy.generate_contour(neurons["mask"][i])
-        neurons["gaussian_mean"][i] = neuron_mask_i_points.mean(axis = 1)
-        neurons["gaussian_cov"][i] = numpy.cov(neuron_mask_i_points)
+    neurons["contour"] = xnumpy.generate_contours(neurons["mask"])
+    neurons["gaussian_mean"], neurons["gaussian_cov"] = xnumpy.masks_mean_and_covariance(neurons["mask"])
 
     neurons["centroid"] = neurons["gaussian_mean"]
 
     return(neurons)
 
 
+@prof.log_call(logger)
+def fuse_sparse_neurons(neuron_1, neuron_2, fraction_mean_neuron_max_threshold):
+    """
+        Merges the two neurons into one neuron, which is returned. Same as fuse_neurons, but only works within the
+        bounding box of both neurons.
+
+        Args:
+            neuron_1(SparseNeuronSet):          contains only the first neuron.
+
+            neuron_2(SparseNeuronSet):          contains only the second neuron.
+
+            fraction_mean_neuron_max_threshold(float):  fraction of the max of the mean image to include in the mask.
+
+        Returns:
+            SparseNeuronSet:                    a new neuron that is the result of fusing the two.
+    """
+
+    assert (len(neuron_1) == len(neuron_2) == 1)
+    assert (neuron_1.shape == neuron_2.shape)
+    assert (neuron_1.dtype == neuron_2.dtype)
+
+    bounding_box = numpy.array([
+        numpy.minimum(neuron_1.neurons["bounding_box"][0, 0], neuron_2.neurons["bounding_box"][0, 0]),
+        numpy.maximum(neuron_1.neurons["bounding_box"][0, 1], neuron_2.neurons["bounding_box"][0, 1])
+    ])
+
+    mean_neuron = numpy.array([neuron_1.crop(0, "image", bounding_box),
+                               neuron_2.crop(0, "image", bounding_box)]).mean(axis = 0)
+
+    # Pixels outside of the bounding box count as zero (as with full frames).
+    mean_neuron_max = mean_neuron.max() if mean_neuron.size else 0
+    if mean_neuron.size < numpy.prod(neuron_1.shape):
+        mean_neuron_max = max(mean_neuron_max, 0)
+
+    mean_neuron_mask = mean_neuron > (fraction_mean_neuron_max_threshold * mean_neuron_max)
+
+    new_neuron = sparse_neurons_from_crops(neuron_1.shape,
+                                           neuron_1.dtype,
+                                           [mean_neuron],
+                                           [mean_neuron_mask],
+                                           [bounding_box])
+
+    return(new_neuron)
+
+
 @prof.log_call(logger)
 @hdf5.record.static_array_debug_recorder
 def fuse_neurons(neuron_1,
@@ -2204,7 +3423,8 @@ def fuse_neurons(neuron_1,
 
         Args:
             neuron_1(numpy.ndarray):            numpy structured array (dtype get_neuron_dtype) containing the first
-                                                neuron.
+                                                neuron. May also be a SparseNeuronSet with one neuron (if neuron_2 is
+                                                too).
 
             neuron_2(numpy.ndarray):            numpy structured array (dtype get_neuron_dtype) containing the second
                                                 neuron.
@@ -2218,6 +3438,13 @@ def fuse_neurons(neuron_1,
     fuse_neurons.recorders.array_debug_recorder["neuron_1"] = neuron_1
     fuse_neurons.recorders.array_debug_recorder["neuron_2"] = neuron_2
 
+    if isinstance(neuron_1, SparseNeuronSet):
+        new_neuron = fuse_sparse_neurons(neuron_1, neuron_2, fraction_mean_neuron_max_threshold)
+
+        fuse_neurons.recorders.array_debug_recorder["new_neuron"] = new_neuron
+
+        return(new_neuron)
+
     assert (neuron_1.shape == neuron_2.shape == tuple())
     assert (neuron_1.dtype == neuron_2.dtype)
 
@@ -2239,9 +3466,9 @@ def fuse_neurons(neuron_1,
 
     new_neuron["max_F"] = new_neuron["image"].max()
 
-    new_neuron_mask_points = numpy.array(new_neuron["mask"].nonzero())
-    new_neuron["gaussian_mean"] = new_neuron_mask_points.mean(axis = 1)
-    new_neuron["gaussian_cov"] = numpy.cov(new_neuron_mask_points)
+    new_neuron_gaussian_mean, new_neuron_gaussian_cov = xnumpy.masks_mean_and_covariance(new_neuron["mask"][None])
+    new_neuron["gaussian_mean"] = new_neuron_gaussian_mean[0]
+    new_neuron["gaussian_cov"] = new_neuron_gaussian_cov[0]
 
     new_neuron["centroid"] = new_neuron["gaussian_mean"]
 
@@ -2467,12 +3694,197 @@ def merge_neuron_sets_once(new_neuron_set_1,
     return(new_neuron_set)
 
 
+@prof.log_call(logger)
+def match_neuron_set_overlapping_pairs(new_neuron_set, alignment_min_threshold):
+    """
+        Finds the best match for each neuron using the same measures as merge_neuron_sets_repeatedly. However, only
+        neurons whose bounding boxes overlap are compared and only over the intersection of their bounding boxes.
+        All other pairs have dot products of zero. So, the results are the same as the dense comparison.
+
+        Overlaps of masks are counts. So, they are exact either way. Angles between images are rounded differently
+        than in the dense comparison (xnumpy.pair_dot_product_normalized), but by no more than a known bound. When an
+        angle is too close to the threshold or to the next best angle to be sure of the decision, the angles are
+        found with the dense comparison instead. So, the neurons merged are always the same as the dense comparison.
+
+        Args:
+            new_neuron_set(numpy.ndarray):              numpy structured array (dtype get_neuron_dtype) or
+                                                        SparseNeuronSet containing the neurons to compare.
+
+            alignment_min_threshold(float):             the angle above which neurons are merged (see
+                                                        merge_neuron_sets_repeatedly).
+
+        Returns:
+            (tuple of numpy.ndarrays):                  the best match and its value for each neuron using the angle
+                                                        between images (upper triangular), the overlap of masks
+                                                        relative to the first mask, and the overlap of masks relative
+                                                        to the second mask (in that order).
+    """
+
+    num_neurons = len(new_neuron_set)
+    pairs_shape = (num_neurons, num_neurons)
+
+    if isinstance(new_neuron_set, SparseNeuronSet):
+        new_neuron_set_pixel_owners = new_neuron_set.get_pixel_owners()
+        new_neuron_set_pixels_used = (new_neuron_set_pixel_owners != -1)
+        new_neuron_set_pixel_owners = new_neuron_set_pixel_owners[new_neuron_set_pixels_used]
+        new_neuron_set_pixels = new_neuron_set.pixels[new_neuron_set_pixels_used]
+
+        new_neuron_set_image_norms = numpy.sqrt(numpy.bincount(
+            new_neuron_set_pixel_owners, weights = new_neuron_set_pixels["image"].astype(float) ** 2,
+            minlength = num_neurons
+        ))
+        new_neuron_set_mask_norms = numpy.bincount(
+            new_neuron_set_pixel_owners, weights = new_neuron_set_pixels["mask"].astype(float),
+            minlength = num_neurons
+        )
+
+        new_neuron_set_bounding_boxes = new_neuron_set.neurons["bounding_box"]
+
+        frame_shape = new_neuron_set.shape
+    else:
+        new_neuron_set_image = new_neuron_set["image"].astype(float)
+        new_neuron_set_mask = new_neuron_set["mask"].astype(float)
+
+        # Computed on the full frame like the dense computation.
+        new_neuron_set_image_norms = xnumpy.norm(xnumpy.array_to_matrix(new_neuron_set_image), ord = 2)
+        new_neuron_set_mask_norms = xnumpy.norm(xnumpy.array_to_matrix(new_neuron_set_mask), ord = 1)
+
+        # Outside of these, neurons have no content and cannot contribute to any dot product.
+        new_neuron_set_bounding_boxes = xnumpy.masks_bounding_boxes(
+            (new_neuron_set_image != 0) | (new_neuron_set_mask != 0)
+        )
+
+        frame_shape = new_neuron_set_image.shape[1:]
+
+    frame_size = int(numpy.prod(frame_shape))
+
+    overlapping_pairs = xnumpy.bounding_boxes_overlapping_pairs(new_neuron_set_bounding_boxes)
+    overlapping_pairs_i = overlapping_pairs[:, 0]
+    overlapping_pairs_j = overlapping_pairs[:, 1]
+
+    logger.debug("Found \"" + repr(len(overlapping_pairs)) + "\" pairs of neurons with overlapping bounding boxes.")
+
+    overlapping_pairs_image_dot_products = numpy.zeros((len(overlapping_pairs),), dtype = float)
+    overlapping_pairs_mask_dot_products = numpy.zeros((len(overlapping_pairs),), dtype = float)
+    for k, (i, j) in enumerate(overlapping_pairs):
+        # Only need to compare the region where both bounding boxes intersect.
+        each_intersection_bounding_box = numpy.array([
+            numpy.maximum(new_neuron_set_bounding_boxes[i, 0], new_neuron_set_bounding_boxes[j, 0]),
+            numpy.minimum(new_neuron_set_bounding_boxes[i, 1], new_neuron_set_bounding_boxes[j, 1])
+        ])
+
+        if isinstance(new_neuron_set, SparseNeuronSet):
+            each_image_i, each_image_j, each_mask_i, each_mask_j = [
+                new_neuron_set.crop(_1, _2, each_intersection_bounding_box).astype(float)
+                for _2 in ["image", "mask"] for _1 in [i, j]
+            ]
+        else:
+            each_intersection = tuple(slice(_1, _2) for _1, _2 in each_intersection_bounding_box.T)
+
+            each_image_i, each_image_j, each_mask_i, each_mask_j = [
+                _2[_1][each_intersection]
+                for _2 in [new_neuron_set_image, new_neuron_set_mask] for _1 in [i, j]
+            ]
+
+        overlapping_pairs_image_dot_products[k] = numpy.dot(each_image_i.ravel(), each_image_j.ravel())
+        overlapping_pairs_mask_dot_products[k] = numpy.dot(each_mask_i.ravel(), each_mask_j.ravel())
+
+    overlapping_pairs_angles = overlapping_pairs_image_dot_products / (
+        new_neuron_set_image_norms[overlapping_pairs_i] * new_neuron_set_image_norms[overlapping_pairs_j]
+    )
+
+    # The angle only uses the upper triangle (i < j), which is exactly what the pairs contain.
+    new_neuron_set_angle_all_optimal_i, new_neuron_set_angle_maxes = xnumpy.sparse_argmax(
+        overlapping_pairs_i,
+        overlapping_pairs_j,
+        overlapping_pairs_angles,
+        pairs_shape
+    )
+
+    # Any way of adding up the products of a dot product (e.g. BLAS) is off by at most ~(the number of products) * eps
+    # relative to the product of the norms (and so are the norms). So, the angle found here and the one found by the
+    # dense computation can only differ by this much.
+    angle_tolerance = 4 * (frame_size + 2) * numpy.finfo(float).eps
+
+    # Next best angle for each neuron. Every neuron has at least one implicit zero (the lower triangle).
+    angle_columns = numpy.concatenate([overlapping_pairs_j, numpy.arange(num_neurons)])
+    angle_values = numpy.concatenate([overlapping_pairs_angles, numpy.zeros((num_neurons,))])
+    angle_order = numpy.lexsort((-angle_values, angle_columns))
+    angle_columns = angle_columns[angle_order]
+    angle_values = angle_values[angle_order]
+
+    angle_columns_start = numpy.searchsorted(angle_columns, numpy.arange(num_neurons))
+    angle_columns_second = numpy.minimum(angle_columns_start + 1, len(angle_values) - 1)
+    new_neuron_set_angle_seconds = numpy.where(
+        angle_columns[angle_columns_second] == numpy.arange(num_neurons),
+        angle_values[angle_columns_second],
+        -numpy.inf
+    )
+
+    # Whether the dense computation could decide differently (above the threshold or not, which neuron is best).
+    new_neuron_set_angle_uncertain = (
+        (numpy.abs(new_neuron_set_angle_maxes - alignment_min_threshold) <= angle_tolerance) |
+        ((new_neuron_set_angle_maxes > alignment_min_threshold) &
+         ((new_neuron_set_angle_maxes - new_neuron_set_angle_seconds) <= 2 * angle_tolerance))
+    )
+
+    # Neurons without an image give NaN angles with every neuron in the dense computation.
+    if new_neuron_set_angle_uncertain.any() or (new_neuron_set_image_norms == 0).any() or \
+            (~numpy.isfinite(overlapping_pairs_angles)).any():
+        logger.debug("Angles of neurons are too close to decide from overlapping pairs. Using dense angles instead.")
+
+        if isinstance(new_neuron_set, SparseNeuronSet):
+            new_neuron_set_flattened_image = numpy.zeros((num_neurons, frame_size), dtype = float)
+            new_neuron_set_flattened_image[(
+                new_neuron_set_pixel_owners,
+                numpy.ravel_multi_index(tuple(new_neuron_set_pixels["index"].T), frame_shape)
+            )] = new_neuron_set_pixels["image"]
+        else:
+            new_neuron_set_flattened_image = xnumpy.array_to_matrix(new_neuron_set["image"])
+
+        # Same as merge_neuron_sets_repeatedly without use_spatial_index.
+        new_neuron_set_angle = xnumpy.pair_dot_product_normalized(new_neuron_set_flattened_image, ord = 2)
+        new_neuron_set_angle = numpy.triu(new_neuron_set_angle, k = 1)
+
+        new_neuron_set_angle_all_optimal_i = new_neuron_set_angle.argmax(axis = 0)
+        new_neuron_set_angle_maxes = new_neuron_set_angle[(new_neuron_set_angle_all_optimal_i,
+                                                           numpy.arange(num_neurons),)]
+
+    # The mask overlaps are not symmetric. So, both (i, j) and (j, i) are needed.
+    overlapping_pairs_rows = numpy.concatenate([overlapping_pairs_i, overlapping_pairs_j])
+    overlapping_pairs_columns = numpy.concatenate([overlapping_pairs_j, overlapping_pairs_i])
+    overlapping_pairs_mask_dot_products = numpy.concatenate([overlapping_pairs_mask_dot_products,
+                                                             overlapping_pairs_mask_dot_products])
+
+    new_neuron_set_masks_overlaid_1_all_optimal_i, new_neuron_set_masks_overlaid_1_maxes = xnumpy.sparse_argmax(
+        overlapping_pairs_rows,
+        overlapping_pairs_columns,
+        overlapping_pairs_mask_dot_products / new_neuron_set_mask_norms[overlapping_pairs_rows],
+        pairs_shape
+    )
+
+    new_neuron_set_masks_overlaid_2_all_optimal_i, new_neuron_set_masks_overlaid_2_maxes = xnumpy.sparse_argmax(
+        overlapping_pairs_rows,
+        overlapping_pairs_columns,
+        overlapping_pairs_mask_dot_products / new_neuron_set_mask_norms[overlapping_pairs_columns],
+        pairs_shape
+    )
+
+    return((new_neuron_set_angle_all_optimal_i,
+            new_neuron_set_angle_maxes,
+            new_neuron_set_masks_overlaid_1_all_optimal_i,
+            new_neuron_set_masks_overlaid_1_maxes,
+            new_neuron_set_masks_overlaid_2_all_optimal_i,
+            new_neuron_set_masks_overlaid_2_maxes))
+
+
 @prof.log_call(logger)
 @hdf5.record.static_array_debug_recorder
 def merge_neuron_sets_repeatedly(new_neuron_set_1,
                                  new_neuron_set_2,
                                  alignment_min_threshold,
                                  overlap_min_threshold,
+                                 use_spatial_index = True,
                                  **parameters):
     """
         Merges the two sets of neurons into one. Appends neurons that cannot be merged with the existing set.
@@ -2486,7 +3898,8 @@ def merge_neuron_sets_repeatedly(new_neuron_set_1,
 
         Args:
             new_neuron_set_1(numpy.ndarray):            numpy structured array (dtype get_neuron_dtype) containing the
-                                                        first neuron set (preferred for tie breaking).
+                                                        first neuron set (preferred for tie breaking). May also be a
+                                                        SparseNeuronSet (if new_neuron_set_2 is too).
 
             new_neuron_set_2(numpy.ndarray):            numpy structured array (dtype get_neuron_dtype) containing the
                                                         second neuron set.
@@ -2499,6 +3912,13 @@ def merge_neuron_sets_repeatedly(new_neuron_set_1,
                                                         of the neurons) for them to be treated as candidates for merging
                                                         (uses the function expanded_numpy.dot_product_partially_normalized).
 
+            use_spatial_index(bool):                    whether to only compare neurons whose bounding boxes overlap
+                                                        (instead of computing dense dot products between all pairs).
+                                                        Non-overlapping neurons have dot products of zero. So, both
+                                                        give the same merge decisions (see
+                                                        match_neuron_set_overlapping_pairs). Always used for
+                                                        SparseNeuronSets.
+
             **parameters(dict):                         dictionary of parameters
 
         Returns:
@@ -2514,7 +3934,13 @@ def merge_neuron_sets_repeatedly(new_neuron_set_1,
 
     assert (new_neuron_set_1.dtype == new_neuron_set_2.dtype)
 
-    new_neuron_set = numpy.hstack([new_neuron_set_1, new_neuron_set_2])
+    if isinstance(new_neuron_set_1, SparseNeuronSet):
+        # Dense products would need full frames.
+        use_spatial_index = True
+
+        new_neuron_set = concatenate_sparse_neurons([new_neuron_set_1, new_neuron_set_2])
+    else:
+        new_neuron_set = numpy.hstack([new_neuron_set_1, new_neuron_set_2])
 
     if len(new_neuron_set_1) and len(new_neuron_set_2):
         logger.debug("Have 2 sets of neurons to merge.")
@@ -2528,57 +3954,76 @@ def merge_neuron_sets_repeatedly(new_neuron_set_1,
     while (new_neuron_set.size != 1) and (original_new_neuron_set_size != new_neuron_set.size):
         original_new_neuron_set_size = new_neuron_set.size
 
-        new_neuron_set_flattened_image = xnumpy.array_to_matrix(new_neuron_set["image"])
+        # Get all the j indices
+        new_neuron_set_all_j = numpy.arange(len(new_neuron_set))
 
-        new_neuron_set_flattened_mask = xnumpy.array_to_matrix(new_neuron_set["mask"])
+        merge_neuron_sets_repeatedly.recorders.array_debug_recorder["new_neuron_set_all_j"] = new_neuron_set_all_j
 
-        # Measure the normalized dot product between any two neurons (i.e. related to the angle of separation)
-        new_neuron_set_angle = xnumpy.pair_dot_product_normalized(new_neuron_set_flattened_image,
-                                                                          ord = 2)
-        new_neuron_set_angle = numpy.triu(new_neuron_set_angle, k = 1)
+        if use_spatial_index:
+            (new_neuron_set_angle_all_optimal_i,
+             new_neuron_set_angle_maxes,
+             new_neuron_set_masks_overlaid_1_all_optimal_i,
+             new_neuron_set_masks_overlaid_1_maxes,
+             new_neuron_set_masks_overlaid_2_all_optimal_i,
+             new_neuron_set_masks_overlaid_2_maxes) = match_neuron_set_overlapping_pairs(new_neuron_set,
+                                                                                         alignment_min_threshold)
+
+            merge_neuron_sets_repeatedly.recorders.array_debug_recorder["new_neuron_set_angle_all_optimal_i"] = new_neuron_set_angle_all_optimal_i
+            merge_neuron_sets_repeatedly.recorders.array_debug_recorder["new_neuron_set_masks_overlaid_1_all_optimal_i"] = \
+                               new_neuron_set_masks_overlaid_1_all_optimal_i
+            merge_neuron_sets_repeatedly.recorders.array_debug_recorder["new_neuron_set_masks_overlaid_2_all_optimal_i"] = \
+                               new_neuron_set_masks_overlaid_2_all_optimal_i
+
+            merge_neuron_sets_repeatedly.recorders.array_debug_recorder["new_neuron_set_angle_maxes"] = new_neuron_set_angle_maxes
+            merge_neuron_sets_repeatedly.recorders.array_debug_recorder["new_neuron_set_masks_overlaid_1_maxes"] = new_neuron_set_masks_overlaid_1_maxes
+            merge_neuron_sets_repeatedly.recorders.array_debug_recorder["new_neuron_set_masks_overlaid_2_maxes"] = new_neuron_set_masks_overlaid_2_maxes
+        else:
+            new_neuron_set_flattened_image = xnumpy.array_to_matrix(new_neuron_set["image"])
 
-        merge_neuron_sets_repeatedly.recorders.array_debug_recorder["new_neuron_set_angle"] = new_neuron_set_angle
+            new_neuron_set_flattened_mask = xnumpy.array_to_matrix(new_neuron_set["mask"])
 
-        # Measure the distance between the two masks
-        # (note distance relative to the total mask content of each mask individually)
-        new_neuron_set_masks_overlaid = xnumpy.pair_dot_product_partially_normalized(
-            new_neuron_set_flattened_mask, ord = 1)
-        numpy.fill_diagonal(new_neuron_set_masks_overlaid, 0)
+            # Measure the normalized dot product between any two neurons (i.e. related to the angle of separation)
+            new_neuron_set_angle = xnumpy.pair_dot_product_normalized(new_neuron_set_flattened_image,
+                                                                              ord = 2)
+            new_neuron_set_angle = numpy.triu(new_neuron_set_angle, k = 1)
 
-        new_neuron_set_masks_overlaid_1 = new_neuron_set_masks_overlaid
-        new_neuron_set_masks_overlaid_2 = new_neuron_set_masks_overlaid.T
+            merge_neuron_sets_repeatedly.recorders.array_debug_recorder["new_neuron_set_angle"] = new_neuron_set_angle
 
-        merge_neuron_sets_repeatedly.recorders.array_debug_recorder["new_neuron_set_masks_overlaid_1"] = new_neuron_set_masks_overlaid_1
-        merge_neuron_sets_repeatedly.recorders.array_debug_recorder["new_neuron_set_masks_overlaid_2"] = new_neuron_set_masks_overlaid_2
+            # Measure the distance between the two masks
+            # (note distance relative to the total mask content of each mask individually)
+            new_neuron_set_masks_overlaid = xnumpy.pair_dot_product_partially_normalized(
+                new_neuron_set_flattened_mask, ord = 1)
+            numpy.fill_diagonal(new_neuron_set_masks_overlaid, 0)
 
-        # Now that the three measures for the correlation method have been found, we want to know,
-        # which are the best correlated neurons between the two sets using these measures.
-        # This done to find the neuron in new_neuron_set_1 that best matches each neuron in new_neuron_set_2.
-        new_neuron_set_angle_all_optimal_i = new_neuron_set_angle.argmax(axis = 0)
-        new_neuron_set_masks_overlaid_1_all_optimal_i = new_neuron_set_masks_overlaid_1.argmax(axis = 0)
-        new_neuron_set_masks_overlaid_2_all_optimal_i = new_neuron_set_masks_overlaid_2.argmax(axis = 0)
+            new_neuron_set_masks_overlaid_1 = new_neuron_set_masks_overlaid
+            new_neuron_set_masks_overlaid_2 = new_neuron_set_masks_overlaid.T
 
-        merge_neuron_sets_repeatedly.recorders.array_debug_recorder["new_neuron_set_angle_all_optimal_i"] = new_neuron_set_angle_all_optimal_i
-        merge_neuron_sets_repeatedly.recorders.array_debug_recorder["new_neuron_set_masks_overlaid_1_all_optimal_i"] = \
-                           new_neuron_set_masks_overlaid_1_all_optimal_i
-        merge_neuron_sets_repeatedly.recorders.array_debug_recorder["new_neuron_set_masks_overlaid_2_all_optimal_i"] = \
-                           new_neuron_set_masks_overlaid_2_all_optimal_i
+            merge_neuron_sets_repeatedly.recorders.array_debug_recorder["new_neuron_set_masks_overlaid_1"] = new_neuron_set_masks_overlaid_1
+            merge_neuron_sets_repeatedly.recorders.array_debug_recorder["new_neuron_set_masks_overlaid_2"] = new_neuron_set_masks_overlaid_2
 
-        # Get all the j indices
-        new_neuron_set_all_j = numpy.arange(len(new_neuron_set))
+            # Now that the three measures for the correlation method have been found, we want to know,
+            # which are the best correlated neurons between the two sets using these measures.
+            # This done to find the neuron in new_neuron_set_1 that best matches each neuron in new_neuron_set_2.
+            new_neuron_set_angle_all_optimal_i = new_neuron_set_angle.argmax(axis = 0)
+            new_neuron_set_masks_overlaid_1_all_optimal_i = new_neuron_set_masks_overlaid_1.argmax(axis = 0)
+            new_neuron_set_masks_overlaid_2_all_optimal_i = new_neuron_set_masks_overlaid_2.argmax(axis = 0)
 
-        merge_neuron_sets_repeatedly.recorders.array_debug_recorder["new_neuron_set_all_j"] = new_neuron_set_all_j
+            merge_neuron_sets_repeatedly.recorders.array_debug_recorder["new_neuron_set_angle_all_optimal_i"] = new_neuron_set_angle_all_optimal_i
+            merge_neuron_sets_repeatedly.recorders.array_debug_recorder["new_neuron_set_masks_overlaid_1_all_optimal_i"] = \
+                               new_neuron_set_masks_overlaid_1_all_optimal_i
+            merge_neuron_sets_repeatedly.recorders.array_debug_recorder["new_neuron_set_masks_overlaid_2_all_optimal_i"] = \
+                               new_neuron_set_masks_overlaid_2_all_optimal_i
 
-        # Get the maximum corresponding to the best matched pairs from before
-        new_neuron_set_angle_maxes = new_neuron_set_angle[(new_neuron_set_angle_all_optimal_i, new_neuron_set_all_j,)]
-        new_neuron_set_masks_overlaid_1_maxes = new_neuron_set_masks_overlaid_1[
-            (new_neuron_set_masks_overlaid_1_all_optimal_i, new_neuron_set_all_j,)]
-        new_neuron_set_masks_overlaid_2_maxes = new_neuron_set_masks_overlaid_2[
-            (new_neuron_set_masks_overlaid_2_all_optimal_i, new_neuron_set_all_j,)]
+            # Get the maximum corresponding to the best matched pairs from before
+            new_neuron_set_angle_maxes = new_neuron_set_angle[(new_neuron_set_angle_all_optimal_i, new_neuron_set_all_j,)]
+            new_neuron_set_masks_overlaid_1_maxes = new_neuron_set_masks_overlaid_1[
+                (new_neuron_set_masks_overlaid_1_all_optimal_i, new_neuron_set_all_j,)]
+            new_neuron_set_masks_overlaid_2_maxes = new_neuron_set_masks_overlaid_2[
+                (new_neuron_set_masks_overlaid_2_all_optimal_i, new_neuron_set_all_j,)]
 
-        merge_neuron_sets_repeatedly.recorders.array_debug_recorder["new_neuron_set_angle_maxes"] = new_neuron_set_angle_maxes
-        merge_neuron_sets_repeatedly.recorders.array_debug_recorder["new_neuron_set_masks_overlaid_1_maxes"] = new_neuron_set_masks_overlaid_1_maxes
-        merge_neuron_sets_repeatedly.recorders.array_debug_recorder["new_neuron_set_masks_overlaid_2_maxes"] = new_neuron_set_masks_overlaid_2_maxes
+            merge_neuron_sets_repeatedly.recorders.array_debug_recorder["new_neuron_set_angle_maxes"] = new_neuron_set_angle_maxes
+            merge_neuron_sets_repeatedly.recorders.array_debug_recorder["new_neuron_set_masks_overlaid_1_maxes"] = new_neuron_set_masks_overlaid_1_maxes
+            merge_neuron_sets_repeatedly.recorders.array_debug_recorder["new_neuron_set_masks_overlaid_2_maxes"] = new_neuron_set_masks_overlaid_2_maxes
 
         # Store a list of the optimal neurons in the existing set to fuse with (by default set all values to -1)
         new_neuron_set_all_optimal_i = numpy.zeros((len(new_neuron_set),), dtype = int)
@@ -2655,7 +4100,7 @@ def merge_neuron_sets_repeatedly(new_neuron_set_1,
         if new_neuron_set_all_optimal_i.size:
             merge_neuron_sets_repeatedly.recorders.array_debug_recorder["new_neuron_set_all_optimal_i_3"] = new_neuron_set_all_optimal_i
 
-        new_neuron_set_kept = numpy.ones(new_neuron_set.shape, dtype = bool)
+        new_neuron_set_kept = numpy.ones((len(new_neuron_set),), dtype = bool)
 
         # Fuse all the neurons that can be from new_neuron_set_2 to the new_neuron_set (composed of new_neuron_set_1)
         for i, j in itertools.izip(new_neuron_set_all_optimal_i, new_neuron_set_all_j_fuse):
@@ -2719,15 +4164,55 @@ def expand_rois(new_data, roi_masks, **parameters):
     return(correlation_map)
 
 
+@prof.log_call(logger)
+def wavelet_denoising_image(new_image, parameters):
+    """
+        Runs wavelet_denoising on an image. Designed to be run in a WorkerPool (see postprocess_data).
+
+        Args:
+            new_image(numpy.ndarray):             image to find neurons in.
+            parameters(dict):                     parameters for wavelet_denoising.
+
+        Returns:
+            numpy.ndarray:                        the neurons found.
+    """
+
+    return(wavelet_denoising(new_image, **parameters))
+
+
+@prof.log_call(logger)
+def merge_neuron_sets_pair(new_neuron_set_1, new_neuron_set_2, parameters):
+    """
+        Runs merge_neuron_sets on a pair of neuron sets. Designed to be run in a WorkerPool (see postprocess_data).
+
+        Args:
+            new_neuron_set_1(numpy.ndarray):      first set of neurons.
+            new_neuron_set_2(numpy.ndarray):      second set of neurons.
+            parameters(dict):                     parameters for merge_neuron_sets.
+
+        Returns:
+            numpy.ndarray:                        the merged neurons.
+    """
+
+    return(merge_neuron_sets(new_neuron_set_1, new_neuron_set_2, **parameters))
+
+
 @prof.log_call(logger)
 @hdf5.record.static_array_debug_recorder
 def postprocess_data(new_dictionary, **parameters):
     """
         Generates neurons from the dictionary.
+
+        Each basis image of the dictionary is denoised on its own. So, this can be spread across processes by giving
+        num_processes. Then, neurons are merged in the order of the basis images (as is done without processes).
+        Unless deterministic_merge is False. In that case, pairs of neuron sets are merged in parallel (as a tree),
+        which gives a result that may differ slightly from merging in order. Debug information can only be recorded
+        from this process. So, processes are not used when it is recorded.
         
         Args:
             new_dictionary(numpy.ndarray):        dictionary of basis images to analyze for neurons.
-            **parameters(dict):                   dictionary of parameters
+            **parameters(dict):                   dictionary of parameters (may include num_processes and
+                                                  deterministic_merge)
         
         Returns:
             numpy.ndarray:                        structured array with relevant information for each neuron found.
@@ -2747,25 +4232,93 @@ def postprocess_data(new_dictionary, **parameters):
             neuron_sets_array_debug_recorder[i_str] = None
             yield ( (i, each, neuron_sets_array_debug_recorder[i_str]) )
 
+    # Neurons only keep their own pixels until the end (if wavelet_denoising produces a SparseNeuronSet).
+    use_sparse_neurons = parameters["wavelet_denoising"].get("sparse", False)
+
+    num_processes = parameters.get("num_processes", 1)
+    if postprocess_data.recorders.array_debug_recorder:
+        num_processes = 1
+    num_processes = min(num_processes, len(new_dictionary))
+
+    deterministic_merge = parameters.get("deterministic_merge", True)
+
+    wavelet_denoising.recorders.array_debug_recorder = postprocess_data.recorders.array_debug_recorder
+    merge_neuron_sets.recorders.array_debug_recorder = postprocess_data.recorders.array_debug_recorder
+
     # Get all neurons for all images
-    new_neurons_set = get_empty_neuron(shape=new_dictionary[0].shape, dtype=new_dictionary[0].dtype)
-    unmerged_neuron_set = get_empty_neuron(shape=new_dictionary[0].shape, dtype=new_dictionary[0].dtype)
-    for i, each_new_dictionary_image, each_array_debug_recorder in array_debug_recorder_enumerator(new_dictionary):
-        wavelet_denoising.recorders.array_debug_recorder = postprocess_data.recorders.array_debug_recorder
-        each_new_neuron_set = wavelet_denoising(each_new_dictionary_image,
-                                                **parameters["wavelet_denoising"])
+    if use_sparse_neurons:
+        new_neurons_set = get_empty_sparse_neurons(shape=new_dictionary[0].shape, dtype=new_dictionary[0].dtype)
+        unmerged_neuron_set = get_empty_sparse_neurons(shape=new_dictionary[0].shape, dtype=new_dictionary[0].dtype)
+    else:
+        new_neurons_set = get_empty_neuron(shape=new_dictionary[0].shape, dtype=new_dictionary[0].dtype)
+        unmerged_neuron_set = get_empty_neuron(shape=new_dictionary[0].shape, dtype=new_dictionary[0].dtype)
 
-        logger.debug("Denoised a set of neurons from frame " + str(i + 1) + " of " + str(len(new_dictionary)) + ".")
+    postprocess_pool = None
+    if num_processes > 1:
+        postprocess_pool = xmultiprocessing.WorkerPool(num_processes)
 
-        unmerged_neuron_set = numpy.hstack([unmerged_neuron_set, each_new_neuron_set])
+    try:
+        if postprocess_pool is None:
+            new_neuron_sets = itertools.imap(
+                lambda _: wavelet_denoising(_[1], **parameters["wavelet_denoising"]),
+                array_debug_recorder_enumerator(new_dictionary)
+            )
+        else:
+            new_neuron_sets = [_.result() for _ in postprocess_pool.map(
+                wavelet_denoising_image, new_dictionary, itertools.repeat(parameters["wavelet_denoising"])
+            )]
+
+        merge_neuron_sets_queue = []
+        for i, each_new_neuron_set in enumerate(new_neuron_sets):
+            logger.debug("Denoised a set of neurons from frame " + str(i + 1) + " of " + str(len(new_dictionary)) + ".")
+
+            # The unmerged neurons are only used for debugging.
+            if not postprocess_data.recorders.array_debug_recorder:
+                pass
+            elif use_sparse_neurons:
+                unmerged_neuron_set = concatenate_sparse_neurons([unmerged_neuron_set, each_new_neuron_set])
+            else:
+                unmerged_neuron_set = numpy.hstack([unmerged_neuron_set, each_new_neuron_set])
 
-        merge_neuron_sets.recorders.array_debug_recorder = postprocess_data.recorders.array_debug_recorder
-        new_neurons_set = merge_neuron_sets(new_neurons_set, each_new_neuron_set,
-                                            **parameters["merge_neuron_sets"])
+            if (postprocess_pool is None) or deterministic_merge:
+                new_neurons_set = merge_neuron_sets(new_neurons_set, each_new_neuron_set,
+                                                    **parameters["merge_neuron_sets"])
 
-        logger.debug("Merged a set of neurons from frame " + str(i + 1) + " of " + str(len(new_dictionary)) + ".")
+                logger.debug("Merged a set of neurons from frame " + str(i + 1) + " of " + str(len(new_dictionary)) + ".")
+            else:
+                merge_neuron_sets_queue.append(each_new_neuron_set)
+
+        # Merge neighboring pairs in parallel until only one set is left.
+        while len(merge_neuron_sets_queue) > 1:
+            merge_neuron_sets_futures = postprocess_pool.map(
+                merge_neuron_sets_pair,
+                merge_neuron_sets_queue[0::2],
+                merge_neuron_sets_queue[1::2],
+                itertools.repeat(parameters["merge_neuron_sets"])
+            )
+
+            merge_neuron_sets_queue = [_.result() for _ in merge_neuron_sets_futures] + \
+                                      merge_neuron_sets_queue[2 * len(merge_neuron_sets_futures):]
+
+            logger.debug("Merged neurons into \"" + str(len(merge_neuron_sets_queue)) + "\" sets.")
+
+        if merge_neuron_sets_queue:
+            new_neurons_set = merge_neuron_sets(new_neurons_set, merge_neuron_sets_queue[0],
+                                                **parameters["merge_neuron_sets"])
+    finally:
+        if postprocess_pool is not None:
+            postprocess_pool.close()
+
+    if use_sparse_neurons:
+        new_neurons_set = densify_neurons(new_neurons_set)
+
+        # The unmerged neurons are only used for debugging (otherwise none were gathered).
+        if postprocess_data.recorders.array_debug_recorder:
+            unmerged_neuron_set = densify_neurons(unmerged_neuron_set)
+        else:
+            unmerged_neuron_set = get_empty_neuron(shape=new_dictionary[0].shape, dtype=new_dictionary[0].dtype)
 
-    if unmerged_neuron_set.size:
+    if postprocess_data.recorders.array_debug_recorder and unmerged_neuron_set.size:
         postprocess_data.recorders.array_debug_recorder["unmerged_neuron_set"] = unmerged_neuron_set
 
         unmerged_neuron_set_contours = unmerged_neuron_set["contour"].astype(numpy.uint64)
@@ -2779,7 +4332,7 @@ def postprocess_data(new_dictionary, **parameters):
 
         postprocess_data.recorders.array_debug_recorder["unmerged_neuron_set_contours"] = unmerged_neuron_set_contours
 
-    if new_neurons_set.size:
+    if postprocess_data.recorders.array_debug_recorder and new_neurons_set.size:
         postprocess_data.recorders.array_debug_recorder["new_neurons_set"] = new_neurons_set
 
         new_neurons_set_contours = new_neurons_set["contour"].astype(numpy.uint64)
@@ -1,8 +1,10 @@
 __author__ = "John Kirkham <kirkhamj@janelia.hhmi.org>"
 __date__ = "$Mar 27, 2015 09:32:02 EDT$"
 
-__all__ = ["record", "search", "serializers"]
+__all__ = ["cache", "pool", "record", "search", "serializers"]
 
+import cache
+import pool
 import record
 import search
 import serializers
@@ -0,0 +1,464 @@
+import glob
+import hashlib
+import json
+import os
+import tempfile
+
+import h5py
+import numpy
+
+
+# Need in order to have logging information no matter what.
+from nanshe.util import prof
+
+
+# Get the logger
+logger = prof.logging.getLogger(__name__)
+
+
+@prof.log_call(logger)
+def hash_parameters(parameters):
+    """
+        Finds a hash of some parameters that does not depend on the order of keys.
+
+        Args:
+            parameters(dict):               parameters to hash (must be JSON serializable).
+
+        Returns:
+            str:                            the hash as a hex string.
+
+        Examples:
+            >>> hash_parameters({"a" : 1, "b" : [2, 3]}) == hash_parameters({"b" : [2, 3], "a" : 1})
+            True
+
+            >>> hash_parameters({"a" : 1}) == hash_parameters({"a" : 2})
+            False
+    """
+
+    return(hashlib.sha1(json.dumps(parameters, sort_keys = True)).hexdigest())
+
+
+@prof.log_call(logger)
+def find_window_overlap(window_1, window_2):
+    """
+        Finds where two windows overlap.
+
+        Args:
+            window_1(numpy.ndarray):        start and stop along each axis (shape is (ndim, 2)).
+            window_2(numpy.ndarray):        start and stop along each axis (shape is (ndim, 2)).
+
+        Returns:
+            numpy.ndarray:                  start and stop of the overlap along each axis (stop is not less than
+                                            start even if they do not overlap).
+
+        Examples:
+            >>> find_window_overlap(numpy.array([[0, 10], [0, 10]]), numpy.array([[5, 15], [2, 8]]))
+            array([[ 5, 10],
+                   [ 2,  8]])
+
+            >>> find_window_overlap(numpy.array([[0, 10]]), numpy.array([[12, 15]]))
+            array([[12, 12]])
+    """
+
+    window_1 = numpy.asarray(window_1)
+    window_2 = numpy.asarray(window_2)
+
+    overlap = numpy.empty(numpy.broadcast(window_1, window_2).shape, dtype = int)
+    overlap[..., 0] = numpy.maximum(window_1[..., 0], window_2[..., 0])
+    overlap[..., 1] = numpy.maximum(numpy.minimum(window_1[..., 1], window_2[..., 1]), overlap[..., 0])
+
+    return(overlap)
+
+
+@prof.log_class(logger)
+class DictionaryCache(object):
+    """
+        Keeps dictionaries found for windows of a field of view (FOV) on disk. Each is an HDF5 file in the cache
+        directory. It is named by a hash of the FOV with the parameters used and the window. So, a dictionary can be
+        found again by a later block or session to start dictionary learning from.
+
+        Files are written elsewhere in the directory and then moved into place. So, several processes may share a
+        cache.
+    """
+
+    def __init__(self, dirname):
+        """
+            Opens a cache (creating the directory if needed).
+
+            Args:
+                dirname(str):               directory where the cache is kept.
+        """
+
+        self.dirname = dirname
+
+        try:
+            os.makedirs(self.dirname)
+        except OSError:
+            # If it already exists, that is fine.
+            if not os.path.isdir(self.dirname):
+                raise
+
+    def key(self, fov, parameters):
+        """
+            Finds the key that dictionaries from the same FOV and parameters share.
+
+            Args:
+                fov(str):                   name of the field of view.
+                parameters(dict):           parameters the dictionary was learned with.
+
+            Returns:
+                str:                        the key.
+        """
+
+        return(hash_parameters({"fov" : fov, "parameters" : parameters}))
+
+    def filename(self, fov, window, parameters):
+        """
+            Finds the file a dictionary is kept in.
+
+            Args:
+                fov(str):                   name of the field of view.
+                window(numpy.ndarray):      start and stop along each spatial axis in the FOV.
+                parameters(dict):           parameters the dictionary was learned with.
+
+            Returns:
+                str:                        the filename.
+        """
+
+        window = numpy.asarray(window, dtype = int)
+
+        window_str = "_".join([str(_1) + "-" + str(_2) for _1, _2 in window.tolist()])
+
+        return(os.path.join(self.dirname, self.key(fov, parameters) + "_" + window_str + os.extsep + "h5"))
+
+    def store(self, fov, window, parameters, dictionary):
+        """
+            Adds a dictionary to the cache (replacing one for the same window).
+
+            Args:
+                fov(str):                   name of the field of view.
+                window(numpy.ndarray):      start and stop along each spatial axis in the FOV.
+                parameters(dict):           parameters the dictionary was learned with.
+                dictionary(numpy.ndarray):  the dictionary (first axis is atoms; the rest is the window's shape).
+        """
+
+        window = numpy.asarray(window, dtype = int)
+
+        assert (dictionary.shape[1:] == tuple(window[:, 1] - window[:, 0]))
+
+        fd, temp_filename = tempfile.mkstemp(suffix = os.extsep + "h5", dir = self.dirname)
+        os.close(fd)
+
+        try:
+            with h5py.File(temp_filename, "w") as temp_file:
+                temp_file.create_dataset("dictionary", data = dictionary, chunks = True)
+                temp_file.attrs["fov"] = fov
+                temp_file.attrs["window"] = window
+
+            os.rename(temp_filename, self.filename(fov, window, parameters))
+        except:
+            os.remove(temp_filename)
+            raise
+
+    def find(self, fov, window, parameters):
+        """
+            Finds the cached dictionary whose window overlaps the most with the window given.
+
+            Args:
+                fov(str):                   name of the field of view.
+                window(numpy.ndarray):      start and stop along each spatial axis in the FOV.
+                parameters(dict):           parameters the dictionary was learned with.
+
+            Returns:
+                (numpy.ndarray, numpy.ndarray): the dictionary and its window or None if none overlap.
+        """
+
+        window = numpy.asarray(window, dtype = int)
+
+        best_filename = None
+        best_window = None
+        best_overlap_size = 0
+        for each_filename in sorted(glob.glob(os.path.join(self.dirname, self.key(fov, parameters) + "_*"))):
+            try:
+                with h5py.File(each_filename, "r") as each_file:
+                    each_window = each_file.attrs["window"]
+            except (IOError, KeyError):
+                # Removed or still being written.
+                continue
+
+            if each_window.shape != window.shape:
+                continue
+
+            each_overlap = find_window_overlap(window, each_window)
+            each_overlap_size = numpy.prod(each_overlap[:, 1] - each_overlap[:, 0])
+
+            if each_overlap_size > best_overlap_size:
+                best_filename = each_filename
+                best_window = each_window
+                best_overlap_size = each_overlap_size
+
+        if best_filename is None:
+            return(None)
+
+        with h5py.File(best_filename, "r") as best_file:
+            best_dictionary = best_file["dictionary"][...]
+
+        logger.debug("Found cached dictionary \"" + best_filename + "\" for window \"" + repr(window.tolist()) + "\".")
+
+        return(best_dictionary, best_window)
+
+    def find_seed(self, fov, window, parameters):
+        """
+            Finds a dictionary to start learning from for the window given. This is the cached dictionary overlapping
+            the most with the window. Its atoms are cropped to the overlap and the rest of the window is zero.
+
+            Args:
+                fov(str):                   name of the field of view.
+                window(numpy.ndarray):      start and stop along each spatial axis in the FOV.
+                parameters(dict):           parameters the dictionary was learned with.
+
+            Returns:
+                numpy.ndarray:              the dictionary to start from or None if there is nothing to start
+                                            from.
+        """
+
+        window = numpy.asarray(window, dtype = int)
+
+        found = self.find(fov, window, parameters)
+        if found is None:
+            return(None)
+
+        cached_dictionary, cached_window = found
+
+        if (cached_window == window).all():
+            return(cached_dictionary)
+
+        overlap = find_window_overlap(window, cached_window)
+
+        seed = numpy.zeros((len(cached_dictionary),) + tuple(window[:, 1] - window[:, 0]),
+                           dtype = cached_dictionary.dtype)
+        seed[(slice(None),) + tuple([slice(_1, _2) for _1, _2 in (overlap - window[:, :1]).tolist()])] = \
+            cached_dictionary[
+                (slice(None),) + tuple([slice(_1, _2) for _1, _2 in (overlap - cached_window[:, :1]).tolist()])
+            ]
+
+        return(seed)
+
+
+@prof.log_call(logger)
+def hash_array(new_array, block_frame_length = None):
+    """
+        Finds a hash of the contents of an array (along with its shape and type). The array is read a block of frames
+        at a time. So, it may be a h5py.Dataset larger than memory.
+
+        Args:
+            new_array(numpy.ndarray):       array to hash (first axis is time).
+            block_frame_length(int):        number of frames to read at a time (all if None).
+
+        Returns:
+            str:                            the hash as a hex string.
+
+        Examples:
+            >>> hash_array(numpy.arange(6).reshape(3, 2)) == hash_array(numpy.arange(6).reshape(3, 2), 2)
+            True
+
+            >>> hash_array(numpy.arange(6).reshape(3, 2)) == hash_array(numpy.arange(6).reshape(2, 3))
+            False
+    """
+
+    if block_frame_length is None:
+        block_frame_length = max(1, len(new_array))
+
+    new_array_hash = hashlib.sha1()
+    new_array_hash.update(numpy.dtype(new_array.dtype).str)
+    new_array_hash.update(repr(tuple(new_array.shape)))
+
+    for i in xrange(0, len(new_array), block_frame_length):
+        new_array_hash.update(numpy.ascontiguousarray(new_array[i:i + block_frame_length]).data)
+
+    return(new_array_hash.hexdigest())
+
+
+@prof.log_class(logger)
+class StageCache(object):
+    """
+        Keeps results of stages on disk addressed by a key (e.g. a hash of the stage's input and parameters). Each is
+        an HDF5 file in the cache directory. Using an entry marks it as recently used. If a size limit is given, the
+        least recently used entries are removed to stay within it.
+
+        Files are written elsewhere in the directory and then moved into place. So, several processes may share a
+        cache.
+    """
+
+    def __init__(self, dirname, max_size = None):
+        """
+            Opens a cache (creating the directory if needed).
+
+            Args:
+                dirname(str):               directory where the cache is kept.
+                max_size(int):              most bytes that entries may take up (no limit if None).
+        """
+
+        self.dirname = dirname
+        self.max_size = max_size
+
+        try:
+            os.makedirs(self.dirname)
+        except OSError:
+            # If it already exists, that is fine.
+            if not os.path.isdir(self.dirname):
+                raise
+
+    def filename(self, key):
+        """
+            Finds the file an entry is kept in.
+
+            Args:
+                key(str):                   key of the entry.
+
+            Returns:
+                str:                        the filename.
+        """
+
+        return(os.path.join(self.dirname, key + os.extsep + "h5"))
+
+    def __contains__(self, key):
+        return(os.path.exists(self.filename(key)))
+
+    def touch(self, key):
+        """
+            Marks an entry as recently used.
+
+            Args:
+                key(str):                   key of the entry.
+        """
+
+        try:
+            os.utime(self.filename(key), None)
+        except OSError:
+            # Already removed.
+            pass
+
+    def get(self, key, default = None):
+        """
+            Reads an entry.
+
+            Args:
+                key(str):                   key of the entry.
+                default:                    what to return if there is no entry.
+
+            Returns:
+                numpy.ndarray:              the value of the entry.
+        """
+
+        try:
+            with h5py.File(self.filename(key), "r") as entry_file:
+                value = entry_file["data"][...]
+        except IOError:
+            return(default)
+
+        self.touch(key)
+
+        return(value)
+
+    def load(self, key, recorder, name, block_frame_length = None):
+        """
+            Copies an entry into a recorder a block of frames at a time. So, it need not fit in memory.
+
+            Args:
+                key(str):                   key of the entry.
+                recorder(HDF5ArrayRecorder): where to copy the entry to.
+                name(str):                  name to give the entry in recorder.
+                block_frame_length(int):    number of frames to copy at a time (all if None).
+
+            Returns:
+                h5py.Dataset:               the copy in recorder (None if there is no entry).
+        """
+
+        try:
+            entry_file = h5py.File(self.filename(key), "r")
+        except IOError:
+            return(None)
+
+        with entry_file:
+            entry_data = entry_file["data"]
+
+            if block_frame_length is None:
+                block_frame_length = max(1, len(entry_data))
+
+            value = recorder.create_dataset(name, entry_data.shape, entry_data.dtype, chunks = True)
+            for i in xrange(0, len(entry_data), block_frame_length):
+                value[i:i + block_frame_length] = entry_data[i:i + block_frame_length]
+
+        self.touch(key)
+
+        return(value)
+
+    def put(self, key, value, block_frame_length = None):
+        """
+            Adds an entry (replacing any with the same key). Then, removes the least recently used entries if the
+            cache is too large.
+
+            Args:
+                key(str):                   key of the entry.
+                value(numpy.ndarray):       value of the entry (may be a h5py.Dataset).
+                block_frame_length(int):    number of frames to copy at a time (all if None).
+        """
+
+        if block_frame_length is None:
+            block_frame_length = max(1, len(value))
+
+        fd, temp_filename = tempfile.mkstemp(suffix = os.extsep + "h5" + os.extsep + "tmp", dir = self.dirname)
+        os.close(fd)
+
+        try:
+            with h5py.File(temp_filename, "w") as temp_file:
+                temp_data = temp_file.create_dataset("data", value.shape, value.dtype, chunks = (True if value.size else None))
+                for i in xrange(0, len(value), block_frame_length):
+                    temp_data[i:i + block_frame_length] = value[i:i + block_frame_length]
+
+            os.rename(temp_filename, self.filename(key))
+        except:
+            os.remove(temp_filename)
+            raise
+
+        self.evict(keep = key)
+
+    def evict(self, keep = None):
+        """
+            Removes the least recently used entries until the cache is within its size limit.
+
+            Args:
+                keep(str):                  key of an entry to keep regardless (e.g. the one just added).
+        """
+
+        if self.max_size is None:
+            return
+
+        entries = []
+        for each_filename in glob.glob(os.path.join(self.dirname, "*" + os.extsep + "h5")):
+            try:
+                each_stat = os.stat(each_filename)
+            except OSError:
+                continue
+
+            entries.append((each_stat.st_mtime, each_stat.st_size, each_filename))
+
+        entries.sort()
+
+        total_size = sum([_[1] for _ in entries])
+        for each_mtime, each_size, each_filename in entries:
+            if total_size <= self.max_size:
+                break
+
+            if (keep is not None) and (each_filename == self.filename(keep)):
+                continue
+
+            try:
+                os.remove(each_filename)
+            except OSError:
+                pass
+
+            total_size -= each_size
+
+            logger.debug("Evicted \"" + each_filename + "\" from the stage cache.")
@@ -0,0 +1,208 @@
+import atexit
+import collections
+import contextlib
+import os
+import threading
+
+import h5py
+
+
+# Need in order to have logging information no matter what.
+from nanshe.util import prof
+
+
+# Get the logger
+logger = prof.logging.getLogger(__name__)
+
+
+@prof.log_class(logger)
+class HDF5FilePool(object):
+    """
+        Keeps HDF5 files open so that they can be shared instead of opened again (each open can be slow on network
+        filesystems). Files are counted while in use (between acquire and release). Once no longer in use, they are
+        kept open. The least recently used are closed when there are more than max_open_files.
+
+        A file opened for reading is reopened for writing if asked (only if it is not in use). Files that other
+        processes will open (especially for writing) should be closed first (see close).
+
+        Examples:
+            >>> import tempfile; temp_dir = tempfile.mkdtemp()
+            >>> filename = os.path.join(temp_dir, "test.h5")
+
+            >>> pool = HDF5FilePool(max_open_files = 1)
+
+            >>> with pool.open(filename, "a") as file_handle:
+            ...     file_handle["data"] = [1, 2, 3]
+
+            >>> with pool.open(filename, "r") as file_handle:
+            ...     print file_handle["data"][...]
+            [1 2 3]
+
+            >>> filename in pool
+            True
+
+            >>> pool.close()
+
+            >>> filename in pool
+            False
+
+            >>> import shutil; shutil.rmtree(temp_dir)
+    """
+
+    # Modes that can be used to write.
+    write_modes = ["r+", "a"]
+
+    def __init__(self, max_open_files = 64):
+        self.max_open_files = max_open_files
+
+        self.lock = threading.RLock()
+
+        # Open files in order of last use (most recent last). Each has the file handle and the number of users.
+        self.file_handles = collections.OrderedDict()
+
+    @staticmethod
+    def key(filename):
+        return(os.path.realpath(filename))
+
+    def __contains__(self, filename):
+        with self.lock:
+            return(HDF5FilePool.key(filename) in self.file_handles)
+
+    def __len__(self):
+        with self.lock:
+            return(len(self.file_handles))
+
+    def acquire(self, filename, mode = "r"):
+        """
+            Gets an open file (opening it if needed) and marks it as in use.
+
+            Args:
+                filename(str):          HDF5 file to open.
+                mode(str):              "r" to read or "r+"/"a" to write.
+
+            Returns:
+                h5py.File:              the open file.
+        """
+
+        if (mode != "r") and (mode not in HDF5FilePool.write_modes):
+            raise ValueError("Unsupported mode: \"" + repr(mode) + "\".")
+
+        key = HDF5FilePool.key(filename)
+
+        with self.lock:
+            file_handle, count = self.file_handles.pop(key, (None, 0))
+
+            if (file_handle is not None) and (not file_handle):
+                # Closed somewhere else.
+                file_handle, count = None, 0
+
+            if (file_handle is not None) and (mode in HDF5FilePool.write_modes) and (file_handle.mode != "r+"):
+                if count:
+                    self.file_handles[key] = (file_handle, count)
+
+                    raise IOError("Unable to reopen \"" + filename + "\" for writing while it is being read.")
+
+                file_handle.close()
+                file_handle = None
+
+            if file_handle is None:
+                file_handle = h5py.File(filename, mode)
+
+            self.file_handles[key] = (file_handle, count + 1)
+
+            self.evict()
+
+        return(file_handle)
+
+    def release(self, file_handle):
+        """
+            Marks a file (previously acquired) as no longer in use. It is flushed and kept open.
+
+            Args:
+                file_handle(h5py.File):     file to release.
+        """
+
+        key = HDF5FilePool.key(file_handle.filename)
+
+        with self.lock:
+            file_handle, count = self.file_handles[key]
+
+            if file_handle and (file_handle.mode == "r+"):
+                file_handle.flush()
+
+            self.file_handles[key] = (file_handle, count - 1)
+
+            self.evict()
+
+    @contextlib.contextmanager
+    def open(self, filename, mode = "r"):
+        file_handle = self.acquire(filename, mode)
+
+        try:
+            yield file_handle
+        finally:
+            self.release(file_handle)
+
+    def evict(self):
+        # Closes the least recently used files that are not in use until at most max_open_files are left.
+        with self.lock:
+            for each_key in list(self.file_handles.keys()):
+                if len(self.file_handles) <= self.max_open_files:
+                    break
+
+                each_file_handle, each_count = self.file_handles[each_key]
+
+                if not each_count:
+                    del self.file_handles[each_key]
+
+                    if each_file_handle:
+                        each_file_handle.close()
+
+    def close(self, filename = None):
+        """
+            Closes a file (or all files) not in use.
+
+            Args:
+                filename(str):          file to close (all if None).
+        """
+
+        with self.lock:
+            keys = list(self.file_handles.keys())
+            if filename is not None:
+                keys = [_ for _ in keys if _ == HDF5FilePool.key(filename)]
+
+            for each_key in keys:
+                each_file_handle, each_count = self.file_handles[each_key]
+
+                if not each_count:
+                    del self.file_handles[each_key]
+
+                    if each_file_handle:
+                        each_file_handle.close()
+
+
+# Pool for this process (along with the process ID to find out if it was inherited on fork).
+file_pool = (None, None)
+
+
+@prof.log_call(logger)
+def get_file_pool():
+    """
+        Gets the HDF5FilePool for this process. After a fork, the child gets a new pool instead of using the parent's
+        files.
+
+        Returns:
+            HDF5FilePool:           the pool of open HDF5 files for this process.
+    """
+
+    global file_pool
+
+    pid, pool = file_pool
+
+    if pid != os.getpid():
+        pool = HDF5FilePool()
+        file_pool = (os.getpid(), pool)
+
+        atexit.register(pool.close)
+
+    return(pool)
@@ -2,6 +2,12 @@ __author__ = "John Kirkham <kirkhamj@janelia.hhmi.org>"
 __date__ = "$Jun 04, 2014 11:10:55 EDT$"
 
 
+import os
+import Queue
+import tempfile
+import threading
+import traceback
+
 import numpy
 import h5py
 
@@ -17,6 +23,120 @@ from nanshe.util import prof
 logger = prof.logging.getLogger(__name__)
 
 
+@prof.log_class(logger)
+class DeferredArray(object):
+    """
+        Wraps a callable (and its arguments) that computes an array to be recorded. Recorders only call it when they
+        actually record something. So, debug-only arrays cost nothing when recording is disabled.
+
+        Examples:
+            >>> EmptyArrayRecorder()["a"] = DeferredArray(numpy.ones, (2,))
+
+            >>> DeferredArray(numpy.ones, (2,))()
+            array([ 1.,  1.])
+    """
+
+    def __init__(self, a_callable, *args, **kwargs):
+        self.a_callable = a_callable
+        self.args = args
+        self.kwargs = kwargs
+
+    def __call__(self):
+        return(self.a_callable(*self.args, **self.kwargs))
+
+
+@prof.log_class(logger)
+class HDF5ArrayWriter(object):
+    """
+        Writes arrays to an HDF5 file in batches from a background thread. Writes are queued until they take up
+        max_buffer_size bytes. Then, they are written together and the file is flushed once for the whole batch.
+        Only one batch is queued behind the one being written. So, at most about twice max_buffer_size is held.
+
+        Errors raised while writing are raised again on the next call (submit, wait, or close).
+    """
+
+    def __init__(self, hdf5_handle, max_buffer_size = 2**26):
+        self.hdf5_file = hdf5_handle.file
+        self.max_buffer_size = max_buffer_size
+
+        self.batch = []
+        self.batch_size = 0
+
+        self.batches = Queue.Queue(maxsize = 1)
+        self.error = None
+
+        self.thread = threading.Thread(target = self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while True:
+            batch = self.batches.get()
+
+            try:
+                if batch is None:
+                    break
+
+                # Drop later writes after a failure. It will be raised in the main thread.
+                if self.error is None:
+                    try:
+                        for each_callable, each_args, each_kwargs in batch:
+                            each_callable(*each_args, **each_kwargs)
+
+                        self.hdf5_file.flush()
+                    except Exception as e:
+                        logger.error(traceback.format_exc())
+
+                        self.error = e
+            finally:
+                self.batches.task_done()
+
+    def raise_error(self):
+        if self.error is not None:
+            error = self.error
+            self.error = None
+
+            raise(error)
+
+    def submit(self, nbytes, a_callable, *args, **kwargs):
+        self.raise_error()
+
+        self.batch.append((a_callable, args, kwargs))
+        self.batch_size += nbytes
+
+        if self.batch_size >= self.max_buffer_size:
+            self.send()
+
+    def send(self):
+        if self.batch:
+            # Blocks while the previous batch is still waiting to be written.
+            self.batches.put(self.batch)
+
+            self.batch = []
+            self.batch_size = 0
+
+    def wait(self):
+        self.send()
+        self.batches.join()
+
+        self.raise_error()
+
+    def close(self):
+        if self.thread is not None:
+            try:
+                self.wait()
+            finally:
+                self.batches.put(None)
+                self.thread.join()
+                self.thread = None
+
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
 @prof.log_class(logger)
 class EmptyArrayRecorder(object):
     def __init__(self):
@@ -57,19 +177,49 @@ class EmptyArrayRecorder(object):
                 raise ValueError("Cannot store dataset in top level group.")
         elif (value is None) or (value is h5py.Group):
             self.__recorders.add(key)
+        elif isinstance(value, DeferredArray):
+            # Nothing is recorded. So, there is no need to compute it.
+            pass
         else:
             if value.size:
                 pass
             else:
                 raise ValueError("The array provided for output by the name: \"" + key + "\" is empty.")
 
+    def create_dataset(self, key, shape, dtype, **kwargs):
+        # Nothing is recorded. However, the dataset may not fit in memory (e.g. a whole movie). So, it is kept in a
+        # temporary HDF5 file instead. The file is removed right away, but stays open until the dataset is released.
+        fd, temp_filename = tempfile.mkstemp(suffix = os.extsep + "h5")
+        os.close(fd)
+
+        try:
+            temp_file = h5py.File(temp_filename, "w")
+            dataset = temp_file.create_dataset(key, shape, dtype=dtype, **kwargs)
+        finally:
+            os.remove(temp_filename)
+
+        return(dataset)
+
 
 @prof.log_class(logger)
 class HDF5ArrayRecorder(object):
-    def __init__(self, hdf5_handle, overwrite = False):
+    def __init__(self, hdf5_handle, overwrite = False, writer = None):
         self.hdf5_handle = hdf5_handle
         self.overwrite = overwrite
 
+        # If given, arrays are written in batches by this HDF5ArrayWriter.
+        self.writer = writer
+
+    def wait(self):
+        # Ensures all queued writes have reached the file.
+        if self.writer is not None:
+            self.writer.wait()
+
+    def flush(self):
+        # The writer flushes once per batch instead.
+        if self.writer is None:
+            self.hdf5_handle.file.flush()
+
     def __nonzero__(self):
         return(True)
 
@@ -87,33 +237,45 @@ class HDF5ArrayRecorder(object):
         return(value)
 
     def __contains__(self, key):
+        self.wait()
+
         return(key in self.hdf5_handle)
 
     def __getitem__(self, key):
         if (key == "."):
             return(self)
 
+        self.wait()
+
         try:
             if isinstance(self.hdf5_handle[key], h5py.Group):
-                return(HDF5ArrayRecorder(self.hdf5_handle[key], overwrite = self.overwrite))
+                return(HDF5ArrayRecorder(self.hdf5_handle[key], overwrite = self.overwrite, writer = self.writer))
             else:
                 return(serializers.read_numpy_structured_array_from_HDF5(self.hdf5_handle, key))
         except:
             raise(KeyError("unable to open object (Symbol table: Can't open object " + repr(key) + " in " + repr(self.hdf5_handle) + ")"))
 
     def __setitem__(self, key, value):
+        if isinstance(value, DeferredArray):
+            value = value()
+
         if (key == "."):
             if not ( (value is None) or (value is h5py.Group) ):
                 raise ValueError("Cannot store dataset in top level group ( " + self.hdf5_handle.name + " ).")
 
             if self.overwrite:
+                # Queued writes may be in what is being removed.
+                self.wait()
+
                 for each_key in self.hdf5_handle:
                     del self.hdf5_handle[each_key]
 
-                self.hdf5_handle.file.flush()
+                self.flush()
         elif (value is None) or (value is h5py.Group):
             # Check to see if the output must go somewhere special.
             if key:
+                self.wait()
+
                 # If so, check to see if it exists.
                 if key in self.hdf5_handle:
                     # If it does and we want to overwrite it, do so.
@@ -122,37 +284,67 @@ class HDF5ArrayRecorder(object):
 
                         self.hdf5_handle.create_group(key)
 
-                        self.hdf5_handle.file.flush()
+                        self.flush()
                 else:
                     # Create it if it doesn't, exist.
                     self.hdf5_handle.create_group(key)
 
-                    self.hdf5_handle.file.flush()
+                    self.flush()
         else:
             # Attempt to create a dataset in self.hdf5_handle named key with value and do not overwrite.
             # Exception will be thrown if value is empty or if key already exists (as intended).
             if value.size:
-                serializers.create_numpy_structured_array_in_HDF5(self.hdf5_handle,
-                                                                      key,
-                                                                      value,
-                                                                      overwrite = self.overwrite)
-                self.hdf5_handle.file.flush()
+                if self.writer is None:
+                    serializers.create_numpy_structured_array_in_HDF5(self.hdf5_handle,
+                                                                          key,
+                                                                          value,
+                                                                          overwrite = self.overwrite)
+                    self.hdf5_handle.file.flush()
+                else:
+                    # Copied as the caller may change the array before it is written.
+                    value = numpy.array(value)
+
+                    self.writer.submit(value.nbytes,
+                                       serializers.create_numpy_structured_array_in_HDF5,
+                                       self.hdf5_handle,
+                                       key,
+                                       value,
+                                       overwrite = self.overwrite)
 
                 return()
             else:
                 raise ValueError("The array provided for output by the name: \"" + key + "\" is empty.")
 
+    def create_dataset(self, key, shape, dtype, **kwargs):
+        # Provides an empty dataset to be filled in piece by piece (e.g. when the whole array won't fit in memory).
+        self.wait()
+
+        if key in self.hdf5_handle:
+            if self.overwrite:
+                del self.hdf5_handle[key]
+            else:
+                raise ValueError("A dataset by the name: \"" + key + "\" already exists.")
+
+        dataset = self.hdf5_handle.create_dataset(key, shape, dtype=dtype, **kwargs)
+        self.flush()
+
+        return(dataset)
+
 
 @prof.log_class(logger)
 class HDF5EnumeratedArrayRecorder(object):
-    def __init__(self, hdf5_handle):
+    def __init__(self, hdf5_handle, writer = None):
         self.hdf5_handle = hdf5_handle
 
+        # If given, arrays are written in batches by this HDF5ArrayWriter.
+        # Groups are still created right away as the indices depend on them.
+        self.writer = writer
+
         # Must be a logger if it already exists.
         assert self.hdf5_handle.attrs.get("is_logger", True)
 
         self.hdf5_handle.attrs["is_logger"] = True
-        self.hdf5_handle.file.flush()
+        self.flush()
 
         self.hdf5_index_data_handles = {"." : -1}
         for each_index in self.hdf5_handle:
@@ -187,12 +379,25 @@ class HDF5EnumeratedArrayRecorder(object):
 
         return(value)
 
+    def wait(self):
+        # Ensures all queued writes have reached the file.
+        if self.writer is not None:
+            self.writer.wait()
+
+    def flush(self):
+        # The writer flushes once per batch instead.
+        if self.writer is None:
+            self.hdf5_handle.file.flush()
+
     def __contains__(self, key):
         return(self.get(key) is not None)
 
     def __getitem__(self, key):
         if (key == "."):
             return(self)
+
+        self.wait()
+
         try:
             root_i = self.hdf5_index_data_handles.get(".", -1)
             key_i = self.hdf5_index_data_handles.get(key, -1)
@@ -207,7 +412,7 @@ class HDF5EnumeratedArrayRecorder(object):
 
             key_handle = self.hdf5_handle[root_i_str][key]
             if key_i is None:
-                return(HDF5EnumeratedArrayRecorder(key_handle))
+                return(HDF5EnumeratedArrayRecorder(key_handle, writer = self.writer))
             else:
                 key_i_str = str(key_i)
                 return(serializers.read_numpy_structured_array_from_HDF5(key_handle, key_i_str))
@@ -215,13 +420,16 @@ class HDF5EnumeratedArrayRecorder(object):
             raise(KeyError("unable to open object (Symbol table: Can't open object " + repr(key) + " in " + repr(self.hdf5_handle) + ")"))
 
     def __setitem__(self, key, value):
+        if isinstance(value, DeferredArray):
+            value = value()
+
         if (key == "."):
             if not ( (value is None) or (value is h5py.Group) ):
                 raise ValueError("Cannot store dataset in top level group ( " + self.hdf5_handle.name + " ).")
 
             self.hdf5_index_data_handles = { "." : self.hdf5_index_data_handles["."] + 1 }
             self.hdf5_handle.create_group(str(self.hdf5_index_data_handles["."]))
-            self.hdf5_handle.file.flush()
+            self.flush()
         else:
             hdf5_index_handle = None
             try:
@@ -231,7 +439,7 @@ class HDF5EnumeratedArrayRecorder(object):
                     self.hdf5_index_data_handles = { "." : self.hdf5_index_data_handles["."] + 1 }
 
                 self.hdf5_handle.create_group(str(self.hdf5_index_data_handles["."]))
-                self.hdf5_handle.file.flush()
+                self.flush()
 
                 hdf5_index_handle = self.hdf5_handle[str(self.hdf5_index_data_handles["."])]
 
@@ -239,7 +447,7 @@ class HDF5EnumeratedArrayRecorder(object):
                 # Create a group if it doesn't already exist.
                 hdf5_index_handle.require_group(key)
                 hdf5_index_handle.attrs["is_logger"] = True
-                hdf5_index_handle.file.flush()
+                self.flush()
                 self.hdf5_index_data_handles[key] = None
             else:
                 # Attempt to create a dataset in self.hdf5_handle named key with value and do not overwrite.
@@ -250,23 +458,36 @@ class HDF5EnumeratedArrayRecorder(object):
                 try:
                     assert isinstance(value, numpy.ndarray)
                 except AssertionError:
-                    if not value.dtype.names:
+                    if hasattr(value, "__array__") and not isinstance(value, numpy.generic):
+                        # e.g. segment.SparseNeuronSet
+                        value = numpy.asarray(value)
+                    elif not value.dtype.names:
                         raise
                 if value.size:
                     # If so, check to see if it exists.
                     if key not in self.hdf5_index_data_handles:
                         hdf5_index_handle.create_group(key)
                         hdf5_index_handle[key].attrs["is_logger"] = False
-                        hdf5_index_handle.file.flush()
+                        self.flush()
                         self.hdf5_index_data_handles[key] = -1
 
                     self.hdf5_index_data_handles[key] += 1
 
-                    serializers.create_numpy_structured_array_in_HDF5(hdf5_index_handle[key],
-                                                                           str(self.hdf5_index_data_handles[key]),
-                                                                           value)
+                    if self.writer is None:
+                        serializers.create_numpy_structured_array_in_HDF5(hdf5_index_handle[key],
+                                                                               str(self.hdf5_index_data_handles[key]),
+                                                                               value)
 
-                    self.hdf5_handle.file.flush()
+                        self.hdf5_handle.file.flush()
+                    else:
+                        # Copied as the caller may change the array before it is written.
+                        value = numpy.array(value)
+
+                        self.writer.submit(value.nbytes,
+                                           serializers.create_numpy_structured_array_in_HDF5,
+                                           hdf5_index_handle[key],
+                                           str(self.hdf5_index_data_handles[key]),
+                                           value)
                 else:
                     raise ValueError("The array provided for output by the name: \"" + key + "\" is empty.")
 
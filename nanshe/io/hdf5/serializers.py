@@ -3,10 +3,19 @@ __date__ = "$May 14, 2014 22:19:59 EDT$"
 
 
 import os
+import warnings
 
 import numpy
 import h5py
 
+try:
+    # Registers extra HDF5 filters (e.g. LZ4 and Blosc) for reading and writing.
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
+
+
+import pool
 
 # Need in order to have logging information no matter what.
 from nanshe.util import prof
@@ -17,7 +26,113 @@ logger = prof.logging.getLogger(__name__)
 
 
 @prof.log_call(logger)
-def create_numpy_structured_array_in_HDF5(file_handle, internalPath, data, overwrite = False):
+def guess_chunks(shape, dtype, layout = None, chunk_size = 2**20):
+    """
+        Picks a chunk shape for a dataset given how it will be read.
+
+        Args:
+            shape(tuple):               shape of the dataset.
+            dtype(numpy.dtype):         type of the dataset.
+            layout(str):                how the dataset is read. Either "frames" (movies read a frame at a time),
+                                        "records" (neuron tables read a neuron at a time), "pixels" (read as traces
+                                        through all frames), or None to leave it to h5py.
+            chunk_size(int):            number of bytes to aim for in each chunk.
+
+        Returns:
+            chunks(tuple or bool):      chunk shape to use (or True to let h5py choose).
+
+        Examples:
+            >>> guess_chunks((100, 64, 64), numpy.float32, "frames", chunk_size = 2**16)
+            (4, 64, 64)
+
+            >>> guess_chunks((100, 64, 64), numpy.float32, "frames", chunk_size = 2**10)
+            (1, 64, 64)
+
+            >>> guess_chunks((10,), numpy.dtype([("area", int)]), "records")
+            (10,)
+
+            >>> guess_chunks((100, 64, 64), numpy.float32, "pixels", chunk_size = 2**16)
+            (100, 12, 12)
+
+            >>> guess_chunks((100, 64, 64), numpy.float32)
+            True
+    """
+
+    shape = tuple(shape)
+    dtype = numpy.dtype(dtype)
+
+    if (layout is None) or (not shape) or (0 in shape):
+        return(True)
+
+    chunks = None
+    if layout in ["frames", "records"]:
+        # Only whole frames (or records) are kept in each chunk.
+        entry_size = dtype.itemsize * int(numpy.prod(shape[1:]))
+        num_entries = max(1, chunk_size // max(1, entry_size))
+
+        chunks = (min(shape[0], num_entries),) + shape[1:]
+    elif layout == "pixels":
+        # All frames for a square tile of pixels.
+        num_pixels = max(1, chunk_size // (dtype.itemsize * shape[0]))
+
+        if len(shape) > 1:
+            tile_length = max(1, int(num_pixels ** (1.0 / (len(shape) - 1))))
+            chunks = (shape[0],) + tuple(min(_, tile_length) for _ in shape[1:])
+        else:
+            chunks = shape
+    else:
+        raise ValueError("Unknown layout: \"" + repr(layout) + "\".")
+
+    return(chunks)
+
+
+@prof.log_call(logger)
+def get_compression_kwargs(compression = None):
+    """
+        Gets the arguments needed for h5py to compress a dataset.
+
+        Args:
+            compression(str):           compression to use. Either "lz4" or "blosc" (requires hdf5plugin), "gzip",
+                                        or None for no compression. Without hdf5plugin, "lz4" and "blosc" fall back to
+                                        "gzip".
+
+        Returns:
+            dict:                       keyword arguments for h5py.Group.create_dataset.
+
+        Examples:
+            >>> get_compression_kwargs()
+            {}
+
+            >>> sorted(get_compression_kwargs("gzip").items())
+            [('compression', 'gzip'), ('compression_opts', 4), ('shuffle', True)]
+    """
+
+    if compression is None:
+        return({})
+
+    if compression in ["lz4", "blosc"]:
+        if hdf5plugin is not None:
+            if compression == "lz4":
+                return(dict(hdf5plugin.LZ4()))
+            else:
+                return(dict(hdf5plugin.Blosc(cname = "lz4", shuffle = hdf5plugin.Blosc.SHUFFLE)))
+        else:
+            warnings.warn(
+                "Unable to use \"" + compression + "\" compression without hdf5plugin. Falling back to gzip.",
+                RuntimeWarning
+            )
+
+            compression = "gzip"
+
+    if compression == "gzip":
+        return({"compression" : "gzip", "compression_opts" : 4, "shuffle" : True})
+    else:
+        raise ValueError("Unknown compression: \"" + repr(compression) + "\".")
+
+
+@prof.log_call(logger)
+def create_numpy_structured_array_in_HDF5(file_handle, internalPath, data, overwrite = False, layout = None,
+                                          compression = None):
     """
         Serializes a NumPy structure array to an HDF5 file by using the HDF5 compound data type.
         Also, will handle normal NumPy arrays and scalars, as well.
@@ -34,6 +149,8 @@ def create_numpy_structured_array_in_HDF5(file_handle, internalPath, data, overw
             internalPath(str):          an internal path for the HDF5 file.
             data(numpy.ndarray):        the NumPy structure array to save (or normal NumPy array).
             overwrite(bool):            whether to overwrite what is already there (defaults to False).
+            layout(str):                how the data will be read to pick chunks (see guess_chunks).
+            compression(str):           how to compress the data (see get_compression_kwargs).
     """
 
     close_file_handle = False
@@ -51,12 +168,18 @@ def create_numpy_structured_array_in_HDF5(file_handle, internalPath, data, overw
                 raise TypeError("The argument provided for data is type: \"" + repr(type(data)) + "\" is not convertible to type \"" + repr(numpy.ndarray) + "\".")
 
 
+    # Scalars can't be chunked or compressed.
+    dataset_kwargs = {}
+    if data_array.ndim:
+        dataset_kwargs["chunks"] = guess_chunks(data_array.shape, data_array.dtype, layout)
+        dataset_kwargs.update(get_compression_kwargs(compression))
+
     try:
         file_handle.create_dataset(internalPath,
                                    shape = data_array.shape,
                                    dtype = data_array.dtype,
                                    data = data_array,
-                                   chunks = bool(data_array.ndim))
+                                   **dataset_kwargs)
     except RuntimeError:
         if overwrite:
             del file_handle[internalPath]
@@ -64,7 +187,7 @@ def create_numpy_structured_array_in_HDF5(file_handle, internalPath, data, overw
                                        shape = data_array.shape,
                                        dtype = data_array.dtype,
                                        data = data_array,
-                                       chunks = True)
+                                       **dataset_kwargs)
         else:
             raise
 
@@ -73,7 +196,7 @@ def create_numpy_structured_array_in_HDF5(file_handle, internalPath, data, overw
 
 
 @prof.log_call(logger)
-def read_numpy_structured_array_from_HDF5(file_handle, internalPath):
+def read_numpy_structured_array_from_HDF5(file_handle, internalPath, lazy = False):
     """
         Serializes a NumPy structure array from an HDF5 file by using the HDF5 compound data type.
         Also, it will handle normal NumPy arrays and scalars, as well.
@@ -85,6 +208,8 @@ def read_numpy_structured_array_from_HDF5(file_handle, internalPath):
         Args:
             file_handle(HDF5 file):     either an HDF5 file or an HDF5 filename.
             internalPath(str):          an internal path for the HDF5 file.
+            lazy(bool):                 whether to return an HDF5LazyArray, which only reads what is indexed (must be
+                                        closed if file_handle is a filename or a reference to another file is used).
 
         Note:
             TODO: Write doctests.
@@ -93,6 +218,9 @@ def read_numpy_structured_array_from_HDF5(file_handle, internalPath):
             data(numpy.ndarray):    the NumPy structure array.
     """
 
+    if lazy:
+        return(HDF5LazyArray(file_handle, internalPath))
+
     close_file_handle = False
 
     if isinstance(file_handle, str) or isinstance(file_handle, unicode):
@@ -109,7 +237,7 @@ def read_numpy_structured_array_from_HDF5(file_handle, internalPath):
     if isinstance(data_ref, h5py.Reference):
         if ("filename" in data_object.attrs) and \
            (os.path.normpath(data_object.attrs["filename"]) != os.path.normpath(data_file.filename)):
-            with h5py.File(data_object.attrs["filename"], "r") as external_file_handle:
+            with pool.get_file_pool().open(data_object.attrs["filename"], "r") as external_file_handle:
                 if isinstance(data_ref, h5py.RegionReference):
                     data = external_file_handle[data_ref][data_ref]
                 else:
@@ -125,7 +253,7 @@ def read_numpy_structured_array_from_HDF5(file_handle, internalPath):
             assert ("dataset" in data_object.attrs)
 
             new_dataset_name = data_object.attrs["dataset"]
-            with h5py.File(data_object.attrs["filename"], "r") as external_file_handle:
+            with pool.get_file_pool().open(data_object.attrs["filename"], "r") as external_file_handle:
                 # assert isinstance(new_dataset_name, h5py.Dataset)
 
                 if ("field" in data_object.attrs) and ("slice" in data_object.attrs):
@@ -152,6 +280,238 @@ def read_numpy_structured_array_from_HDF5(file_handle, internalPath):
     return(data)
 
 
+@prof.log_class(logger)
+class HDF5LazyArray(object):
+    """
+        Provides an array stored by create_numpy_structured_array_in_HDF5 that is only read when it is indexed. Only
+        what is indexed is read. So, single fields (e.g. the area of each neuron) can be read without the rest.
+
+        References and pseudo-references are resolved once (when constructed). Files opened to do so are kept open
+        (through the HDF5FilePool) until close is called. If the reference selects only part of a dataset (e.g. a slice or a region), that part
+        is read once on first use and kept in memory. Other indexing is then done on it.
+
+        Examples:
+            >>> import tempfile; temp_dir = tempfile.mkdtemp()
+            >>> filename = os.path.join(temp_dir, "test.h5")
+
+            >>> data = numpy.zeros((3,), dtype=[("area", int), ("mask", bool, (2, 2))])
+            >>> data["area"] = [1, 2, 3]
+
+            >>> create_numpy_structured_array_in_HDF5(filename, "data", data)
+
+            >>> with HDF5LazyArray(filename, "data") as data_lazy:
+            ...     print data_lazy.shape
+            ...     print data_lazy["area"]
+            ...     print data_lazy["mask", 1:].shape
+            ...     print data_lazy["mask"].shape
+            (3,)
+            [1 2 3]
+            (2, 2, 2)
+            (3, 2, 2)
+
+            >>> import shutil; shutil.rmtree(temp_dir)
+    """
+
+    def __init__(self, file_handle, internalPath):
+        # Files opened here (closed with close).
+        self.file_handles = []
+
+        if isinstance(file_handle, str) or isinstance(file_handle, unicode):
+            file_handle = self.open_file(file_handle)
+
+        self.dataset = None
+        self.field = None
+        self.selection = None
+        self.selected_data = None
+
+        data_object = file_handle[internalPath]
+        data_file = data_object.file
+
+        # Check the type without reading anything.
+        data_ref_type = h5py.check_dtype(ref=data_object.dtype)
+
+        if data_ref_type is not None:
+            data_ref = data_object[()]
+
+            if ("filename" in data_object.attrs) and \
+               (os.path.normpath(data_object.attrs["filename"]) != os.path.normpath(data_file.filename)):
+                data_file = self.open_file(data_object.attrs["filename"])
+
+            self.dataset = data_file[data_ref]
+
+            if isinstance(data_ref, h5py.RegionReference):
+                self.selection = data_ref
+        elif ("filename" in data_object.attrs):
+            # It's a pseudo-ref.
+            assert ("dataset" in data_object.attrs)
+
+            data_file = self.open_file(data_object.attrs["filename"])
+
+            self.dataset = data_file[data_object.attrs["dataset"]]
+
+            if ("field" in data_object.attrs):
+                self.field = data_object.attrs["field"]
+
+            if ("slice" in data_object.attrs):
+                self.selection = eval(data_object.attrs["slice"])
+
+                if not isinstance(self.selection, tuple):
+                    self.selection = (self.selection,)
+        else:
+            self.dataset = data_object
+
+    def open_file(self, filename):
+        file_handle = pool.get_file_pool().acquire(filename, "r")
+        self.file_handles.append(file_handle)
+
+        return(file_handle)
+
+    def close(self):
+        for each_file_handle in self.file_handles:
+            pool.get_file_pool().release(each_file_handle)
+
+        self.file_handles = []
+
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def read_selected(self):
+        # Reads only the part of the dataset that was referred to (once).
+        if self.selected_data is None:
+            if isinstance(self.selection, h5py.RegionReference):
+                self.selected_data = self.dataset[self.selection]
+
+                if self.field is not None:
+                    self.selected_data = self.selected_data[self.field]
+            elif self.field is not None:
+                self.selected_data = self.dataset[(self.field,) + self.selection]
+            else:
+                self.selected_data = self.dataset[self.selection]
+
+        return(self.selected_data)
+
+    @property
+    def dtype(self):
+        if self.selection is not None:
+            return(self.read_selected().dtype)
+        elif self.field is not None:
+            return(self.dataset.dtype[self.field].base)
+        else:
+            return(self.dataset.dtype)
+
+    @property
+    def shape(self):
+        if self.selection is not None:
+            return(self.read_selected().shape)
+        elif self.field is not None:
+            return(self.dataset.shape + self.dataset.dtype[self.field].shape)
+        else:
+            return(self.dataset.shape)
+
+    @property
+    def ndim(self):
+        return(len(self.shape))
+
+    @property
+    def size(self):
+        return(int(numpy.prod(self.shape)))
+
+    def __len__(self):
+        return(self.shape[0])
+
+    def __getitem__(self, key):
+        if self.selection is not None:
+            return(self.read_selected()[key])
+
+        if not isinstance(key, tuple):
+            key = (key,)
+
+        # Field names are handled by h5py when given with the slicing.
+        if self.field is not None:
+            key = (self.field,) + key
+
+        return(self.dataset[key])
+
+    def __array__(self, dtype=None):
+        result = self[...]
+
+        if dtype is not None:
+            result = result.astype(dtype)
+
+        return(result)
+
+
+@prof.log_call(logger)
+def create_sparse_neurons_in_HDF5(file_handle, internalPath, shape, neurons, pixels, overwrite = False,
+                                  compression = None):
+    """
+        Serializes the parts of a sparse neuron set (segment.SparseNeuronSet) to an HDF5 group. The group contains
+        the datasets neurons and pixels and has the frame shape as an attribute.
+
+        Args:
+            file_handle(HDF5 file):     either an HDF5 file or an HDF5 filename.
+            internalPath(str):          an internal path for the HDF5 file.
+            shape(tuple):               shape of a frame.
+            neurons(numpy.ndarray):     structured array of neurons (dtype segment.get_sparse_neuron_dtype).
+            pixels(numpy.ndarray):      structured array of pixels (dtype segment.get_sparse_neuron_pixel_dtype).
+            overwrite(bool):            whether to overwrite what is already there (defaults to False).
+            compression(str):           how to compress the data (see get_compression_kwargs).
+    """
+
+    close_file_handle = False
+
+    if isinstance(file_handle, str) or isinstance(file_handle, unicode):
+        file_handle = h5py.File(file_handle, "a")
+        close_file_handle = True
+
+    if (internalPath in file_handle) and overwrite:
+        del file_handle[internalPath]
+
+    group = file_handle.create_group(internalPath)
+    group.attrs["shape"] = numpy.array(shape, dtype=numpy.int64)
+
+    create_numpy_structured_array_in_HDF5(group, "neurons", neurons, layout = "records", compression = compression)
+    create_numpy_structured_array_in_HDF5(group, "pixels", pixels, layout = "records", compression = compression)
+
+    if close_file_handle:
+        file_handle.close()
+
+
+@prof.log_call(logger)
+def read_sparse_neurons_from_HDF5(file_handle, internalPath):
+    """
+        Reads the parts of a sparse neuron set (segment.SparseNeuronSet) from an HDF5 group (as written by
+        create_sparse_neurons_in_HDF5).
+
+        Args:
+            file_handle(HDF5 file):     either an HDF5 file or an HDF5 filename.
+            internalPath(str):          an internal path for the HDF5 file.
+
+        Returns:
+            (tuple):                    the frame shape, the neurons, and the pixels.
+    """
+
+    close_file_handle = False
+
+    if isinstance(file_handle, str) or isinstance(file_handle, unicode):
+        file_handle = h5py.File(file_handle, "r")
+        close_file_handle = True
+
+    group = file_handle[internalPath]
+
+    shape = tuple(group.attrs["shape"].tolist())
+    neurons = group["neurons"][...]
+    pixels = group["pixels"][...]
+
+    if close_file_handle:
+        file_handle.close()
+
+    return((shape, neurons, pixels))
+
+
 class HDF5MaskedDataset(object):
     """
         Provides an abstraction of the masked array the HDF5 Group where the contents of a
@@ -12,6 +12,7 @@ import vigra.impex
 
 from nanshe.util import iters, xglob, prof,\
     xnumpy, pathHelpers
+from nanshe.io.hdf5 import serializers
 
 
 
@@ -245,10 +246,13 @@ def convert_tiffs(new_tiff_filenames, new_hdf5_pathname, axis = 0, channel = 0,
             new_hdf5_file.create_group(new_hdf5_groupname)
 
         new_hdf5_group = new_hdf5_file[new_hdf5_groupname]
+        # Chunk by frame as that is how the viewer reads them.
         new_hdf5_dataset = new_hdf5_group.create_dataset(new_hdf5_dataset_name,
                                                          new_hdf5_dataset_shape,
                                                          new_hdf5_dataset_dtype,
-                                                         chunks=True)
+                                                         chunks=serializers.guess_chunks(new_hdf5_dataset_shape,
+                                                                                         new_hdf5_dataset_dtype,
+                                                                                         "frames"))
 
         new_hdf5_dataset_axis_pos = 0
         for each_new_tiff_filename in new_tiff_filenames:
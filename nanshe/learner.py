@@ -7,6 +7,7 @@ import json
 import itertools
 import multiprocessing
 import subprocess
+import sys
 import time
 
 # Generally useful and fast to import so done immediately.
@@ -20,7 +21,7 @@ import nanshe
 from nanshe.util import prof
 
 from nanshe.util import iters, xnumpy,\
-    wrappers, pathHelpers
+    wrappers, pathHelpers, xmultiprocessing
 
 from nanshe.io import hdf5
 
@@ -100,14 +101,26 @@ def generate_neurons_a_block(input_filename, output_filename, debug = False, **p
     output_group_name = output_filename_details.internalPath
 
 
+    # With a memory budget, the input data is left on disk and preprocessed a tile at a time.
+    memory_budget = parameters["generate_neurons"]["preprocess_data"].get("memory_budget", None)
+
+    # Files are opened once and shared (until the block is done).
+    file_pool = hdf5.pool.get_file_pool()
+
     # Read the input data.
     original_images = None
-    with h5py.File(input_filename_details.externalPath, "r") as input_file_handle:
-        original_images = hdf5.serializers.read_numpy_structured_array_from_HDF5(input_file_handle, input_dataset_name)
-        original_images = original_images.astype(numpy.float32)
+    original_images_window = None
+    with file_pool.open(input_filename_details.externalPath, "r") as input_file_handle:
+        # Blocks are given by the slice of the full field of view that they take.
+        if "slice" in input_file_handle[input_dataset_name].attrs:
+            original_images_window = eval(input_file_handle[input_dataset_name].attrs["slice"])
+
+        if memory_budget is None:
+            original_images = hdf5.serializers.read_numpy_structured_array_from_HDF5(input_file_handle, input_dataset_name)
+            original_images = original_images.astype(numpy.float32)
 
     # Write out the output.
-    with h5py.File(output_filename_details.externalPath, "a") as output_file_handle:
+    with file_pool.open(output_filename_details.externalPath, "a") as output_file_handle:
         # Create a new output directory if doesn't exists.
         if output_group_name not in output_file_handle:
             output_file_handle.create_group(output_group_name)
@@ -123,12 +136,20 @@ def generate_neurons_a_block(input_filename, output_filename, debug = False, **p
             else:
                 output_group["original_images"] = h5py.ExternalLink(input_filename_details.externalPath, input_dataset_name)
 
+        # Debug arrays are written in batches in the background (if needed)
+        array_debug_writer = None
+        array_debug_recorder_kwargs = {}
+        if debug:
+            array_debug_writer = hdf5.record.HDF5ArrayWriter(output_group)
+            array_debug_recorder_kwargs["writer"] = array_debug_writer
+
         # Get a debug logger for the HDF5 file (if needed)
         array_debug_recorder = hdf5.record.generate_HDF5_array_recorder(output_group,
             group_name = "debug",
             enable = debug,
             overwrite_group = False,
-            recorder_constructor = hdf5.record.HDF5EnumeratedArrayRecorder
+            recorder_constructor = hdf5.record.HDF5EnumeratedArrayRecorder,
+            **array_debug_recorder_kwargs
         )
 
         # Saves intermediate result to make resuming easier
@@ -137,10 +158,27 @@ def generate_neurons_a_block(input_filename, output_filename, debug = False, **p
             overwrite = True
         )
 
+        input_file_handle = None
+        if memory_budget is not None:
+            if input_filename_details.externalPath == output_filename_details.externalPath:
+                original_images = output_file_handle[input_dataset_name]
+            else:
+                input_file_handle = file_pool.acquire(input_filename_details.externalPath, "r")
+                original_images = input_file_handle[input_dataset_name]
+
         # Generate the neurons and attempt to resume if possible
-        generate_neurons.resume_logger = resume_logger
-        generate_neurons.recorders.array_debug_recorder = array_debug_recorder
-        generate_neurons(original_images = original_images, **parameters["generate_neurons"])
+        try:
+            generate_neurons.resume_logger = resume_logger
+            generate_neurons.recorders.array_debug_recorder = array_debug_recorder
+            generate_neurons(original_images = original_images,
+                             window = original_images_window,
+                             **parameters["generate_neurons"])
+        finally:
+            if array_debug_writer is not None:
+                array_debug_writer.close()
+
+            if input_file_handle is not None:
+                file_pool.release(input_file_handle)
 
         # Save the configuration parameters in the attributes as a string.
         if "parameters" not in output_group.attrs:
@@ -150,9 +188,273 @@ def generate_neurons_a_block(input_filename, output_filename, debug = False, **p
                                                         )
             )
 
+    # The output is read by others once done (e.g. merging blocks). So, both files are closed here.
+    file_pool.close(output_filename_details.externalPath)
+    file_pool.close(input_filename_details.externalPath)
+
+
+@prof.log_call(logger)
+def generate_neurons_a_block_redirected(parameters_filename, input_filename, output_filename, stdout_filename, stderr_filename):
+    """
+        Runs generate_neurons_io_handler on a single block. Designed to be run in a WorkerPool worker. Like the
+        subprocess backend, the stdout and stderr of the worker are redirected to the given files while it runs.
+
+        Args:
+            parameters_filename     JSON filename with parameters.
+            input_filename          HDF5 filename to read from (should be a path to a h5py.Dataset)
+            output_filename         HDF5 filename to write to (should be a path to a h5py.Group)
+            stdout_filename         file to redirect stdout to.
+            stderr_filename         file to redirect stderr to.
+    """
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+    original_stdout, original_stderr = sys.stdout, sys.stderr
+
+    # Redirect at the file descriptor level (when there is one) so that loggers and any C extensions are caught too.
+    # sys.stdout and sys.stderr may not have one (e.g. nose capturing output or in a notebook). So, those of
+    # sys.__stdout__ and sys.__stderr__ are used. Also, sys.stdout and sys.stderr are swapped for any Python code.
+    stdout_fd = get_fileno(sys.__stdout__)
+    stderr_fd = get_fileno(sys.__stderr__)
+
+    original_stdout_fd = os.dup(stdout_fd) if stdout_fd is not None else None
+    original_stderr_fd = os.dup(stderr_fd) if stderr_fd is not None else None
+    try:
+        with open(stdout_filename, "w") as stdout_file, open(stderr_filename, "w") as stderr_file:
+            if stdout_fd is not None:
+                os.dup2(stdout_file.fileno(), stdout_fd)
+            if stderr_fd is not None:
+                os.dup2(stderr_file.fileno(), stderr_fd)
+
+            sys.stdout, sys.stderr = stdout_file, stderr_file
+
+            try:
+                generate_neurons_io_handler(input_filename, output_filename, parameters_filename)
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+
+                sys.stdout, sys.stderr = original_stdout, original_stderr
+
+                if stdout_fd is not None:
+                    os.dup2(original_stdout_fd, stdout_fd)
+                if stderr_fd is not None:
+                    os.dup2(original_stderr_fd, stderr_fd)
+    finally:
+        if original_stdout_fd is not None:
+            os.close(original_stdout_fd)
+        if original_stderr_fd is not None:
+            os.close(original_stderr_fd)
+
+
+@prof.log_call(logger)
+def get_fileno(a_file):
+    """
+        Gets the file descriptor of a file object if it has one.
+
+        Args:
+            a_file(file):           file object (may be None or have no file descriptor like StringIO).
+
+        Returns:
+            int:                    the file descriptor or None if there is none.
+
+        Examples:
+            >>> import StringIO
+            >>> get_fileno(StringIO.StringIO()) is None
+            True
+
+            >>> import tempfile
+            >>> with tempfile.TemporaryFile() as f:
+            ...     get_fileno(f) == f.fileno()
+            True
+    """
+
+    try:
+        a_file.flush()
+        return(a_file.fileno())
+    except (AttributeError, ValueError, IOError):
+        return(None)
+
+
+@prof.log_call(logger)
+def read_block_neurons(block_filename, window_trimmed_slice, sparse = False):
+    """
+        Reads the neurons found in a block and keeps only those that are more than half within the block (excluding
+        the overlapping window).
+
+        Args:
+            block_filename(str):                HDF5 filename of the block's output.
+            window_trimmed_slice(tuple):        slices selecting the block from the windowed block.
+            sparse(bool):                       whether to return a SparseNeuronSet instead.
+
+        Returns:
+            numpy.ndarray:                      the accepted neurons (in the coordinates of the windowed block) or
+                                                None if there were no neurons.
+    """
+
+    neurons_block_accepted = None
+
+    with hdf5.pool.get_file_pool().open(block_filename, "r") as block_file_handle:
+        if "neurons" in block_file_handle:
+            # Only the masks are needed to decide which neurons to keep. So, the rest is only read for those kept.
+            with hdf5.serializers.read_numpy_structured_array_from_HDF5(block_file_handle, "/neurons", lazy = True) as neurons_block_smaller:
+                neurons_block_smaller_mask = neurons_block_smaller["mask"]
+
+                neurons_block_windowed_count = numpy.squeeze(numpy.apply_over_axes(numpy.sum, neurons_block_smaller_mask.astype(float), tuple(xrange(1, neurons_block_smaller_mask.ndim))))
+
+                if neurons_block_windowed_count.shape == tuple():
+                    neurons_block_windowed_count = numpy.array([neurons_block_windowed_count])
+
+                neurons_block_non_windowed_count = numpy.squeeze(numpy.apply_over_axes(numpy.sum, neurons_block_smaller_mask[window_trimmed_slice].astype(float), tuple(xrange(1, neurons_block_smaller_mask.ndim))))
+
+                if neurons_block_non_windowed_count.shape == tuple():
+                    neurons_block_non_windowed_count = numpy.array([neurons_block_non_windowed_count])
+
+                if len(neurons_block_non_windowed_count):
+                    # Find ones that are inside the margins by more than half
+                    neurons_block_acceptance = ((neurons_block_non_windowed_count / neurons_block_windowed_count) > 0.5)
+
+                    # Take a subset of our previous neurons that are within the margins by half
+                    neurons_block_acceptance = neurons_block_acceptance.nonzero()[0]
+                    if len(neurons_block_acceptance):
+                        neurons_block_accepted = neurons_block_smaller[list(neurons_block_acceptance)]
+                    else:
+                        neurons_block_accepted = neurons_block_smaller[:0]
+
+                    if sparse:
+                        neurons_block_accepted = segment.sparsify_neurons(neurons_block_accepted)
+
+    return(neurons_block_accepted)
+
+
+@prof.log_class(logger)
+class BlockNeuronsMerger(object):
+    """
+        Merges the neurons found in each block into one set of neurons for the whole field of view.
+
+        Blocks can be added in any order as soon as they finish. Their neurons are read, sparsified and moved into the
+        field of view right away. However, they are merged strictly in block order (as soon as all preceding blocks
+        have been added). merge_neuron_sets is not commutative (ties go to the earlier neuron and fused neurons can
+        match again), so merging in completion order would make the result depend on scheduling. Merging in block
+        order keeps the result identical to merging all blocks after they finish. If merging eagerly is disabled, all
+        merging is left until finish.
+    """
+
+    def __init__(self, shape, block_filenames, block_windowed_slices, block_window_trimmed_slices, to_merge_eagerly = True, **parameters):
+        """
+            Constructs a merger with no neurons.
+
+            Args:
+                shape(tuple):                           shape of a frame for the whole field of view.
+                block_filenames(list):                  HDF5 filename of each block's output.
+                block_windowed_slices(list):            slices placing each windowed block within the field of view.
+                block_window_trimmed_slices(list):      slices selecting each block from its windowed block.
+                to_merge_eagerly(bool):                 whether to merge as soon as possible or only on finish.
+                **parameters(dict):                     passed to segment.merge_neuron_sets.
+        """
+
+        assert (len(block_filenames) == len(block_windowed_slices) == len(block_window_trimmed_slices))
+
+        # Sparse so that only the pixels of each neuron are kept (instead of the whole field of view).
+        self.neurons = segment.get_empty_sparse_neurons(shape=shape, dtype=float)
+
+        self.block_filenames = block_filenames
+        self.block_windowed_slices = block_windowed_slices
+        self.block_window_trimmed_slices = block_window_trimmed_slices
+
+        self.to_merge_eagerly = to_merge_eagerly
+        self.parameters = parameters
+
+        self.next_block_index = 0
+        self.waiting_blocks = {}
+
+    def __len__(self):
+        return(len(self.block_filenames))
+
+    def add_block(self, block_index):
+        """
+            Reads the neurons of a finished block and merges any blocks that are now next in order.
+
+            Args:
+                block_index(int):                       which block has finished.
+        """
+
+        assert (self.next_block_index <= block_index < len(self))
+        assert (block_index not in self.waiting_blocks)
+
+        self.waiting_blocks[block_index] = self.read_block(block_index)
+
+        if self.to_merge_eagerly:
+            self.merge_waiting_blocks()
+
+    def read_block(self, block_index):
+        """
+            Reads the neurons of a finished block and places them in the field of view.
+
+            Args:
+                block_index(int):                       which block to read.
+
+            Returns:
+                SparseNeuronSet:                        the accepted neurons of the block (in the coordinates of the
+                                                        field of view) or None if there were no neurons.
+        """
+
+        neurons_block_accepted = read_block_neurons(self.block_filenames[block_index],
+                                                    self.block_window_trimmed_slices[block_index],
+                                                    sparse = True)
+
+        if neurons_block_accepted is not None:
+            windowed_slice = self.block_windowed_slices[block_index]
+
+            # Only the pixels are moved. Other properties are copied as is.
+            #TODO: Correct centroid to larger block position.
+            neurons_block_accepted = neurons_block_accepted.astype(self.neurons.dtype).translate(
+                [_.indices(_1)[0] for _, _1 in itertools.izip(windowed_slice[1:], self.neurons.shape)],
+                self.neurons.shape
+            )
+
+        return(neurons_block_accepted)
+
+    def merge_waiting_blocks(self, array_debug_recorder = hdf5.record.EmptyArrayRecorder()):
+        """
+            Merges the blocks that have been added in order until one is reached that has not been added.
+
+            Args:
+                array_debug_recorder(ArrayRecorder):    where merge_neuron_sets records debug information.
+        """
+
+        while self.next_block_index in self.waiting_blocks:
+            neurons_block = self.waiting_blocks.pop(self.next_block_index)
+
+            if neurons_block is not None:
+                segment.merge_neuron_sets.recorders.array_debug_recorder = array_debug_recorder
+                self.neurons = segment.merge_neuron_sets(self.neurons, neurons_block, **self.parameters)
+
+            self.next_block_index += 1
+
+    def finish(self, array_debug_recorder = hdf5.record.EmptyArrayRecorder()):
+        """
+            Reads any blocks not yet added and merges all remaining blocks in order.
+
+            Args:
+                array_debug_recorder(ArrayRecorder):    where merge_neuron_sets records debug information.
+
+            Returns:
+                numpy.ndarray:                          the merged neurons.
+        """
+
+        for each_block_index in xrange(self.next_block_index, len(self)):
+            if each_block_index not in self.waiting_blocks:
+                self.waiting_blocks[each_block_index] = self.read_block(each_block_index)
+
+        self.merge_waiting_blocks(array_debug_recorder)
+
+        return(segment.densify_neurons(self.neurons))
+
 
 @prof.log_call(logger)
-def generate_neurons_blocks(input_filename, output_filename, num_processes = multiprocessing.cpu_count(), block_shape = None, num_blocks = None, half_window_shape = None, half_border_shape = None, use_drmaa = False, num_drmaa_cores = 16, debug = False, **parameters):
+def generate_neurons_blocks(input_filename, output_filename, num_processes = multiprocessing.cpu_count(), block_shape = None, num_blocks = None, half_window_shape = None, half_border_shape = None, use_drmaa = False, num_drmaa_cores = 16, use_process_pool = True, debug = False, **parameters):
     #TODO: Move this function into a new module with its own command line interface.
     #TODO: Heavy refactoring required on this function.
 
@@ -180,9 +482,12 @@ def generate_neurons_blocks(input_filename, output_filename, num_processes = mul
     intermediate_output_dir = output_filename_details.externalPath.rsplit(output_filename_details.extension, 1)[0] + "_blocks"
 
 
+    # Files are opened once and shared (until the blocks are run).
+    file_pool = hdf5.pool.get_file_pool()
+
     # Read the input data.
     original_images_shape_array = None
-    with h5py.File(input_filename_details.externalPath, "r") as input_file_handle:
+    with file_pool.open(input_filename_details.externalPath, "r") as input_file_handle:
         original_images_shape_array = numpy.array(input_file_handle[input_dataset_name].shape)
 
     # Get the amount of the border to slice
@@ -340,7 +645,7 @@ def generate_neurons_blocks(input_filename, output_filename, num_processes = mul
     output_filename_block = []
     stdout_filename_block = []
     stderr_filename_block = []
-    with h5py.File(output_filename_details.externalPath, "a") as output_file_handle:
+    with file_pool.open(output_filename_details.externalPath, "a") as output_file_handle:
         # Create a new output directory if doesn't exists.
         if output_group_name not in output_file_handle:
             output_file_handle.create_group(output_group_name)
@@ -358,13 +663,8 @@ def generate_neurons_blocks(input_filename, output_filename, num_processes = mul
 
         output_group_blocks = output_group["blocks"]
 
-        input_file_handle = None
-        try:
-            # Skipping using region refs.
-            input_file_handle = h5py.File(input_filename_details.externalPath, "r")
-        except IOError:
-            # File is already open
-            input_file_handle = output_file_handle
+        # Skipping using region refs. (Gets the output file if they are the same.)
+        input_file_handle = file_pool.acquire(input_filename_details.externalPath, "r")
 
         for i, i_str, sequential_block_i in iters.filled_stringify_enumerate(original_images_pared_slices.flat):
             intermediate_basename_i = intermediate_output_dir + "/" + i_str
@@ -386,7 +686,7 @@ def generate_neurons_blocks(input_filename, output_filename, num_processes = mul
 
             block_i = output_group_blocks[i_str]
 
-            with h5py.File(intermediate_basename_i + os.extsep + "h5", "a") as each_block_file_handle:
+            with file_pool.open(intermediate_basename_i + os.extsep + "h5", "a") as each_block_file_handle:
                 # Create a soft link to the original images. But use the appropriate type of soft link depending on whether
                 # the input and output file are the same.
                 if "original_images" not in each_block_file_handle:
@@ -395,8 +695,10 @@ def generate_neurons_blocks(input_filename, output_filename, num_processes = mul
                 input_filename_block.append(each_block_file_handle.filename + "/" + "original_images")
                 output_filename_block.append(each_block_file_handle.filename + "/")
 
-        if input_file_handle != output_file_handle:
-            input_file_handle.close()
+        file_pool.release(input_file_handle)
+
+    # The blocks open these files in other processes. So, they must be closed here.
+    file_pool.close()
 
     cur_module_dirpath = os.path.dirname(os.path.dirname(nanshe.__file__))
     cur_module_filepath = os.path.splitext(os.path.abspath(__file__))[0]
@@ -404,8 +706,6 @@ def generate_neurons_blocks(input_filename, output_filename, num_processes = mul
     cur_module_name = cur_module_name.replace(os.path.sep, ".")
     cur_module_filepath += os.extsep + "py"
 
-    import sys
-
     python = sys.executable
 
     executable_run = ""
@@ -416,6 +716,18 @@ def generate_neurons_blocks(input_filename, output_filename, num_processes = mul
     executable_run += "from %s import main; exit(main(*argv))" % \
                       (cur_module_name,)
 
+    # Merges blocks in order as they finish (while other blocks run). When debugging, merging is left until the end as
+    # the debug information is recorded in the output file.
+    block_merger = BlockNeuronsMerger(
+        tuple(original_images_shape_array[1:]),
+        [_.rstrip("/") for _ in output_filename_block],
+        [tuple([slice(_1, _2, 1) for _1, _2 in [(None, None)] + _["windowed_stack_selection"].tolist()[1:]]) for _ in original_images_pared_slices.flat],
+        [tuple([slice(_1, _2, 1) for _1, _2 in _["windowed_block_selection"].tolist()]) for _ in original_images_pared_slices.flat],
+        to_merge_eagerly = not debug,
+        **parameters["generate_neurons"]["postprocess_data"]["merge_neuron_sets"]
+    )
+    block_index_by_output = dict([(_2, _1) for _1, _2 in enumerate(output_filename_block)])
+
     block_process_args_gen = itertools.izip(itertools.repeat(python),
                                             itertools.repeat("-c"),
                                             itertools.repeat(executable_run),
@@ -477,6 +789,8 @@ def generate_neurons_blocks(input_filename, output_filename, num_processes = mul
 
             logger.info("Finished process ( \"" + " ".join(each_arg_pack) + "\" ).")
             s.deleteJobTemplate(each_process_template)
+
+            block_merger.add_block(block_index_by_output[each_arg_pack[5]])
             # finished_processes.append((each_arg_pack, each_process_id))
 
         s.exit()
@@ -485,8 +799,39 @@ def generate_neurons_blocks(input_filename, output_filename, num_processes = mul
         diff_queue_time = end_queue_time - start_queue_time
 
         logger.info("Run time for queued jobs to complete is \"" + str(diff_queue_time) + " s\".")
+    elif use_process_pool:
+        start_queue_time = time.time()
+        logger.info("Waiting for blocks to complete.")
+
+        # Workers are forked once and stay warm (modules already imported). Each pulls the next block when idle.
+        with xmultiprocessing.WorkerPool(min(num_processes, len(output_filename_block))) as block_pool:
+            block_futures = {}
+            for each_block_args in itertools.izip(itertools.repeat(intermediate_config),
+                                                  input_filename_block,
+                                                  output_filename_block,
+                                                  stdout_filename_block,
+                                                  stderr_filename_block):
+                each_block_future = block_pool.submit(generate_neurons_a_block_redirected, *each_block_args)
+                block_futures[each_block_future] = each_block_args
+
+                logger.info("Queued block ( \"" + " ".join(each_block_args) + "\" ).")
+
+            for each_block_future in xmultiprocessing.as_completed(block_futures):
+                each_block_args = block_futures[each_block_future]
+
+                if each_block_future.exception() is not None:
+                    logger.error("Block ( \"" + " ".join(each_block_args) + "\" ) has failed. See \"" + each_block_args[-1] + "\" for details.")
+                    raise each_block_future.exception()
+
+                logger.info("Finished block ( \"" + " ".join(each_block_args) + "\" ) in \"" + str(each_block_future.run_time) + " s\".")
+
+                block_merger.add_block(block_index_by_output[each_block_args[2]])
+
+        end_queue_time = time.time()
+        diff_queue_time = end_queue_time - start_queue_time
+
+        logger.info("Run time for blocks to complete is \"" + str(diff_queue_time) + " s\".")
     else:
-        # TODO: Refactor into a separate class (have it return futures somehow)
         # finished_processes = []
         running_processes = []
         pool_tasks_empty = False
@@ -513,6 +858,8 @@ def generate_neurons_blocks(input_filename, output_filename, num_processes = mul
                     if running_processes[i][1].poll() is not None:
                         logger.info("Finished process ( \"" + " ".join(running_processes[i][0]) + "\" ).")
 
+                        block_merger.add_block(block_index_by_output[running_processes[i][0][5]])
+
                         # finished_processes.append(running_processes[i])
                         del running_processes[i]
                     else:
@@ -524,62 +871,31 @@ def generate_neurons_blocks(input_filename, output_filename, num_processes = mul
     start_time = time.time()
     logger.info("Starting merge over all blocks.")
 
-    with h5py.File(output_filename_details.externalPath, "a") as output_file_handle:
+    with file_pool.open(output_filename_details.externalPath, "a") as output_file_handle:
         output_group = output_file_handle[output_group_name]
 
-        new_neurons_set = segment.get_empty_neuron(shape=tuple(original_images_shape_array[1:]), dtype=float)
+        array_debug_writer = None
+        array_debug_recorder_kwargs = {}
+        if debug:
+            array_debug_writer = hdf5.record.HDF5ArrayWriter(output_group)
+            array_debug_recorder_kwargs["writer"] = array_debug_writer
 
-        for i, i_str, (output_filename_block_i, sequential_block_i) in iters.filled_stringify_enumerate(itertools.izip(output_filename_block, original_images_pared_slices.flat)):
-            windowed_slice_i = tuple([slice(_1, _2, 1) for _1, _2 in [(None, None)] + sequential_block_i["windowed_stack_selection"].tolist()[1:]])
-            window_trimmed_i = tuple([slice(_1, _2, 1) for _1, _2 in sequential_block_i["windowed_block_selection"].tolist()])
-            output_filename_block_i = output_filename_block_i.rstrip("/")
-
-            with h5py.File(output_filename_block_i, "r") as each_block_file_handle:
-                if "neurons" in each_block_file_handle:
-                    neurons_block_i_smaller = hdf5.serializers.read_numpy_structured_array_from_HDF5(each_block_file_handle, "/neurons")
-
-                    neurons_block_i_windowed_count = numpy.squeeze(numpy.apply_over_axes(numpy.sum, neurons_block_i_smaller["mask"].astype(float), tuple(xrange(1, neurons_block_i_smaller["mask"].ndim))))
-
-                    if neurons_block_i_windowed_count.shape == tuple():
-                        neurons_block_i_windowed_count = numpy.array([neurons_block_i_windowed_count])
-
-                    neurons_block_i_non_windowed_count = numpy.squeeze(numpy.apply_over_axes(numpy.sum, neurons_block_i_smaller["mask"][window_trimmed_i].astype(float), tuple(xrange(1, neurons_block_i_smaller["mask"].ndim))))
-
-                    if neurons_block_i_non_windowed_count.shape == tuple():
-                        neurons_block_i_non_windowed_count = numpy.array([neurons_block_i_non_windowed_count])
-
-                    if len(neurons_block_i_non_windowed_count):
-                        # Find ones that are inside the margins by more than half
-                        neurons_block_i_acceptance = ((neurons_block_i_non_windowed_count / neurons_block_i_windowed_count) > 0.5)
-
-                        # Take a subset of our previous neurons that are within the margins by half
-                        neurons_block_i_accepted = neurons_block_i_smaller[neurons_block_i_acceptance]
-
-                        neurons_block_i = numpy.zeros(neurons_block_i_accepted.shape, dtype=new_neurons_set.dtype)
-                        neurons_block_i["mask"][windowed_slice_i] = neurons_block_i_accepted["mask"]
-                        neurons_block_i["contour"][windowed_slice_i] = neurons_block_i_accepted["contour"]
-                        neurons_block_i["image"][windowed_slice_i] = neurons_block_i_accepted["image"]
-
-                        # Copy other properties
-                        neurons_block_i["area"] = neurons_block_i_accepted["area"]
-                        neurons_block_i["max_F"] = neurons_block_i_accepted["max_F"]
-                        neurons_block_i["gaussian_mean"] = neurons_block_i_accepted["gaussian_mean"]
-                        neurons_block_i["gaussian_cov"] = neurons_block_i_accepted["gaussian_cov"]
-                        #TODO: Correct centroid to larger block position.
-                        neurons_block_i["centroid"] = neurons_block_i_accepted["centroid"]
-
-                        array_debug_recorder = hdf5.record.generate_HDF5_array_recorder(output_group,
-                            group_name = "debug",
-                            enable = debug,
-                            overwrite_group = False,
-                            recorder_constructor = hdf5.record.HDF5EnumeratedArrayRecorder
-                        )
+        array_debug_recorder = hdf5.record.generate_HDF5_array_recorder(output_group,
+            group_name = "debug",
+            enable = debug,
+            overwrite_group = False,
+            recorder_constructor = hdf5.record.HDF5EnumeratedArrayRecorder,
+            **array_debug_recorder_kwargs
+        )
 
-                        segment.merge_neuron_sets.recorders.array_debug_recorder = array_debug_recorder
-                        new_neurons_set = segment.merge_neuron_sets(new_neurons_set, neurons_block_i,
-                                                                                      **parameters["generate_neurons"]["postprocess_data"]["merge_neuron_sets"])
+        try:
+            new_neurons_set = block_merger.finish(array_debug_recorder)
+        finally:
+            if array_debug_writer is not None:
+                array_debug_writer.close()
 
-        hdf5.serializers.create_numpy_structured_array_in_HDF5(output_group, "neurons", new_neurons_set, overwrite = True)
+        hdf5.serializers.create_numpy_structured_array_in_HDF5(output_group, "neurons", new_neurons_set, overwrite = True,
+                                                               layout = "records")
 
         if "parameters" not in output_group["neurons"].attrs:
             output_group["neurons"].attrs["parameters"] = repr(dict(list(parameters.items()) + \
@@ -589,11 +905,15 @@ def generate_neurons_blocks(input_filename, output_filename, num_processes = mul
                                                                       ("half_border_shape", half_border_shape),
                                                                       ("use_drmaa", use_drmaa),
                                                                       ("num_drmaa_cores", num_drmaa_cores),
+                                                                      ("use_process_pool", use_process_pool),
                                                                       ("debug", debug)
                                                                     ]
                                                               )
             )
 
+    # Leave the files closed for whoever uses them next.
+    file_pool.close()
+
     logger.info("Finished merge over all blocks.")
     end_time = time.time()
 
@@ -605,37 +925,120 @@ def generate_neurons_blocks(input_filename, output_filename, num_processes = mul
 @prof.log_call(logger)
 @hdf5.record.static_subgrouping_array_recorders(array_debug_recorder = hdf5.record.EmptyArrayRecorder())
 @wrappers.static_variables(resume_logger = hdf5.record.EmptyArrayRecorder())
-def generate_neurons(original_images, run_stage = "all", **parameters):
+def generate_neurons(original_images, run_stage = "all", window = None, **parameters):
+    # If given, preprocessing works through tiles within this many bytes. So, original_images may be a h5py.Dataset.
+    memory_budget = parameters["preprocess_data"].get("memory_budget", None)
+
+    # Number of frames to read at a time when original_images may not fit in memory.
+    frames_block_size = None
+    if memory_budget is not None:
+        frames_block_size = max(1, int(memory_budget // (4 * numpy.prod(original_images.shape[1:]))))
+
     if "original_images_max_projection" not in generate_neurons.recorders.array_debug_recorder:
-        generate_neurons.recorders.array_debug_recorder["original_images_max_projection"] = xnumpy.add_singleton_op(
-            numpy.max,
-            original_images,
-            axis = 0
-        )
+        if memory_budget is None:
+            generate_neurons.recorders.array_debug_recorder["original_images_max_projection"] = xnumpy.add_singleton_op(
+                numpy.max,
+                original_images,
+                axis = 0
+            )
+        else:
+            generate_neurons.recorders.array_debug_recorder["original_images_max_projection"] = xnumpy.blocked_reduce(
+                numpy.maximum,
+                original_images,
+                frames_block_size
+            )
 
     if "original_images_mean_projection" not in generate_neurons.recorders.array_debug_recorder:
-        generate_neurons.recorders.array_debug_recorder["original_images_mean_projection"] = xnumpy.add_singleton_op(
-            numpy.mean,
-            original_images,
-            axis = 0
-        )
+        if memory_budget is None:
+            generate_neurons.recorders.array_debug_recorder["original_images_mean_projection"] = xnumpy.add_singleton_op(
+                numpy.mean,
+                original_images,
+                axis = 0
+            )
+        else:
+            generate_neurons.recorders.array_debug_recorder["original_images_mean_projection"] = xnumpy.blocked_reduce(
+                numpy.add,
+                original_images,
+                frames_block_size,
+                dtype = numpy.float64
+            ) / len(original_images)
+
+    # Results of each stage may be kept in a cache. Each is keyed on a hash of the input of the stage (e.g. the
+    # original images) with the parameters of the stage and those before it. So, stages whose input and parameters
+    # have not changed are skipped. The dictionary and neurons keys are found once their input is known.
+    stage_cache = None
+    stage_cache_keys = {}
+    if "stage_cache" in parameters:
+        stage_cache = hdf5.cache.StageCache(parameters["stage_cache"]["dirname"],
+                                            parameters["stage_cache"].get("max_size", None))
+
+        # Includes memory_budget. Preprocessing in tiles can give different results (see preprocess_data_halo).
+        stage_cache_keys["preprocessed_images"] = hdf5.cache.hash_parameters({
+            "original_images" : hdf5.cache.hash_array(original_images, frames_block_size),
+            "preprocess_data" : parameters["preprocess_data"]
+        })
 
     # Preprocess images
     new_preprocessed_images = generate_neurons.resume_logger.get("preprocessed_images", None)
+    # Whether the preprocessed images were computed again (instead of kept or taken from the cache).
+    preprocessed = False
     if (new_preprocessed_images is None) or (run_stage == "preprocessing") or (run_stage == "all"):
-        new_preprocessed_images = original_images.copy()
-        segment.preprocess_data.recorders.array_debug_recorder = generate_neurons.recorders.array_debug_recorder
-        new_preprocessed_images = segment.preprocess_data(new_preprocessed_images,
-                                                                            out = new_preprocessed_images,
-                                                                            **parameters["preprocess_data"])
-        generate_neurons.resume_logger["preprocessed_images"] = new_preprocessed_images
+        # Entries may be evicted at any time. So, they are only read once (None if missing).
+        new_preprocessed_images = None
+        if (stage_cache is not None) and (memory_budget is None):
+            new_preprocessed_images = stage_cache.get(stage_cache_keys["preprocessed_images"])
+        elif stage_cache is not None:
+            new_preprocessed_images = stage_cache.load(stage_cache_keys["preprocessed_images"],
+                                                       generate_neurons.resume_logger,
+                                                       "preprocessed_images",
+                                                       frames_block_size)
+
+        if new_preprocessed_images is not None:
+            logger.info("Using cached preprocessed images.")
+
+            if memory_budget is None:
+                generate_neurons.resume_logger["preprocessed_images"] = new_preprocessed_images
+        elif memory_budget is None:
+            preprocessed = True
+
+            new_preprocessed_images = original_images.copy()
+            segment.preprocess_data.recorders.array_debug_recorder = generate_neurons.recorders.array_debug_recorder
+            new_preprocessed_images = segment.preprocess_data(new_preprocessed_images,
+                                                                                out = new_preprocessed_images,
+                                                                                **parameters["preprocess_data"])
+            generate_neurons.resume_logger["preprocessed_images"] = new_preprocessed_images
+
+            if stage_cache is not None:
+                stage_cache.put(stage_cache_keys["preprocessed_images"], new_preprocessed_images)
+        else:
+            preprocessed = True
+
+            # Tiles are written straight to where the result is kept. So, the whole movie is never in memory.
+            new_preprocessed_images = generate_neurons.resume_logger.create_dataset("preprocessed_images",
+                                                                                    original_images.shape,
+                                                                                    numpy.float32,
+                                                                                    chunks = True)
+            segment.preprocess_data_blocked.recorders.array_debug_recorder = generate_neurons.recorders.array_debug_recorder
+            segment.preprocess_data_blocked(original_images,
+                                            out = new_preprocessed_images,
+                                            **parameters["preprocess_data"])
+
+            if stage_cache is not None:
+                stage_cache.put(stage_cache_keys["preprocessed_images"], new_preprocessed_images, frames_block_size)
 
         if "preprocessed_images_max_projection" not in generate_neurons.recorders.array_debug_recorder:
-            generate_neurons.recorders.array_debug_recorder["preprocessed_images_max_projection"] = xnumpy.add_singleton_op(
-            numpy.max,
-            new_preprocessed_images,
-            axis = 0
-        )
+            if memory_budget is None:
+                generate_neurons.recorders.array_debug_recorder["preprocessed_images_max_projection"] = xnumpy.add_singleton_op(
+                    numpy.max,
+                    new_preprocessed_images,
+                    axis = 0
+                )
+            else:
+                generate_neurons.recorders.array_debug_recorder["preprocessed_images_max_projection"] = xnumpy.blocked_reduce(
+                    numpy.maximum,
+                    new_preprocessed_images,
+                    frames_block_size
+                )
 
     if run_stage == "preprocessing":
         return
@@ -643,9 +1046,93 @@ def generate_neurons(original_images, run_stage = "all", **parameters):
     # Find the dictionary
     new_dictionary = generate_neurons.resume_logger.get("dictionary", None)
     if (new_dictionary is None) or (run_stage == "dictionary") or (run_stage == "all"):
-        segment.generate_dictionary.recorders.array_debug_recorder = generate_neurons.recorders.array_debug_recorder
-        new_dictionary = segment.generate_dictionary(new_preprocessed_images,
-                                                                       **parameters["generate_dictionary"])
+        generate_dictionary_parameters = dict(parameters["generate_dictionary"])
+
+        # Learning may start from a cached dictionary of the same field of view (from an earlier session or an
+        # overlapping block). Parameters that only change how long or how learning runs are left out of the key.
+        warm_start = generate_dictionary_parameters.pop("warm_start", None)
+        dictionary_cache = None
+        dictionary_cache_window = None
+        dictionary_cache_parameters = None
+        if warm_start is not None:
+            dictionary_cache = hdf5.cache.DictionaryCache(warm_start["cache_dirname"])
+
+            dictionary_cache_window = numpy.array([[0, _] for _ in original_images.shape[1:]])
+            if window is not None:
+                dictionary_cache_window[:, 0] += [(_.start or 0) for _ in window[1:]]
+                dictionary_cache_window[:, 1] += dictionary_cache_window[:, 0]
+
+            dictionary_cache_parameters = dict(generate_dictionary_parameters["spams.trainDL"])
+            dictionary_cache_parameters.pop("iter", None)
+            dictionary_cache_parameters.pop("numThreads", None)
+
+            generate_dictionary_parameters["initial_dictionary"] = dictionary_cache.find_seed(
+                warm_start["fov"], dictionary_cache_window, dictionary_cache_parameters
+            )
+
+            # Starting from a dictionary should need fewer iterations.
+            if (generate_dictionary_parameters["initial_dictionary"] is not None) and ("iter" in warm_start):
+                generate_dictionary_parameters["spams.trainDL"] = dict(generate_dictionary_parameters["spams.trainDL"])
+                generate_dictionary_parameters["spams.trainDL"]["iter"] = warm_start["iter"]
+
+        new_dictionary = None
+        if stage_cache is not None:
+            # Learning from another seed gives another dictionary. So, the seed is part of the key.
+            initial_dictionary = generate_dictionary_parameters.get("initial_dictionary", None)
+            stage_cache_keys["dictionary"] = hdf5.cache.hash_parameters({
+                "preprocessed_images" : stage_cache_keys["preprocessed_images"],
+                "generate_dictionary" : parameters["generate_dictionary"],
+                "initial_dictionary" : (hdf5.cache.hash_array(initial_dictionary)
+                                        if initial_dictionary is not None else None)
+            })
+
+            new_dictionary = stage_cache.get(stage_cache_keys["dictionary"])
+
+        if new_dictionary is not None:
+            logger.info("Using cached dictionary.")
+        else:
+            if (memory_budget is not None) and ("block_frame_length" not in generate_dictionary_parameters):
+                # Reading all of the preprocessed images would not keep within the memory budget. So, they are
+                # streamed in blocks of as many frames as fit in it (once cast to double precision for spams).
+                if generate_dictionary_parameters["spams.trainDL"].get("iter", -1) <= 0:
+                    raise ValueError("With a memory budget, the dictionary is learned from blocks of frames. " +
+                                     "This requires a positive number of iterations (spams.trainDL iter). " +
+                                     "Instead got iter of \"" +
+                                     repr(generate_dictionary_parameters["spams.trainDL"].get("iter", None)) + "\".")
+
+                generate_dictionary_parameters["block_frame_length"] = max(
+                    1, int(memory_budget // (8 * numpy.prod(new_preprocessed_images.shape[1:])))
+                )
+
+            if "block_frame_length" not in generate_dictionary_parameters:
+                segment.generate_dictionary.recorders.array_debug_recorder = generate_neurons.recorders.array_debug_recorder
+                # All frames are needed at once.
+                new_dictionary = segment.generate_dictionary(new_preprocessed_images[...],
+                                                                               **generate_dictionary_parameters)
+            else:
+                # Frames are streamed a block at a time. The state of learning is kept so that it can be resumed.
+                # Unless the preprocessed images it came from were computed again.
+                if preprocessed or ("dictionary_learning" not in generate_neurons.resume_logger):
+                    generate_neurons.resume_logger["dictionary_learning"] = None
+
+                segment.generate_dictionary_streamed.recorders.array_debug_recorder = generate_neurons.recorders.array_debug_recorder
+                new_dictionary = segment.generate_dictionary_streamed(
+                    new_preprocessed_images,
+                    checkpoint = generate_neurons.resume_logger["dictionary_learning"],
+                    **generate_dictionary_parameters
+                )
+
+                # Learning is finished. So, the next run starts over.
+                generate_neurons.resume_logger["dictionary_learning"] = None
+
+            if dictionary_cache is not None:
+                dictionary_cache.store(
+                    warm_start["fov"], dictionary_cache_window, dictionary_cache_parameters, new_dictionary
+                )
+
+            if stage_cache is not None:
+                stage_cache.put(stage_cache_keys["dictionary"], new_dictionary)
+
         generate_neurons.resume_logger["dictionary"] = new_dictionary
 
         if "dictionary_max_projection" not in generate_neurons.recorders.array_debug_recorder:
@@ -662,9 +1149,25 @@ def generate_neurons(original_images, run_stage = "all", **parameters):
     new_neurons = None
     new_neurons = generate_neurons.resume_logger.get("neurons", None)
     if (new_neurons is None) or (run_stage == "postprocessing") or (run_stage == "all"):
-        segment.postprocess_data.recorders.array_debug_recorder = generate_neurons.recorders.array_debug_recorder
-        new_neurons = segment.postprocess_data(new_dictionary,
-                                                                 **parameters["postprocess_data"])
+        new_neurons = None
+        if stage_cache is not None:
+            # Keyed on the dictionary itself. So, it does not matter how the dictionary was found.
+            stage_cache_keys["neurons"] = hdf5.cache.hash_parameters({
+                "dictionary" : hdf5.cache.hash_array(new_dictionary),
+                "postprocess_data" : parameters["postprocess_data"]
+            })
+
+            new_neurons = stage_cache.get(stage_cache_keys["neurons"])
+
+        if new_neurons is not None:
+            logger.info("Using cached neurons.")
+        else:
+            segment.postprocess_data.recorders.array_debug_recorder = generate_neurons.recorders.array_debug_recorder
+            new_neurons = segment.postprocess_data(new_dictionary,
+                                                                     **parameters["postprocess_data"])
+
+            if stage_cache is not None:
+                stage_cache.put(stage_cache_keys["neurons"], new_neurons)
 
         if new_neurons.size:
             generate_neurons.resume_logger["neurons"] = new_neurons
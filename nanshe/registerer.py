@@ -2,13 +2,12 @@ __author__ = "John Kirkham <kirkhamj@janelia.hhmi.org>"
 __date__ = "$Feb 20, 2015 13:00:51 EST$"
 
 
+import collections
 import itertools
-import os
+import time
 
-import h5py
-
-from nanshe.util import prof
-from nanshe.io import xjson
+from nanshe.util import prof, xmultiprocessing
+from nanshe.io import hdf5, xjson
 from nanshe.util.pathHelpers import PathComponents
 from nanshe.imp import registration
 
@@ -19,6 +18,73 @@ logger = prof.logging.getLogger(__name__)
 
 
 
+@prof.log_call(logger)
+def register_files(input_filenames, output_filenames, memory_budget=None, **parameters):
+    """
+        Registers each input into its output in turn. Designed to be run in a WorkerPool worker for a group of files
+        that share an output file (as HDF5 files cannot be written to concurrently).
+
+        Args:
+            input_filenames(list of strs):      HDF5 datasets to register (including the internal path).
+            output_filenames(list of strs):     HDF5 datasets to write the registered frames to (including the
+                                                internal path).
+            memory_budget(int):                 bytes of memory registration may use at a time. By default, no
+                                                limit. (Default None)
+            **parameters(dict):                 passed to register_mean_offsets.
+
+        Returns:
+            list of dicts:                      the number of frames ("num_frames"), bytes ("num_bytes") and seconds
+                                                taken ("run_time") to register each input.
+    """
+
+    # Files are opened once and shared by the registrations of this group (e.g. the output file).
+    file_pool = hdf5.pool.get_file_pool()
+
+    stats = []
+    for each_input_filename, each_output_filename in itertools.izip(input_filenames, output_filenames):
+        each_input_filename_components = PathComponents(each_input_filename)
+        each_output_filename_components = PathComponents(each_output_filename)
+
+        start_time = time.time()
+        # The output is opened first. So, an input in the same file shares its handle (instead of reopening it).
+        with file_pool.open(each_output_filename_components.externalPath, "a") as output_file:
+            with file_pool.open(each_input_filename_components.externalPath, "r") as input_file:
+                data = input_file[each_input_filename_components.internalPath]
+
+                each_parameters = dict(parameters)
+                if (memory_budget is not None) and (each_parameters.get("block_frame_length", -1) == -1):
+                    each_parameters["block_frame_length"] = registration.find_block_frame_length(
+                        data.shape, memory_budget
+                    )
+
+                registration.register_mean_offsets(
+                    data,
+                    to_truncate=True,
+                    out=output_file.require_group(each_output_filename_components.internalDirectory),
+                    out_name=each_output_filename_components.internalDatasetName,
+                    **each_parameters
+                )
+
+                stats.append({
+                    "num_frames" : len(data),
+                    "num_bytes" : data.size * data.dtype.itemsize,
+                    "run_time" : time.time() - start_time
+                })
+
+        logger.info(
+            "Registered \"" + each_input_filename + "\" into \"" + each_output_filename + "\" in \"" +
+            str(stats[-1]["run_time"]) + " s\" (\"" +
+            str(stats[-1]["num_frames"] / max(stats[-1]["run_time"], 1e-6)) + " frames/s\", \"" +
+            str(stats[-1]["num_bytes"] / max(stats[-1]["run_time"], 1e-6) / 2**20) + " MB/s\")."
+        )
+
+    # The outputs are read by others once done. So, they are closed here.
+    for each_filename in itertools.chain(output_filenames, input_filenames):
+        file_pool.close(PathComponents(each_filename).externalPath)
+
+    return(stats)
+
+
 @prof.log_call(logger)
 def main(*argv):
     """
@@ -54,39 +120,70 @@ def main(*argv):
     parser.add_argument("output_filenames",
                         metavar = "OUTPUT_FILE",
                         type = str,
-                        nargs = 1,
-                        help = "HDF5 file to export (this should include a path to where the internal dataset should be stored)."
+                        nargs = "+",
+                        help = "HDF5 file to export (this should include a path to where the internal dataset should be stored). " +
+                               "Inputs and outputs are paired in order (the first half of the files are inputs and the second half outputs)."
     )
 
     # Results of parsing arguments (ignore the first one as it is the command line call).
     parsed_args = parser.parse_args(argv[1:])
 
+    # Inputs consume all but the last file. So, split the files evenly between inputs and outputs.
+    all_filenames = parsed_args.input_filenames + parsed_args.output_filenames
+    if len(all_filenames) % 2:
+        parser.error("Each input file needs an output file. Instead got \"" + str(len(all_filenames)) + "\" files.")
+    parsed_args.input_filenames = all_filenames[:(len(all_filenames) // 2)]
+    parsed_args.output_filenames = all_filenames[(len(all_filenames) // 2):]
+
     # Go ahead and stuff in parameters with the other parsed_args
     parsed_args.parameters = xjson.read_parameters(parsed_args.config_filename)
 
-    parsed_args.input_file_components = []
-    for each_input_filename in parsed_args.input_filenames:
-        parsed_args.input_file_components.append(PathComponents(each_input_filename))
-
-    parsed_args.output_file_components = []
-    for each_output_filename in parsed_args.output_filenames:
-        parsed_args.output_file_components.append(PathComponents(each_output_filename))
-
-
-    for each_input_filename_components, each_output_filename_components in itertools.izip(parsed_args.input_file_components, parsed_args.output_file_components):
-        with h5py.File(each_input_filename_components.externalPath, "r") as input_file:
-            with h5py.File(each_output_filename_components.externalPath, "a") as output_file:
-                data = input_file[each_input_filename_components.internalPath]
-                result_filename = registration.register_mean_offsets(
-                    data, to_truncate=True, **parsed_args.parameters
-                )
-                with h5py.File(result_filename, "r") as result_file:
-                    result_file.copy(
-                        "reg_frames",
-                        output_file[each_output_filename_components.internalDirectory],
-                        name=each_output_filename_components.internalDatasetName
-                    )
-                os.remove(result_filename)
-                os.removedirs(os.path.dirname(result_filename))
+    # These configure how files are spread across processes. The rest are for registration.
+    num_processes = parsed_args.parameters.pop("num_processes", 1)
+    memory_budget = parsed_args.parameters.pop("memory_budget", None)
+
+    # Pairs writing to the same output file must be registered in turn.
+    file_groups = collections.OrderedDict()
+    for each_input_filename, each_output_filename in itertools.izip(parsed_args.input_filenames, parsed_args.output_filenames):
+        each_file_group = file_groups.setdefault(PathComponents(each_output_filename).externalPath, ([], []))
+        each_file_group[0].append(each_input_filename)
+        each_file_group[1].append(each_output_filename)
+
+    num_processes = max(1, min(num_processes, len(file_groups)))
+
+    # Every process gets an equal share of the memory.
+    if memory_budget is not None:
+        memory_budget //= num_processes
+
+    start_time = time.time()
+
+    stats = []
+    if num_processes == 1:
+        for each_input_filenames, each_output_filenames in file_groups.values():
+            stats.extend(register_files(
+                each_input_filenames, each_output_filenames, memory_budget=memory_budget, **parsed_args.parameters
+            ))
+    else:
+        with xmultiprocessing.WorkerPool(num_processes) as file_pool:
+            file_futures = []
+            for each_input_filenames, each_output_filenames in file_groups.values():
+                file_futures.append(file_pool.submit(
+                    register_files,
+                    each_input_filenames,
+                    each_output_filenames,
+                    memory_budget=memory_budget,
+                    **parsed_args.parameters
+                ))
+
+            for each_file_future in file_futures:
+                stats.extend(each_file_future.result())
+
+    run_time = time.time() - start_time
+
+    logger.info(
+        "Registered \"" + str(len(stats)) + "\" files (\"" + str(sum(_["num_frames"] for _ in stats)) +
+        "\" frames) in \"" + str(run_time) + " s\" using \"" + str(num_processes) + "\" processes (\"" +
+        str(sum(_["num_bytes"] for _ in stats) / max(run_time, 1e-6) / 2**20) + " MB/s\")."
+    )
 
     return(0)
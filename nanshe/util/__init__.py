@@ -2,7 +2,7 @@ __author__ = "John Kirkham <kirkhamj@janelia.hhmi.org>"
 __date__ = "$Mar 27, 2015 09:28:53 EDT$"
 
 __all__ = [
-    "iters", "pathHelpers", "prof", "wrappers", "xglob", "xnumpy"
+    "iters", "pathHelpers", "prof", "wrappers", "xglob", "xmultiprocessing", "xnumpy"
 ]
 
 import iters
@@ -10,4 +10,5 @@ import pathHelpers
 import prof
 import wrappers
 import xglob
+import xmultiprocessing
 import xnumpy
@@ -0,0 +1,605 @@
+import collections
+import multiprocessing
+import os
+import Queue
+import sys
+import threading
+import time
+import traceback
+
+
+# Need in order to have logging information no matter what.
+import prof
+
+
+# Get the logger
+logger = prof.logging.getLogger(__name__)
+
+
+
+class WorkerException(Exception):
+    """
+        Raised when a task fails in a worker. Contains the formatted traceback from the worker.
+    """
+
+    pass
+
+
+class WorkerDiedException(WorkerException):
+    """
+        Raised when a worker terminates abnormally (e.g. segfault) while running a task.
+    """
+
+    pass
+
+
+class Future(object):
+    """
+        A handle on the eventual result of a task submitted to a WorkerPool.
+
+        Loosely modeled after concurrent.futures.Future, which is not available in Python 2.
+    """
+
+    def __init__(self, task_id = None):
+        """
+            Constructs an unfinished Future.
+
+            Args:
+                task_id(int):           the identifier of the task this is tied to.
+        """
+
+        self.task_id = task_id
+
+        self.run_time = None
+        self.worker_pid = None
+
+        self.finished = False
+        self.value = None
+        self.error = None
+        self.callbacks = []
+
+        self.condition = threading.Condition()
+
+    def done(self):
+        """
+            Determines if the task has finished (successfully or not).
+
+            Returns:
+                bool:                   whether the task has finished.
+        """
+
+        with self.condition:
+            return(self.finished)
+
+    def wait(self, timeout = None):
+        """
+            Blocks until the task has finished or the timeout elapses.
+
+            Args:
+                timeout(float):         seconds to wait (None waits forever).
+
+            Returns:
+                bool:                   whether the task has finished.
+        """
+
+        with self.condition:
+            if not self.finished:
+                if timeout is None:
+                    # Waiting in chunks keeps this interruptible by KeyboardInterrupt in Python 2.
+                    while not self.finished:
+                        self.condition.wait(1.0)
+                else:
+                    self.condition.wait(timeout)
+
+            return(self.finished)
+
+    def exception(self, timeout = None):
+        """
+            Gets the exception raised by the task, if any.
+
+            Args:
+                timeout(float):         seconds to wait (None waits forever).
+
+            Returns:
+                Exception:              raised by the task or None if it succeeded.
+        """
+
+        if not self.wait(timeout):
+            raise RuntimeError("Task \"" + repr(self.task_id) + "\" did not finish in \"" + repr(timeout) + " s\".")
+
+        return(self.error)
+
+    def result(self, timeout = None):
+        """
+            Gets the value returned by the task. If the task failed, its exception is raised here.
+
+            Args:
+                timeout(float):         seconds to wait (None waits forever).
+
+            Returns:
+                object:                 whatever the task returned.
+        """
+
+        error = self.exception(timeout)
+
+        if error is not None:
+            raise error
+
+        return(self.value)
+
+    def add_done_callback(self, a_callable):
+        """
+            Calls a_callable with this Future once it has finished. If it has already finished, this occurs now.
+
+            Args:
+                a_callable(callable):   takes this Future as its only argument.
+        """
+
+        with self.condition:
+            if not self.finished:
+                self.callbacks.append(a_callable)
+                return
+
+        a_callable(self)
+
+    def set_result(self, value, run_time = None):
+        """
+            Marks the task as having succeeded.
+
+            Args:
+                value(object):          what the task returned.
+                run_time(float):        how long the task ran in seconds.
+        """
+
+        self.finish(value, None, run_time)
+
+    def set_exception(self, error, run_time = None):
+        """
+            Marks the task as having failed.
+
+            Args:
+                error(Exception):       what the task raised.
+                run_time(float):        how long the task ran in seconds.
+        """
+
+        self.finish(None, error, run_time)
+
+    def finish(self, value, error, run_time):
+        """
+            Stores the outcome of the task, wakes up any waiters, and runs any callbacks.
+
+            Args:
+                value(object):          what the task returned.
+                error(Exception):       what the task raised (None if it succeeded).
+                run_time(float):        how long the task ran in seconds.
+        """
+
+        with self.condition:
+            if self.finished:
+                return
+
+            self.value = value
+            self.error = error
+            self.run_time = run_time
+            self.finished = True
+
+            callbacks = self.callbacks
+            self.callbacks = []
+
+            self.condition.notify_all()
+
+        for each_callback in callbacks:
+            try:
+                each_callback(self)
+            except Exception:
+                logger.error("Callback for task \"" + repr(self.task_id) + "\" failed." + os.linesep + traceback.format_exc())
+
+
+def as_completed(futures):
+    """
+        Iterates through the futures in the order they finish (not the order given).
+
+        Args:
+            futures(iterable):          Futures to wait on.
+
+        Returns:
+            (generator):                yields each Future as it finishes.
+    """
+
+    futures = list(futures)
+
+    completed_futures = Queue.Queue()
+    for each_future in futures:
+        each_future.add_done_callback(completed_futures.put)
+
+    for i in xrange(len(futures)):
+        # Waiting in chunks keeps this interruptible by KeyboardInterrupt in Python 2.
+        each_completed_future = None
+        while each_completed_future is None:
+            try:
+                each_completed_future = completed_futures.get(timeout = 1.0)
+            except Queue.Empty:
+                pass
+
+        yield(each_completed_future)
+
+
+def thread_map(a_callable, iterable, num_threads = 1):
+    """
+        Like map, but spreads the calls across threads. This only helps if a_callable spends most of its time outside
+        of the GIL (e.g. in numpy, vigra, or other compiled code working on large arrays).
+
+        Args:
+            a_callable(callable):       what to call on each element.
+            iterable(iterable):         elements to call a_callable on.
+            num_threads(int):           how many threads to use (1 runs everything in this thread).
+
+        Returns:
+            list:                       results in the same order as the elements given.
+
+        Examples:
+            >>> thread_map(abs, [-1, 2, -3], 2)
+            [1, 2, 3]
+    """
+
+    assert (num_threads > 0)
+
+    elements = list(iterable)
+
+    num_threads = min(num_threads, len(elements))
+    if num_threads <= 1:
+        return(map(a_callable, elements))
+
+    # Threads are started directly as a ThreadPool takes a while to shut down, which adds up for callers that
+    # map many times (e.g. once per iteration).
+    results = len(elements) * [None]
+    errors = []
+    next_indices = iter(xrange(len(elements)))
+    next_indices_lock = threading.Lock()
+
+    def run_thread():
+        while not errors:
+            with next_indices_lock:
+                i = next(next_indices, None)
+            if i is None:
+                break
+
+            try:
+                results[i] = a_callable(elements[i])
+            except Exception:
+                errors.append(sys.exc_info())
+
+    threads = [threading.Thread(target=run_thread) for i in xrange(num_threads)]
+    for each_thread in threads:
+        each_thread.daemon = True
+        each_thread.start()
+
+    for each_thread in threads:
+        # Joining with a timeout keeps this interruptible by KeyboardInterrupt in Python 2.
+        while each_thread.is_alive():
+            each_thread.join(9999999)
+
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+
+    return(results)
+
+
+def run_worker(worker_index, task_queue, result_queue):
+    """
+        Main loop of a WorkerPool worker. Runs the tasks given to it (one at a time) until told to stop.
+
+        Args:
+            worker_index(int):                      which worker of the pool this is.
+            task_queue(multiprocessing.Queue):      queue of tasks for this worker (None signals it to stop).
+            result_queue(multiprocessing.Queue):    queue where results are posted.
+    """
+
+    worker_pid = os.getpid()
+
+    while True:
+        each_task = task_queue.get()
+
+        if each_task is None:
+            break
+
+        each_task_id, each_callable, each_args, each_kwargs = each_task
+
+        each_status = "finished"
+        each_value = None
+        start_time = time.time()
+        try:
+            each_value = each_callable(*each_args, **each_kwargs)
+        except Exception:
+            each_status = "failed"
+            each_value = traceback.format_exc()
+        end_time = time.time()
+
+        result_queue.put((each_status, each_task_id, worker_index, worker_pid, (each_value, end_time - start_time)))
+
+
+class WorkerPool(object):
+    """
+        A persistent pool of worker processes. Each task is handed to the next idle worker.
+
+        Unlike multiprocessing.Pool, workers are not daemonic. So, tasks may start processes of their own (e.g. the
+        SPAMS sandbox). Workers that die abnormally are replaced and their task is failed with WorkerDiedException.
+
+        Note:
+            Tasks are handed out by the pool (instead of workers taking them from a shared queue). So, the pool always
+            knows which task a worker has been given, even if the worker dies before it starts running it.
+    """
+
+    def __init__(self, num_processes = multiprocessing.cpu_count(), poll_interval = 1.0):
+        """
+            Starts the worker processes.
+
+            Args:
+                num_processes(int):         number of worker processes to keep running.
+                poll_interval(float):       seconds between checks for workers that have died.
+        """
+
+        assert (num_processes > 0)
+
+        self.num_processes = num_processes
+        self.poll_interval = poll_interval
+
+        self.result_queue = multiprocessing.Queue()
+
+        self.lock = threading.Lock()
+        self.no_pending_futures = threading.Condition(self.lock)
+        self.next_task_id = 0
+        self.pending_futures = {}
+
+        # Tasks not yet given to a worker (in the order submitted).
+        self.waiting_tasks = collections.deque()
+
+        self.closed = False
+
+        # Each worker with its own queue of tasks and the ID of the task it was given (None if idle).
+        self.workers = {}
+        self.worker_task_queues = {}
+        self.worker_task_ids = {}
+        for i in xrange(self.num_processes):
+            self.start_worker(i)
+
+        self.collector = threading.Thread(target = self.collect_results)
+        self.collector.daemon = True
+        self.collector.start()
+
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.terminate()
+
+    def __len__(self):
+        return(self.num_processes)
+
+    def start_worker(self, worker_index):
+        """
+            Starts a new worker process.
+
+            Args:
+                worker_index(int):          the slot the worker occupies.
+        """
+
+        each_task_queue = multiprocessing.Queue()
+
+        each_worker = multiprocessing.Process(target = run_worker,
+                                              args = (worker_index, each_task_queue, self.result_queue))
+        each_worker.daemon = False
+        each_worker.start()
+
+        self.workers[worker_index] = each_worker
+        self.worker_task_queues[worker_index] = each_task_queue
+        self.worker_task_ids[worker_index] = None
+
+    def dispatch(self):
+        """
+            Gives waiting tasks to idle workers. Must be called with the lock held.
+        """
+
+        for each_worker_index in sorted(self.workers.keys()):
+            if not self.waiting_tasks:
+                break
+
+            if self.worker_task_ids[each_worker_index] is not None:
+                continue
+
+            each_task = self.waiting_tasks.popleft()
+
+            # Noted before the worker can get it. So, it is known even if the worker dies right away.
+            self.worker_task_ids[each_worker_index] = each_task[0]
+            self.worker_task_queues[each_worker_index].put(each_task)
+
+    def submit(self, a_callable, *args, **kwargs):
+        """
+            Queues a_callable to be run in a worker with the arguments given.
+
+            Note:
+                Everything given must be picklable. In particular, a_callable must be defined at module level.
+
+            Args:
+                a_callable(callable):       what to run in the worker.
+                *args(tuple):               positional arguments to pass to a_callable.
+                **kwargs(dict):             keyword arguments to pass to a_callable.
+
+            Returns:
+                Future:                     will contain the result of a_callable once it has finished.
+        """
+
+        if self.closed:
+            raise RuntimeError("Cannot submit tasks to a WorkerPool that has been closed.")
+
+        with self.lock:
+            each_task_id = self.next_task_id
+            self.next_task_id += 1
+
+            each_future = Future(each_task_id)
+            self.pending_futures[each_task_id] = each_future
+
+            self.waiting_tasks.append((each_task_id, a_callable, args, kwargs))
+
+            self.dispatch()
+
+        return(each_future)
+
+    def map(self, a_callable, *iterables):
+        """
+            Submits a_callable for each set of arguments drawn from iterables.
+
+            Args:
+                a_callable(callable):       what to run in the worker.
+                *iterables(iterables):      positional arguments to zip together and pass to a_callable.
+
+            Returns:
+                list:                       Futures in the same order as the arguments given.
+        """
+
+        return([self.submit(a_callable, *each_args) for each_args in zip(*iterables)])
+
+    def pop_future(self, task_id):
+        """
+            Removes a task that has finished from those pending. Must be called with the lock held.
+
+            Args:
+                task_id(int):               the task that finished.
+
+            Returns:
+                Future:                     for the task (None if it was already removed).
+        """
+
+        each_future = self.pending_futures.pop(task_id, None)
+
+        if not self.pending_futures:
+            self.no_pending_futures.notify_all()
+
+        return(each_future)
+
+    def collect_results(self):
+        """
+            Runs in a thread to forward results from the workers to their Futures and replace dead workers.
+        """
+
+        while True:
+            try:
+                each_message = self.result_queue.get(timeout = self.poll_interval)
+            except Queue.Empty:
+                self.check_workers()
+                continue
+
+            if each_message is None:
+                break
+
+            each_status, each_task_id, each_worker_index, each_worker_pid, each_payload = each_message
+
+            with self.lock:
+                if self.worker_task_ids.get(each_worker_index) == each_task_id:
+                    self.worker_task_ids[each_worker_index] = None
+
+                each_future = self.pop_future(each_task_id)
+
+                self.dispatch()
+
+            # Already failed (e.g. the worker died right after posting its result).
+            if each_future is None:
+                continue
+
+            each_value, each_run_time = each_payload
+
+            each_future.worker_pid = each_worker_pid
+            if each_status == "finished":
+                each_future.set_result(each_value, each_run_time)
+            else:
+                each_future.set_exception(WorkerException(each_value), each_run_time)
+
+    def check_workers(self):
+        """
+            Fails the task of any worker that has died abnormally and starts a replacement worker.
+        """
+
+        died_futures = []
+
+        with self.lock:
+            for each_worker_index, each_worker in list(self.workers.items()):
+                if each_worker.is_alive() or (each_worker.exitcode == 0):
+                    continue
+
+                each_task_id = self.worker_task_ids[each_worker_index]
+
+                logger.error("Worker \"" + repr(each_worker.pid) + "\" has terminated with exitcode \"" +
+                             repr(each_worker.exitcode) + "\" while running task \"" + repr(each_task_id) + "\".")
+
+                each_future = None
+                if each_task_id is not None:
+                    each_future = self.pop_future(each_task_id)
+
+                if each_future is not None:
+                    each_future.worker_pid = each_worker.pid
+                    died_futures.append((each_future, WorkerDiedException(
+                        "Worker \"" + repr(each_worker.pid) + "\" has terminated with exitcode \"" +
+                        repr(each_worker.exitcode) + "\"."
+                    )))
+
+                # Replaced even if closed as there may still be tasks waiting.
+                self.start_worker(each_worker_index)
+
+            self.dispatch()
+
+        # Outside of the lock as callbacks may submit more tasks.
+        for each_future, each_error in died_futures:
+            each_future.set_exception(each_error)
+
+    def close(self):
+        """
+            Waits for all submitted tasks to finish and then stops the workers.
+        """
+
+        if self.closed:
+            return
+
+        self.closed = True
+
+        with self.lock:
+            while self.pending_futures:
+                # Waiting in chunks keeps this interruptible by KeyboardInterrupt in Python 2.
+                self.no_pending_futures.wait(1.0)
+
+            for each_task_queue in self.worker_task_queues.values():
+                each_task_queue.put(None)
+
+            workers = list(self.workers.values())
+
+        for each_worker in workers:
+            each_worker.join()
+
+        self.result_queue.put(None)
+        self.collector.join()
+
+    def terminate(self):
+        """
+            Stops the workers immediately. Unfinished tasks are failed.
+        """
+
+        self.closed = True
+
+        self.result_queue.put(None)
+        self.collector.join()
+
+        for each_worker in list(self.workers.values()):
+            each_worker.terminate()
+
+        for each_worker in list(self.workers.values()):
+            each_worker.join()
+
+        with self.lock:
+            pending_futures = list(self.pending_futures.values())
+            self.pending_futures.clear()
+            self.waiting_tasks.clear()
+
+        for each_future in pending_futures:
+            each_future.set_exception(WorkerDiedException("WorkerPool was terminated."))
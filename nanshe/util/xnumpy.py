@@ -975,6 +975,116 @@ def roll(new_array, shift, out=None, to_mask=False):
     return(out)
 
 
+@prof.log_call(logger)
+def roll_frames(new_frames, shifts, out=None, to_mask=False):
+    """
+        Like roll, but rolls each frame (along the first axis) by its own shift. Rather than rolling each frame along
+        each axis in turn, the rolled indices of every frame are found and all frames are gathered at once.
+
+        Note:
+            Right shift occurs with a positive and left occurs with a negative.
+
+        Args:
+            new_frames(numpy.ndarray):    frames to roll (first axis is frames).
+            shifts(numpy.ndarray):        integer shifts for each frame (first axis is frames and second is the
+                                          remaining axes).
+            out(numpy.ndarray):           array to store the results in (may be new_frames). If to_mask, this
+                                          must be a MaskedArray.
+            to_mask(bool):                Makes the result a masked array with the portion that rolled off masked.
+
+        Returns:
+            out(numpy.ndarray):           result of the roll.
+
+        Examples:
+            >>> roll_frames(numpy.arange(10).reshape(2,5), numpy.array([[1], [-2]]))
+            array([[4, 0, 1, 2, 3],
+                   [7, 8, 9, 5, 6]])
+
+            >>> roll_frames(numpy.arange(12).reshape(2,2,3), numpy.array([[0, 1], [1, 0]]))
+            array([[[ 2,  0,  1],
+                    [ 5,  3,  4]],
+            <BLANKLINE>
+                   [[ 9, 10, 11],
+                    [ 6,  7,  8]]])
+
+            >>> roll_frames(numpy.arange(10).reshape(2,5), numpy.array([[1], [-2]]), to_mask=True)
+            masked_array(data =
+             [[-- 0 1 2 3]
+             [7 8 9 -- --]],
+                         mask =
+             [[ True False False False False]
+             [False False False  True  True]],
+                   fill_value = 999999)
+            <BLANKLINE>
+
+            >>> a = numpy.arange(10).reshape(2,5); roll_frames(a, numpy.array([[1], [-2]]), out=a)
+            array([[4, 0, 1, 2, 3],
+                   [7, 8, 9, 5, 6]])
+            >>> a
+            array([[4, 0, 1, 2, 3],
+                   [7, 8, 9, 5, 6]])
+
+            >>> a = numpy.arange(10).reshape(2,5); b = numpy.ma.zeros(a.shape, dtype=int)
+            >>> roll_frames(a, numpy.array([[1], [-2]]), out=b, to_mask=True) is b
+            True
+            >>> b.mask
+            array([[ True, False, False, False, False],
+                   [False, False, False,  True,  True]], dtype=bool)
+    """
+
+    shifts = numpy.asarray(shifts)
+
+    assert (shifts.shape == (len(new_frames), new_frames.ndim - 1))
+    assert issubclass(shifts.dtype.type, numpy.integer)
+
+    num_frames = len(new_frames)
+    frame_shape = new_frames.shape[1:]
+
+    # Find the indices each frame's values come from along each axis. These are broadcast against each other.
+    # So, only small index arrays are needed to gather all frames together.
+    frames_indices = [numpy.arange(num_frames).reshape((num_frames,) + len(frame_shape) * (1,))]
+    frames_masks = []
+    for i, each_shape in enumerate(frame_shape):
+        each_indices = numpy.arange(each_shape)[None] - shifts[:, i, None]
+
+        if to_mask:
+            frames_masks.append((each_indices < 0) | (each_indices >= each_shape))
+
+        each_indices %= each_shape
+
+        each_indices_shape = [num_frames] + len(frame_shape) * [1]
+        each_indices_shape[1 + i] = each_shape
+
+        frames_indices.append(each_indices.reshape(each_indices_shape))
+        if to_mask:
+            frames_masks[-1] = frames_masks[-1].reshape(each_indices_shape)
+
+    rolled_frames = numpy.asarray(new_frames)[tuple(frames_indices)]
+
+    rolled_frames_mask = None
+    if to_mask:
+        rolled_frames_mask = numpy.zeros(rolled_frames.shape, dtype=bool)
+        for each_frames_mask in frames_masks:
+            rolled_frames_mask |= each_frames_mask
+
+    if out is None:
+        out = rolled_frames
+
+        if to_mask:
+            out = out.view(numpy.ma.MaskedArray)
+            out.mask = rolled_frames_mask
+    else:
+        numpy.ma.getdata(out)[...] = rolled_frames
+
+        if to_mask:
+            assert isinstance(out, numpy.ma.MaskedArray), \
+                "Provided an array for `out` that is not a MaskedArray when requesting to mask the result."
+
+            out.mask = rolled_frames_mask
+
+    return(out)
+
+
 @prof.log_call(logger)
 def contains(new_array, to_contain):
     """
@@ -3413,6 +3523,195 @@ def masks_overlap_normalized(a, b):
     return(out)
 
 
+@prof.log_call(logger)
+def masks_bounding_boxes(new_masks):
+    """
+        Finds the bounding box of each mask (the smallest box that contains all of its nonzero points).
+
+        Args:
+            new_masks(numpy.ndarray):       masks where the first index selects each mask.
+
+        Returns:
+            out(numpy.ndarray):             an integer array with shape (number of masks, 2, number of dimensions)
+                                            with the lower bound (inclusive) and the upper bound (exclusive) of each
+                                            box. Empty masks have empty boxes (all zero).
+
+        Examples:
+            >>> masks_bounding_boxes(numpy.zeros((0, 3, 4), dtype=bool))
+            array([], shape=(0, 2, 2), dtype=int64)
+
+            >>> masks_bounding_boxes(numpy.zeros((1, 3, 4), dtype=bool))
+            array([[[0, 0],
+                    [0, 0]]])
+
+            >>> masks_bounding_boxes(numpy.eye(3, 4, dtype=bool)[None])
+            array([[[0, 0],
+                    [3, 3]]])
+
+            >>> a = numpy.zeros((2, 3, 4), dtype=bool)
+            >>> a[0, 1, 1:3] = True
+            >>> a[1, 0:2, 3] = True
+            >>> masks_bounding_boxes(a)
+            array([[[1, 1],
+                    [2, 3]],
+            <BLANKLINE>
+                   [[0, 3],
+                    [2, 4]]])
+    """
+
+    # Avoids a copy if the masks are already bool.
+    new_masks = numpy.asarray(new_masks, dtype=bool)
+
+    out = numpy.zeros((len(new_masks), 2, new_masks.ndim - 1), dtype=numpy.int64)
+
+    if not new_masks.size:
+        return(out)
+
+    non_empty = new_masks.reshape(len(new_masks), -1).any(axis=1)
+
+    for each_dim in xrange(1, new_masks.ndim):
+        # Which positions along this dimension have any points in each mask.
+        each_dim_projection = new_masks.any(axis=tuple([_ for _ in xrange(1, new_masks.ndim) if _ != each_dim]))
+
+        out[:, 0, each_dim - 1] = each_dim_projection.argmax(axis=1)
+        out[:, 1, each_dim - 1] = new_masks.shape[each_dim] - each_dim_projection[:, ::-1].argmax(axis=1)
+
+    out[~non_empty] = 0
+
+    return(out)
+
+
+@prof.log_call(logger)
+def bounding_boxes_overlapping_pairs(bounding_boxes):
+    """
+        Finds all pairs of bounding boxes that overlap. Sweeps along the first dimension so that only boxes that
+        overlap along it are compared.
+
+        Args:
+            bounding_boxes(numpy.ndarray):  boxes as returned by masks_bounding_boxes.
+
+        Returns:
+            out(numpy.ndarray):             an integer array with shape (number of pairs, 2) where each row contains
+                                            the indices of a pair of overlapping boxes (smallest index first). Rows
+                                            are sorted. Empty boxes overlap nothing.
+
+        Examples:
+            >>> bounding_boxes_overlapping_pairs(numpy.zeros((0, 2, 2), dtype=int))
+            array([], shape=(0, 2), dtype=int64)
+
+            >>> bounding_boxes_overlapping_pairs(numpy.array([[[0, 0], [2, 2]],
+            ...                                               [[1, 1], [3, 3]],
+            ...                                               [[2, 0], [4, 2]],
+            ...                                               [[0, 0], [0, 0]]]))
+            array([[0, 1],
+                   [1, 2]])
+
+            >>> bounding_boxes_overlapping_pairs(numpy.array([[[1, 0], [3, 3]],
+            ...                                               [[0, 2], [2, 4]],
+            ...                                               [[0, 0], [1, 1]]]))
+            array([[0, 1]])
+    """
+
+    bounding_boxes = numpy.asarray(bounding_boxes)
+
+    lower_bounds = bounding_boxes[:, 0]
+    upper_bounds = bounding_boxes[:, 1]
+
+    # Sort by the lower bound along the first dimension (dropping empty boxes).
+    order = numpy.argsort(lower_bounds[:, 0], kind="mergesort")
+    order = order[(lower_bounds[order] < upper_bounds[order]).all(axis=1)]
+
+    # Only boxes starting before the end of a box (along the first dimension) can overlap it.
+    order_ends = numpy.searchsorted(lower_bounds[order, 0], upper_bounds[order, 0], side="left")
+
+    pairs = [numpy.zeros((0, 2), dtype=numpy.int64)]
+    for k, each_i in enumerate(order):
+        each_candidates = order[k + 1:order_ends[k]]
+
+        if each_candidates.size:
+            each_candidates = each_candidates[
+                ((lower_bounds[each_candidates] < upper_bounds[each_i]) &
+                 (lower_bounds[each_i] < upper_bounds[each_candidates])).all(axis=1)
+            ]
+
+            pairs.append(numpy.array([numpy.minimum(each_i, each_candidates),
+                                      numpy.maximum(each_i, each_candidates)], dtype=numpy.int64).T)
+
+    out = numpy.vstack(pairs)
+    out = out[numpy.lexsort((out[:, 1], out[:, 0]))]
+
+    return(out)
+
+
+@prof.log_call(logger)
+def sparse_argmax(rows, columns, values, shape):
+    """
+        Equivalent to numpy.argmax(a, axis=0) (and the corresponding maxima) where a is a matrix with the given shape,
+        which is zero everywhere except at the positions (rows, columns) where it has the given values. Ties are
+        broken by the smallest index as with numpy.argmax.
+
+        Args:
+            rows(numpy.ndarray):            row of each explicit value.
+            columns(numpy.ndarray):         column of each explicit value (each position may only appear once).
+            values(numpy.ndarray):          explicit values.
+            shape(tuple):                   shape of the matrix.
+
+        Returns:
+            (tuple of numpy.ndarrays):      the row of the max in each column and the max in each column.
+
+        Examples:
+            >>> sparse_argmax([], [], [], (2, 3))
+            (array([0, 0, 0]), array([ 0.,  0.,  0.]))
+
+            >>> sparse_argmax([1, 0, 1], [0, 1, 1], [2.0, 3.0, 3.0], (2, 3))
+            (array([1, 0, 0]), array([ 2.,  3.,  0.]))
+
+            >>> sparse_argmax([0, 2, 1], [0, 0, 1], [-1.0, -2.0, 0.0], (3, 2))
+            (array([1, 0]), array([ 0.,  0.]))
+
+            >>> sparse_argmax([0, 1], [0, 0], [-1.0, -2.0], (2, 1))
+            (array([0]), array([-1.]))
+    """
+
+    rows = numpy.asarray(rows, dtype=numpy.int64)
+    columns = numpy.asarray(columns, dtype=numpy.int64)
+    values = numpy.asarray(values, dtype=float)
+
+    num_rows, num_columns = shape
+
+    out_indices = numpy.zeros((num_columns,), dtype=numpy.int64)
+    out_maxes = numpy.zeros((num_columns,), dtype=float)
+
+    if not values.size:
+        return((out_indices, out_maxes))
+
+    # Order by column, then by largest value, then by smallest row. So, the first entry for each column is its max.
+    order = numpy.lexsort((rows, -values, columns))
+    order_columns = columns[order]
+    order = order[numpy.concatenate([[True], order_columns[1:] != order_columns[:-1]])]
+
+    out_indices[columns[order]] = rows[order]
+    out_maxes[columns[order]] = values[order]
+
+    # Columns where the implicit zeros are at least as large as the explicit max.
+    column_counts = numpy.bincount(columns, minlength=num_columns)
+    for each_column in ((column_counts > 0) & (column_counts < num_rows) & (out_maxes <= 0)).nonzero()[0]:
+        # Find the smallest row that is an implicit zero.
+        each_column_rows = numpy.sort(rows[columns == each_column])
+        each_first_zero_row = (each_column_rows != numpy.arange(len(each_column_rows))).argmax()
+        if each_column_rows[each_first_zero_row] == each_first_zero_row:
+            each_first_zero_row = len(each_column_rows)
+
+        if out_maxes[each_column] < 0:
+            out_indices[each_column] = each_first_zero_row
+        else:
+            out_indices[each_column] = min(out_indices[each_column], each_first_zero_row)
+
+        out_maxes[each_column] = 0
+
+    return((out_indices, out_maxes))
+
+
 @prof.log_call(logger)
 def dot_product_partially_normalized(new_vector_set_1, new_vector_set_2, ord = 2):
     """
@@ -3839,6 +4138,261 @@ def generate_labeled_contours(a_mask, separation_distance = 1.0, margin = 1.0):
     return(a_mask_contoured_labeled)
 
 
+@prof.log_call(logger)
+def generate_contours(new_masks, separation_distance = 1.0, margin = 1.0):
+    """
+        Same as generate_contour applied to each mask in a stack. However, each mask is only transformed within its
+        bounding box padded by one pixel (as all other points are further from the mask), instead of the full frame.
+
+        One distance transform of all the masks together (e.g. of a label image) is not used. Where masks touch or
+        overlap, one would not count as background for the other, which changes the contours. Even transforming
+        groups of masks far enough apart not to affect each other costs more, as each transform spans the frame.
+
+        Args:
+            new_masks(numpy.ndarray):          masks where the first index selects each mask.
+            separation_distance(float):        a separation distance from the edge of the mask for the center of the contour.
+            margin(float):                     the width of contour.
+
+        Returns:
+            (numpy.ndarray):                   a bool array with the contour of each mask.
+
+        Examples:
+            >>> generate_contours(numpy.zeros((0, 3, 3), dtype=bool))
+            array([], shape=(0, 3, 3), dtype=bool)
+
+            >>> a = numpy.zeros((2, 5, 6), dtype=bool)
+            >>> a[0, 1:4, 1:4] = True
+            >>> a[1, 1:5, 3:6] = True
+            >>> generate_contours(a).astype(int)
+            array([[[0, 0, 0, 0, 0, 0],
+                    [0, 1, 1, 1, 0, 0],
+                    [0, 1, 0, 1, 0, 0],
+                    [0, 1, 1, 1, 0, 0],
+                    [0, 0, 0, 0, 0, 0]],
+            <BLANKLINE>
+                   [[0, 0, 0, 0, 0, 0],
+                    [0, 0, 0, 1, 1, 1],
+                    [0, 0, 0, 1, 0, 0],
+                    [0, 0, 0, 1, 0, 0],
+                    [0, 0, 0, 1, 0, 0]]])
+
+            >>> (generate_contours(a) == numpy.array([generate_contour(_) for _ in a])).all()
+            True
+    """
+
+    # Avoids a copy if the masks are already bool.
+    new_masks = numpy.asarray(new_masks, dtype=bool)
+
+    new_contours = numpy.zeros(new_masks.shape, dtype=bool)
+
+    shape = numpy.array(new_masks.shape[1:])
+
+    for i, each_bounding_box in enumerate(masks_bounding_boxes(new_masks)):
+        if (each_bounding_box[0] == each_bounding_box[1]).all():
+            continue
+
+        each_padded_bounding_box = numpy.array([numpy.maximum(each_bounding_box[0] - 1, 0),
+                                                numpy.minimum(each_bounding_box[1] + 1, shape)])
+        each_padded_crop = (i,) + tuple(slice(_1, _2) for _1, _2 in each_padded_bounding_box.T)
+
+        new_contours[each_padded_crop] = generate_contour(new_masks[each_padded_crop],
+                                                          separation_distance = separation_distance,
+                                                          margin = margin)
+
+    return(new_contours)
+
+
+@prof.log_call(logger)
+def grouped_mean_and_covariance(groups, points, num_groups):
+    """
+        Finds the mean and covariance (as numpy.cov would) of the points in each group. All groups are handled in one
+        pass over the points.
+
+        Args:
+            groups(numpy.ndarray):             which group each point belongs to.
+            points(numpy.ndarray):             coordinates of each point (first index is the dimension).
+            num_groups(int):                   number of groups.
+
+        Returns:
+            (tuple of numpy.ndarrays):         the mean of each group (with shape (number of groups, number of
+                                               dimensions)) and the covariance of each group (with shape (number of
+                                               groups, number of dimensions, number of dimensions)).
+
+        Examples:
+            >>> m, c = grouped_mean_and_covariance(numpy.array([0, 1, 0, 1]),
+            ...                                    numpy.array([[1, 0, 1, 2], [1, 0, 2, 2]]),
+            ...                                    2)
+            >>> m
+            array([[ 1. ,  1.5],
+                   [ 1. ,  1. ]])
+            >>> c
+            array([[[ 0. ,  0. ],
+                    [ 0. ,  0.5]],
+            <BLANKLINE>
+                   [[ 2. ,  2. ],
+                    [ 2. ,  2. ]]])
+    """
+
+    groups = numpy.asarray(groups)
+    points = numpy.array(points, dtype=float)
+
+    ndim = len(points)
+
+    groups_counts = numpy.bincount(groups, minlength = num_groups).astype(float)
+
+    groups_means = numpy.zeros((num_groups, ndim), dtype=float)
+    groups_covs = numpy.zeros((num_groups, ndim, ndim), dtype=float)
+
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        for k in xrange(ndim):
+            groups_means[:, k] = numpy.bincount(groups, weights = points[k], minlength = num_groups) / groups_counts
+
+        # Centered (like numpy.cov) to avoid cancellation for points far from the origin.
+        points -= groups_means[groups].T
+
+        for k in xrange(ndim):
+            for l in xrange(k, ndim):
+                groups_covs[:, k, l] = numpy.bincount(
+                    groups, weights = points[k] * points[l], minlength = num_groups
+                ) / (groups_counts - 1)
+                groups_covs[:, l, k] = groups_covs[:, k, l]
+
+    return((groups_means, groups_covs))
+
+
+@prof.log_call(logger)
+def masks_mean_and_covariance(new_masks):
+    """
+        Finds the mean and covariance (as numpy.cov would) of the points in each mask. All masks are handled in one
+        pass over their points.
+
+        Args:
+            new_masks(numpy.ndarray):          masks where the first index selects each mask.
+
+        Returns:
+            (tuple of numpy.ndarrays):         the mean of each mask's points (with shape (number of masks, number of
+                                               dimensions)) and the covariance of each mask's points (with shape
+                                               (number of masks, number of dimensions, number of dimensions)).
+
+        Examples:
+            >>> a = numpy.zeros((2, 3, 4), dtype=bool)
+            >>> a[0, 1, 1:3] = True
+            >>> a[1] = numpy.eye(3, 4, dtype=bool)
+            >>> m, c = masks_mean_and_covariance(a)
+            >>> m
+            array([[ 1. ,  1.5],
+                   [ 1. ,  1. ]])
+            >>> c
+            array([[[ 0. ,  0. ],
+                    [ 0. ,  0.5]],
+            <BLANKLINE>
+                   [[ 1. ,  1. ],
+                    [ 1. ,  1. ]]])
+            >>> numpy.allclose(c[1], numpy.cov(numpy.array(a[1].nonzero())))
+            True
+    """
+
+    new_masks_points = (numpy.asarray(new_masks) != 0).nonzero()
+
+    return(grouped_mean_and_covariance(new_masks_points[0], new_masks_points[1:], len(new_masks)))
+
+
+@prof.log_call(logger)
+def tile_slices_with_halo(shape, tile_shape, halo):
+    """
+        Splits an array of the given shape into tiles. Each tile is extended by a halo on every side (clipped at the
+        edges of the array) so that filters applied to the extended tile give the same result on the tile as they
+        would on the whole array.
+
+        Args:
+            shape(tuple of ints):               shape of the array to split.
+            tile_shape(tuple of ints):          shape of each tile (tiles at the end may be smaller).
+            halo(tuple of ints):                how far to extend each tile on either side along each dimension.
+
+        Returns:
+            (list of tuples):                   for each tile, the slices selecting the tile with its halo from the
+                                                array, the slices selecting the tile from the array, and the slices
+                                                selecting the tile from the tile with its halo.
+
+        Examples:
+            >>> tile_slices_with_halo((5,), (5,), (1,))
+            [((slice(0, 5, None),), (slice(0, 5, None),), (slice(0, 5, None),))]
+
+            >>> tile_slices_with_halo((5,), (2,), (1,)) # doctest: +NORMALIZE_WHITESPACE
+            [((slice(0, 3, None),), (slice(0, 2, None),), (slice(0, 2, None),)),
+             ((slice(1, 5, None),), (slice(2, 4, None),), (slice(1, 3, None),)),
+             ((slice(3, 5, None),), (slice(4, 5, None),), (slice(1, 2, None),))]
+
+            >>> len(tile_slices_with_halo((3, 4, 5), (3, 2, 2), (0, 1, 1)))
+            6
+    """
+
+    shape = numpy.array(shape, dtype=int)
+    tile_shape = numpy.minimum(numpy.array(tile_shape, dtype=int), shape)
+    halo = numpy.array(halo, dtype=int)
+
+    assert (len(shape) == len(tile_shape) == len(halo))
+    assert (tile_shape > 0).all()
+
+    num_tiles = -((-shape) // tile_shape)
+
+    tile_slices = []
+    for each_tile_index in iters.index_generator(*num_tiles):
+        each_tile_start = numpy.array(each_tile_index, dtype=int) * tile_shape
+        each_tile_stop = numpy.minimum(each_tile_start + tile_shape, shape)
+
+        each_halo_start = numpy.maximum(each_tile_start - halo, 0)
+        each_halo_stop = numpy.minimum(each_tile_stop + halo, shape)
+
+        tile_slices.append((
+            tuple(slice(int(_1), int(_2)) for _1, _2 in zip(each_halo_start, each_halo_stop)),
+            tuple(slice(int(_1), int(_2)) for _1, _2 in zip(each_tile_start, each_tile_stop)),
+            tuple(slice(int(_1), int(_2)) for _1, _2 in zip(each_tile_start - each_halo_start,
+                                                            each_tile_stop - each_halo_start))
+        ))
+
+    return(tile_slices)
+
+
+@prof.log_call(logger)
+def blocked_reduce(ufunc, new_array, block_size, dtype=None):
+    """
+        Reduces along the first axis with a ufunc only taking block_size entries at a time. So, new_array can be an
+        HDF5 dataset much larger than memory. Like add_singleton_op, the singleton axis is kept.
+
+        Args:
+            ufunc(numpy.ufunc):                 binary ufunc to reduce with (e.g. numpy.maximum or numpy.add).
+            new_array(numpy.ndarray):           array to reduce (or anything else that can be sliced).
+            block_size(int):                    how many entries along the first axis to take at a time.
+            dtype(numpy.dtype):                 type to reduce in (default is the type of new_array).
+
+        Returns:
+            (numpy.ndarray):                    the reduction with the first axis kept as a singleton.
+
+        Examples:
+            >>> blocked_reduce(numpy.maximum, numpy.arange(10).reshape(5, 2), 2)
+            array([[8, 9]])
+
+            >>> blocked_reduce(numpy.add, numpy.arange(10).reshape(5, 2), 3, dtype=float)
+            array([[ 20.,  25.]])
+    """
+
+    assert (block_size > 0)
+
+    result = None
+    for i in xrange(0, len(new_array), block_size):
+        each_result = ufunc.reduce(new_array[i:i + block_size], axis=0, dtype=dtype)
+
+        if result is None:
+            result = each_result
+        else:
+            ufunc(result, each_result, out=result)
+
+    result = add_singleton_axis_beginning(result)
+
+    return(result)
+
+
 def get_quantiles(probs):
     """
         Determines the probabilites for quantiles for given data much like MATLAB's function
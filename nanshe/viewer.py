@@ -30,6 +30,8 @@ logger = prof.logging.getLogger(__name__)
 import os
 import collections
 import itertools
+import multiprocessing.pool
+import Queue
 import threading
 
 import h5py
@@ -56,6 +58,285 @@ class HDF5DatasetNotFoundException( Exception ):
     """
     pass
 
+@prof.log_class(logger)
+class HDF5TileCache(object):
+    """
+        Keeps tiles of HDF5 datasets that were read recently so that moving back and forth through frames does not
+        read them again. A tile is a run of entries along the first axis (usually time) of a dataset. If the dataset
+        is chunked, tiles line up with the chunks. Otherwise, tiles are roughly tile_size bytes.
+
+        After each read, the next few tiles (in the direction that the frames are being moved through) are read ahead
+        in a background thread. The least recently used tiles are dropped once the cache is larger than max_size
+        bytes.
+
+        Attributes:
+              max_size(int):                           Most bytes of tiles to keep.
+              tile_size(int):                          Bytes in a tile (only if the dataset is not chunked).
+              num_tiles_ahead(int):                    How many tiles to read ahead.
+    """
+
+    def __init__(self, max_size = 2**28, tile_size = 2**22, num_tiles_ahead = 2):
+        self.max_size = max_size
+        self.tile_size = tile_size
+        self.num_tiles_ahead = num_tiles_ahead
+
+        self.lock = threading.RLock()
+
+        # Tiles in order of last use (most recent last) along with the total bytes in them.
+        self.tiles = collections.OrderedDict()
+        self.size = 0
+
+        # Tiles being read along with an event set once they are done.
+        self.tiles_reading = dict()
+
+        # Last tile requested for each dataset to find the direction to read ahead in.
+        self.last_tile_indices = dict()
+
+        self.read_ahead_queue = Queue.Queue(maxsize = 4 * max(1, num_tiles_ahead))
+        self.read_ahead_thread = None
+
+    @staticmethod
+    def key(dataset, record_name = ""):
+        return((os.path.realpath(dataset.file.filename), dataset.name, record_name))
+
+    def tile_length(self, dataset, record_name = ""):
+        """
+            Determines how many entries along the first axis go in a tile.
+
+            Args:
+                dataset(h5py.Dataset):              dataset to be read.
+                record_name(str):                   member to read from a compound type (all if empty).
+
+            Returns:
+                int:                                number of entries in a tile.
+        """
+
+        if dataset.chunks is not None:
+            return(dataset.chunks[0])
+
+        entry_dtype = dataset.dtype[record_name] if record_name else dataset.dtype
+        entry_size = entry_dtype.itemsize * int(numpy.prod(dataset.shape[1:]))
+
+        return(max(1, self.tile_size // max(1, entry_size)))
+
+    def get_tile(self, dataset, record_name, tile_index, tile_length):
+        """
+            Gets a tile from the cache or reads it (waiting for it if it is already being read).
+
+            Args:
+                dataset(h5py.Dataset):              dataset to be read.
+                record_name(str):                   member to read from a compound type (all if empty).
+                tile_index(int):                    which tile along the first axis.
+                tile_length(int):                   number of entries along the first axis in a tile.
+
+            Returns:
+                numpy.ndarray:                      the tile.
+        """
+
+        tile_key = HDF5TileCache.key(dataset, record_name) + (tile_index, tile_length,)
+
+        with self.lock:
+            tile = self.tiles.pop(tile_key, None)
+            if tile is not None:
+                self.tiles[tile_key] = tile
+                return(tile)
+
+            tile_read = self.tiles_reading.get(tile_key)
+            if tile_read is None:
+                self.tiles_reading[tile_key] = threading.Event()
+
+        if tile_read is not None:
+            tile_read.wait()
+
+            with self.lock:
+                tile = self.tiles.get(tile_key)
+
+            # Either already dropped or the read failed. So, read it without the cache.
+            if tile is None:
+                tile = self.read_tile(dataset, record_name, tile_index, tile_length)
+
+            return(tile)
+
+        try:
+            tile = self.read_tile(dataset, record_name, tile_index, tile_length)
+
+            with self.lock:
+                self.tiles[tile_key] = tile
+                self.size += tile.nbytes
+
+                # Drop the least recently used (leaving at least the one just read).
+                while (self.size > self.max_size) and (len(self.tiles) > 1):
+                    self.size -= self.tiles.popitem(last = False)[1].nbytes
+        finally:
+            with self.lock:
+                self.tiles_reading.pop(tile_key).set()
+
+        return(tile)
+
+    @staticmethod
+    def read_tile(dataset, record_name, tile_index, tile_length):
+        tile_slicing = (slice(tile_index * tile_length, min((tile_index + 1) * tile_length, len(dataset))),)
+
+        if record_name:
+            # h5py does not allowing further index on the type within the compound type.
+            tile_slicing += (record_name,)
+
+        return(dataset[tile_slicing])
+
+    def read(self, dataset, slicing, record_name = ""):
+        """
+            Reads the slicing from the dataset using cached tiles where possible and reads ahead.
+
+            Args:
+                dataset(h5py.Dataset):              dataset to be read.
+                slicing(tuple of slices):           slicing for the dataset (and member) to read.
+                record_name(str):                   member to read from a compound type (all if empty).
+
+            Returns:
+                numpy.ndarray:                      the data read.
+        """
+
+        tile_length = self.tile_length(dataset, record_name)
+
+        start, stop, step = slicing[0].indices(len(dataset))
+        stop = max(start, stop)
+
+        first_tile_index = start // tile_length
+        last_tile_index = max(first_tile_index, (stop - 1) // tile_length)
+
+        # Too big to keep. So, read it without the cache.
+        entry_dtype = dataset.dtype[record_name] if record_name else dataset.dtype
+        needed_bytes = (last_tile_index - first_tile_index + 1) * tile_length * \
+            entry_dtype.itemsize * int(numpy.prod(dataset.shape[1:]))
+        if needed_bytes > (self.max_size // 2):
+            if record_name:
+                a_result = dataset[slicing[:len(dataset.shape)] + (record_name,)]
+                return(a_result[len(dataset.shape) * (slice(None),) + slicing[len(dataset.shape):]])
+            else:
+                return(dataset[slicing])
+
+        tiles = [
+            self.get_tile(dataset, record_name, i, tile_length)
+            for i in xrange(first_tile_index, last_tile_index + 1)
+        ]
+
+        self.read_ahead(dataset, record_name, first_tile_index, last_tile_index, tile_length)
+
+        if len(tiles) == 1:
+            block = tiles[0]
+        else:
+            block = numpy.concatenate(tiles)
+
+        offset = first_tile_index * tile_length
+
+        return(block[(slice(start - offset, stop - offset, step),) + tuple(slicing[1:])])
+
+    def read_ahead(self, dataset, record_name, first_tile_index, last_tile_index, tile_length):
+        """
+            Queues the tiles after those requested (before if moving backwards) to be read in the background.
+
+            Args:
+                dataset(h5py.Dataset):              dataset to be read.
+                record_name(str):                   member to read from a compound type (all if empty).
+                first_tile_index(int):              first tile requested.
+                last_tile_index(int):               last tile requested.
+                tile_length(int):                   number of entries along the first axis in a tile.
+        """
+
+        if not self.num_tiles_ahead:
+            return
+
+        key = HDF5TileCache.key(dataset, record_name)
+        num_tiles = (len(dataset) + tile_length - 1) // tile_length
+
+        with self.lock:
+            previous_tile_index = self.last_tile_indices.get(key, first_tile_index)
+            self.last_tile_indices[key] = first_tile_index
+
+            if first_tile_index < previous_tile_index:
+                tile_indices = xrange(first_tile_index - 1, first_tile_index - 1 - self.num_tiles_ahead, -1)
+            else:
+                tile_indices = xrange(last_tile_index + 1, last_tile_index + 1 + self.num_tiles_ahead)
+
+            tile_indices = [
+                _ for _ in tile_indices
+                if (0 <= _ < num_tiles) and (key + (_, tile_length,) not in self.tiles)
+            ]
+
+            if not tile_indices:
+                return
+
+            if self.read_ahead_thread is None:
+                self.read_ahead_thread = threading.Thread(target = self.run_read_ahead)
+                self.read_ahead_thread.daemon = True
+                self.read_ahead_thread.start()
+
+        for each_tile_index in tile_indices:
+            try:
+                self.read_ahead_queue.put_nowait((dataset, record_name, each_tile_index, tile_length))
+            except Queue.Full:
+                # Already behind. So, skip it and it will be read when requested.
+                break
+
+    def run_read_ahead(self):
+        while True:
+            dataset, record_name, tile_index, tile_length = self.read_ahead_queue.get()
+
+            try:
+                # Closed files are skipped.
+                if dataset:
+                    self.get_tile(dataset, record_name, tile_index, tile_length)
+            except Exception:
+                logger.debug("Unable to read ahead tile " + repr(tile_index) + ".", exc_info = True)
+
+    def clear(self):
+        with self.lock:
+            self.tiles.clear()
+            self.size = 0
+            self.last_tile_indices.clear()
+
+
+# Shared by all sources in this process.
+tile_cache = None
+
+# Threads to fill requests in.
+request_thread_pool = None
+
+
+@prof.log_call(logger)
+def get_tile_cache():
+    """
+        Gets the HDF5TileCache shared by all HDF5DataSources.
+
+        Returns:
+            HDF5TileCache:          the cache of tiles read.
+    """
+
+    global tile_cache
+
+    if tile_cache is None:
+        tile_cache = HDF5TileCache()
+
+    return(tile_cache)
+
+
+@prof.log_call(logger)
+def get_request_thread_pool():
+    """
+        Gets the threads that HDF5DataRequests are filled in (so that waiting only waits).
+
+        Returns:
+            multiprocessing.pool.ThreadPool:    the threads used to fill requests.
+    """
+
+    global request_thread_pool
+
+    if request_thread_pool is None:
+        request_thread_pool = multiprocessing.pool.ThreadPool(4)
+
+    return(request_thread_pool)
+
+
 @prof.qt_log_class(logger)
 class HDF5DataSource( QObject ):
     """
@@ -69,6 +350,7 @@ class HDF5DataSource( QObject ):
               dataset_shape(tuple of ints):            A tuple representing the shape of the dataset in each dimension
               dataset_dtype(numpy.dtype or type):      The type of the underlying dataset.
               axis_order(tuple of ints):               A tuple representing how to reshape the array before returning a request
+              tile_cache(HDF5TileCache):               Cache of tiles read from the dataset (shared between sources).
 
     """
 
@@ -94,6 +376,7 @@ class HDF5DataSource( QObject ):
         super(HDF5DataSource, self).__init__()
 
         self.file_handle = None
+        self.file_handle_pooled = False
 
         self.file_path = ""
         self.dataset_path = ""
@@ -106,10 +389,14 @@ class HDF5DataSource( QObject ):
 
         self.axis_order = [-1, -1, -1, -1, -1]
 
-        # If it is a filename, get the file handle.
-        if isinstance(file_handle, str):
-            file_handle.rstrip("/")
-            file_handle = h5py.File(file_handle)
+        self.tile_cache = get_tile_cache()
+
+        # If it is a filename, get the file handle (shared through the pool of open files).
+        # Only a file handle gotten here is given back on clean up. Otherwise, it belongs to the caller.
+        self.file_handle_pooled = isinstance(file_handle, str)
+        if self.file_handle_pooled:
+            file_handle = file_handle.rstrip("/")
+            file_handle = hdf5.pool.get_file_pool().acquire(file_handle, "r")
 
         self.file_handle = file_handle
 
@@ -189,10 +476,11 @@ class HDF5DataSource( QObject ):
         return(self.dataset_shape[-1])
 
     def clean_up(self):
-        # Close file
-        if self.file_handle is not None:
-            self.file_handle.close()
-            self.file_handle = None
+        # Give the file back to the pool
+        if (self.file_handle is not None) and self.file_handle_pooled:
+            hdf5.pool.get_file_pool().release(self.file_handle)
+
+        self.file_handle = None
 
         self.file_path = None
         self.dataset_path = None
@@ -214,7 +502,7 @@ class HDF5DataSource( QObject ):
 
         slicing = iters.reformat_slices(slicing, self.dataset_shape)
 
-        return(HDF5DataRequest(self.file_handle, self.dataset_path, self.axis_order, self.dataset_dtype, slicing, self.record_name))
+        return(HDF5DataRequest(self.file_handle, self.dataset_path, self.axis_order, self.dataset_dtype, slicing, self.record_name, tile_cache = self.tile_cache))
 
     def setDirty( self, slicing):
         if not is_pure_slicing(slicing):
@@ -250,10 +538,12 @@ class HDF5DataRequest( object ):
           slicing(tuple of slices):                The slicing request by Volumina.
           actual_slicing(tuple of slices):         The actual slicing that will be performed on the dataset.
           throw_on_not_found(bool):                   Whether to throw an exception if the dataset is not found.
+          tile_cache(HDF5TileCache):               Cache of tiles to read through (reads directly if None).
 
         Note:
              Before returning the result to Volumina the axes will likely need to be transposed. Also, singleton axes
-             will need to be inserted to ensure the dimensionality is 5 as Volumina expects. This result will be cached
+             will need to be inserted to ensure the dimensionality is 5 as Volumina expects. This is done in a thread
+             from the request thread pool once submitted (waiting submits if needed). This result will be cached
              inside the request instance. So, if this request instance is kept, this won't need to be repeated.
 
     """
@@ -261,7 +551,7 @@ class HDF5DataRequest( object ):
     #TODO: Try to remove throw_on_not_found. This basically would have been thrown earlier. So, we would rather not have this as it is a bit hacky.
     #TODO: Try to remove dataset_dtype as this should be readily available information from the dataset.
 
-    def __init__( self, file_handle, dataset_path, axis_order, dataset_dtype, slicing, record_name = "", throw_on_not_found = False ):
+    def __init__( self, file_handle, dataset_path, axis_order, dataset_dtype, slicing, record_name = "", throw_on_not_found = False, tile_cache = None ):
         """
             Constructs an HDF5DataRequest using a given file and path to the dataset. Optionally, throwing can be
             suppressed if the source is not found.
@@ -274,6 +564,7 @@ class HDF5DataRequest( object ):
                 slicing(tuple of ints):                     The slicing to extract from the HDF5 file.
                 record_name(str):                           Name of member to retrieve from compound type.
                 throw_on_not_found(bool):                   Whether to throw an exception if the dataset is not found.
+                tile_cache(HDF5TileCache):                  Cache of tiles to read through (reads directly if None).
         """
 
         # TODO: Look at adding assertion check on slices.
@@ -284,9 +575,14 @@ class HDF5DataRequest( object ):
         self.dataset_dtype = dataset_dtype
         self.record_name = record_name
         self.throw_on_not_found = throw_on_not_found
+        self.tile_cache = tile_cache
 
         self._result = None
 
+        # Result being filled in the request thread pool (once submitted).
+        self._async_result = None
+        self._submit_lock = threading.Lock()
+
         # Clean up slicing. Here self.slicing is the requested slicing.
         # actual_slicing_dict includes a key for each_axis.
         # To construct the list requires a second pass either way.
@@ -305,45 +601,51 @@ class HDF5DataRequest( object ):
         # Convert to tuple as it is expected.
         self.actual_slicing = tuple(self.actual_slicing)
 
-    def wait( self ):
-        if self._result is None:
-            # Construct a result the size of the slicing
-            slicing_shape = iters.len_slices(self.slicing)
-            self._result = numpy.zeros(slicing_shape, dtype = self.dataset_dtype)
+    def _compute( self ):
+        slicing_shape = iters.len_slices(self.slicing)
 
-            try:
-                dataset = self.file_handle[self.dataset_path]
-
-                a_result = None
-                if self.record_name:
-                    # Copy out the bare minimum data.
-                    # h5py does not allowing further index on the type within the compound type.
-                    a_result = dataset[ self.actual_slicing[:len(dataset.shape)] + (self.record_name,) ]
-                    # Apply the remaining slicing to the data read.
-                    a_result = a_result[ len(dataset.shape) * (slice(None),) + self.actual_slicing[len(dataset.shape):] ]
-                else:
-                    a_result = dataset[self.actual_slicing]
+        try:
+            dataset = self.file_handle[self.dataset_path]
 
-                a_result = numpy.array(a_result)
+            a_result = None
+            if self.tile_cache is not None:
+                a_result = self.tile_cache.read(dataset, self.actual_slicing, self.record_name)
+            elif self.record_name:
+                # Copy out the bare minimum data.
+                # h5py does not allowing further index on the type within the compound type.
+                a_result = dataset[ self.actual_slicing[:len(dataset.shape)] + (self.record_name,) ]
+                # Apply the remaining slicing to the data read.
+                a_result = a_result[ len(dataset.shape) * (slice(None),) + self.actual_slicing[len(dataset.shape):] ]
+            else:
+                a_result = dataset[self.actual_slicing]
 
-                # Get the axis order without the singleton axes
-                the_axis_order = numpy.array(self.axis_order)
-                the_axis_order = the_axis_order[the_axis_order != -1]
+            # Get the axis order without the singleton axes
+            the_axis_order = numpy.array(self.axis_order)
+            the_axis_order = the_axis_order[the_axis_order != -1]
 
-                # Reorder the axes for Volumina
-                a_result = a_result.transpose(the_axis_order)
+            # Reorder the axes for Volumina
+            a_result = numpy.asarray(a_result).transpose(the_axis_order)
 
-                # Insert singleton axes to make 5D for Volumina
-                for i, each_axis_order in enumerate(self.axis_order):
-                    if each_axis_order == -1:
-                        a_result = xnumpy.add_singleton_axis_pos(a_result, i)
+            # Insert singleton axes to make 5D for Volumina (a view so only one copy is made below).
+            a_result = a_result.reshape(slicing_shape)
 
-                self._result[:] = a_result
-            except KeyError:
-                if self.throw_on_not_found:
-                   raise
+            # Copy (as the tiles are shared) to be contiguous in the order Volumina expects.
+            a_result = numpy.array(a_result, dtype = self.dataset_dtype, order = "C")
+        except KeyError:
+            if self.throw_on_not_found:
+               raise
 
-            logger.debug("Found the result.")
+            a_result = numpy.zeros(slicing_shape, dtype = self.dataset_dtype)
+
+        logger.debug("Found the result.")
+
+        return(a_result)
+
+    def wait( self ):
+        if self._result is None:
+            self.submit()
+
+            self._result = self._async_result.get()
 
         return self._result
 
@@ -354,7 +656,9 @@ class HDF5DataRequest( object ):
         pass
 
     def submit( self ):
-        pass
+        with self._submit_lock:
+            if (self._result is None) and (self._async_result is None):
+                self._async_result = get_request_thread_pool().apply_async(self._compute)
 
     # callback( result = result, **kwargs )
     def notify( self, callback, **kwargs ):
@@ -1605,7 +1909,7 @@ def main(*argv):
         parsed_args.input_files[i] = parsed_args.input_files[i].rstrip("/")
         parsed_args.input_files[i] = os.path.abspath(parsed_args.input_files[i])
 
-        parsed_args.file_handles.append(h5py.File(parsed_args.input_files[i], "r"))
+        parsed_args.file_handles.append(hdf5.pool.get_file_pool().acquire(parsed_args.input_files[i], "r"))
 
     # Make all each_layer_source_location_dict is a dict whether they were or not before
     # The key will be the operation to perform and the values will be what to perform the operation on.
@@ -1734,12 +2038,13 @@ def main(*argv):
     app2 = app
     exit_code = app.exec_()
 
-    # Close and clean up files
-    parsed_args.file_handles = []
+    # Give the files back to the pool and clean up
     for i in xrange(len(parsed_args.file_handles)):
-        parsed_args.file_handles[i].close()
+        hdf5.pool.get_file_pool().release(parsed_args.file_handles[i])
         parsed_args.file_handles[i] = None
 
+    hdf5.pool.get_file_pool().close()
+
     parsed_args.file_handles = None
     del parsed_args.file_handles
 
@@ -8,6 +8,7 @@ import nose.plugins.attrib
 
 import ctypes
 import multiprocessing
+import os
 
 import numpy
 
@@ -446,6 +447,149 @@ class TestSpamsSandbox(object):
 
         assert (len(unmatched_g3) == 0)
 
+    def test_find_memmap_file_offset_1(self):
+        a = numpy.arange(24, dtype = numpy.float64).reshape((4, 6), order = "F")
+
+        assert (nanshe.box.spams_sandbox.find_memmap_file_offset(a) is None)
+
+        b = nanshe.box.spams_sandbox.empty_shared_array(a.shape, a.dtype)
+        b[:] = a
+
+        assert (nanshe.box.spams_sandbox.find_memmap_file_offset(b) == (b.filename, 0))
+        assert (nanshe.box.spams_sandbox.find_memmap_file_offset(b[:, 2:]) == (b.filename, 2 * 4 * b.itemsize))
+
+        c_filename, c_offset = nanshe.box.spams_sandbox.find_memmap_file_offset(b[:, 2:])
+        b.flush()
+        c = numpy.memmap(c_filename, dtype = b.dtype, mode = "r", offset = c_offset, shape = (4, 4), order = "F")
+
+        assert (c == a[:, 2:]).all()
+
+        nanshe.box.spams_sandbox.remove_shared_array(b)
+
+        assert not os.path.exists(b.filename)
+
+    def test_call_memmap_spams_trainDL_1(self):
+        d = nanshe.box.spams_sandbox.call_memmap_spams_trainDL(self.g.astype(float),
+                                                                  **{
+                                                                         "gamma2" : 0,
+                                                                         "gamma1" : 0,
+                                                                          "numThreads" : 1,
+                                                                          "K" : self.g.shape[1],
+                                                                          "iter" : 10,
+                                                                          "modeD" : 0,
+                                                                          "posAlpha" : True,
+                                                                          "clean" : True,
+                                                                          "posD" : True,
+                                                                          "batchsize" : 256,
+                                                                          "lambda1" : 0.2,
+                                                                          "lambda2" : 0,
+                                                                          "mode" : 2
+                                                                     }
+        )
+        d = (d != 0)
+
+        self.g = self.g.transpose()
+        d = d.transpose()
+
+        assert (self.g.shape == d.shape)
+
+        assert (self.g.astype(bool).max(axis = 0) == d.astype(bool).max(axis = 0)).all()
+
+        unmatched_g = range(len(self.g))
+        matched = dict()
+
+        for i in xrange(len(d)):
+            new_unmatched_g = []
+            for j in unmatched_g:
+                if not (d[i] == self.g[j]).all():
+                    new_unmatched_g.append(j)
+                else:
+                    matched[i] = j
+
+            unmatched_g = new_unmatched_g
+
+        print unmatched_g
+
+        assert (len(unmatched_g) == 0)
+
+    @nose.plugins.attrib.attr("3D")
+    def test_call_memmap_spams_trainDL_2(self):
+        d3 = nanshe.box.spams_sandbox.call_memmap_spams_trainDL(self.g3.astype(float),
+                                                                   **{
+                                                                          "gamma2" : 0,
+                                                                          "gamma1" : 0,
+                                                                           "numThreads" : 1,
+                                                                           "K" : self.g3.shape[1],
+                                                                           "iter" : 10,
+                                                                           "modeD" : 0,
+                                                                           "posAlpha" : True,
+                                                                           "clean" : True,
+                                                                           "posD" : True,
+                                                                           "batchsize" : 256,
+                                                                           "lambda1" : 0.2,
+                                                                           "lambda2" : 0,
+                                                                           "mode" : 2
+                                                                      }
+        )
+        d3 = (d3 != 0)
+
+        self.g3 = self.g3.transpose()
+        d3 = d3.transpose()
+
+        assert (self.g3.shape == d3.shape)
+
+        assert (self.g3.astype(bool).max(axis = 0) == d3.astype(bool).max(axis = 0)).all()
+
+        unmatched_g3 = range(len(self.g3))
+        matched = dict()
+
+        for i in xrange(len(d3)):
+            new_unmatched_g3 = []
+            for j in unmatched_g3:
+                if not (d3[i] == self.g3[j]).all():
+                    new_unmatched_g3.append(j)
+                else:
+                    matched[i] = j
+
+            unmatched_g3 = new_unmatched_g3
+
+        print unmatched_g3
+
+        assert (len(unmatched_g3) == 0)
+
+    def test_call_memmap_spams_trainDL_3(self):
+        # X is in shared memory already. So, it is not copied. Also, the same sandbox is used for both calls.
+        g = nanshe.box.spams_sandbox.empty_shared_array(self.g.shape, float)
+        g[:] = self.g
+
+        params = {
+            "gamma2" : 0,
+            "gamma1" : 0,
+            "numThreads" : 1,
+            "K" : self.g.shape[1],
+            "iter" : 10,
+            "modeD" : 0,
+            "posAlpha" : True,
+            "clean" : True,
+            "posD" : True,
+            "batchsize" : 256,
+            "lambda1" : 0.2,
+            "lambda2" : 0,
+            "mode" : 2
+        }
+
+        d1 = nanshe.box.spams_sandbox.call_memmap_spams_trainDL(g, **params)
+        sandbox_pid = nanshe.box.spams_sandbox.get_spams_sandbox().process.pid
+        d2 = nanshe.box.spams_sandbox.call_memmap_spams_trainDL(g, **params)
+
+        assert (nanshe.box.spams_sandbox.get_spams_sandbox().process.pid == sandbox_pid)
+
+        nanshe.box.spams_sandbox.remove_shared_array(g)
+
+        assert (d1.shape == d2.shape == self.g.shape)
+        assert ((d1 != 0) == (d2 != 0)).all()
+        assert ((d1 != 0).max(axis = 0) == self.g.astype(bool).max(axis = 0)).all()
+
     def test_call_spams_trainDL_1(self):
         d = nanshe.box.spams_sandbox.call_spams_trainDL(self.g.astype(float),
                                                            **{
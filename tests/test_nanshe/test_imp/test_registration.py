@@ -7,6 +7,8 @@ import nose.plugins
 import nose.plugins.attrib
 
 import os
+import shutil
+import tempfile
 
 import h5py
 import numpy
@@ -312,6 +314,177 @@ class TestRegisterMeanOffsets(object):
         assert (b2.data == b.data).all()
         assert (b2.mask == b.mask).all()
 
+    def test12a(self):
+        a = numpy.zeros((20,11,12), dtype=numpy.float32)
+
+        a[:, 3:-4, 3:-4] = 1
+
+        b = numpy.ma.masked_array(a.copy())
+        b_off = numpy.zeros((len(a), a.ndim-1), dtype=int)
+
+        a[10] = 0
+        a[10, :-7, :-7] = 1
+
+        b[10, :, :3] = numpy.ma.masked
+        b[10, :3, :] = numpy.ma.masked
+        b_off[10] = 3
+
+        fn = nanshe.imp.registration.register_mean_offsets(
+            a, block_frame_length = 3, include_shift = True, num_threads = 3
+        )
+
+        b2 = None
+        b2_off = None
+        with h5py.File(fn, "r") as f:
+            b2g = f["reg_frames"]
+            b2d = nanshe.io.hdf5.serializers.HDF5MaskedDataset(b2g)
+            b2 = b2d[...]
+            b2_off = f["space_shift"][...]
+
+        os.remove(fn)
+
+        assert (b2.dtype == b.dtype)
+        assert (b2.data == b.data).all()
+        assert (b2.mask == b.mask).all()
+        assert (b2_off == b_off).all()
+
+    def test13a(self):
+        y, x = numpy.indices((20, 21))
+
+        a = numpy.empty((20,) + y.shape, dtype=numpy.float32)
+        a[...] = numpy.exp(-((y - 10.0) ** 2 + (x - 10.0) ** 2) / 8.0)
+
+        b = numpy.ma.masked_array(a.copy())
+        b_off = numpy.zeros((len(a), a.ndim-1), dtype=float)
+
+        a[10] = numpy.exp(-((y - 11.5) ** 2 + (x - 9.75) ** 2) / 8.0)
+
+        b[10, :, :1] = numpy.ma.masked
+        b[10, -2:, :] = numpy.ma.masked
+        b_off[10] = [-1.5, 0.25]
+
+        b2, b2_off = nanshe.imp.registration.register_mean_offsets(
+            a, include_shift = True, upsample_factor = 4
+        )
+
+        assert (b2.dtype == b.dtype)
+        assert (numpy.abs(b2.data - b.data)[~b.mask].max() < 1e-3)
+        assert (b2.mask == b.mask).all()
+        assert (b2_off == b_off).all()
+
+    def test14a(self):
+        y, x = numpy.indices((20, 21))
+
+        a = numpy.empty((20,) + y.shape, dtype=numpy.float32)
+        a[...] = numpy.exp(-((y - 10.0) ** 2 + (x - 10.0) ** 2) / 8.0)
+
+        b = a[:, :-2, 1:].copy()
+
+        a[10] = numpy.exp(-((y - 11.5) ** 2 + (x - 9.75) ** 2) / 8.0)
+
+        fn = nanshe.imp.registration.register_mean_offsets(
+            a, block_frame_length = 7, to_truncate = True, upsample_factor = 4, num_threads = 2
+        )
+
+        b2 = None
+        with h5py.File(fn, "r") as f:
+            b2 = f["reg_frames"][...]
+
+        os.remove(fn)
+
+        assert (b2.dtype == b.dtype)
+        assert (b2.shape == b.shape)
+        assert (numpy.abs(b2 - b).max() < 1e-3)
+
+    def test15a(self):
+        a = numpy.zeros((20,11,12), dtype=int)
+
+        a[:, 3:-4, 3:-4] = 1
+
+        b = a[:, 3:, 3:].copy()
+
+        a[10] = 0
+        a[10, :-7, :-7] = 1
+
+        temp_dir = tempfile.mkdtemp()
+        temp_filename = os.path.join(temp_dir, "data.h5")
+
+        b2 = None
+        with h5py.File(temp_filename, "w") as f:
+            f["a"] = a
+
+            b2d = nanshe.imp.registration.register_mean_offsets(
+                f["a"], block_frame_length = 7, to_truncate = True, keep_fft = False, out = f, out_name = "b"
+            )
+
+            assert (b2d.name == "/b")
+
+            b2 = f["b"][...]
+
+        assert (os.listdir(temp_dir) == ["data.h5"])
+
+        shutil.rmtree(temp_dir)
+
+        assert (b2.dtype == b.dtype)
+        assert (b2 == b).all()
+
+    def test16a(self):
+        a = numpy.zeros((20,11,12), dtype=int)
+
+        a[:, 3:-4, 3:-4] = 1
+
+        b = numpy.ma.masked_array(a.copy())
+        b_off = numpy.zeros((len(a), a.ndim-1), dtype=int)
+
+        a[10] = 0
+        a[10, :-7, :-7] = 1
+
+        b[10, :, :3] = numpy.ma.masked
+        b[10, :3, :] = numpy.ma.masked
+        b_off[10] = 3
+
+        temp_dir = tempfile.mkdtemp()
+        temp_filename = os.path.join(temp_dir, "data.h5")
+
+        b2 = None
+        b2_off = None
+        with h5py.File(temp_filename, "w") as f:
+            b2d, b2_off = nanshe.imp.registration.register_mean_offsets(
+                a, keep_fft = False, include_shift = True, out = f
+            )
+
+            b2 = b2d[...]
+
+        shutil.rmtree(temp_dir)
+
+        assert (b2.dtype == b.dtype)
+        assert (b2.data == b.data).all()
+        assert (b2.mask == b.mask).all()
+        assert (b2_off == b_off).all()
+
+    def test17a(self):
+        a = numpy.zeros((30,11,12), dtype=int)
+        a_off = numpy.zeros((len(a), a.ndim-1), dtype=int)
+
+        # Drifts down a pixel every 10 frames.
+        for i in xrange(3):
+            a[(10 * i):(10 * (i + 1)), (3 + i):(-5 + i), 3:-4] = 1
+            a_off[(10 * i):(10 * (i + 1)), 0] = 1 - i
+
+        b = numpy.ma.masked_array(a.copy())
+        b[:] = b[10]
+        b[:10, :1] = numpy.ma.masked
+        b[20:, -1:] = numpy.ma.masked
+
+        b2, a_off2 = nanshe.imp.registration.register_mean_offsets(
+            a, include_shift = True, window_length = 10, num_threads = 3
+        )
+
+        assert (a_off2 == a_off).all()
+        assert (b2.dtype == b.dtype)
+        assert (b2.data[~b2.mask] == b.data[~b.mask]).all()
+        assert (b2.mask == b.mask).all()
+
     @nose.plugins.attrib.attr("3D")
     def test0b(self):
         a = numpy.zeros((20,10,11,12), dtype=int)
@@ -695,6 +868,49 @@ class TestFindOffsets(object):
         assert (a_off2.dtype == a_off.dtype)
         assert (a_off2 == a_off).all()
 
+    def test3a(self):
+        a = numpy.zeros((20,11,12), dtype=int)
+        a_off = numpy.zeros((len(a), a.ndim-1), dtype=int)
+
+        a[:, 3:-4, 3:-4] = 1
+
+        a[10] = 0
+        a[10, :-7, :-7] = 1
+
+        a_off[10] = a.shape[1:]
+        a_off[10] -= 3
+        numpy.negative(a_off, out=a_off)
+
+        am = a.mean(axis=0)
+
+        af = numpy.fft.rfftn(a, axes=range(1, a.ndim))
+        amf = numpy.fft.rfftn(am, axes=range(am.ndim))
+
+
+        a_off2 = nanshe.imp.registration.find_offsets(af, amf, shape=a.shape[1:])
+
+        assert (a_off2.dtype == a_off.dtype)
+        assert (a_off2 == a_off).all()
+
+    def test4a(self):
+        y, x = numpy.indices((20, 21))
+
+        a = numpy.empty((20,) + y.shape, dtype=float)
+        a[...] = numpy.exp(-((y - 10.0) ** 2 + (x - 10.0) ** 2) / 8.0)
+        a_off = numpy.zeros((len(a), a.ndim-1), dtype=float)
+
+        a[10] = numpy.exp(-((y - 11.5) ** 2 + (x - 9.75) ** 2) / 8.0)
+        a_off[10] = [-1.5, 0.25]
+
+        af = numpy.fft.rfftn(a, axes=range(1, a.ndim))
+        amf = numpy.fft.rfftn(a[0], axes=range(a.ndim - 1))
+
+
+        a_off2 = nanshe.imp.registration.find_offsets(af, amf, shape=a.shape[1:], upsample_factor=4)
+
+        assert (a_off2.dtype == a_off.dtype)
+        assert (a_off2 == a_off).all()
+
     @nose.plugins.attrib.attr("3D")
     def test0b(self):
         a = numpy.zeros((20,10,11,12), dtype=int)
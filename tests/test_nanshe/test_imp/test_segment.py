@@ -6,6 +6,11 @@ import nose
 import nose.plugins
 import nose.plugins.attrib
 
+import os
+import shutil
+import tempfile
+
+import h5py
 import numpy
 import scipy
 
@@ -16,6 +21,8 @@ import scipy.stats
 
 import nanshe.util.xnumpy
 
+import nanshe.io.hdf5.record
+
 import nanshe.imp.segment
 
 import nanshe.syn.data
@@ -493,6 +500,77 @@ class TestSegment(object):
         # Turns out that a difference greater than 0.1 will be over 10 standard deviations away.
         assert ( ((a - 100.0*b) < 0.1).all() )
 
+    def test_extract_f0_5(self):
+        spatial_smoothing_gaussian_filter_stdev = 2.0
+        spatial_smoothing_gaussian_filter_window_size = 3.0
+        which_quantile = 0.5
+        temporal_smoothing_gaussian_filter_stdev = 2.0
+        temporal_smoothing_gaussian_filter_window_size = 3.0
+        half_window_size = 5
+
+        mean = 0.0
+        stdev = 1.0
+
+        a = numpy.random.normal(mean, stdev, (57, 20, 30)).astype(numpy.float32)
+
+        b = nanshe.imp.segment.extract_f0(a,
+            spatial_smoothing_gaussian_filter_stdev=spatial_smoothing_gaussian_filter_stdev,
+            spatial_smoothing_gaussian_filter_window_size = spatial_smoothing_gaussian_filter_window_size,
+            which_quantile=which_quantile,
+            temporal_smoothing_gaussian_filter_stdev=temporal_smoothing_gaussian_filter_stdev,
+            temporal_smoothing_gaussian_filter_window_size = temporal_smoothing_gaussian_filter_window_size,
+            half_window_size=half_window_size)
+
+        for block_size, num_threads in [(1, 1), (7, 3), (20, 2), (100, 4)]:
+            c = a.copy()
+            nanshe.imp.segment.extract_f0(c,
+                spatial_smoothing_gaussian_filter_stdev=spatial_smoothing_gaussian_filter_stdev,
+                spatial_smoothing_gaussian_filter_window_size = spatial_smoothing_gaussian_filter_window_size,
+                which_quantile=which_quantile,
+                temporal_smoothing_gaussian_filter_stdev=temporal_smoothing_gaussian_filter_stdev,
+                temporal_smoothing_gaussian_filter_window_size = temporal_smoothing_gaussian_filter_window_size,
+                half_window_size=half_window_size,
+                out=c,
+                block_size=block_size,
+                num_threads=num_threads)
+
+            assert numpy.allclose(b, c, atol = 1e-6)
+
+    def test_extract_f0_6(self):
+        spatial_smoothing_gaussian_filter_stdev = 1.0
+        spatial_smoothing_gaussian_filter_window_size = 3.0
+        which_quantile = 0.5
+        temporal_smoothing_gaussian_filter_stdev = 2.0
+        temporal_smoothing_gaussian_filter_window_size = 3.0
+        half_window_size = 5
+
+        mean = 0.0
+        stdev = 1.0
+
+        for shape in [(40,), (40, 13)]:
+            a = numpy.random.normal(mean, stdev, shape).astype(numpy.float32)
+
+            b = nanshe.imp.segment.extract_f0(a,
+                spatial_smoothing_gaussian_filter_stdev=spatial_smoothing_gaussian_filter_stdev,
+                spatial_smoothing_gaussian_filter_window_size = spatial_smoothing_gaussian_filter_window_size,
+                which_quantile=which_quantile,
+                temporal_smoothing_gaussian_filter_stdev=temporal_smoothing_gaussian_filter_stdev,
+                temporal_smoothing_gaussian_filter_window_size = temporal_smoothing_gaussian_filter_window_size,
+                half_window_size=half_window_size)
+
+            for block_size, num_threads in [(1, 1), (2, 3), (5, 2)]:
+                c = nanshe.imp.segment.extract_f0(a,
+                    spatial_smoothing_gaussian_filter_stdev=spatial_smoothing_gaussian_filter_stdev,
+                    spatial_smoothing_gaussian_filter_window_size = spatial_smoothing_gaussian_filter_window_size,
+                    which_quantile=which_quantile,
+                    temporal_smoothing_gaussian_filter_stdev=temporal_smoothing_gaussian_filter_stdev,
+                    temporal_smoothing_gaussian_filter_window_size = temporal_smoothing_gaussian_filter_window_size,
+                    half_window_size=half_window_size,
+                    block_size=block_size,
+                    num_threads=num_threads)
+
+                assert numpy.allclose(b, c, atol = 1e-6)
+
     def test_preprocess_data_1(self):
         ## Does NOT test accuracy.
 
@@ -769,6 +847,59 @@ class TestSegment(object):
 
         nanshe.imp.segment.preprocess_data(image_stack, **config)
 
+    def test_preprocess_data_blocked_1(self):
+        config = {
+            "normalize_data" : {
+                "renormalized_images" : {
+                    "ord" : 2
+                }
+            },
+            "extract_f0" : {
+                "spatial_smoothing_gaussian_filter_stdev" : 2.0,
+                "spatial_smoothing_gaussian_filter_window_size" : 3.0,
+                "which_quantile" : 0.5,
+                "temporal_smoothing_gaussian_filter_stdev" : 2.0,
+                "temporal_smoothing_gaussian_filter_window_size" : 3.0,
+                "half_window_size" : 5
+            },
+            "wavelet.transform" : {
+                "scale" : [
+                    3,
+                    2,
+                    2
+                ]
+            }
+        }
+
+        space = numpy.array([30, 60, 50])
+        radii = numpy.array([5, 6])
+        magnitudes = numpy.array([15, 16])
+        points = numpy.array([[10, 20, 24],
+                              [20, 41, 15]])
+
+        masks = nanshe.syn.data.generate_hypersphere_masks(space, points, radii)
+        images = nanshe.syn.data.generate_gaussian_images(space, points, radii/3.0, magnitudes) * masks
+        image_stack = images.max(axis = 0).astype(numpy.float32) + 10
+
+        image_stack_preprocessed = nanshe.imp.segment.preprocess_data(image_stack, **config)
+
+        # Small enough to need several tiles.
+        memory_budget = image_stack.nbytes
+
+        image_stack_preprocessed_blocked = numpy.empty_like(image_stack)
+        nanshe.imp.segment.preprocess_data_blocked(image_stack,
+                                                   out = image_stack_preprocessed_blocked,
+                                                   memory_budget = memory_budget,
+                                                   **config)
+
+        halo = nanshe.imp.segment.preprocess_data_halo(image_stack.ndim, **config)
+        tile_shape = nanshe.imp.segment.preprocess_data_tile_shape(image_stack.shape, halo, memory_budget)
+
+        assert (tile_shape[0] == image_stack.shape[0])
+        assert (tile_shape != image_stack.shape)
+
+        assert numpy.allclose(image_stack_preprocessed, image_stack_preprocessed_blocked, atol = 1e-6)
+
     def test_generate_dictionary_0(self):
         p = numpy.array([[27, 51],
                          [66, 85],
@@ -873,6 +1004,115 @@ class TestSegment(object):
 
         assert (len(unmatched_g) == 0)
 
+    def test_generate_dictionary_streamed_0(self):
+        p = numpy.array([[27, 51],
+                         [66, 85],
+                         [77, 45]])
+
+        space = numpy.array((100, 100))
+        radii = numpy.array((5, 6, 7))
+
+        g = nanshe.syn.data.generate_hypersphere_masks(space, p, radii)
+
+        d = nanshe.imp.segment.generate_dictionary_streamed(g.astype(numpy.float32),
+                                                            len(g),
+                                                            **{
+                                                                "spams.trainDL" : {
+                                                                    "gamma2" : 0,
+                                                                    "gamma1" : 0,
+                                                                     "numThreads" : 1,
+                                                                     "K" : len(g),
+                                                                     "iter" : 10,
+                                                                     "modeD" : 0,
+                                                                     "posAlpha" : True,
+                                                                     "clean" : True,
+                                                                     "posD" : True,
+                                                                     "batchsize" : 256,
+                                                                     "lambda1" : 0.2,
+                                                                     "lambda2" : 0,
+                                                                     "mode" : 2
+                                                                }
+                                                            }
+        )
+        d = (d != 0)
+
+        assert (g.shape == d.shape)
+
+        assert (g.astype(bool).max(axis = 0) == d.astype(bool).max(axis = 0)).all()
+
+        unmatched_g = range(len(g))
+        matched = dict()
+
+        for i in xrange(len(d)):
+            new_unmatched_g = []
+            for j in unmatched_g:
+                if not (d[i] == g[j]).all():
+                    new_unmatched_g.append(j)
+                else:
+                    matched[i] = j
+
+            unmatched_g = new_unmatched_g
+
+        print(unmatched_g)
+
+        assert (len(unmatched_g) == 0)
+
+    def test_generate_dictionary_streamed_1(self):
+        p = numpy.array([[27, 51],
+                         [66, 85],
+                         [77, 45]])
+
+        space = numpy.array((100, 100))
+        radii = numpy.array((5, 6, 7))
+
+        g = nanshe.syn.data.generate_hypersphere_masks(space, p, radii)
+        g = numpy.concatenate([g, g]).astype(numpy.float32)
+
+        params = {
+            "spams.trainDL" : {
+                "gamma2" : 0,
+                "gamma1" : 0,
+                 "numThreads" : 1,
+                 "K" : 3,
+                 "iter" : 4,
+                 "modeD" : 0,
+                 "posAlpha" : True,
+                 "clean" : True,
+                 "posD" : True,
+                 "batchsize" : 256,
+                 "lambda1" : 0.2,
+                 "lambda2" : 0,
+                 "mode" : 2
+            }
+        }
+
+        checkpoint_dirname = tempfile.mkdtemp()
+        checkpoint_filename = os.path.join(checkpoint_dirname, "checkpoint.h5")
+
+        try:
+            with h5py.File(checkpoint_filename, "w") as checkpoint_file:
+                checkpoint = nanshe.io.hdf5.record.HDF5ArrayRecorder(checkpoint_file, overwrite = True)
+
+                # Stop half way through.
+                params["spams.trainDL"]["iter"] = 2
+                nanshe.imp.segment.generate_dictionary_streamed(g, 3, checkpoint = checkpoint, **params)
+
+                assert (checkpoint_file["num_iters_done"][0] == 2)
+                assert (checkpoint_file["block_index"][0] == 0)
+                assert (checkpoint_file["D"].shape == (g[0].size, 3))
+                assert (checkpoint_file["A"].shape == (3, 3))
+                assert (checkpoint_file["B"].shape == (g[0].size, 3))
+
+                # Finish from where it stopped.
+                params["spams.trainDL"]["iter"] = 4
+                d = nanshe.imp.segment.generate_dictionary_streamed(g, 3, checkpoint = checkpoint, **params)
+
+                assert (checkpoint_file["num_iters_done"][0] == 4)
+        finally:
+            shutil.rmtree(checkpoint_dirname)
+
+        assert (d.shape == (3,) + g.shape[1:])
+
     @nose.plugins.attrib.attr("3D")
     def test_generate_dictionary_2(self):
         p = numpy.array([[27, 51, 87],
@@ -1916,6 +2156,34 @@ class TestSegment(object):
 
         assert (neurons["centroid"] == neurons["gaussian_mean"]).all()
 
+    def test_extract_neurons_3(self):
+        image = 5 * numpy.ones((100, 100))
+
+        xy = numpy.indices(image.shape)
+
+        circle_centers = numpy.array([[25, 25], [74, 74], [2, 97]])
+
+        circle_radii = numpy.array([25, 25, 5])
+
+        circle_offsets = nanshe.util.xnumpy.expand_view(circle_centers, image.shape) - \
+                         nanshe.util.xnumpy.expand_view(xy, reps_before=len(circle_centers))
+
+        circle_offsets_squared = circle_offsets**2
+
+        circle_masks = (circle_offsets_squared.sum(axis = 1)**.5 < nanshe.util.xnumpy.expand_view(circle_radii, image.shape))
+
+        neurons = nanshe.imp.segment.extract_neurons(image, circle_masks)
+
+        sparse_neurons = nanshe.imp.segment.extract_neurons(image, circle_masks, sparse = True)
+
+        assert isinstance(sparse_neurons, nanshe.imp.segment.SparseNeuronSet)
+
+        assert (len(sparse_neurons) == len(neurons))
+
+        assert (len(sparse_neurons.pixels) == circle_masks.sum())
+
+        assert (nanshe.imp.segment.densify_neurons(sparse_neurons) == neurons).all()
+
     def test_fuse_neurons_1(self):
         fraction_mean_neuron_max_threshold = 0.01
 
@@ -2003,6 +2271,38 @@ class TestSegment(object):
 
         assert (fused_neurons["centroid"] == fused_neurons["gaussian_mean"]).all()
 
+    def test_fuse_neurons_3(self):
+        fraction_mean_neuron_max_threshold = 0.01
+
+        image = 5 * numpy.ones((100, 100))
+
+        xy = numpy.indices(image.shape)
+
+        circle_centers = numpy.array([[25, 25], [35, 35]])
+
+        circle_radii = numpy.array([15, 15])
+
+        circle_offsets = nanshe.util.xnumpy.expand_view(circle_centers, image.shape) - \
+                         nanshe.util.xnumpy.expand_view(xy, reps_before=len(circle_centers))
+
+        circle_offsets_squared = circle_offsets**2
+
+        circle_masks = (circle_offsets_squared.sum(axis = 1)**.5 < nanshe.util.xnumpy.expand_view(circle_radii, image.shape))
+
+        neurons = nanshe.imp.segment.extract_neurons(image, circle_masks)
+
+        fused_neurons = nanshe.imp.segment.fuse_neurons(neurons[0], neurons[1],
+                                                        fraction_mean_neuron_max_threshold)
+
+        sparse_neurons = nanshe.imp.segment.sparsify_neurons(neurons)
+
+        sparse_fused_neurons = nanshe.imp.segment.fuse_neurons(sparse_neurons[0], sparse_neurons[1],
+                                                               fraction_mean_neuron_max_threshold)
+
+        assert (len(sparse_fused_neurons) == 1)
+
+        assert (nanshe.imp.segment.densify_neurons(sparse_fused_neurons)[0] == fused_neurons)
+
     def test_merge_neuron_sets_1(self):
         alignment_min_threshold = 0.6
         overlap_min_threshold = 0.6
@@ -2117,6 +2417,205 @@ class TestSegment(object):
 
         assert (neurons == merged_neurons).all()
 
+    def test_merge_neuron_sets_5(self):
+        alignment_min_threshold = 0.6
+        overlap_min_threshold = 0.6
+        fuse_neurons = {"fraction_mean_neuron_max_threshold" : 0.01}
+
+        image = 5 * numpy.ones((100, 100))
+
+        xy = numpy.indices(image.shape)
+
+        circle_centers = numpy.array([[25, 25], [27, 26], [74, 74], [60, 60], [10, 85], [85, 10], [83, 12]])
+
+        circle_radii = numpy.array([10, 10, 12, 12, 5, 6, 6])
+
+        circle_offsets = nanshe.util.xnumpy.expand_view(circle_centers, image.shape) - \
+                         nanshe.util.xnumpy.expand_view(xy, reps_before=len(circle_centers))
+
+        circle_offsets_squared = circle_offsets**2
+
+        circle_masks = (circle_offsets_squared.sum(axis = 1)**.5 < nanshe.util.xnumpy.expand_view(circle_radii, image.shape))
+
+        neurons = nanshe.imp.segment.extract_neurons(image, circle_masks)
+
+        merged_neurons_dense = nanshe.imp.segment.merge_neuron_sets(neurons[:3], neurons[3:], alignment_min_threshold, overlap_min_threshold, use_spatial_index = False, fuse_neurons = fuse_neurons)
+        merged_neurons_indexed = nanshe.imp.segment.merge_neuron_sets(neurons[:3], neurons[3:], alignment_min_threshold, overlap_min_threshold, use_spatial_index = True, fuse_neurons = fuse_neurons)
+
+        assert (len(merged_neurons_dense) < len(neurons))
+
+        assert (len(merged_neurons_dense) == len(merged_neurons_indexed))
+
+        assert (merged_neurons_dense["mask"] == merged_neurons_indexed["mask"]).all()
+
+        assert (merged_neurons_dense["image"] == merged_neurons_indexed["image"]).all()
+
+    def test_merge_neuron_sets_6(self):
+        alignment_min_threshold = 0.6
+        overlap_min_threshold = 0.6
+        fuse_neurons = {"fraction_mean_neuron_max_threshold" : 0.01}
+
+        image = 5 * numpy.ones((100, 100))
+
+        xy = numpy.indices(image.shape)
+
+        circle_centers = numpy.array([[25, 25], [27, 26], [74, 74], [60, 60], [10, 85], [85, 10], [83, 12]])
+
+        circle_radii = numpy.array([10, 10, 12, 12, 5, 6, 6])
+
+        circle_offsets = nanshe.util.xnumpy.expand_view(circle_centers, image.shape) - \
+                         nanshe.util.xnumpy.expand_view(xy, reps_before=len(circle_centers))
+
+        circle_offsets_squared = circle_offsets**2
+
+        circle_masks = (circle_offsets_squared.sum(axis = 1)**.5 < nanshe.util.xnumpy.expand_view(circle_radii, image.shape))
+
+        neurons = nanshe.imp.segment.extract_neurons(image, circle_masks)
+        sparse_neurons = nanshe.imp.segment.extract_neurons(image, circle_masks, sparse = True)
+
+        merged_neurons = nanshe.imp.segment.merge_neuron_sets(neurons[:3], neurons[3:], alignment_min_threshold, overlap_min_threshold, fuse_neurons = fuse_neurons)
+        merged_sparse_neurons = nanshe.imp.segment.merge_neuron_sets(sparse_neurons[:3], sparse_neurons[3:], alignment_min_threshold, overlap_min_threshold, fuse_neurons = fuse_neurons)
+
+        assert isinstance(merged_sparse_neurons, nanshe.imp.segment.SparseNeuronSet)
+
+        merged_sparse_neurons = nanshe.imp.segment.densify_neurons(merged_sparse_neurons)
+
+        assert (len(merged_neurons) < len(neurons))
+
+        assert (len(merged_neurons) == len(merged_sparse_neurons))
+
+        assert (merged_neurons["mask"] == merged_sparse_neurons["mask"]).all()
+
+        assert (merged_neurons["contour"] == merged_sparse_neurons["contour"]).all()
+
+        assert (merged_neurons["image"] == merged_sparse_neurons["image"]).all()
+
+    def test_merge_neuron_sets_7(self):
+        fuse_neurons = {"fraction_mean_neuron_max_threshold" : 0.01}
+
+        numpy.random.seed(0)
+
+        for i in xrange(10):
+            image = numpy.random.random((100, 100)).astype(numpy.float32)
+
+            xy = numpy.indices(image.shape)
+
+            circle_centers = numpy.random.randint(10, 90, (12, 2))
+
+            circle_radii = numpy.random.randint(10, 25, (12,))
+
+            circle_offsets = nanshe.util.xnumpy.expand_view(circle_centers, image.shape) - \
+                             nanshe.util.xnumpy.expand_view(xy, reps_before=len(circle_centers))
+
+            circle_offsets_squared = circle_offsets**2
+
+            circle_masks = (circle_offsets_squared.sum(axis = 1)**.5 < nanshe.util.xnumpy.expand_view(circle_radii, image.shape))
+
+            neurons = nanshe.imp.segment.extract_neurons(image, circle_masks)
+
+            # Best matches found by the dense computation.
+            neurons_angle = numpy.triu(nanshe.util.xnumpy.pair_dot_product_normalized(
+                nanshe.util.xnumpy.array_to_matrix(neurons["image"]), ord = 2
+            ), k = 1)
+            neurons_masks_overlaid = nanshe.util.xnumpy.pair_dot_product_partially_normalized(
+                nanshe.util.xnumpy.array_to_matrix(neurons["mask"]), ord = 1
+            )
+            numpy.fill_diagonal(neurons_masks_overlaid, 0)
+
+            neurons_matches = []
+            for each_matrix in [neurons_angle, neurons_masks_overlaid, neurons_masks_overlaid.T]:
+                neurons_matches.append(each_matrix.argmax(axis = 0))
+                neurons_matches.append(each_matrix.max(axis = 0))
+
+            # Thresholds between values found, at a value found (too close to decide without the dense angles), and
+            # with two neurons exactly alike (too close to decide which is best).
+            alignment_min_thresholds = [
+                numpy.median(neurons_matches[1][neurons_matches[1] > 0]) - 1e-3,
+                numpy.median(neurons_matches[1][neurons_matches[1] > 0])
+            ]
+            overlap_min_threshold = numpy.median(neurons_matches[3][neurons_matches[3] > 0])
+
+            for each_neurons in [neurons, nanshe.imp.segment.sparsify_neurons(neurons)]:
+                for each_alignment_min_threshold in alignment_min_thresholds:
+                    each_neurons_matches = nanshe.imp.segment.match_neuron_set_overlapping_pairs(
+                        each_neurons, each_alignment_min_threshold
+                    )
+
+                    # Masks overlaps are counts (exact). Angles are close and decide the same.
+                    for k in [2, 3, 4, 5]:
+                        assert (neurons_matches[k] == each_neurons_matches[k]).all()
+
+                    neurons_angle_significant = (neurons_matches[1] > each_alignment_min_threshold)
+                    assert (neurons_angle_significant == (each_neurons_matches[1] > each_alignment_min_threshold)).all()
+                    assert (neurons_matches[0][neurons_angle_significant] ==
+                            each_neurons_matches[0][neurons_angle_significant]).all()
+                    assert numpy.allclose(neurons_matches[1], each_neurons_matches[1], rtol = 0, atol = 1e-12)
+
+            for each_alignment_min_threshold in alignment_min_thresholds:
+                for each_neurons_1, each_neurons_2 in [(neurons[:6], neurons[6:]),
+                                                       (neurons[:6], neurons[[6, 7, 7, 8, 9, 10, 11]])]:
+                    merged_neurons_dense = nanshe.imp.segment.merge_neuron_sets(each_neurons_1, each_neurons_2, each_alignment_min_threshold, overlap_min_threshold, use_spatial_index = False, fuse_neurons = fuse_neurons)
+                    merged_neurons_indexed = nanshe.imp.segment.merge_neuron_sets(each_neurons_1, each_neurons_2, each_alignment_min_threshold, overlap_min_threshold, use_spatial_index = True, fuse_neurons = fuse_neurons)
+
+                    assert (len(merged_neurons_dense) == len(merged_neurons_indexed))
+
+                    assert (merged_neurons_dense["mask"] == merged_neurons_indexed["mask"]).all()
+
+                    assert (merged_neurons_dense["image"] == merged_neurons_indexed["image"]).all()
+
+    def test_SparseNeuronSet_1(self):
+        image = 5 * numpy.ones((100, 100))
+
+        xy = numpy.indices(image.shape)
+
+        circle_centers = numpy.array([[25, 25], [74, 74], [50, 10]])
+
+        circle_radii = numpy.array([25, 25, 5])
+
+        circle_offsets = nanshe.util.xnumpy.expand_view(circle_centers, image.shape) - \
+                         nanshe.util.xnumpy.expand_view(xy, reps_before=len(circle_centers))
+
+        circle_offsets_squared = circle_offsets**2
+
+        circle_masks = (circle_offsets_squared.sum(axis = 1)**.5 < nanshe.util.xnumpy.expand_view(circle_radii, image.shape))
+
+        neurons = nanshe.imp.segment.extract_neurons(image, circle_masks)
+
+        sparse_neurons = nanshe.imp.segment.sparsify_neurons(neurons)
+
+        assert (nanshe.imp.segment.densify_neurons(sparse_neurons) == neurons).all()
+
+        assert (nanshe.imp.segment.densify_neurons(sparse_neurons[[2, 0]]) == neurons[[2, 0]]).all()
+
+        assert (nanshe.imp.segment.densify_neurons(sparse_neurons[-1]) == neurons[-1:]).all()
+
+        sparse_neurons[1] = sparse_neurons[2]
+
+        assert (nanshe.imp.segment.densify_neurons(sparse_neurons) == neurons[[0, 2, 2]]).all()
+
+        # The pixels of the neuron replaced are dropped.
+        assert (len(sparse_neurons.pixels) == (circle_masks[0].sum() + 2 * circle_masks[2].sum()))
+
+        assert (numpy.asarray(sparse_neurons) == neurons[[0, 2, 2]]).all()
+
+        sparse_neurons_float32 = numpy.asarray(sparse_neurons, dtype=nanshe.imp.segment.get_neuron_dtype(
+            shape=image.shape, dtype=numpy.float32
+        ))
+
+        assert (sparse_neurons_float32["image"].dtype == numpy.float32)
+
+        assert (sparse_neurons_float32["image"] == neurons["image"][[0, 2, 2]]).all()
+
+        joined_sparse_neurons = nanshe.imp.segment.concatenate_sparse_neurons([sparse_neurons[:1], sparse_neurons[1:]])
+
+        assert (nanshe.imp.segment.densify_neurons(joined_sparse_neurons) == neurons[[0, 2, 2]]).all()
+
+        translated_sparse_neurons = nanshe.imp.segment.sparsify_neurons(neurons[:1]).translate((5, 10), (110, 120))
+
+        assert (translated_sparse_neurons.shape == (110, 120))
+
+        assert (nanshe.imp.segment.densify_neurons(translated_sparse_neurons)["mask"][0, 5:105, 10:110] == neurons["mask"][0]).all()
+
     def test_postprocess_data_1(self):
         config = {
             "wavelet_denoising" : {
@@ -2471,3 +2970,89 @@ class TestSegment(object):
             unmatched_points = new_unmatched_points
 
         assert (len(unmatched_points) == 0)
+
+    def test_postprocess_data_5(self):
+        config = {
+            "wavelet_denoising" : {
+                "remove_low_intensity_local_maxima" : {
+                    "percentage_pixels_below_max" : 0.0
+                },
+                "wavelet.transform" : {
+                    "scale" : 4
+                },
+                "accepted_region_shape_constraints" : {
+                    "major_axis_length" : {
+                        "max" : 25.0,
+                        "min" : 0.0
+                    }
+                },
+                "accepted_neuron_shape_constraints" : {
+                    "eccentricity" : {
+                        "max" : 0.9,
+                        "min" : 0.0
+                    },
+                    "area" : {
+                        "max" : 600,
+                        "min" : 30
+                    }
+                },
+                "estimate_noise" : {
+                    "significance_threshold" : 3.0
+                },
+                "significant_mask" : {
+                    "noise_threshold" : 3.0
+                },
+                "remove_too_close_local_maxima" : {
+                    "min_local_max_distance" : 10.0
+                },
+                "use_watershed" : True
+            },
+            "merge_neuron_sets" : {
+                "alignment_min_threshold" : 0.6,
+                "fuse_neurons" : {
+                    "fraction_mean_neuron_max_threshold" : 0.01
+                },
+                "overlap_min_threshold" : 0.6
+            }
+        }
+
+        space = numpy.array([100, 100])
+        radii = numpy.array([7, 6, 6, 6, 7, 6])
+        magnitudes = numpy.array([15, 16, 15, 17, 16, 16])
+        points = numpy.array([[30, 24],
+                           [59, 65],
+                           [21, 65],
+                           [13, 12],
+                           [72, 16],
+                           [45, 32]])
+
+        masks = nanshe.syn.data.generate_hypersphere_masks(space, points, radii)
+        images = nanshe.syn.data.generate_gaussian_images(space, points, radii/3.0, magnitudes) * masks
+
+        bases_indices = [[1,3,4], [0,2], [5]]
+
+        bases_images = numpy.zeros((len(bases_indices),) + images.shape[1:] , dtype=images.dtype)
+
+        for i, each_basis_indices in enumerate(bases_indices):
+            bases_images[i] = images[list(each_basis_indices)].max(axis = 0)
+
+        neurons = nanshe.imp.segment.postprocess_data(bases_images, **config)
+
+        config["num_processes"] = 2
+
+        # Merging in order gives exactly the same result as without processes.
+        config["deterministic_merge"] = True
+        neurons_parallel = nanshe.imp.segment.postprocess_data(bases_images, **config)
+
+        assert (neurons.dtype == neurons_parallel.dtype)
+        assert (neurons.shape == neurons_parallel.shape)
+
+        for each_name in neurons.dtype.names:
+            assert (neurons[each_name] == neurons_parallel[each_name]).all()
+
+        # Merging as a tree finds the same neurons.
+        config["deterministic_merge"] = False
+        neurons_parallel = nanshe.imp.segment.postprocess_data(bases_images, **config)
+
+        assert (len(neurons) == len(neurons_parallel))
+        assert (numpy.sort(neurons["max_F"]) == numpy.sort(neurons_parallel["max_F"])).all()
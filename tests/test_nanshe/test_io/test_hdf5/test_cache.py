@@ -0,0 +1,145 @@
+import os
+import shutil
+import tempfile
+
+import numpy
+
+import nanshe.io.hdf5.cache
+import nanshe.io.hdf5.record
+
+
+class TestDictionaryCache(object):
+    def setup(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+        self.parameters = {"K" : 3, "lambda1" : 0.2}
+
+        self.window = numpy.array([[0, 10], [0, 20]])
+        self.dictionary = numpy.random.random((3, 10, 20)).astype(numpy.float32)
+
+        self.cache = nanshe.io.hdf5.cache.DictionaryCache(os.path.join(self.temp_dir, "cache"))
+
+    def test_find_1(self):
+        assert (self.cache.find("fov", self.window, self.parameters) is None)
+
+        self.cache.store("fov", self.window, self.parameters, self.dictionary)
+
+        assert os.path.exists(self.cache.filename("fov", self.window, self.parameters))
+        assert (len(os.listdir(self.cache.dirname)) == 1)
+
+        dictionary, window = self.cache.find("fov", self.window, self.parameters)
+
+        assert (dictionary == self.dictionary).all()
+        assert (window == self.window).all()
+
+        # Keyed by field of view and parameters.
+        assert (self.cache.find("other_fov", self.window, self.parameters) is None)
+        assert (self.cache.find("fov", self.window, {"K" : 3, "lambda1" : 0.1}) is None)
+
+        # Windows that do not overlap are not found.
+        assert (self.cache.find("fov", numpy.array([[10, 20], [0, 20]]), self.parameters) is None)
+
+    def test_find_2(self):
+        self.cache.store("fov", self.window, self.parameters, self.dictionary)
+        self.cache.store("fov", numpy.array([[5, 15], [0, 20]]), self.parameters, self.dictionary + 1)
+
+        # The window overlapping the most is found.
+        dictionary, window = self.cache.find("fov", numpy.array([[6, 16], [0, 20]]), self.parameters)
+
+        assert (dictionary == self.dictionary + 1).all()
+        assert (window == numpy.array([[5, 15], [0, 20]])).all()
+
+    def test_find_seed_1(self):
+        self.cache.store("fov", self.window, self.parameters, self.dictionary)
+
+        seed = self.cache.find_seed("fov", self.window, self.parameters)
+
+        assert (seed == self.dictionary).all()
+
+    def test_find_seed_2(self):
+        self.cache.store("fov", self.window, self.parameters, self.dictionary)
+
+        seed = self.cache.find_seed("fov", numpy.array([[5, 15], [10, 25]]), self.parameters)
+
+        assert (seed.shape == (3, 10, 15))
+
+        assert (seed[:, :5, :10] == self.dictionary[:, 5:, 10:]).all()
+        assert (seed[:, 5:] == 0).all()
+        assert (seed[:, :, 10:] == 0).all()
+
+    def teardown(self):
+        self.cache = None
+
+        shutil.rmtree(self.temp_dir)
+
+        self.temp_dir = ""
+
+
+class TestStageCache(object):
+    def setup(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+        self.data = numpy.random.random((5, 4, 3)).astype(numpy.float32)
+
+        self.cache = nanshe.io.hdf5.cache.StageCache(os.path.join(self.temp_dir, "cache"))
+
+    def test_hash_array_1(self):
+        data_hash = nanshe.io.hdf5.cache.hash_array(self.data)
+
+        assert (data_hash == nanshe.io.hdf5.cache.hash_array(self.data, 2))
+        assert (data_hash != nanshe.io.hdf5.cache.hash_array(self.data.astype(numpy.float64)))
+
+        self.data[-1, -1, -1] += 1
+
+        assert (data_hash != nanshe.io.hdf5.cache.hash_array(self.data))
+
+    def test_get_1(self):
+        assert ("a" not in self.cache)
+        assert (self.cache.get("a") is None)
+
+        self.cache.put("a", self.data, 2)
+
+        assert ("a" in self.cache)
+        assert (self.cache.get("a") == self.data).all()
+
+    def test_get_2(self):
+        neurons = numpy.zeros((0,), dtype = [("image", numpy.float32, (4, 3)), ("area", int)])
+
+        self.cache.put("a", neurons)
+
+        cached_neurons = self.cache.get("a")
+
+        assert (cached_neurons.dtype == neurons.dtype)
+        assert (cached_neurons.shape == neurons.shape)
+
+    def test_load_1(self):
+        assert (self.cache.load("a", nanshe.io.hdf5.record.EmptyArrayRecorder(), "data") is None)
+
+        self.cache.put("a", self.data)
+
+        data = self.cache.load("a", nanshe.io.hdf5.record.EmptyArrayRecorder(), "data", 2)
+
+        assert (data[...] == self.data).all()
+
+    def test_evict_1(self):
+        self.cache.put("a", self.data)
+        self.cache.put("b", self.data)
+
+        entry_size = os.path.getsize(self.cache.filename("a"))
+
+        # Make "b" the least recently used.
+        os.utime(self.cache.filename("b"), (0, 0))
+
+        self.cache.max_size = 2 * entry_size
+        self.cache.put("c", self.data)
+
+        assert ("a" in self.cache)
+        assert ("b" not in self.cache)
+        assert ("c" in self.cache)
+
+    def teardown(self):
+        self.cache = None
+
+        shutil.rmtree(self.temp_dir)
+
+        self.temp_dir = ""
@@ -0,0 +1,118 @@
+import os
+import shutil
+import tempfile
+
+import h5py
+
+import nanshe.io.hdf5.pool
+
+
+class TestHDF5FilePool(object):
+    def setup(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+        self.filenames = []
+        for i in xrange(3):
+            self.filenames.append(os.path.join(self.temp_dir, str(i) + os.extsep + "h5"))
+
+            with h5py.File(self.filenames[-1], "w") as each_file:
+                each_file["data"] = [i]
+
+        self.pool = nanshe.io.hdf5.pool.HDF5FilePool(max_open_files = 2)
+
+    def test_acquire_1(self):
+        file_handle_1 = self.pool.acquire(self.filenames[0], "r")
+        file_handle_2 = self.pool.acquire(self.filenames[0], "r")
+
+        # Shared while open.
+        assert (file_handle_1 is file_handle_2)
+        assert (file_handle_1.mode == "r")
+
+        self.pool.release(file_handle_1)
+        self.pool.release(file_handle_2)
+
+        # Kept open after use.
+        assert (self.filenames[0] in self.pool)
+
+        with self.pool.open(self.filenames[0], "r") as file_handle_3:
+            assert (file_handle_3 is file_handle_1)
+
+    def test_acquire_2(self):
+        with self.pool.open(self.filenames[0], "r") as file_handle:
+            # Can't reopen for writing while it is being read.
+            got_error = False
+            try:
+                self.pool.acquire(self.filenames[0], "a")
+            except IOError:
+                got_error = True
+
+            assert got_error
+
+            assert file_handle
+
+        # Reopened for writing once no longer used.
+        with self.pool.open(self.filenames[0], "a") as file_handle:
+            assert (file_handle.mode == "r+")
+
+            file_handle["data_2"] = [1]
+
+        # Reading uses the file open for writing.
+        with self.pool.open(self.filenames[0], "r") as file_handle:
+            assert (file_handle.mode == "r+")
+            assert (file_handle["data_2"][0] == 1)
+
+    def test_evict_1(self):
+        file_handles = []
+        for each_filename in self.filenames:
+            with self.pool.open(each_filename, "r") as each_file_handle:
+                file_handles.append(each_file_handle)
+
+        # The least recently used was closed.
+        assert (len(self.pool) == 2)
+        assert (self.filenames[0] not in self.pool)
+        assert not file_handles[0]
+        assert file_handles[1]
+        assert file_handles[2]
+
+    def test_evict_2(self):
+        # Files in use are not closed.
+        file_handles = []
+        for each_filename in self.filenames:
+            file_handles.append(self.pool.acquire(each_filename, "r"))
+
+        assert (len(self.pool) == 3)
+        assert all(file_handles)
+
+        for each_file_handle in file_handles:
+            self.pool.release(each_file_handle)
+
+        assert (len(self.pool) == 2)
+
+    def test_close_1(self):
+        with self.pool.open(self.filenames[0], "r") as file_handle_1:
+            with self.pool.open(self.filenames[1], "r") as file_handle_2:
+                pass
+
+            self.pool.close()
+
+            # Only closes what is not in use.
+            assert file_handle_1
+            assert not file_handle_2
+
+        self.pool.close(self.filenames[0])
+
+        assert not file_handle_1
+        assert (len(self.pool) == 0)
+
+    def test_get_file_pool_1(self):
+        pool = nanshe.io.hdf5.pool.get_file_pool()
+
+        assert (pool is nanshe.io.hdf5.pool.get_file_pool())
+
+    def teardown(self):
+        self.pool.close()
+        self.pool = None
+
+        shutil.rmtree(self.temp_dir)
+
+        self.temp_dir = ""
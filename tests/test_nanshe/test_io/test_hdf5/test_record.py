@@ -110,6 +110,24 @@ class TestRecord(object):
         assert not got_value_error
 
 
+        # Create a dataset to fill in (kept on disk instead of in memory)
+
+        dataset = recorder.create_dataset("dataset", (4, 3), numpy.float32, chunks = True)
+
+        assert isinstance(dataset, h5py.Dataset)
+        assert dataset.shape == (4, 3)
+        assert dataset.dtype == numpy.float32
+
+        dataset[...] = numpy.arange(12).reshape(4, 3)
+
+        assert (dataset[...] == numpy.arange(12).reshape(4, 3)).all()
+
+        # The temporary file is already removed.
+        assert not os.path.exists(dataset.file.filename)
+
+        assert "dataset" not in recorder
+
+
     def test_HDF5ArrayRecorder(self):
         hdf5_filename = os.path.join(self.temp_dir, "test.h5")
 
@@ -364,6 +382,101 @@ class TestRecord(object):
             assert len(hdf5_file["1"]) == 0
 
 
+    def test_DeferredArray(self):
+        calls = []
+
+        def compute(value):
+            calls.append(value)
+
+            return(numpy.arange(value))
+
+
+        # Nothing is computed when recording is disabled.
+
+        recorder = nanshe.io.hdf5.record.EmptyArrayRecorder()
+
+        recorder["a"] = nanshe.io.hdf5.record.DeferredArray(compute, 3)
+
+        assert calls == []
+
+
+        # Computed only once when recording.
+
+        hdf5_filename = os.path.join(self.temp_dir, "test.h5")
+
+        with h5py.File(hdf5_filename, "w") as hdf5_file:
+            recorder = nanshe.io.hdf5.record.HDF5ArrayRecorder(hdf5_file)
+
+            recorder["a"] = nanshe.io.hdf5.record.DeferredArray(compute, 3)
+
+            assert calls == [3]
+
+            assert (hdf5_file["a"][...] == numpy.arange(3)).all()
+
+            hdf5_file.create_group("b")
+
+            recorder = nanshe.io.hdf5.record.HDF5EnumeratedArrayRecorder(
+                hdf5_file["b"]
+            )
+
+            recorder["a"] = nanshe.io.hdf5.record.DeferredArray(compute, 4)
+
+            assert calls == [3, 4]
+
+            assert (hdf5_file["b/0/a/0"][...] == numpy.arange(4)).all()
+
+
+    def test_HDF5ArrayWriter(self):
+        hdf5_filename = os.path.join(self.temp_dir, "test.h5")
+
+        with h5py.File(hdf5_filename, "w") as hdf5_file:
+            hdf5_file.create_group("a")
+            hdf5_file.create_group("b")
+
+            with nanshe.io.hdf5.record.HDF5ArrayWriter(hdf5_file, max_buffer_size = 100) as writer:
+                recorder = nanshe.io.hdf5.record.HDF5ArrayRecorder(hdf5_file["a"], writer = writer)
+
+                value = numpy.arange(10)
+                recorder["value"] = value
+
+                # Arrays are copied before they are queued.
+                value[:] = 0
+
+                recorder["group"] = None
+                recorder["group"]["value"] = numpy.arange(20)
+
+                # Reads wait on the queued writes.
+                assert (recorder["value"] == numpy.arange(10)).all()
+
+                recorder = nanshe.io.hdf5.record.HDF5EnumeratedArrayRecorder(hdf5_file["b"], writer = writer)
+
+                for i in xrange(5):
+                    recorder["value"] = i * numpy.ones((3,))
+
+            assert (hdf5_file["a/group/value"][...] == numpy.arange(20)).all()
+
+            assert len(hdf5_file["b/0/value"]) == 5
+
+            for i in xrange(5):
+                assert (hdf5_file["b/0/value/" + str(i)][...] == i).all()
+
+
+            # Errors from writing are raised in the caller.
+
+            writer = nanshe.io.hdf5.record.HDF5ArrayWriter(hdf5_file)
+
+            recorder = nanshe.io.hdf5.record.HDF5ArrayRecorder(hdf5_file["a"], writer = writer)
+            recorder["value"] = numpy.arange(10)
+
+            got_error = False
+            try:
+                writer.close()
+            except Exception:
+                got_error = True
+
+            assert got_error
+
+
     def teardown(self):
         shutil.rmtree(self.temp_dir)
 
@@ -5,6 +5,7 @@ __date__ = "$Jul 28, 2014 11:50:37 EDT$"
 import os
 import shutil
 import tempfile
+import warnings
 
 import numpy
 import h5py
@@ -129,6 +130,50 @@ class TestSerializers(object):
         assert (numpy.asarray(data2) == self.temp_hdf5_file["data"].value).all()
 
 
+    def test_create_numpy_structured_array_in_HDF5_4(self):
+        data = numpy.random.random((20, 16, 16)).astype(numpy.float32)
+
+        nanshe.io.hdf5.serializers.create_numpy_structured_array_in_HDF5(
+            self.temp_hdf5_file, "frames", data, layout="frames", compression="gzip"
+        )
+        nanshe.io.hdf5.serializers.create_numpy_structured_array_in_HDF5(
+            self.temp_hdf5_file, "pixels", data, layout="pixels"
+        )
+
+        assert (self.temp_hdf5_file["frames"].chunks == data.shape)
+        assert (self.temp_hdf5_file["frames"].compression == "gzip")
+        assert self.temp_hdf5_file["frames"].shuffle
+        assert (self.temp_hdf5_file["frames"][...] == data).all()
+
+        assert (self.temp_hdf5_file["pixels"].chunks == data.shape)
+        assert (self.temp_hdf5_file["pixels"].compression is None)
+        assert (self.temp_hdf5_file["pixels"][...] == data).all()
+
+        # Scalars are not chunked.
+        nanshe.io.hdf5.serializers.create_numpy_structured_array_in_HDF5(
+            self.temp_hdf5_file, "scalar", numpy.float32(1), layout="frames", compression="gzip"
+        )
+
+        assert (self.temp_hdf5_file["scalar"].chunks is None)
+        assert (self.temp_hdf5_file["scalar"][()] == 1)
+
+    def test_create_numpy_structured_array_in_HDF5_5(self):
+        data = numpy.random.random((20, 16, 16)).astype(numpy.float32)
+
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter("always")
+
+            nanshe.io.hdf5.serializers.create_numpy_structured_array_in_HDF5(
+                self.temp_hdf5_file, "data", data, layout="frames", compression="lz4"
+            )
+
+        # Falls back to gzip without hdf5plugin.
+        if nanshe.io.hdf5.serializers.hdf5plugin is None:
+            assert (self.temp_hdf5_file["data"].compression == "gzip")
+            assert any(issubclass(_.category, RuntimeWarning) for _ in w)
+
+        assert (self.temp_hdf5_file["data"][...] == data).all()
+
     def test_read_numpy_structured_array_from_HDF5_1(self):
         data1 = numpy.random.random((10, 10))
 
@@ -199,6 +244,91 @@ class TestSerializers(object):
         assert (data1 == data3).all()
 
 
+    def test_read_numpy_structured_array_from_HDF5_3(self):
+        data1 = numpy.zeros((10, 10), dtype=[("a", float, 2), ("b", int, 3)])
+        data1["a"] = numpy.random.random((10, 10, 2))
+        data1["b"] = numpy.random.random_integers(0, 10, (10, 10, 3))
+
+        nanshe.io.hdf5.serializers.create_numpy_structured_array_in_HDF5(self.temp_hdf5_file, "data", data1)
+
+        data2 = nanshe.io.hdf5.serializers.read_numpy_structured_array_from_HDF5(self.temp_hdf5_file, "data", lazy=True)
+
+        assert (data1.dtype == data2.dtype)
+        assert (data1.shape == data2.shape)
+        assert (data1 == data2[...]).all()
+        assert (data1["a"] == data2["a"]).all()
+        assert (data1["b"][2:5] == data2["b", 2:5]).all()
+        assert (data1[[1, 3]] == data2[[1, 3]]).all()
+
+        self.temp_hdf5_file["data_rref"] = self.temp_hdf5_file["data"].regionref[2:8, 2:8]
+
+        data3 = nanshe.io.hdf5.serializers.read_numpy_structured_array_from_HDF5(self.temp_hdf5_file, "data_rref", lazy=True)
+
+        assert (data1[2:8, 2:8].dtype == data3.dtype)
+        assert (data1[2:8, 2:8].shape == data3.shape)
+        assert (data1[2:8, 2:8]["a"] == data3["a"]).all()
+
+        self.temp_hdf5_file2 = h5py.File(os.path.join(self.temp_dir, "test2.h5"), "w")
+
+        # Pseudo-reference to a field and slice in another file.
+        self.temp_hdf5_file2["data_pref"] = 0
+        self.temp_hdf5_file2["data_pref"].attrs["filename"] = self.temp_hdf5_file.filename
+        self.temp_hdf5_file2["data_pref"].attrs["dataset"] = "data"
+        self.temp_hdf5_file2["data_pref"].attrs["field"] = "b"
+        self.temp_hdf5_file2["data_pref"].attrs["slice"] = "(slice(1, 4), slice(None))"
+
+        with nanshe.io.hdf5.serializers.read_numpy_structured_array_from_HDF5(self.temp_hdf5_file2, "data_pref", lazy=True) as data4:
+            assert (data1["b"][1:4].dtype == data4.dtype)
+            assert (data1["b"][1:4].shape == data4.shape)
+            assert (data1["b"][1:4] == numpy.asarray(data4)).all()
+            assert (data1["b"][2:4, 3] == data4[1:, 3]).all()
+
+        assert (data4.file_handles == [])
+
+
+    def test_create_sparse_neurons_in_HDF5_1(self):
+        shape = (10, 11)
+
+        neurons = numpy.zeros((3,), dtype=[("bounding_box", numpy.int64, (2, 2)),
+                                           ("pixels_start", numpy.int64),
+                                           ("pixels_stop", numpy.int64)])
+        neurons["pixels_start"] = [0, 2, 3]
+        neurons["pixels_stop"] = [2, 3, 5]
+
+        pixels = numpy.zeros((5,), dtype=[("index", numpy.int64, (2,)), ("image", float)])
+        pixels["index"] = numpy.random.random_integers(0, 9, (5, 2))
+        pixels["image"] = numpy.random.random((5,))
+
+        nanshe.io.hdf5.serializers.create_sparse_neurons_in_HDF5(self.temp_hdf5_file, "neurons", shape, neurons, pixels)
+
+        assert ("neurons" in self.temp_hdf5_file)
+        assert ("neurons" in self.temp_hdf5_file["neurons"])
+        assert ("pixels" in self.temp_hdf5_file["neurons"])
+
+        shape_1, neurons_1, pixels_1 = nanshe.io.hdf5.serializers.read_sparse_neurons_from_HDF5(self.temp_hdf5_file, "neurons")
+
+        assert (shape == shape_1)
+        assert (neurons.dtype == neurons_1.dtype)
+        assert (neurons == neurons_1).all()
+        assert (pixels.dtype == pixels_1.dtype)
+        assert (pixels == pixels_1).all()
+
+        try:
+            nanshe.io.hdf5.serializers.create_sparse_neurons_in_HDF5(self.temp_hdf5_file, "neurons", shape, neurons[:1], pixels[:2])
+        except:
+            assert (True)
+        else:
+            assert (False)
+
+        nanshe.io.hdf5.serializers.create_sparse_neurons_in_HDF5(self.temp_hdf5_file, "neurons", shape, neurons[:1], pixels[:2], overwrite=True)
+
+        shape_2, neurons_2, pixels_2 = nanshe.io.hdf5.serializers.read_sparse_neurons_from_HDF5(self.temp_hdf5_file, "neurons")
+
+        assert (shape == shape_2)
+        assert (neurons[:1] == neurons_2).all()
+        assert (pixels[:2] == pixels_2).all()
+
+
     def teardown(self):
         self.temp_hdf5_file.close()
 
@@ -10,6 +10,8 @@ import json
 import operator
 import os
 import shutil
+import StringIO
+import sys
 import tempfile
 
 import h5py
@@ -17,12 +19,21 @@ import numpy
 
 import nanshe.util.xnumpy
 import nanshe.io.hdf5.record
+import nanshe.io.hdf5.serializers
+
+import nanshe.imp.segment
 
 import nanshe.syn.data
 
 import nanshe.learner
 
 
+def print_to_outputs(input_filename, output_filename, parameters_filename):
+    sys.stdout.write("stdout " + input_filename)
+    sys.stderr.write("stderr " + output_filename)
+    os.write(1, " fd " + parameters_filename)
+
+
 class TestLearner(object):
     def setup(self):
         self.config_a_block = {
@@ -1280,6 +1291,40 @@ class TestLearner(object):
 
         assert (len(unmatched_points) == 0)
 
+    def test_generate_neurons_a_block_redirected_1(self):
+        stdout_filename = os.path.join(self.temp_dir, "block.out")
+        stderr_filename = os.path.join(self.temp_dir, "block.err")
+
+        # Like output capture in nose or a notebook where there is no file descriptor.
+        original_stdout, original_stderr = sys.stdout, sys.stderr
+        captured_stdout, captured_stderr = StringIO.StringIO(), StringIO.StringIO()
+
+        original_generate_neurons_io_handler = nanshe.learner.generate_neurons_io_handler
+        try:
+            sys.stdout, sys.stderr = captured_stdout, captured_stderr
+            nanshe.learner.generate_neurons_io_handler = print_to_outputs
+
+            nanshe.learner.generate_neurons_a_block_redirected("config", "input", "output", stdout_filename, stderr_filename)
+
+            assert (sys.stdout is captured_stdout)
+            assert (sys.stderr is captured_stderr)
+        finally:
+            nanshe.learner.generate_neurons_io_handler = original_generate_neurons_io_handler
+            sys.stdout, sys.stderr = original_stdout, original_stderr
+
+        assert (captured_stdout.getvalue() == "")
+        assert (captured_stderr.getvalue() == "")
+
+        with open(stdout_filename, "r") as stdout_file:
+            stdout_contents = stdout_file.read()
+
+        # Both what went through sys.stdout and straight to the file descriptor.
+        assert ("stdout input" in stdout_contents)
+        assert (" fd config" in stdout_contents)
+
+        with open(stderr_filename, "r") as stderr_file:
+            assert (stderr_file.read() == "stderr output")
+
     @nose.plugins.attrib.attr("3D")
     def test_generate_neurons_a_block_2(self):
         nanshe.learner.generate_neurons_a_block(self.hdf5_input_3D_filepath, self.hdf5_output_3D_filepath, **self.config_a_block_3D)
@@ -1453,6 +1498,80 @@ class TestLearner(object):
 
         assert (len(unmatched_points) == 0)
 
+    def test_generate_neurons_blocks_5(self):
+        config_blocks_subprocess = dict(self.config_blocks["generate_neurons_blocks"])
+        config_blocks_subprocess["use_process_pool"] = False
+
+        nanshe.learner.generate_neurons_blocks(self.hdf5_input_filepath, self.hdf5_output_filepath, **config_blocks_subprocess)
+
+        assert os.path.exists(self.hdf5_output_filename)
+
+        with h5py.File(self.hdf5_output_filename, "r") as fid:
+            assert ("neurons" in fid)
+
+            neurons = fid["neurons"].value
+
+        assert (len(self.points) == len(neurons))
+
+        neuron_maxes = (neurons["image"] == nanshe.util.xnumpy.expand_view(neurons["max_F"], neurons["image"].shape[1:]))
+        neuron_max_points = numpy.array(neuron_maxes.max(axis = 0).nonzero()).T.copy()
+
+        matched = dict()
+        unmatched_points = numpy.arange(len(self.points))
+        for i in xrange(len(neuron_max_points)):
+            new_unmatched_points = []
+            for j in unmatched_points:
+                if not (neuron_max_points[i] == self.points[j]).all():
+                    new_unmatched_points.append(j)
+                else:
+                    matched[i] = j
+
+            unmatched_points = new_unmatched_points
+
+        assert (len(unmatched_points) == 0)
+
+    def test_BlockNeuronsMerger_1(self):
+        merge_parameters = self.config_blocks["generate_neurons_blocks"]["generate_neurons"]["postprocess_data"]["merge_neuron_sets"]
+
+        neurons = numpy.zeros((len(self.points),), dtype = nanshe.imp.segment.get_neuron_dtype(self.masks.shape[1:], float))
+        neurons["mask"] = self.masks
+        neurons["image"] = self.images
+        neurons["contour"] = [nanshe.util.xnumpy.generate_contour(_) for _ in self.masks]
+        neurons["area"] = self.masks.sum(axis = -1).sum(axis = -1)
+        neurons["max_F"] = self.images.max(axis = -1).max(axis = -1)
+        neurons["gaussian_mean"] = self.points
+        neurons["centroid"] = self.points
+
+        # Overlapping blocks so that some neurons must be merged.
+        block_neurons = [neurons[:3], neurons[2:5], neurons[4:]]
+
+        block_filenames = []
+        for i, each_block_neurons in enumerate(block_neurons):
+            block_filenames.append(os.path.join(self.temp_dir, "block_" + str(i) + ".h5"))
+            with h5py.File(block_filenames[-1], "w") as fid:
+                nanshe.io.hdf5.serializers.create_numpy_structured_array_in_HDF5(fid, "neurons", each_block_neurons)
+
+        full_slices = [(slice(None), slice(None), slice(None))] * len(block_filenames)
+
+        expected_neurons = nanshe.imp.segment.get_empty_neuron(shape = self.masks.shape[1:], dtype = float)
+        for each_block_neurons in block_neurons:
+            expected_neurons = nanshe.imp.segment.merge_neuron_sets(expected_neurons, each_block_neurons, **merge_parameters)
+
+        block_merger_1 = nanshe.learner.BlockNeuronsMerger(self.masks.shape[1:], block_filenames, full_slices, full_slices, **merge_parameters)
+        for i in [2, 0, 1]:
+            block_merger_1.add_block(i)
+        neurons_1 = block_merger_1.finish()
+
+        block_merger_2 = nanshe.learner.BlockNeuronsMerger(self.masks.shape[1:], block_filenames, full_slices, full_slices, to_merge_eagerly = False, **merge_parameters)
+        block_merger_2.add_block(1)
+        neurons_2 = block_merger_2.finish()
+
+        assert (len(expected_neurons) == len(neurons_1) == len(neurons_2))
+
+        for each_name in expected_neurons.dtype.names:
+            assert (expected_neurons[each_name] == neurons_1[each_name]).all()
+            assert (expected_neurons[each_name] == neurons_2[each_name]).all()
+
     def test_generate_neurons_1(self):
         with h5py.File(self.hdf5_output_filename, "a") as output_file_handle:
             output_group = output_file_handle["/"]
@@ -1550,6 +1669,385 @@ class TestLearner(object):
 
         assert (len(unmatched_points) == 0)
 
+    def test_generate_neurons_3(self):
+        # Dictionary learning streams blocks of frames.
+        config_a_block = json.loads(json.dumps(self.config_a_block))
+        config_a_block["generate_neurons"]["generate_dictionary"]["block_frame_length"] = len(self.image_stack) // 2
+
+        with h5py.File(self.hdf5_output_filename, "a") as output_file_handle:
+            output_group = output_file_handle["/"]
+
+            # Get a debug logger for the HDF5 file (if needed)
+            array_debug_recorder = nanshe.io.hdf5.record.generate_HDF5_array_recorder(output_group,
+                group_name = "debug",
+                enable = config_a_block["debug"],
+                overwrite_group = False,
+                recorder_constructor = nanshe.io.hdf5.record.HDF5EnumeratedArrayRecorder
+            )
+
+            # Saves intermediate result to make resuming easier
+            resume_logger = nanshe.io.hdf5.record.generate_HDF5_array_recorder(output_group,
+                recorder_constructor = nanshe.io.hdf5.record.HDF5ArrayRecorder,
+                overwrite = True
+            )
+
+            nanshe.learner.generate_neurons.resume_logger = resume_logger
+            nanshe.learner.generate_neurons.recorders.array_debug_recorder = array_debug_recorder
+            nanshe.learner.generate_neurons(self.image_stack, **config_a_block["generate_neurons"])
+
+        assert os.path.exists(self.hdf5_output_filename)
+
+        with h5py.File(self.hdf5_output_filename, "r") as fid:
+            assert ("dictionary" in fid)
+            assert ("neurons" in fid)
+
+            # Finished learning is not kept for resuming.
+            assert ("dictionary_learning" in fid)
+            assert (len(fid["dictionary_learning"]) == 0)
+
+            dictionary = fid["dictionary"].value
+            neurons = fid["neurons"].value
+
+        assert (dictionary.shape == (config_a_block["generate_neurons"]["generate_dictionary"]["spams.trainDL"]["K"],) +
+                                   self.image_stack.shape[1:])
+
+        assert (len(self.points) == len(neurons))
+
+    def test_generate_neurons_4(self):
+        # Stages are kept in a cache. So, only stages with new parameters are run again.
+        config_a_block = json.loads(json.dumps(self.config_a_block))
+        config_a_block["generate_neurons"]["stage_cache"] = {
+            "dirname" : os.path.join(self.temp_dir, "stage_cache")
+        }
+
+        stages = dict([(_, getattr(nanshe.imp.segment, _)) for _ in ["preprocess_data",
+                                                                     "generate_dictionary",
+                                                                     "postprocess_data"]])
+
+        def stage_not_run(*args, **kwargs):
+            raise AssertionError("A stage was run instead of taken from the cache.")
+
+        stage_not_run.recorders = stages["preprocess_data"].recorders
+
+        neurons = []
+        try:
+            for i in xrange(2):
+                # The second run must take every stage from the cache.
+                if i == 1:
+                    for each_stage in stages:
+                        setattr(nanshe.imp.segment, each_stage, stage_not_run)
+
+                with h5py.File(self.hdf5_output_filename, "w") as output_file_handle:
+                    output_group = output_file_handle["/"]
+
+                    # Saves intermediate result to make resuming easier
+                    resume_logger = nanshe.io.hdf5.record.generate_HDF5_array_recorder(output_group,
+                        recorder_constructor = nanshe.io.hdf5.record.HDF5ArrayRecorder,
+                        overwrite = True
+                    )
+
+                    nanshe.learner.generate_neurons.resume_logger = resume_logger
+                    nanshe.learner.generate_neurons.recorders.array_debug_recorder = nanshe.io.hdf5.record.EmptyArrayRecorder()
+                    nanshe.learner.generate_neurons(self.image_stack, **config_a_block["generate_neurons"])
+
+                    nanshe.learner.generate_neurons.resume_logger = nanshe.io.hdf5.record.EmptyArrayRecorder()
+
+                with h5py.File(self.hdf5_output_filename, "r") as fid:
+                    assert ("preprocessed_images" in fid)
+                    assert ("dictionary" in fid)
+                    assert ("neurons" in fid)
+
+                    neurons.append(fid["neurons"].value)
+
+                assert (len(os.listdir(config_a_block["generate_neurons"]["stage_cache"]["dirname"])) == 3)
+
+            # The second run comes from the cache.
+            assert (neurons[0] == neurons[1]).all()
+
+            # Only postprocessing is new.
+            nanshe.imp.segment.postprocess_data = stages["postprocess_data"]
+
+            config_a_block["generate_neurons"]["postprocess_data"]["wavelet_denoising"]["remove_low_intensity_local_maxima"]["percentage_pixels_below_max"] = 0.1
+
+            nanshe.learner.generate_neurons(self.image_stack, **config_a_block["generate_neurons"])
+        finally:
+            for each_stage, each_callable in stages.items():
+                setattr(nanshe.imp.segment, each_stage, each_callable)
+
+        assert (len(os.listdir(config_a_block["generate_neurons"]["stage_cache"]["dirname"])) == 4)
+
+    def test_generate_neurons_5(self):
+        # With a memory budget, dictionary learning streams blocks of frames that fit in it.
+        config_a_block = json.loads(json.dumps(self.config_a_block))
+        config_a_block["generate_neurons"]["preprocess_data"]["memory_budget"] = 16 * self.image_stack.size
+
+        block_frame_lengths = []
+        generate_dictionary_streamed = nanshe.imp.segment.generate_dictionary_streamed
+
+        def generate_dictionary_streamed_spy(new_data, block_frame_length, **parameters):
+            block_frame_lengths.append(block_frame_length)
+
+            return(generate_dictionary_streamed(new_data, block_frame_length, **parameters))
+
+        generate_dictionary_streamed_spy.recorders = generate_dictionary_streamed.recorders
+
+        nanshe.imp.segment.generate_dictionary_streamed = generate_dictionary_streamed_spy
+        try:
+            with h5py.File(self.hdf5_output_filename, "a") as output_file_handle:
+                output_group = output_file_handle["/"]
+
+                # Saves intermediate result to make resuming easier
+                resume_logger = nanshe.io.hdf5.record.generate_HDF5_array_recorder(output_group,
+                    recorder_constructor = nanshe.io.hdf5.record.HDF5ArrayRecorder,
+                    overwrite = True
+                )
+
+                nanshe.learner.generate_neurons.resume_logger = resume_logger
+                nanshe.learner.generate_neurons.recorders.array_debug_recorder = nanshe.io.hdf5.record.EmptyArrayRecorder()
+                nanshe.learner.generate_neurons(self.image_stack, **config_a_block["generate_neurons"])
+
+                nanshe.learner.generate_neurons.resume_logger = nanshe.io.hdf5.record.EmptyArrayRecorder()
+        finally:
+            nanshe.imp.segment.generate_dictionary_streamed = generate_dictionary_streamed
+
+        # As many frames as fit in the budget (in double precision).
+        assert (block_frame_lengths == [2 * len(self.image_stack)])
+
+        with h5py.File(self.hdf5_output_filename, "r") as fid:
+            assert ("dictionary" in fid)
+            assert ("neurons" in fid)
+
+        # Learning from all frames at once is not possible without a positive number of iterations.
+        config_a_block["generate_neurons"]["generate_dictionary"]["spams.trainDL"]["iter"] = -1
+
+        got_value_error = False
+        try:
+            nanshe.learner.generate_neurons(self.image_stack, **config_a_block["generate_neurons"])
+        except ValueError:
+            got_value_error = True
+
+        assert got_value_error
+
+    def test_generate_neurons_6(self):
+        # The second run starts learning from the dictionary that the first run cached and uses fewer iterations.
+        config_a_block = json.loads(json.dumps(self.config_a_block))
+        config_a_block["generate_neurons"]["generate_dictionary"]["warm_start"] = {
+            "cache_dirname" : os.path.join(self.temp_dir, "dictionary_cache"),
+            "fov" : "images",
+            "iter" : 10
+        }
+
+        generate_dictionary_calls = []
+        prepare_initial_dictionary_calls = []
+        generate_dictionary = nanshe.imp.segment.generate_dictionary
+        prepare_initial_dictionary = nanshe.imp.segment.prepare_initial_dictionary
+
+        def generate_dictionary_spy(new_data, initial_dictionary = None, **parameters):
+            generate_dictionary_calls.append((initial_dictionary, parameters["spams.trainDL"]["iter"]))
+
+            return(generate_dictionary(new_data, initial_dictionary = initial_dictionary, **parameters))
+
+        generate_dictionary_spy.recorders = generate_dictionary.recorders
+
+        def prepare_initial_dictionary_spy(initial_dictionary, new_data, float_dtype):
+            prepare_initial_dictionary_calls.append(initial_dictionary)
+
+            return(prepare_initial_dictionary(initial_dictionary, new_data, float_dtype))
+
+        dictionaries = []
+        nanshe.imp.segment.generate_dictionary = generate_dictionary_spy
+        nanshe.imp.segment.prepare_initial_dictionary = prepare_initial_dictionary_spy
+        try:
+            for i in xrange(2):
+                with h5py.File(self.hdf5_output_filename, "w") as output_file_handle:
+                    output_group = output_file_handle["/"]
+
+                    # Saves intermediate result to make resuming easier
+                    resume_logger = nanshe.io.hdf5.record.generate_HDF5_array_recorder(output_group,
+                        recorder_constructor = nanshe.io.hdf5.record.HDF5ArrayRecorder,
+                        overwrite = True
+                    )
+
+                    nanshe.learner.generate_neurons.resume_logger = resume_logger
+                    nanshe.learner.generate_neurons.recorders.array_debug_recorder = nanshe.io.hdf5.record.EmptyArrayRecorder()
+                    nanshe.learner.generate_neurons(self.image_stack, **config_a_block["generate_neurons"])
+
+                    nanshe.learner.generate_neurons.resume_logger = nanshe.io.hdf5.record.EmptyArrayRecorder()
+
+                with h5py.File(self.hdf5_output_filename, "r") as fid:
+                    assert ("dictionary" in fid)
+                    assert ("neurons" in fid)
+
+                    dictionaries.append(fid["dictionary"].value)
+        finally:
+            nanshe.imp.segment.generate_dictionary = generate_dictionary
+            nanshe.imp.segment.prepare_initial_dictionary = prepare_initial_dictionary
+
+        assert (len(generate_dictionary_calls) == 2)
+
+        # The first run has nothing to start from.
+        assert (generate_dictionary_calls[0][0] is None)
+        assert (generate_dictionary_calls[0][1] ==
+                config_a_block["generate_neurons"]["generate_dictionary"]["spams.trainDL"]["iter"])
+
+        # The second run starts from the dictionary of the first run (same window).
+        assert (generate_dictionary_calls[1][0] is not None)
+        assert (generate_dictionary_calls[1][0] == dictionaries[0]).all()
+        assert (generate_dictionary_calls[1][1] ==
+                config_a_block["generate_neurons"]["generate_dictionary"]["warm_start"]["iter"])
+
+        assert (len(prepare_initial_dictionary_calls) == 1)
+        assert (prepare_initial_dictionary_calls[0] == dictionaries[0]).all()
+
+        assert (dictionaries[1].shape == dictionaries[0].shape)
+
+    def test_generate_neurons_7(self):
+        # Preprocessed images from the cache are the same. So, streamed dictionary learning still resumes.
+        config_a_block = json.loads(json.dumps(self.config_a_block))
+        config_a_block["generate_neurons"]["stage_cache"] = {
+            "dirname" : os.path.join(self.temp_dir, "stage_cache")
+        }
+        config_a_block["generate_neurons"]["generate_dictionary"]["block_frame_length"] = len(self.image_stack) // 2
+
+        with h5py.File(self.hdf5_output_filename, "w") as output_file_handle:
+            output_group = output_file_handle["/"]
+
+            # Saves intermediate result to make resuming easier
+            resume_logger = nanshe.io.hdf5.record.generate_HDF5_array_recorder(output_group,
+                recorder_constructor = nanshe.io.hdf5.record.HDF5ArrayRecorder,
+                overwrite = True
+            )
+
+            nanshe.learner.generate_neurons.resume_logger = resume_logger
+            nanshe.learner.generate_neurons.recorders.array_debug_recorder = nanshe.io.hdf5.record.EmptyArrayRecorder()
+            config_a_block["generate_neurons"]["run_stage"] = "preprocessing"
+            nanshe.learner.generate_neurons(self.image_stack, **config_a_block["generate_neurons"])
+
+            # As if learning was stopped part way through.
+            output_group.create_group("dictionary_learning")
+            output_group["dictionary_learning"]["D"] = numpy.ones((2, 2))
+
+            checkpoints_resumed = []
+            generate_dictionary_streamed = nanshe.imp.segment.generate_dictionary_streamed
+
+            class LearningStopped(Exception):
+                pass
+
+            def generate_dictionary_streamed_spy(new_data, block_frame_length, checkpoint, **parameters):
+                checkpoints_resumed.append("D" in checkpoint)
+
+                raise LearningStopped()
+
+            generate_dictionary_streamed_spy.recorders = generate_dictionary_streamed.recorders
+
+            nanshe.imp.segment.generate_dictionary_streamed = generate_dictionary_streamed_spy
+            try:
+                config_a_block["generate_neurons"]["run_stage"] = "all"
+                nanshe.learner.generate_neurons(self.image_stack, **config_a_block["generate_neurons"])
+            except LearningStopped:
+                pass
+            finally:
+                nanshe.imp.segment.generate_dictionary_streamed = generate_dictionary_streamed
+
+                nanshe.learner.generate_neurons.resume_logger = nanshe.io.hdf5.record.EmptyArrayRecorder()
+
+        assert (checkpoints_resumed == [True])
+
+    def test_generate_neurons_8(self):
+        # Preprocessing in tiles (with a memory budget) is not taken from preprocessing the whole movie in the cache.
+        config_a_block = json.loads(json.dumps(self.config_a_block))
+        config_a_block["generate_neurons"]["stage_cache"] = {
+            "dirname" : os.path.join(self.temp_dir, "stage_cache")
+        }
+
+        preprocess_data_blocked_calls = []
+        preprocess_data_blocked = nanshe.imp.segment.preprocess_data_blocked
+
+        def preprocess_data_blocked_spy(*args, **kwargs):
+            preprocess_data_blocked_calls.append(kwargs["memory_budget"])
+
+            return(preprocess_data_blocked(*args, **kwargs))
+
+        preprocess_data_blocked_spy.recorders = preprocess_data_blocked.recorders
+
+        nanshe.imp.segment.preprocess_data_blocked = preprocess_data_blocked_spy
+        try:
+            for i in xrange(2):
+                if i == 1:
+                    config_a_block["generate_neurons"]["preprocess_data"]["memory_budget"] = 16 * self.image_stack.size
+
+                with h5py.File(self.hdf5_output_filename, "w") as output_file_handle:
+                    output_group = output_file_handle["/"]
+
+                    # Saves intermediate result to make resuming easier
+                    resume_logger = nanshe.io.hdf5.record.generate_HDF5_array_recorder(output_group,
+                        recorder_constructor = nanshe.io.hdf5.record.HDF5ArrayRecorder,
+                        overwrite = True
+                    )
+
+                    nanshe.learner.generate_neurons.resume_logger = resume_logger
+                    nanshe.learner.generate_neurons.recorders.array_debug_recorder = nanshe.io.hdf5.record.EmptyArrayRecorder()
+                    config_a_block["generate_neurons"]["run_stage"] = "preprocessing"
+                    nanshe.learner.generate_neurons(self.image_stack, **config_a_block["generate_neurons"])
+
+                    nanshe.learner.generate_neurons.resume_logger = nanshe.io.hdf5.record.EmptyArrayRecorder()
+        finally:
+            nanshe.imp.segment.preprocess_data_blocked = preprocess_data_blocked
+
+        assert (preprocess_data_blocked_calls == [16 * self.image_stack.size])
+
+        assert (len(os.listdir(config_a_block["generate_neurons"]["stage_cache"]["dirname"])) == 2)
+
+    def test_generate_neurons_9(self):
+        # A dictionary learned from a different seed (warm start) is not taken from the cache.
+        config_a_block = json.loads(json.dumps(self.config_a_block))
+        config_a_block["generate_neurons"]["stage_cache"] = {
+            "dirname" : os.path.join(self.temp_dir, "stage_cache")
+        }
+        config_a_block["generate_neurons"]["generate_dictionary"]["warm_start"] = {
+            "cache_dirname" : os.path.join(self.temp_dir, "dictionary_cache"),
+            "fov" : "images"
+        }
+
+        generate_dictionary_calls = []
+        generate_dictionary = nanshe.imp.segment.generate_dictionary
+
+        def generate_dictionary_spy(new_data, initial_dictionary = None, **parameters):
+            generate_dictionary_calls.append(initial_dictionary)
+
+            return(generate_dictionary(new_data, initial_dictionary = initial_dictionary, **parameters))
+
+        generate_dictionary_spy.recorders = generate_dictionary.recorders
+
+        nanshe.imp.segment.generate_dictionary = generate_dictionary_spy
+        try:
+            for i in xrange(2):
+                with h5py.File(self.hdf5_output_filename, "w") as output_file_handle:
+                    output_group = output_file_handle["/"]
+
+                    # Saves intermediate result to make resuming easier
+                    resume_logger = nanshe.io.hdf5.record.generate_HDF5_array_recorder(output_group,
+                        recorder_constructor = nanshe.io.hdf5.record.HDF5ArrayRecorder,
+                        overwrite = True
+                    )
+
+                    nanshe.learner.generate_neurons.resume_logger = resume_logger
+                    nanshe.learner.generate_neurons.recorders.array_debug_recorder = nanshe.io.hdf5.record.EmptyArrayRecorder()
+                    config_a_block["generate_neurons"]["run_stage"] = "dictionary"
+                    nanshe.learner.generate_neurons(self.image_stack, **config_a_block["generate_neurons"])
+
+                    nanshe.learner.generate_neurons.resume_logger = nanshe.io.hdf5.record.EmptyArrayRecorder()
+        finally:
+            nanshe.imp.segment.generate_dictionary = generate_dictionary
+
+        # The second run starts from the dictionary of the first. So, it is learned again.
+        assert (len(generate_dictionary_calls) == 2)
+        assert (generate_dictionary_calls[0] is None)
+        assert (generate_dictionary_calls[1] is not None)
+
+        # Preprocessed images once and a dictionary for each seed.
+        assert (len(os.listdir(config_a_block["generate_neurons"]["stage_cache"]["dirname"])) == 3)
+
     def teardown(self):
         try:
             os.remove(self.config_a_block_filename)
@@ -154,6 +154,58 @@ class TestRegisterer(object):
 
         assert (b2 == b).all()
 
+    def test_main_3a(self):
+        a = numpy.zeros((20,10,11), dtype=int)
+
+        a[:, 3:-3, 3:-3] = 1
+
+        b = numpy.ma.masked_array(a.copy())
+
+        a[10] = 0
+        a[10, :-6, :-6] = 1
+
+        b[10, :, :3] = numpy.ma.masked
+        b[10, :3, :] = numpy.ma.masked
+
+        b = nanshe.util.xnumpy.truncate_masked_frames(b)
+
+
+        with open(self.config_filename, "a") as config_file:
+                json.dump({"num_processes" : 2, "memory_budget" : 2 * 32 * 10 * 11 * 6}, config_file)
+
+        with h5py.File(self.data_filename, "a") as data_file:
+            data_file["images"] = a
+            data_file["images_2"] = a
+            data_file["images_3"] = a
+
+        other_result_filename = os.path.join(self.temp_dirname, "out_2.h5")
+
+        # The first and last pairs share an output file.
+        nanshe.registerer.main(
+            nanshe.registerer.__file__,
+            self.config_filename,
+            self.data_filename + "/" + "images",
+            self.data_filename + "/" + "images_2",
+            self.data_filename + "/" + "images_3",
+            self.result_filename + "/" + "images",
+            other_result_filename + "/" + "images",
+            self.result_filename + "/" + "images_3"
+        )
+
+        b2 = None
+        b3 = None
+        with h5py.File(self.result_filename, "r") as result_file:
+            b2 = result_file["images"][...]
+            b3 = result_file["images_3"][...]
+
+        b4 = None
+        with h5py.File(other_result_filename, "r") as result_file:
+            b4 = result_file["images"][...]
+
+        assert (b2 == b).all()
+        assert (b3 == b).all()
+        assert (b4 == b).all()
+
     @nose.plugins.attrib.attr("3D")
     def test_main_0b(self):
         a = numpy.zeros((20,10,11,12), dtype=int)
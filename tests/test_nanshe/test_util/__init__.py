@@ -2,11 +2,12 @@ __author__ = "John Kirkham <kirkhamj@janelia.hhmi.org>"
 __date__ = "$Mar 27, 2015 19:28:12 EDT$"
 
 __all__ = [
-    "test_prof", "test_wrappers", "test_xglob", "testPathHelpers"
+    "test_prof", "test_wrappers", "test_xglob", "test_xmultiprocessing", "testPathHelpers"
 ]
 
 
 import test_prof
 import test_wrappers
 import test_xglob
+import test_xmultiprocessing
 import testPathHelpers
@@ -0,0 +1,151 @@
+import os
+import signal
+import time
+
+import nanshe.util.xmultiprocessing
+
+
+def square(a):
+    return(a * a)
+
+
+def sleep_then_return(a, delay):
+    time.sleep(delay)
+    return(a)
+
+
+def raise_value_error(a):
+    raise ValueError("Bad value \"" + repr(a) + "\".")
+
+
+def exit_abnormally(a):
+    os._exit(3)
+
+
+def get_pid():
+    return(os.getpid())
+
+
+class TestXMultiprocessing(object):
+    def test_Future_1(self):
+        f = nanshe.util.xmultiprocessing.Future(0)
+
+        assert (not f.done())
+        assert (not f.wait(0.01))
+
+        f.set_result(5, 0.5)
+
+        assert f.done()
+        assert (f.result() == 5)
+        assert (f.exception() is None)
+        assert (f.run_time == 0.5)
+
+
+    def test_Future_2(self):
+        f = nanshe.util.xmultiprocessing.Future(0)
+
+        called = []
+        f.add_done_callback(called.append)
+
+        assert (called == [])
+
+        f.set_exception(ValueError("test"))
+
+        assert (called == [f])
+        assert isinstance(f.exception(), ValueError)
+
+        try:
+            f.result()
+        except ValueError:
+            pass
+        else:
+            assert False, "Expected result to raise the stored exception."
+
+        f.add_done_callback(called.append)
+
+        assert (called == [f, f])
+
+
+    def test_thread_map_1(self):
+        results = nanshe.util.xmultiprocessing.thread_map(square, range(10), 3)
+
+        assert (results == [_ * _ for _ in range(10)])
+
+
+    def test_WorkerPool_1(self):
+        with nanshe.util.xmultiprocessing.WorkerPool(2) as pool:
+            futures = pool.map(square, range(10))
+
+            results = [_.result() for _ in futures]
+
+        assert (results == [_ * _ for _ in range(10)])
+        assert all([(_.run_time is not None) for _ in futures])
+
+
+    def test_WorkerPool_2(self):
+        with nanshe.util.xmultiprocessing.WorkerPool(2) as pool:
+            future_1 = pool.submit(sleep_then_return, 1, 0.5)
+            future_2 = pool.submit(sleep_then_return, 2, 0.0)
+
+            results = [_.result() for _ in nanshe.util.xmultiprocessing.as_completed([future_1, future_2])]
+
+        assert (results == [2, 1])
+
+
+    def test_WorkerPool_3(self):
+        with nanshe.util.xmultiprocessing.WorkerPool(1) as pool:
+            future_1 = pool.submit(raise_value_error, 1)
+            future_2 = pool.submit(square, 2)
+
+            assert isinstance(future_1.exception(), nanshe.util.xmultiprocessing.WorkerException)
+            assert ("ValueError" in str(future_1.exception()))
+
+            # Worker should survive a failed task.
+            assert (future_2.result() == 4)
+
+
+    def test_WorkerPool_4(self):
+        with nanshe.util.xmultiprocessing.WorkerPool(1, poll_interval = 0.1) as pool:
+            future_1 = pool.submit(exit_abnormally, 1)
+            future_2 = pool.submit(square, 3)
+
+            assert isinstance(future_1.exception(), nanshe.util.xmultiprocessing.WorkerDiedException)
+
+            # Worker should be replaced.
+            assert (future_2.result() == 9)
+
+
+    def test_WorkerPool_5(self):
+        with nanshe.util.xmultiprocessing.WorkerPool(1) as pool:
+            pids = [_.result() for _ in [pool.submit(get_pid) for i in range(5)]]
+
+        # Workers should be reused.
+        assert (len(set(pids)) == 1)
+        assert (pids[0] != os.getpid())
+
+
+    def test_WorkerPool_6(self):
+        with nanshe.util.xmultiprocessing.WorkerPool(1, poll_interval = 0.1) as pool:
+            worker_pid = pool.submit(get_pid).result()
+
+            future_1 = pool.submit(sleep_then_return, 1, 10.0)
+            future_2 = pool.submit(square, 2)
+
+            time.sleep(0.5)
+            os.kill(worker_pid, signal.SIGKILL)
+
+            # The task the worker was given is failed and the rest still run.
+            assert isinstance(future_1.exception(), nanshe.util.xmultiprocessing.WorkerDiedException)
+            assert (future_2.result() == 4)
+
+
+    def test_WorkerPool_7(self):
+        with nanshe.util.xmultiprocessing.WorkerPool(2, poll_interval = 0.1) as pool:
+            futures = [pool.submit(exit_abnormally, i) for i in range(3)] + [pool.submit(square, i) for i in range(3)]
+
+            # Every task finishes (even those whose worker died).
+            completed_futures = list(nanshe.util.xmultiprocessing.as_completed(futures))
+
+        assert (len(completed_futures) == len(futures))
+        assert all([isinstance(_.exception(), nanshe.util.xmultiprocessing.WorkerDiedException) for _ in futures[:3]])
+        assert ([_.result() for _ in futures[3:]] == [0, 1, 4])